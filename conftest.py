@@ -0,0 +1,160 @@
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""pytest hooks for test.py.
+
+At the end of the test session, this reports how much time was spent setting
+up and tearing down the tests' fixtures (for example, creating and mounting
+filesystems and cleaning up keys) separately from the time spent in the tests
+themselves, per filesystem type if TEST_FILESYSTEMS is set.
+
+It also profiles each test: how long its setup, call and teardown phases took,
+and how many times each fscryptctl command was invoked (as recorded by
+test.py in FSCRYPTCTL_INVOCATIONS) with its wall time, CPU time and estimated
+valgrind overhead.  The slowest tests and the tests with the most invocations
+are reported, and if the environment variable TEST_PROFILE is set, the whole
+profile is written to that file as JSON so that it can be compared across runs.
+
+This works with pytest-xdist too, since the reports from the workers, including
+their user properties, are sent to the main process."""
+
+import collections
+import json
+import os
+import time
+
+import pytest
+
+# The number of tests to list in each part of the profile report
+PROFILE_REPORT_SIZE = 10
+
+# (filesystem type, phase) => [number of tests, total seconds]
+_durations = collections.defaultdict(lambda: [0, 0.0])
+
+# test node ID => profile of the test, in the format written to TEST_PROFILE
+_profiles = {}
+
+
+def pytest_collection_modifyitems(items):
+    # Record the filesystem type in the reports of each test.
+    for item in items:
+        callspec = getattr(item, "callspec", None)
+        fstype = callspec.params.get("filesystem") if callspec else None
+        item.user_properties.append(("filesystem", fstype or "TEST_DIR"))
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    # Attach the fscryptctl invocations made during this phase of the test to
+    # its report, as {command: [count, wall time, CPU time, valgrind time]}.
+    outcome = yield
+    invocations = getattr(item.module, "FSCRYPTCTL_INVOCATIONS", None)
+    if invocations is None:
+        return
+    commands = {}
+    for command, *times in invocations:
+        entry = commands.setdefault(command, [0, 0.0, 0.0, 0.0])
+        entry[0] += 1
+        for i, t in enumerate(times, 1):
+            entry[i] += t
+    del invocations[:]
+    outcome.get_result().user_properties.append(("fscryptctl", commands))
+
+
+def _new_profile(fstype):
+    return {"filesystem": fstype, "setup": 0.0, "call": 0.0, "teardown": 0.0,
+            "invocations": 0, "wall": 0.0, "cpu": 0.0, "valgrind": 0.0,
+            "commands": {}}
+
+
+def pytest_runtest_logreport(report):
+    properties = dict(report.user_properties)
+    fstype = properties.get("filesystem", "TEST_DIR")
+    entry = _durations[(fstype, report.when)]
+    entry[0] += 1
+    entry[1] += report.duration
+
+    profile = _profiles.setdefault(report.nodeid, _new_profile(fstype))
+    profile[report.when] += report.duration
+    for command, counts in properties.get("fscryptctl", {}).items():
+        totals = profile["commands"].setdefault(command, [0, 0.0, 0.0, 0.0])
+        for i, value in enumerate(counts):
+            totals[i] += value
+        profile["invocations"] += counts[0]
+        profile["wall"] += counts[1]
+        profile["cpu"] += counts[2]
+        profile["valgrind"] += counts[3]
+
+
+def _total_time(profile):
+    return profile["setup"] + profile["call"] + profile["teardown"]
+
+
+def _write_profile_report(terminalreporter):
+    def write_test(nodeid, profile):
+        terminalreporter.write_line(
+            "{:7.2f}s (setup {:.2f}s, teardown {:.2f}s), {} invocations "
+            "({:.2f}s, cpu {:.2f}s, valgrind {:.2f}s) {}".format(
+                _total_time(profile), profile["setup"], profile["teardown"],
+                profile["invocations"], profile["wall"], profile["cpu"],
+                profile["valgrind"], nodeid))
+
+    tests = sorted(_profiles.items())
+    terminalreporter.write_sep("-", "slowest tests")
+    for nodeid, profile in sorted(tests, key=lambda t: _total_time(t[1]),
+                                  reverse=True)[:PROFILE_REPORT_SIZE]:
+        write_test(nodeid, profile)
+    terminalreporter.write_sep("-", "most fscryptctl invocations")
+    for nodeid, profile in sorted(tests, key=lambda t: t[1]["invocations"],
+                                  reverse=True)[:PROFILE_REPORT_SIZE]:
+        if profile["invocations"]:
+            write_test(nodeid, profile)
+
+
+def _write_profile_json(path):
+    commands = {}
+    for profile in _profiles.values():
+        for command, counts in profile["commands"].items():
+            totals = commands.setdefault(command, [0, 0.0, 0.0, 0.0])
+            for i, value in enumerate(counts):
+                totals[i] += value
+    settings = {name: os.environ.get(name, "") for name in
+                ["ENABLE_VALGRIND", "ENABLE_BATCH", "TEST_BACKEND",
+                 "TEST_FILESYSTEMS"]}
+    with open(path, "w") as f:
+        json.dump({"time": time.time(), "settings": settings,
+                   "commands": commands, "tests": _profiles}, f, indent=2,
+                  sort_keys=True)
+        f.write("\n")
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _durations:
+        return
+    terminalreporter.write_sep("-", "time spent in setup vs. tests")
+    for fstype in sorted({fstype for fstype, _ in _durations}):
+        phases = {when: _durations[(fstype, when)]
+                  for when in ["setup", "call", "teardown"]}
+        terminalreporter.write_line(
+            "{}: setup {:.2f}s, tests {:.2f}s, teardown {:.2f}s "
+            "({} tests)".format(fstype, phases["setup"][1],
+                                phases["call"][1], phases["teardown"][1],
+                                phases["setup"][0]))
+    _write_profile_report(terminalreporter)
+    path = os.environ.get("TEST_PROFILE")
+    if path:
+        _write_profile_json(path)
+        terminalreporter.write_line("wrote profile to {}".format(path))
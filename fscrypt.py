@@ -0,0 +1,573 @@
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""In-process Python interface to the fscrypt ioctls.
+
+This module issues the same ioctls as the fscryptctl binary, but directly from
+Python via fcntl.ioctl() rather than by executing a new process for each
+operation.  The structure layouts mirror fscrypt_uapi.h.
+
+Paths may be given either as a path or as an already-open file descriptor, so
+that callers which do many operations on the same filesystem can keep a single
+file descriptor open.  Errors are reported by raising OSError, with the errno
+value that the kernel returned."""
+
+import argparse
+import collections
+import contextlib
+import ctypes
+import errno
+import fcntl
+import hashlib
+import hmac
+import os
+
+# Encryption policy flags
+FSCRYPT_POLICY_FLAGS_PAD_4 = 0x00
+FSCRYPT_POLICY_FLAGS_PAD_8 = 0x01
+FSCRYPT_POLICY_FLAGS_PAD_16 = 0x02
+FSCRYPT_POLICY_FLAGS_PAD_32 = 0x03
+FSCRYPT_POLICY_FLAGS_PAD_MASK = 0x03
+FSCRYPT_POLICY_FLAG_DIRECT_KEY = 0x04
+FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64 = 0x08
+FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32 = 0x10
+
+# Encryption algorithms
+FSCRYPT_MODE_AES_256_XTS = 1
+FSCRYPT_MODE_AES_256_CTS = 4
+FSCRYPT_MODE_AES_128_CBC = 5
+FSCRYPT_MODE_AES_128_CTS = 6
+FSCRYPT_MODE_SM4_XTS = 7
+FSCRYPT_MODE_SM4_CTS = 8
+FSCRYPT_MODE_ADIANTUM = 9
+FSCRYPT_MODE_AES_256_HCTR2 = 10
+
+FSCRYPT_POLICY_V1 = 0
+FSCRYPT_POLICY_V2 = 2
+FSCRYPT_KEY_DESCRIPTOR_SIZE = 8
+FSCRYPT_KEY_IDENTIFIER_SIZE = 16
+FSCRYPT_MAX_KEY_SIZE = 64
+
+FSCRYPT_KEY_SPEC_TYPE_DESCRIPTOR = 1
+FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER = 2
+
+FSCRYPT_ADD_KEY_FLAG_HW_WRAPPED = 0x00000001
+
+FSCRYPT_KEY_REMOVAL_STATUS_FLAG_FILES_BUSY = 0x00000001
+FSCRYPT_KEY_REMOVAL_STATUS_FLAG_OTHER_USERS = 0x00000002
+
+FSCRYPT_KEY_STATUS_ABSENT = 1
+FSCRYPT_KEY_STATUS_PRESENT = 2
+FSCRYPT_KEY_STATUS_INCOMPLETELY_REMOVED = 3
+FSCRYPT_KEY_STATUS_FLAG_ADDED_BY_SELF = 0x00000001
+
+# The HKDF application-specific info prefix and context byte that the kernel
+# uses to derive key identifiers (see fs/crypto/fscrypt_private.h)
+HKDF_INFO_PREFIX = b"fscrypt\0"
+HKDF_CONTEXT_KEY_IDENTIFIER = 1
+
+# Human-readable names of the encryption modes, matching fscryptctl.c
+MODE_NAMES = {
+    FSCRYPT_MODE_AES_256_XTS: "AES-256-XTS",
+    FSCRYPT_MODE_AES_256_CTS: "AES-256-CTS",
+    FSCRYPT_MODE_AES_128_CBC: "AES-128-CBC",
+    FSCRYPT_MODE_AES_128_CTS: "AES-128-CTS",
+    FSCRYPT_MODE_SM4_XTS: "SM4-XTS",
+    FSCRYPT_MODE_SM4_CTS: "SM4-CTS",
+    FSCRYPT_MODE_ADIANTUM: "Adiantum",
+    FSCRYPT_MODE_AES_256_HCTR2: "AES-256-HCTR2",
+}
+
+# Valid amounts of filename padding, indexed by the padding flag
+PADDING_VALUES = [4, 8, 16, 32]
+
+
+class fscrypt_policy_v1(ctypes.Structure):
+    _fields_ = [
+        ("version", ctypes.c_uint8),
+        ("contents_encryption_mode", ctypes.c_uint8),
+        ("filenames_encryption_mode", ctypes.c_uint8),
+        ("flags", ctypes.c_uint8),
+        ("master_key_descriptor", ctypes.c_uint8 * FSCRYPT_KEY_DESCRIPTOR_SIZE),
+    ]
+
+
+class fscrypt_policy_v2(ctypes.Structure):
+    _fields_ = [
+        ("version", ctypes.c_uint8),
+        ("contents_encryption_mode", ctypes.c_uint8),
+        ("filenames_encryption_mode", ctypes.c_uint8),
+        ("flags", ctypes.c_uint8),
+        ("log2_data_unit_size", ctypes.c_uint8),
+        ("__reserved", ctypes.c_uint8 * 3),
+        ("master_key_identifier", ctypes.c_uint8 * FSCRYPT_KEY_IDENTIFIER_SIZE),
+    ]
+
+
+class _fscrypt_policy(ctypes.Union):
+    _fields_ = [
+        ("version", ctypes.c_uint8),
+        ("v1", fscrypt_policy_v1),
+        ("v2", fscrypt_policy_v2),
+    ]
+
+
+class fscrypt_get_policy_ex_arg(ctypes.Structure):
+    _fields_ = [
+        ("policy_size", ctypes.c_uint64),
+        ("policy", _fscrypt_policy),
+    ]
+
+
+class _fscrypt_key_specifier_u(ctypes.Union):
+    _fields_ = [
+        ("__reserved", ctypes.c_uint8 * 32),
+        ("descriptor", ctypes.c_uint8 * FSCRYPT_KEY_DESCRIPTOR_SIZE),
+        ("identifier", ctypes.c_uint8 * FSCRYPT_KEY_IDENTIFIER_SIZE),
+    ]
+
+
+class fscrypt_key_specifier(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_uint32),
+        ("__reserved", ctypes.c_uint32),
+        ("u", _fscrypt_key_specifier_u),
+    ]
+
+
+class fscrypt_add_key_arg(ctypes.Structure):
+    _fields_ = [
+        ("key_spec", fscrypt_key_specifier),
+        ("raw_size", ctypes.c_uint32),
+        ("key_id", ctypes.c_uint32),
+        ("flags", ctypes.c_uint32),
+        ("__reserved", ctypes.c_uint32 * 7),
+        # followed by __u8 raw[]
+    ]
+
+
+# The payload of an "fscrypt-provisioning" key in the kernel keyring, which can
+# be referenced by fscrypt_add_key_arg.key_id instead of passing the raw key
+class fscrypt_provisioning_key_payload(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_uint32),
+        ("flags", ctypes.c_uint32),
+        # followed by __u8 raw[]
+    ]
+
+
+class fscrypt_remove_key_arg(ctypes.Structure):
+    _fields_ = [
+        ("key_spec", fscrypt_key_specifier),
+        ("removal_status_flags", ctypes.c_uint32),
+        ("__reserved", ctypes.c_uint32 * 5),
+    ]
+
+
+class fscrypt_get_key_status_arg(ctypes.Structure):
+    _fields_ = [
+        ("key_spec", fscrypt_key_specifier),
+        ("__reserved", ctypes.c_uint32 * 6),
+        ("status", ctypes.c_uint32),
+        ("status_flags", ctypes.c_uint32),
+        ("user_count", ctypes.c_uint32),
+        ("__out_reserved", ctypes.c_uint32 * 13),
+    ]
+
+
+# From <linux/blk-crypto.h>
+class blk_crypto_generate_key_arg(ctypes.Structure):
+    _fields_ = [
+        ("lt_key_ptr", ctypes.c_uint64),
+        ("lt_key_size", ctypes.c_uint64),
+        ("reserved", ctypes.c_uint64 * 4),
+    ]
+
+
+# The generic Linux ioctl number encoding from <asm-generic/ioctl.h>.  This is
+# used by most architectures, but not by alpha, mips, powerpc, or sparc.
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+
+def _IOC(direction, type_, nr, size):
+    return (direction << 30) | (size << 16) | (ord(type_) << 8) | nr
+
+
+def _IOR(type_, nr, size):
+    return _IOC(_IOC_READ, type_, nr, size)
+
+
+def _IOWR(type_, nr, size):
+    return _IOC(_IOC_READ | _IOC_WRITE, type_, nr, size)
+
+
+FS_IOC_SET_ENCRYPTION_POLICY = _IOR("f", 19, ctypes.sizeof(fscrypt_policy_v1))
+FS_IOC_GET_ENCRYPTION_POLICY_EX = _IOWR("f", 22, 9)  # size + version
+FS_IOC_ADD_ENCRYPTION_KEY = _IOWR("f", 23, ctypes.sizeof(fscrypt_add_key_arg))
+FS_IOC_REMOVE_ENCRYPTION_KEY = _IOWR("f", 24,
+                                     ctypes.sizeof(fscrypt_remove_key_arg))
+FS_IOC_REMOVE_ENCRYPTION_KEY_ALL_USERS = _IOWR(
+    "f", 25, ctypes.sizeof(fscrypt_remove_key_arg))
+FS_IOC_GET_ENCRYPTION_KEY_STATUS = _IOWR(
+    "f", 26, ctypes.sizeof(fscrypt_get_key_status_arg))
+BLKCRYPTOGENERATEKEY = _IOWR("\x12", 138,
+                             ctypes.sizeof(blk_crypto_generate_key_arg))
+
+# The largest hardware-wrapped key that fscryptctl accepts
+MAX_WRAPPED_KEY_SIZE = 128
+
+# Kernel keyring definitions from <linux/keyctl.h>
+FSCRYPT_PROVISIONING_KEY_TYPE = b"fscrypt-provisioning"
+KEY_SPEC_SESSION_KEYRING = -3
+KEY_SPEC_USER_KEYRING = -4
+KEYCTL_INVALIDATE = 21
+
+# The (add_key, keyctl) system call numbers.  Python has no wrappers for these
+# system calls, and libkeyutils isn't necessarily installed.
+_KEYRING_SYSCALLS = {
+    "x86_64": (248, 250),
+    "aarch64": (217, 219),
+    "riscv64": (217, 219),
+    "i386": (286, 288),
+    "i686": (286, 288),
+    "armv7l": (309, 311),
+    "ppc64le": (269, 271),
+    "s390x": (278, 280),
+}
+
+
+# The decoded result of FS_IOC_GET_ENCRYPTION_POLICY_EX.  |version| is 1 or 2
+# (not FSCRYPT_POLICY_V1, which is really 0).  |key| is the hex master key
+# descriptor for v1 policies and the hex master key identifier for v2 policies.
+# |log2_data_unit_size| is always 0 for v1 policies.
+Policy = collections.namedtuple("Policy", [
+    "version", "key", "contents_mode", "filenames_mode", "flags",
+    "log2_data_unit_size"])
+
+# The decoded result of FS_IOC_GET_ENCRYPTION_KEY_STATUS.
+KeyStatus = collections.namedtuple("KeyStatus", [
+    "status", "status_flags", "user_count"])
+
+
+def mode_name(mode):
+    """Returns the human-readable name of an encryption mode number."""
+    return MODE_NAMES.get(mode, "Unknown ({})".format(mode))
+
+
+def flags_to_string(flags):
+    """Formats encryption policy flags the same way as fscryptctl get_policy,
+    for example "PAD_32, DIRECT_KEY"."""
+    names = ["PAD_{}".format(PADDING_VALUES[flags & FSCRYPT_POLICY_FLAGS_PAD_MASK])]
+    flags &= ~FSCRYPT_POLICY_FLAGS_PAD_MASK
+    for flag, name in [(FSCRYPT_POLICY_FLAG_DIRECT_KEY, "DIRECT_KEY"),
+                       (FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64, "IV_INO_LBLK_64"),
+                       (FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32, "IV_INO_LBLK_32")]:
+        if flags & flag:
+            names.append(name)
+            flags &= ~flag
+    if flags:
+        names.append("Unknown ({:02x})".format(flags))
+    return ", ".join(names)
+
+
+def hkdf_sha512(ikm, info, length, salt=b""):
+    """Computes HKDF-SHA512 (RFC 5869) using only the standard library."""
+    prk = hmac.new(salt, ikm, hashlib.sha512).digest()
+    okm = b""
+    block = b""
+    counter = 1
+    while len(okm) < length:
+        block = hmac.new(prk, block + info + bytes([counter]),
+                         hashlib.sha512).digest()
+        okm += block
+        counter += 1
+    return okm[:length]
+
+
+def compute_key_identifier(raw):
+    """Computes the hex key identifier that the kernel assigns to the raw key
+    |raw| when it is added for use with v2 encryption policies."""
+    info = HKDF_INFO_PREFIX + bytes([HKDF_CONTEXT_KEY_IDENTIFIER])
+    return hkdf_sha512(raw, info, FSCRYPT_KEY_IDENTIFIER_SIZE).hex()
+
+
+def compute_key_descriptor(raw):
+    """Computes the hex key descriptor that the fscrypt tool conventionally
+    uses for the raw key |raw| with v1 encryption policies."""
+    digest = hashlib.sha512(hashlib.sha512(raw).digest()).digest()
+    return digest[:FSCRYPT_KEY_DESCRIPTOR_SIZE].hex()
+
+
+def padding(policy):
+    """Returns the amount of filenames padding, in bytes, used by |policy|."""
+    return PADDING_VALUES[policy.flags & FSCRYPT_POLICY_FLAGS_PAD_MASK]
+
+
+def data_unit_size(policy):
+    """Returns the data unit size in bytes used by |policy|, or 0 if the
+    policy uses the default data unit size."""
+    if policy.log2_data_unit_size:
+        return 1 << policy.log2_data_unit_size
+    return 0
+
+
+@contextlib.contextmanager
+def _opened(path):
+    """Yields a file descriptor for |path|, which may be either a path or an
+    already-open file descriptor.  Only file descriptors opened here are
+    closed afterwards."""
+    if isinstance(path, int):
+        yield path
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def _identifier_key_spec(identifier):
+    """Builds an identifier-type fscrypt_key_specifier from a hex string."""
+    raw = bytes.fromhex(identifier)
+    if len(raw) != FSCRYPT_KEY_IDENTIFIER_SIZE:
+        raise ValueError("invalid key identifier: " + identifier)
+    spec = fscrypt_key_specifier()
+    spec.type = FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER
+    ctypes.memmove(spec.u.identifier, raw, len(raw))
+    return spec
+
+
+def _keyring_syscall(index, *args):
+    machine = os.uname().machine
+    if machine not in _KEYRING_SYSCALLS:
+        raise OSError(errno.ENOSYS,
+                      "keyring system calls unknown on " + machine)
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.syscall.restype = ctypes.c_long
+    ret = libc.syscall(ctypes.c_long(_KEYRING_SYSCALLS[machine][index]), *args)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+def add_provisioning_key(raw, description, hw_wrapped=False,
+                         keyring=KEY_SPEC_SESSION_KEYRING):
+    """Adds the raw key |raw| (bytes) to the kernel keyring |keyring| as an
+    "fscrypt-provisioning" key with the given description (str), for use with
+    add_key(key_id=...).  Returns the key's serial number."""
+    size = ctypes.sizeof(fscrypt_provisioning_key_payload) + len(raw)
+    buf = ctypes.create_string_buffer(size)
+    payload = fscrypt_provisioning_key_payload.from_buffer(buf)
+    payload.type = FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER
+    if hw_wrapped:
+        payload.flags = FSCRYPT_ADD_KEY_FLAG_HW_WRAPPED
+    ctypes.memmove(ctypes.addressof(buf) +
+                   ctypes.sizeof(fscrypt_provisioning_key_payload),
+                   raw, len(raw))
+    try:
+        key_type = ctypes.c_char_p(FSCRYPT_PROVISIONING_KEY_TYPE)
+        return _keyring_syscall(0, key_type,
+                                ctypes.c_char_p(description.encode()), buf,
+                                ctypes.c_size_t(size), ctypes.c_int32(keyring))
+    finally:
+        ctypes.memset(buf, 0, size)
+
+
+def invalidate_key(key_id):
+    """Invalidates the kernel keyring key with the given serial number."""
+    _keyring_syscall(1, ctypes.c_int(KEYCTL_INVALIDATE),
+                     ctypes.c_int32(key_id))
+
+
+def add_key(mountpoint, raw, hw_wrapped=False, key_id=None):
+    """Adds the raw key |raw| (bytes) to the filesystem containing
+    |mountpoint| and returns the key identifier as a hex string.  If
+    |hw_wrapped| is true, |raw| must be an ephemerally-wrapped key.  If
+    |key_id| is given, |raw| must be empty and the key is instead taken from
+    the "fscrypt-provisioning" keyring key with that serial number."""
+    max_size = MAX_WRAPPED_KEY_SIZE if hw_wrapped else FSCRYPT_MAX_KEY_SIZE
+    if key_id is not None:
+        if raw:
+            raise ValueError("can't give both a raw key and a key ID")
+    elif not 16 <= len(raw) <= max_size:
+        raise ValueError("invalid key size: {}".format(len(raw)))
+    size = ctypes.sizeof(fscrypt_add_key_arg) + len(raw)
+    buf = ctypes.create_string_buffer(size)
+    arg = fscrypt_add_key_arg.from_buffer(buf)
+    arg.key_spec.type = FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER
+    arg.raw_size = len(raw)
+    if key_id is not None:
+        arg.key_id = key_id
+    if hw_wrapped:
+        arg.flags = FSCRYPT_ADD_KEY_FLAG_HW_WRAPPED
+    ctypes.memmove(ctypes.addressof(buf) + ctypes.sizeof(fscrypt_add_key_arg),
+                   raw, len(raw))
+    try:
+        with _opened(mountpoint) as fd:
+            fcntl.ioctl(fd, FS_IOC_ADD_ENCRYPTION_KEY, buf)
+        return bytes(arg.key_spec.u.identifier).hex()
+    finally:
+        ctypes.memset(buf, 0, size)
+
+
+def remove_key(identifier, mountpoint, all_users=False):
+    """Removes the key with the hex identifier |identifier| from the filesystem
+    containing |mountpoint|.  Returns the FSCRYPT_KEY_REMOVAL_STATUS_FLAG_*
+    flags reported by the kernel; a nonzero value means the key was only
+    partially removed."""
+    arg = fscrypt_remove_key_arg()
+    arg.key_spec = _identifier_key_spec(identifier)
+    ioc = FS_IOC_REMOVE_ENCRYPTION_KEY
+    if all_users:
+        ioc = FS_IOC_REMOVE_ENCRYPTION_KEY_ALL_USERS
+    with _opened(mountpoint) as fd:
+        fcntl.ioctl(fd, ioc, arg)
+    return arg.removal_status_flags
+
+
+def get_key_status(identifier, mountpoint):
+    """Returns the KeyStatus of the key with the hex identifier |identifier| on
+    the filesystem containing |mountpoint|."""
+    arg = fscrypt_get_key_status_arg()
+    arg.key_spec = _identifier_key_spec(identifier)
+    with _opened(mountpoint) as fd:
+        fcntl.ioctl(fd, FS_IOC_GET_ENCRYPTION_KEY_STATUS, arg)
+    return KeyStatus(arg.status, arg.status_flags, arg.user_count)
+
+
+def generate_hw_wrapped_key(blkdev):
+    """Generates a new hardware-wrapped key using the inline encryption
+    hardware of the block device |blkdev|, like fscryptctl
+    generate_hw_wrapped_key, and returns it in long-term wrapped form."""
+    lt_key = ctypes.create_string_buffer(MAX_WRAPPED_KEY_SIZE)
+    arg = blk_crypto_generate_key_arg()
+    arg.lt_key_ptr = ctypes.addressof(lt_key)
+    arg.lt_key_size = MAX_WRAPPED_KEY_SIZE
+    with _opened(blkdev) as fd:
+        fcntl.ioctl(fd, BLKCRYPTOGENERATEKEY, arg)
+    return lt_key.raw[:arg.lt_key_size]
+
+
+def get_policy(path):
+    """Returns the Policy of the given file or directory.  Raises OSError with
+    errno ENODATA if it is not encrypted, or ValueError if its policy version
+    isn't recognized."""
+    arg = fscrypt_get_policy_ex_arg()
+    arg.policy_size = ctypes.sizeof(arg.policy)
+    with _opened(path) as fd:
+        fcntl.ioctl(fd, FS_IOC_GET_ENCRYPTION_POLICY_EX, arg)
+    if arg.policy.version == FSCRYPT_POLICY_V1:
+        p = arg.policy.v1
+        return Policy(1, bytes(p.master_key_descriptor).hex(),
+                      p.contents_encryption_mode, p.filenames_encryption_mode,
+                      p.flags, 0)
+    if arg.policy.version == FSCRYPT_POLICY_V2:
+        p = arg.policy.v2
+        return Policy(2, bytes(p.master_key_identifier).hex(),
+                      p.contents_encryption_mode, p.filenames_encryption_mode,
+                      p.flags, p.log2_data_unit_size)
+    raise ValueError("unrecognized encryption policy version {}".format(
+        arg.policy.version))
+
+
+def make_policy(identifier, contents_mode=FSCRYPT_MODE_AES_256_XTS,
+                filenames_mode=FSCRYPT_MODE_AES_256_CTS,
+                flags=FSCRYPT_POLICY_FLAGS_PAD_32, log2_data_unit_size=0):
+    """Builds a v2 Policy with the same defaults as fscryptctl set_policy."""
+    return Policy(2, identifier, contents_mode, filenames_mode, flags,
+                  log2_data_unit_size)
+
+
+def _argument_type(parse, what):
+    def parse_argument(value):
+        try:
+            return parse(value)
+        except (KeyError, ValueError):
+            raise argparse.ArgumentTypeError(
+                "invalid {}: {}".format(what, value)) from None
+    return parse_argument
+
+
+def _parse_mode(value):
+    return {name: mode for mode, name in MODE_NAMES.items()}[value]
+
+
+def _parse_data_unit_size(value):
+    size = int(value)
+    if size <= 1 or size & (size - 1):
+        raise ValueError
+    return size.bit_length() - 1
+
+
+def add_policy_arguments(parser):
+    """Adds the encryption policy options of fscryptctl set_policy to the
+    argparse |parser|.  Use policy_from_arguments() to build the Policy."""
+    parser.add_argument("--contents", default=FSCRYPT_MODE_AES_256_XTS,
+                        type=_argument_type(_parse_mode, "contents mode"),
+                        help="contents encryption mode")
+    parser.add_argument("--filenames", default=FSCRYPT_MODE_AES_256_CTS,
+                        type=_argument_type(_parse_mode, "filenames mode"),
+                        help="filenames encryption mode")
+    parser.add_argument("--padding", default=32,
+                        type=_argument_type(int, "padding"),
+                        choices=PADDING_VALUES,
+                        help="bytes of zero-padding for filenames")
+    parser.add_argument("--direct-key", action="store_true",
+                        help="use the DIRECT_KEY flag")
+    parser.add_argument("--iv-ino-lblk-64", action="store_true",
+                        help="use the IV_INO_LBLK_64 flag")
+    parser.add_argument("--iv-ino-lblk-32", action="store_true",
+                        help="use the IV_INO_LBLK_32 flag")
+    parser.add_argument("--data-unit-size", dest="log2_data_unit_size",
+                        default=0, metavar="DATA_UNIT_SIZE",
+                        type=_argument_type(_parse_data_unit_size,
+                                            "data unit size"),
+                        help="data unit size in bytes")
+
+
+def policy_from_arguments(identifier, args):
+    """Builds the v2 Policy selected by the options that were added by
+    add_policy_arguments()."""
+    flags = PADDING_VALUES.index(args.padding)
+    for enabled, flag in [
+            (args.direct_key, FSCRYPT_POLICY_FLAG_DIRECT_KEY),
+            (args.iv_ino_lblk_64, FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64),
+            (args.iv_ino_lblk_32, FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32)]:
+        if enabled:
+            flags |= flag
+    return make_policy(identifier, args.contents, args.filenames, flags,
+                       args.log2_data_unit_size)
+
+
+def set_policy(path, policy):
+    """Sets the v2 Policy |policy| on the given empty directory.  This succeeds
+    if the directory already has exactly the same policy."""
+    if policy.version != 2:
+        raise ValueError("only v2 encryption policies can be set")
+    arg = fscrypt_policy_v2()
+    arg.version = FSCRYPT_POLICY_V2
+    arg.contents_encryption_mode = policy.contents_mode
+    arg.filenames_encryption_mode = policy.filenames_mode
+    arg.flags = policy.flags
+    arg.log2_data_unit_size = policy.log2_data_unit_size
+    raw = bytes.fromhex(policy.key)
+    if len(raw) != FSCRYPT_KEY_IDENTIFIER_SIZE:
+        raise ValueError("invalid key identifier: " + policy.key)
+    ctypes.memmove(arg.master_key_identifier, raw, len(raw))
+    with _opened(path) as fd:
+        fcntl.ioctl(fd, FS_IOC_SET_ENCRYPTION_POLICY, arg)
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Compares the throughput of the encryption settings on this system.
+
+For each candidate encryption policy, a temporary directory is created in the
+given directory and encrypted with that policy, using a randomly generated key
+which is removed afterwards.  Then a set of file I/O workloads is run in it,
+and the policies are ranked by throughput for each workload.  Policies that the
+kernel rejects, for example because the filesystem or the kernel's crypto API
+doesn't support them, are skipped.  The policies that are unsupported are
+looked up in the capability cache of fscrypt_caps.py (probing them the first
+time), so they don't need to be tried; --no-caps-cache disables this.  An
+unencrypted directory is measured too, as a baseline.
+
+Before each read workload, the page cache is dropped so that the data really
+has to be read from disk and decrypted.  This requires root; otherwise a
+warning is printed and the reads are served from the page cache.
+
+The CPU time that is reported is system-wide, from /proc/stat, since the
+kernel decrypts file contents in worker threads rather than in the process
+reading the file.  So for meaningful CPU times the system should be idle.
+
+Usage: fscrypt_advisor.py [--size=MIB] [--small-files=N] [--json=FILE]
+                          [--workload=NAME]... [--no-caps-cache] DIRECTORY"""
+
+import argparse
+import collections
+import errno
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import time
+
+import fscrypt
+import fscrypt_caps
+
+# A candidate policy: a short name, and the arguments to fscrypt.make_policy()
+# (or None for the unencrypted baseline)
+Candidate = collections.namedtuple("Candidate", ["name", "policy_args"])
+
+CANDIDATES = [
+    Candidate("unencrypted", None),
+    Candidate("AES-256-XTS/AES-256-CTS", {}),
+    Candidate("AES-256-XTS/AES-256-HCTR2", {
+        "filenames_mode": fscrypt.FSCRYPT_MODE_AES_256_HCTR2}),
+    Candidate("AES-128-CBC/AES-128-CTS", {
+        "contents_mode": fscrypt.FSCRYPT_MODE_AES_128_CBC,
+        "filenames_mode": fscrypt.FSCRYPT_MODE_AES_128_CTS}),
+    Candidate("Adiantum", {
+        "contents_mode": fscrypt.FSCRYPT_MODE_ADIANTUM,
+        "filenames_mode": fscrypt.FSCRYPT_MODE_ADIANTUM}),
+    Candidate("Adiantum+DIRECT_KEY", {
+        "contents_mode": fscrypt.FSCRYPT_MODE_ADIANTUM,
+        "filenames_mode": fscrypt.FSCRYPT_MODE_ADIANTUM,
+        "flags": (fscrypt.FSCRYPT_POLICY_FLAGS_PAD_32 |
+                  fscrypt.FSCRYPT_POLICY_FLAG_DIRECT_KEY)}),
+    Candidate("SM4-XTS/SM4-CTS", {
+        "contents_mode": fscrypt.FSCRYPT_MODE_SM4_XTS,
+        "filenames_mode": fscrypt.FSCRYPT_MODE_SM4_CTS}),
+    Candidate("AES-256-XTS/AES-256-CTS+IV_INO_LBLK_64", {
+        "flags": (fscrypt.FSCRYPT_POLICY_FLAGS_PAD_32 |
+                  fscrypt.FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64)}),
+    Candidate("AES-256-XTS/AES-256-CTS+IV_INO_LBLK_32", {
+        "flags": (fscrypt.FSCRYPT_POLICY_FLAGS_PAD_32 |
+                  fscrypt.FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32)}),
+    Candidate("AES-256-XTS/AES-256-CTS,data_unit_size=512", {
+        "log2_data_unit_size": 9}),
+]
+
+WORKLOADS = ["seq_write", "seq_read", "rand_write", "rand_read", "small_files"]
+
+# The I/O size for the sequential and random workloads
+SEQ_IO_SIZE = 1 << 20
+RAND_IO_SIZE = 4096
+SMALL_FILE_SIZE = 4096
+
+# The result of one workload: bytes transferred, wall time, system-wide CPU
+# time, and the number of files (for small_files) or I/O requests (otherwise)
+Measurement = collections.namedtuple("Measurement", [
+    "bytes", "seconds", "cpu_seconds", "operations"])
+
+
+def _busy_cpu_seconds():
+    """Returns the total non-idle CPU time of the system, in seconds."""
+    with open("/proc/stat") as f:
+        fields = [int(x) for x in f.readline().split()[1:]]
+    # user nice system idle iowait irq softirq steal ...
+    busy = sum(fields) - fields[3] - fields[4]
+    return busy / os.sysconf("SC_CLK_TCK")
+
+
+class _Runner:
+    """Runs the workloads in one directory."""
+
+    def __init__(self, directory, size, num_small_files, drop_caches):
+        self.directory = directory
+        self.size = size
+        self.num_small_files = num_small_files
+        self.drop_caches = drop_caches
+        self.file = os.path.join(directory, "file")
+        self.small_dir = os.path.join(directory, "small")
+        self.rng = random.Random(0)
+
+    def _drop_caches(self):
+        os.sync()
+        if not self.drop_caches:
+            return
+        try:
+            with open("/proc/sys/vm/drop_caches", "w") as f:
+                f.write("3")
+        except OSError as e:
+            print("warning: can't drop caches ({}); reads may be served from "
+                  "the page cache".format(e.strerror), file=sys.stderr)
+            self.drop_caches = False
+
+    def _measure(self, func):
+        start_cpu = _busy_cpu_seconds()
+        start = time.perf_counter()
+        num_bytes, operations = func()
+        return Measurement(num_bytes, time.perf_counter() - start,
+                           _busy_cpu_seconds() - start_cpu, operations)
+
+    def _random_offsets(self):
+        blocks = self.size // RAND_IO_SIZE
+        return [self.rng.randrange(blocks) * RAND_IO_SIZE
+                for _ in range(max(1, blocks // 4))]
+
+    def seq_write(self):
+        buf = os.urandom(SEQ_IO_SIZE)
+        fd = os.open(self.file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            written = 0
+            while written < self.size:
+                written += os.write(fd, buf[:self.size - written])
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return written, (written + SEQ_IO_SIZE - 1) // SEQ_IO_SIZE
+
+    def seq_read(self):
+        fd = os.open(self.file, os.O_RDONLY)
+        try:
+            total = 0
+            while True:
+                n = len(os.read(fd, SEQ_IO_SIZE))
+                if n == 0:
+                    break
+                total += n
+        finally:
+            os.close(fd)
+        return total, (total + SEQ_IO_SIZE - 1) // SEQ_IO_SIZE
+
+    def rand_write(self):
+        buf = os.urandom(RAND_IO_SIZE)
+        offsets = self._random_offsets()
+        fd = os.open(self.file, os.O_WRONLY)
+        try:
+            for offset in offsets:
+                os.pwrite(fd, buf, offset)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return len(offsets) * RAND_IO_SIZE, len(offsets)
+
+    def rand_read(self):
+        offsets = self._random_offsets()
+        fd = os.open(self.file, os.O_RDONLY)
+        try:
+            for offset in offsets:
+                os.pread(fd, RAND_IO_SIZE, offset)
+        finally:
+            os.close(fd)
+        return len(offsets) * RAND_IO_SIZE, len(offsets)
+
+    def _write_small_files(self):
+        buf = os.urandom(SMALL_FILE_SIZE)
+        os.mkdir(self.small_dir)
+        for i in range(self.num_small_files):
+            fd = os.open(os.path.join(self.small_dir, str(i)),
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                os.write(fd, buf)
+            finally:
+                os.close(fd)
+        os.sync()
+        return self.num_small_files * SMALL_FILE_SIZE, self.num_small_files
+
+    def _read_small_files(self):
+        total = 0
+        with os.scandir(self.small_dir) as it:
+            for entry in it:
+                with open(entry.path, "rb") as f:
+                    total += len(f.read())
+        return total, self.num_small_files
+
+    def small_files(self):
+        """Creates many small files, then reads them back with a cold cache.
+        Filenames are encrypted too, so this also exercises the filenames
+        encryption mode."""
+        write = self._measure(self._write_small_files)
+        self._drop_caches()
+        read = self._measure(self._read_small_files)
+        return Measurement(write.bytes + read.bytes,
+                           write.seconds + read.seconds,
+                           write.cpu_seconds + read.cpu_seconds,
+                           write.operations)
+
+    def run(self, workloads):
+        """Runs the given workloads and returns a dict from workload name to
+        Measurement.  The other workloads use the file written by seq_write,
+        so it is always run, first."""
+        results = {}
+        for workload in WORKLOADS:
+            if workload not in workloads and workload != "seq_write":
+                continue
+            if workload in ("seq_read", "rand_read"):
+                self._drop_caches()
+            if workload == "small_files":
+                measurement = self.small_files()
+            else:
+                measurement = self._measure(getattr(self, workload))
+            if workload in workloads:
+                results[workload] = measurement
+        return results
+
+
+def _prepare_directory(path, key_identifier, candidate):
+    """Creates the directory for a candidate and encrypts it.  Raises OSError if
+    the kernel rejects the policy, including if it is accepted by set_policy
+    but files can't actually be created with it."""
+    os.mkdir(path)
+    if candidate.policy_args is None:
+        return
+    fscrypt.set_policy(path, fscrypt.make_policy(key_identifier,
+                                                 **candidate.policy_args))
+    probe = os.path.join(path, "probe")
+    with open(probe, "w") as f:
+        f.write("probe")
+    os.remove(probe)
+
+
+def _skip_reason(e):
+    if e.errno == errno.EINVAL:
+        return "not supported by the kernel or filesystem"
+    if e.errno == errno.ENOPKG:
+        return "algorithm not available in the kernel's crypto API"
+    return e.strerror or str(e)
+
+
+def _known_skip_reason(capabilities, candidate):
+    """Returns the reason that the candidate's policy is unsupported according
+    to |capabilities| (from fscrypt_caps), or None if it is supported or its
+    support is unknown."""
+    if capabilities is None or candidate.policy_args is None:
+        return None
+    try:
+        return fscrypt_caps.unsupported_reason(
+            capabilities, fscrypt.make_policy("", **candidate.policy_args))
+    except KeyError:
+        return None
+
+
+def evaluate(directory, candidates=None, workloads=None, size=64 << 20,
+             num_small_files=1000, drop_caches=True, log=None,
+             capabilities=None):
+    """Runs the workloads for each candidate policy in a temporary subdirectory
+    of |directory|.  Returns a list of (Candidate, dict from workload to
+    Measurement, or a string giving the reason the candidate was skipped).  If
+    |capabilities| (from fscrypt_caps) is given, the candidates that it says
+    are unsupported are skipped without trying them."""
+    workloads = workloads or WORKLOADS
+    raw_key = os.urandom(fscrypt.FSCRYPT_MAX_KEY_SIZE)
+    key_identifier = fscrypt.add_key(directory, raw_key)
+    results = []
+    try:
+        for i, candidate in enumerate(candidates or CANDIDATES):
+            path = os.path.join(directory, "fscrypt_advisor.{}.{}".format(
+                os.getpid(), i))
+            reason = _known_skip_reason(capabilities, candidate)
+            try:
+                if reason is None:
+                    try:
+                        _prepare_directory(path, key_identifier, candidate)
+                    except OSError as e:
+                        reason = _skip_reason(e)
+                if reason is not None:
+                    results.append((candidate, reason))
+                    if log:
+                        log("{}: skipped ({})".format(candidate.name, reason))
+                    continue
+                runner = _Runner(path, size, num_small_files, drop_caches)
+                results.append((candidate, runner.run(workloads)))
+                drop_caches = runner.drop_caches
+                if log:
+                    log("{}: done".format(candidate.name))
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+    finally:
+        fscrypt.remove_key(key_identifier, directory)
+    return results
+
+
+def throughput(measurement):
+    """Returns the throughput of a Measurement in MB/s."""
+    if measurement.seconds == 0:
+        return 0.0
+    return measurement.bytes / measurement.seconds / 1e6
+
+
+def rank(results, workload):
+    """Returns (Candidate, Measurement) for the candidates that weren't
+    skipped, sorted from fastest to slowest on the given workload."""
+    measured = [(candidate, r[workload]) for candidate, r in results
+                if not isinstance(r, str) and workload in r]
+    return sorted(measured, key=lambda item: -throughput(item[1]))
+
+
+def overall_rank(results, workloads):
+    """Ranks the candidates by the geometric mean of their throughput over the
+    given workloads.  Returns a list of (Candidate, geometric mean MB/s, total
+    CPU seconds)."""
+    ranked = []
+    for candidate, r in results:
+        if isinstance(r, str):
+            continue
+        rates = [throughput(r[w]) for w in workloads if w in r]
+        if not rates or min(rates) <= 0:
+            continue
+        mean = math.exp(sum(math.log(rate) for rate in rates) / len(rates))
+        ranked.append((candidate, mean, sum(r[w].cpu_seconds
+                                            for w in workloads if w in r)))
+    return sorted(ranked, key=lambda item: -item[1])
+
+
+def results_to_json(results):
+    """Converts the results of evaluate() to a JSON-serializable dict."""
+    out = {"kernel": os.uname().release, "candidates": []}
+    for candidate, r in results:
+        entry = {"name": candidate.name, "policy": candidate.policy_args}
+        if isinstance(r, str):
+            entry["skipped"] = r
+        else:
+            entry["workloads"] = {
+                workload: dict(m._asdict(), mb_per_sec=throughput(m))
+                for workload, m in r.items()}
+        out["candidates"].append(entry)
+    return out
+
+
+def print_results(results, workloads, out=sys.stdout):
+    """Prints the per-workload and overall rankings."""
+    name_width = max(len(candidate.name) for candidate, _ in results)
+    for workload in workloads:
+        print("{}:".format(workload), file=out)
+        for i, (candidate, m) in enumerate(rank(results, workload)):
+            print("  {:2}. {:<{}} {:9.1f} MB/s {:8.3f} s CPU".format(
+                i + 1, candidate.name, name_width, throughput(m),
+                m.cpu_seconds), file=out)
+    print("overall (geometric mean of MB/s):", file=out)
+    for i, (candidate, mean, cpu) in enumerate(overall_rank(results,
+                                                            workloads)):
+        print("  {:2}. {:<{}} {:9.1f} MB/s {:8.3f} s CPU".format(
+            i + 1, candidate.name, name_width, mean, cpu), file=out)
+    skipped = [(candidate, r) for candidate, r in results if isinstance(r, str)]
+    if skipped:
+        print("skipped:", file=out)
+        for candidate, reason in skipped:
+            print("  {}: {}".format(candidate.name, reason), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the throughput of the encryption settings.")
+    parser.add_argument("--size", type=int, default=64,
+                        help="size of the file for the sequential and random "
+                        "workloads, in MiB (default: 64)")
+    parser.add_argument("--small-files", type=int, default=1000,
+                        help="number of files for the small_files workload "
+                        "(default: 1000)")
+    parser.add_argument("--workload", action="append", choices=WORKLOADS,
+                        help="workload to run (may be repeated; default: all)")
+    parser.add_argument("--no-drop-caches", action="store_true",
+                        help="don't drop the page cache before reading")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results as JSON to FILE")
+    parser.add_argument("--no-caps-cache", action="store_true",
+                        help="try every policy rather than consulting the "
+                        "capability cache")
+    parser.add_argument("directory")
+    args = parser.parse_args()
+
+    workloads = args.workload or WORKLOADS
+    capabilities = None
+    if not args.no_caps_cache:
+        capabilities = fscrypt_caps.get_capabilities(args.directory)
+    results = evaluate(args.directory, workloads=workloads,
+                       size=args.size << 20, num_small_files=args.small_files,
+                       drop_caches=not args.no_drop_caches,
+                       log=lambda msg: print(msg, file=sys.stderr),
+                       capabilities=capabilities)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results_to_json(results), f, indent=2)
+            f.write("\n")
+    print_results(results, workloads)
+
+
+if __name__ == "__main__":
+    main()
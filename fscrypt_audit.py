@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Audits the encryption policies used in a directory tree.
+
+The tree is walked by a pool of worker threads.  The encryption policy is only
+queried for directories: the kernel requires that all files in an encrypted
+directory have the same policy as the directory, so each file is counted under
+its parent directory's policy.  Files in unencrypted directories are counted as
+unencrypted.  The walk doesn't cross into other filesystems.
+
+The summary groups directories and files by encryption policy, and it also
+reports two kinds of anomalies: unencrypted directories inside an encrypted
+directory ("unencrypted islands"), and encrypted directories whose policy
+differs from that of their encrypted parent directory ("mixed policies").  The
+kernel doesn't allow creating either of these, so they indicate files that were
+created by other means, such as by an offline tool or by filesystem corruption.
+
+Usage: fscrypt_audit.py [--jobs=N] [--json] DIRECTORY"""
+
+import argparse
+import collections
+import errno
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+import fscrypt
+
+# The directories and files that use one encryption policy.  |roots| are the
+# directories at which the policy starts, i.e. whose parent directory doesn't
+# have the same policy.
+PolicyUsage = collections.namedtuple("PolicyUsage", [
+    "roots", "directories", "files"])
+
+
+class AuditResult:
+    """The result of auditing a directory tree."""
+
+    def __init__(self):
+        # Map from fscrypt.Policy (or None for unencrypted) to PolicyUsage
+        self.usage = {}
+        # Unencrypted directories whose parent directory is encrypted
+        self.islands = []
+        # (path, policy, parent_policy) of encrypted directories whose parent
+        # directory is encrypted with a different policy
+        self.mixed = []
+        # (path, error message) of directories that couldn't be audited
+        self.errors = []
+        self.elapsed = 0.0
+
+    def record(self, policy, is_root, directories, files):
+        usage = self.usage.get(policy, PolicyUsage(0, 0, 0))
+        self.usage[policy] = PolicyUsage(usage.roots + int(is_root),
+                                         usage.directories + directories,
+                                         usage.files + files)
+
+    def directories_scanned(self):
+        return sum(usage.directories for usage in self.usage.values())
+
+
+def _get_policy(path):
+    """Returns the encryption policy of the given directory, or None if it is
+    unencrypted."""
+    try:
+        return fscrypt.get_policy(path)
+    except OSError as e:
+        if e.errno == errno.ENODATA:
+            return None
+        raise
+
+
+class _Auditor:
+    """Walks a directory tree using a pool of worker threads."""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.result = AuditResult()
+
+    def _audit_directory(self, path, dev, policy):
+        """Scans one directory whose policy is already known, and queues its
+        subdirectories."""
+        files = 0
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.stat(follow_symlinks=False).st_dev == dev:
+                        subdirs.append(entry.path)
+                else:
+                    files += 1
+        with self.lock:
+            self.result.record(policy, False, 0, files)
+        for subdir in subdirs:
+            self.queue.put((subdir, dev, policy))
+
+    def _check_directory(self, path, dev, parent_policy):
+        """Determines the policy of one directory, records it, and scans it."""
+        policy = _get_policy(path)
+        with self.lock:
+            self.result.record(policy, policy != parent_policy, 1, 0)
+            if parent_policy is not None:
+                if policy is None:
+                    self.result.islands.append(path)
+                elif policy != parent_policy:
+                    self.result.mixed.append((path, policy, parent_policy))
+        self._audit_directory(path, dev, policy)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, dev, parent_policy = item
+            try:
+                self._check_directory(path, dev, parent_policy)
+            except OSError as e:
+                with self.lock:
+                    self.result.errors.append((path, e.strerror or str(e)))
+            except ValueError as e:
+                with self.lock:
+                    self.result.errors.append((path, str(e)))
+            finally:
+                self.queue.task_done()
+
+    def run(self, root):
+        start = time.monotonic()
+        self.queue.put((root, os.stat(root).st_dev, _root_parent_policy(root)))
+        threads = [threading.Thread(target=self._worker, daemon=True)
+                   for _ in range(self.jobs)]
+        for thread in threads:
+            thread.start()
+        self.queue.join()
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+        self.result.elapsed = time.monotonic() - start
+        self.result.islands.sort()
+        self.result.mixed.sort()
+        self.result.errors.sort()
+        return self.result
+
+
+def _root_parent_policy(root):
+    """Returns the policy of the parent directory of |root|, so that |root|
+    itself is checked for anomalies too.  The parent isn't audited otherwise."""
+    parent = os.path.join(root, "..")
+    if os.stat(parent).st_dev != os.stat(root).st_dev:
+        return None
+    try:
+        return _get_policy(parent)
+    except (OSError, ValueError):
+        return None
+
+
+def audit(root, jobs=None):
+    """Audits the directory tree rooted at |root| and returns an AuditResult.
+    |jobs| is the number of worker threads to use."""
+    return _Auditor(jobs or min(32, (os.cpu_count() or 1) * 4)).run(root)
+
+
+def describe_policy(policy):
+    """Describes an encryption policy on one line."""
+    if policy is None:
+        return "unencrypted"
+    if policy.log2_data_unit_size:
+        du = str(fscrypt.data_unit_size(policy))
+    else:
+        du = "default"
+    return "v{} key {} contents {} filenames {} flags {} data unit size {}".format(
+        policy.version, policy.key, fscrypt.mode_name(policy.contents_mode),
+        fscrypt.mode_name(policy.filenames_mode),
+        fscrypt.flags_to_string(policy.flags).replace(" ", ""), du)
+
+
+def _policy_to_json(policy):
+    if policy is None:
+        return None
+    return policy._asdict()
+
+
+def result_to_json(result):
+    """Converts an AuditResult to a JSON-serializable dict."""
+    return {
+        "policies": [dict(policy=_policy_to_json(policy), **usage._asdict())
+                     for policy, usage in result.usage.items()],
+        "unencrypted_islands": result.islands,
+        "mixed_policies": [{"path": path, "policy": _policy_to_json(policy),
+                            "parent_policy": _policy_to_json(parent)}
+                           for path, policy, parent in result.mixed],
+        "errors": [{"path": path, "error": error}
+                   for path, error in result.errors],
+        "directories_scanned": result.directories_scanned(),
+        "elapsed_seconds": result.elapsed,
+    }
+
+
+def print_result(result, out=sys.stdout):
+    """Prints a human-readable summary of an AuditResult."""
+    def sort_key(item):
+        return (item[0] is not None, -item[1].files, -item[1].directories)
+    for policy, usage in sorted(result.usage.items(), key=sort_key):
+        print("{}: {} roots, {} directories, {} files".format(
+            describe_policy(policy), usage.roots, usage.directories,
+            usage.files), file=out)
+    if result.islands:
+        print("Unencrypted islands ({}):".format(len(result.islands)), file=out)
+        for path in result.islands:
+            print("  " + path, file=out)
+    if result.mixed:
+        print("Mixed policies ({}):".format(len(result.mixed)), file=out)
+        for path, policy, parent in result.mixed:
+            print("  {}: {} (parent: {})".format(
+                path, describe_policy(policy), describe_policy(parent)),
+                file=out)
+    if result.errors:
+        print("Errors ({}):".format(len(result.errors)), file=out)
+        for path, error in result.errors:
+            print("  {}: {}".format(path, error), file=out)
+    print("Scanned {} directories in {:.3f} seconds".format(
+        result.directories_scanned(), result.elapsed), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Audit the encryption policies used in a directory tree.")
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="number of worker threads")
+    parser.add_argument("--json", action="store_true",
+                        help="print the result as JSON")
+    parser.add_argument("directory")
+    args = parser.parse_args()
+
+    result = audit(args.directory, args.jobs)
+    if args.json:
+        json.dump(result_to_json(result), sys.stdout, indent=2)
+        print()
+    else:
+        print_result(result)
+    if result.islands or result.mixed or result.errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Measures the latency of the fscrypt operations.
+
+Each operation is measured both in-process through the fscrypt module ("ioctl")
+and by executing fscryptctl ("cli", or "batch" if ENABLE_BATCH=1 is set).  Only
+the operation itself is timed; any setup needed before each iteration, such as
+re-adding a key that was just removed, is not.
+
+This reuses the setup helpers from test.py, so it has the same requirements:
+the fscryptctl binary must be on the PATH, and the environment variable TEST_DIR
+must point to a directory on a filesystem that supports encryption.  Like the
+tests, it uses (and deletes) the "test" subdirectory of TEST_DIR.
+
+The results can be written as JSON with --json, and a previous JSON result (for
+example from a different kernel) can be compared against with --compare.
+
+Usage: fscrypt_bench.py [--iterations=N] [--json=FILE] [--compare=FILE]
+                        [OPERATION...]"""
+
+import argparse
+import collections
+import json
+import math
+import os
+import sys
+import time
+
+import fscrypt
+import test
+
+# Latency statistics, in seconds except for |count| and |ops_per_sec|
+Stats = collections.namedtuple("Stats", [
+    "count", "p50", "p99", "max", "mean", "ops_per_sec"])
+
+
+def percentile(sorted_samples, fraction):
+    """Returns the nearest-rank percentile of a nonempty sorted list.
+    |fraction| is in the range [0, 1]."""
+    rank = max(1, math.ceil(len(sorted_samples) * fraction))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def summarize(samples):
+    """Computes Stats for a nonempty list of durations in seconds."""
+    samples = sorted(samples)
+    total = sum(samples)
+    return Stats(len(samples), percentile(samples, 0.50),
+                 percentile(samples, 0.99), samples[-1], total / len(samples),
+                 len(samples) / total if total else 0.0)
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def _cli(*args, stdin=b""):
+    """Executes fscryptctl like the tests do, and raises an error if it
+    fails."""
+    returncode, stdout, stderr = test.run_fscryptctl(args, stdin)
+    if returncode != 0:
+        raise SystemError(test.postprocess_output(stderr))
+    return stdout
+
+
+class _Benchmark:
+    """The operations being measured, and the directories they use."""
+
+    def __init__(self):
+        self.mountpoint = test.RAW_TEST_DIR
+        self.encrypted_dir = os.path.join(test.TEST_DIR, "encrypted")
+        self.busy_dir = os.path.join(test.TEST_DIR, "busy")
+        self.busy_file = os.path.join(self.busy_dir, "file")
+        self.policy_dir = os.path.join(test.TEST_DIR, "set_policy")
+        self.num_policy_dirs = 0
+        # The encrypted directory uses TEST_KEY, the directory with an open
+        # file uses TEST_KEY_32B, and TEST_KEY_16B (which is too short to be
+        # used with AES-256-XTS) is repeatedly added and removed.
+        self.key = test.TEST_KEY
+        self.busy_key = test.TEST_KEY_32B
+        self.spare_key = test.TEST_KEY_16B
+
+    def setup(self):
+        test.cleanup_directory()
+        os.mkdir(test.TEST_DIR)
+        os.mkdir(self.policy_dir)
+        test.prepare_encrypted_dir(self.encrypted_dir, key=self.key)
+        test.prepare_encrypted_dir(self.busy_dir, key=self.busy_key)
+        with open(self.busy_file, "w") as f:
+            f.write("contents")
+
+    def add_key(self, cli):
+        raw = self.spare_key["raw"]
+        if cli:
+            elapsed, _ = _timed(_cli, "add_key", self.mountpoint, stdin=raw)
+        else:
+            elapsed, _ = _timed(fscrypt.add_key, self.mountpoint, raw)
+        fscrypt.remove_key(self.spare_key["identifier"], self.mountpoint)
+        return elapsed
+
+    def remove_key(self, cli):
+        identifier = self.spare_key["identifier"]
+        fscrypt.add_key(self.mountpoint, self.spare_key["raw"])
+        if cli:
+            return _timed(_cli, "remove_key", identifier, self.mountpoint)[0]
+        return _timed(fscrypt.remove_key, identifier, self.mountpoint)[0]
+
+    def remove_key_incomplete(self, cli):
+        """Removes a key while a file that uses it is open, so the key can only
+        be removed incompletely.  Afterwards the file is closed and the key is
+        added back, which makes it fully present again."""
+        identifier = self.busy_key["identifier"]
+        fd = os.open(self.busy_file, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            if cli:
+                elapsed, _ = _timed(_cli, "remove_key", identifier,
+                                    self.mountpoint)
+            else:
+                elapsed, flags = _timed(fscrypt.remove_key, identifier,
+                                        self.mountpoint)
+                assert flags & fscrypt.FSCRYPT_KEY_REMOVAL_STATUS_FLAG_FILES_BUSY
+        finally:
+            os.close(fd)
+        fscrypt.add_key(self.mountpoint, self.busy_key["raw"])
+        return elapsed
+
+    def key_status(self, cli):
+        identifier = self.key["identifier"]
+        if cli:
+            return _timed(_cli, "key_status", identifier, self.mountpoint)[0]
+        return _timed(fscrypt.get_key_status, identifier, self.mountpoint)[0]
+
+    def get_policy(self, cli):
+        if cli:
+            return _timed(_cli, "get_policy", self.encrypted_dir)[0]
+        return _timed(fscrypt.get_policy, self.encrypted_dir)[0]
+
+    def set_policy(self, cli):
+        self.num_policy_dirs += 1
+        path = os.path.join(self.policy_dir, str(self.num_policy_dirs))
+        os.mkdir(path)
+        identifier = self.key["identifier"]
+        if cli:
+            return _timed(_cli, "set_policy", identifier, path)[0]
+        return _timed(fscrypt.set_policy, path,
+                      fscrypt.make_policy(identifier))[0]
+
+
+OPERATIONS = ["add_key", "remove_key", "remove_key_incomplete", "key_status",
+              "get_policy", "set_policy"]
+
+
+def cli_interface_name():
+    """Returns the name of the interface used when executing fscryptctl."""
+    return "batch" if test.ENABLE_BATCH else "cli"
+
+
+def run(operations=None, iterations=1000):
+    """Measures each of the given operations (default all of OPERATIONS) over
+    both interfaces.  Returns a list of (operation, interface, Stats)."""
+    benchmark = _Benchmark()
+    results = []
+    benchmark.setup()
+    try:
+        for operation in operations or OPERATIONS:
+            func = getattr(benchmark, operation)
+            for interface, cli in [("ioctl", False),
+                                   (cli_interface_name(), True)]:
+                samples = [func(cli) for _ in range(iterations)]
+                results.append((operation, interface, summarize(samples)))
+    finally:
+        test.cleanup_directory()
+    return results
+
+
+def results_to_json(results, iterations):
+    """Converts the results of run() to a JSON-serializable dict.  Latencies
+    are in microseconds."""
+    uname = os.uname()
+    return {
+        "kernel": uname.release,
+        "machine": uname.machine,
+        "iterations": iterations,
+        "results": [{
+            "operation": operation,
+            "interface": interface,
+            "count": stats.count,
+            "p50_us": stats.p50 * 1e6,
+            "p99_us": stats.p99 * 1e6,
+            "max_us": stats.max * 1e6,
+            "mean_us": stats.mean * 1e6,
+            "ops_per_sec": stats.ops_per_sec,
+        } for operation, interface, stats in results],
+    }
+
+
+def print_results(data, baseline=None, out=sys.stdout):
+    """Prints the JSON form of the results as a table.  If |baseline| is given,
+    it is another JSON result whose p50 latencies are compared against."""
+    previous = {}
+    if baseline:
+        print("Kernel {} (baseline: kernel {})".format(
+            data["kernel"], baseline["kernel"]), file=out)
+        for r in baseline["results"]:
+            previous[(r["operation"], r["interface"])] = r
+    else:
+        print("Kernel {}".format(data["kernel"]), file=out)
+    header = "{:<22} {:<9} {:>10} {:>10} {:>10} {:>10}".format(
+        "operation", "interface", "p50 (us)", "p99 (us)", "max (us)",
+        "ops/sec")
+    if baseline:
+        header += " {:>9}".format("p50 vs")
+    print(header, file=out)
+    for r in data["results"]:
+        line = "{:<22} {:<9} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.0f}".format(
+            r["operation"], r["interface"], r["p50_us"], r["p99_us"],
+            r["max_us"], r["ops_per_sec"])
+        old = previous.get((r["operation"], r["interface"]))
+        if old:
+            line += " {:>8.2f}x".format(r["p50_us"] / old["p50_us"])
+        print(line, file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the latency of the fscrypt operations.")
+    parser.add_argument("--iterations", "-n", type=int, default=1000,
+                        help="number of times to execute each operation")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results as JSON to FILE")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare against the JSON results in FILE")
+    parser.add_argument("operations", nargs="*", metavar="OPERATION",
+                        help="operations to measure (default: all)")
+    args = parser.parse_args()
+    for operation in args.operations:
+        if operation not in OPERATIONS:
+            parser.error("unknown operation: {} (choose from {})".format(
+                operation, ", ".join(OPERATIONS)))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    data = results_to_json(run(args.operations, args.iterations),
+                           args.iterations)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+    print_results(data, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Probes and caches which encryption settings a kernel and filesystem support.
+
+Which encryption policies can be used depends on the kernel version, on which
+algorithms the kernel's crypto API was built with, and on the filesystem and
+how it was formatted.  The only reliable way to find out is to try them.  This
+tries, on the filesystem containing the given directory:
+
+  - whether the v2 fscrypt ioctls (FS_IOC_ADD_ENCRYPTION_KEY and friends) work
+  - each valid pair of contents and filenames encryption modes
+  - the DIRECT_KEY, IV_INO_LBLK_64, and IV_INO_LBLK_32 flags
+  - data unit sizes from 512 bytes to 64 KiB, which may be limited by the
+    filesystem block size
+  - whether the block device supports the blk-crypto ioctls for
+    hardware-wrapped keys
+
+Each policy is tried by setting it on a new directory and creating a file in
+it, using a random key which is removed afterwards.  The results are cached in
+a JSON file, keyed by the kernel release and build and by the filesystem's
+UUID, so that later callers (such as the test suite, or tools choosing which
+policy to use) can just look them up.  The cache is $FSCRYPT_CAPS_CACHE if set,
+otherwise $XDG_CACHE_HOME/fscryptctl/capabilities.json.
+
+This prints which settings are supported, or with --json the capabilities
+themselves.  --refresh probes again even if the result is already cached.
+
+Usage: fscrypt_caps.py [--cache=FILE] [--refresh] [--json] DIRECTORY"""
+
+import argparse
+import collections
+import errno
+import json
+import os
+import shutil
+import sys
+
+import fscrypt
+
+# A policy to probe: a short name, and the arguments to fscrypt.make_policy()
+Probe = collections.namedtuple("Probe", ["name", "policy_args"])
+
+
+def _probe(contents, filenames, flags=0, log2_data_unit_size=0):
+    policy = fscrypt.make_policy(
+        "", contents, filenames, fscrypt.FSCRYPT_POLICY_FLAGS_PAD_32 | flags,
+        log2_data_unit_size)
+    return Probe(policy_name(policy), {
+        "contents_mode": contents, "filenames_mode": filenames,
+        "flags": policy.flags, "log2_data_unit_size": log2_data_unit_size})
+
+
+def policy_name(policy):
+    """Returns the name under which the support for |policy| is cached.  The
+    amount of filenames padding doesn't affect support, so it isn't
+    included."""
+    name = "{}/{}".format(fscrypt.mode_name(policy.contents_mode),
+                          fscrypt.mode_name(policy.filenames_mode))
+    flags = fscrypt.flags_to_string(policy.flags).split(", ")[1:]
+    if flags:
+        name += "+" + "+".join(flags)
+    if policy.log2_data_unit_size:
+        name += ",data_unit_size={}".format(fscrypt.data_unit_size(policy))
+    return name
+
+
+_XTS = fscrypt.FSCRYPT_MODE_AES_256_XTS
+_CTS = fscrypt.FSCRYPT_MODE_AES_256_CTS
+
+PROBES = [
+    _probe(_XTS, _CTS),
+    _probe(_XTS, fscrypt.FSCRYPT_MODE_AES_256_HCTR2),
+    _probe(fscrypt.FSCRYPT_MODE_AES_128_CBC, fscrypt.FSCRYPT_MODE_AES_128_CTS),
+    _probe(fscrypt.FSCRYPT_MODE_SM4_XTS, fscrypt.FSCRYPT_MODE_SM4_CTS),
+    _probe(fscrypt.FSCRYPT_MODE_ADIANTUM, fscrypt.FSCRYPT_MODE_ADIANTUM),
+    _probe(fscrypt.FSCRYPT_MODE_ADIANTUM, fscrypt.FSCRYPT_MODE_ADIANTUM,
+           fscrypt.FSCRYPT_POLICY_FLAG_DIRECT_KEY),
+    _probe(_XTS, _CTS, fscrypt.FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64),
+    _probe(_XTS, _CTS, fscrypt.FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32),
+] + [_probe(_XTS, _CTS, log2_data_unit_size=bits) for bits in range(9, 17)]
+
+
+def _error_reason(e):
+    if e.errno == errno.EINVAL:
+        return "not supported by the kernel or filesystem"
+    if e.errno == errno.ENOPKG:
+        return "algorithm not available in the kernel's crypto API"
+    return e.strerror or str(e)
+
+
+def filesystem_uuid(path):
+    """Returns the UUID of the filesystem containing |path|, from
+    /dev/disk/by-uuid.  If it has none there, returns its filesystem ID (from
+    statfs) instead, which most filesystems derive from their UUID."""
+    dev = os.stat(path).st_dev
+    try:
+        names = os.listdir("/dev/disk/by-uuid")
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            if os.stat(os.path.join("/dev/disk/by-uuid", name)).st_rdev == dev:
+                return name
+        except OSError:
+            continue
+    return "fsid-{:x}".format(os.statvfs(path).f_fsid)
+
+
+def cache_key(path):
+    """Returns the key of the capabilities of the filesystem containing |path|
+    in the cache: the kernel release and build, and the filesystem UUID.
+    Results obtained with fscrypt_shim.so are kept apart from real ones."""
+    uname = os.uname()
+    key = "{} {} {}".format(uname.release, uname.version,
+                            filesystem_uuid(path))
+    if "fscrypt_shim" in os.environ.get("LD_PRELOAD", ""):
+        key += " (shim)"
+    return key
+
+
+def default_cache_path():
+    path = os.environ.get("FSCRYPT_CAPS_CACHE")
+    if path:
+        return path
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "fscryptctl", "capabilities.json")
+
+
+def _probe_blk_crypto(path):
+    dev = os.stat(path).st_dev
+    blkdev = "/dev/block/{}:{}".format(os.major(dev), os.minor(dev))
+    try:
+        fscrypt.generate_hw_wrapped_key(blkdev)
+    except OSError as e:
+        if e.errno in (errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOENT):
+            return False, "not supported by the block device"
+        return None, "{}: {}".format(blkdev, e.strerror)
+    return True, None
+
+
+def probe(path):
+    """Probes the encryption capabilities of the kernel and the filesystem
+    containing the directory |path|.  Returns a JSON-serializable dict, in
+    which "policies" maps the name of each Probe to None if the policy is
+    supported or to the reason it isn't."""
+    caps = {"v2_ioctls": True, "v2_ioctls_error": None, "policies": {}}
+    caps["blk_crypto_ioctls"], caps["blk_crypto_ioctls_error"] = \
+        _probe_blk_crypto(path)
+    try:
+        identifier = fscrypt.add_key(path, os.urandom(
+            fscrypt.FSCRYPT_MAX_KEY_SIZE))
+    except OSError as e:
+        caps["v2_ioctls"] = False
+        caps["v2_ioctls_error"] = _error_reason(e)
+        for p in PROBES:
+            caps["policies"][p.name] = "v2 ioctls not supported"
+        return caps
+    try:
+        for i, p in enumerate(PROBES):
+            directory = os.path.join(path, "fscrypt_caps.{}.{}".format(
+                os.getpid(), i))
+            os.mkdir(directory)
+            try:
+                fscrypt.set_policy(directory, fscrypt.make_policy(
+                    identifier, **p.policy_args))
+                # Some settings are only rejected when the first file is
+                # created and its key is derived.
+                with open(os.path.join(directory, "probe"), "w") as f:
+                    f.write("probe")
+                caps["policies"][p.name] = None
+            except OSError as e:
+                caps["policies"][p.name] = _error_reason(e)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        fscrypt.remove_key(identifier, path)
+    return caps
+
+
+def _load_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        # A corrupt cache is just probed again.
+        return {}
+
+
+def _save_cache(cache_path, cache):
+    """Writes the cache atomically, so that concurrent readers (such as
+    parallel test processes) never see a partially written file."""
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, cache_path)
+
+
+def get_capabilities(path, cache_path=None, refresh=False):
+    """Returns the capabilities of the kernel and the filesystem containing the
+    directory |path|, as returned by probe(), from the cache if they have been
+    probed before (unless |refresh|)."""
+    cache_path = cache_path or default_cache_path()
+    key = cache_key(path)
+    cache = _load_cache(cache_path)
+    if refresh or key not in cache:
+        caps = probe(path)
+        # Re-read the cache in case another process updated it meanwhile.
+        cache = _load_cache(cache_path)
+        cache[key] = caps
+        _save_cache(cache_path, cache)
+    return cache[key]
+
+
+def unsupported_reason(caps, policy):
+    """Returns None if |policy| (a fscrypt.Policy) is supported according to
+    the capabilities |caps|, or the reason it isn't.  Raises KeyError if the
+    policy's settings weren't probed."""
+    return caps["policies"][policy_name(policy)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Probe which encryption settings are supported.")
+    parser.add_argument("--cache", default=None,
+                        help="cache file (default: {})".format(
+                            default_cache_path()))
+    parser.add_argument("--refresh", action="store_true",
+                        help="probe again even if the result is cached")
+    parser.add_argument("--json", action="store_true",
+                        help="print the capabilities as JSON")
+    parser.add_argument("directory", metavar="DIRECTORY")
+    args = parser.parse_args()
+
+    try:
+        caps = get_capabilities(args.directory, args.cache, args.refresh)
+    except OSError as e:
+        print("error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    if args.json:
+        json.dump(caps, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+    for name, error in [("v2 ioctls", caps["v2_ioctls_error"]),
+                        ("blk-crypto ioctls",
+                         caps["blk_crypto_ioctls_error"])]:
+        print("{}: {}".format(name, error or "supported"))
+    for name, error in caps["policies"].items():
+        print("{}: {}".format(name, error or "supported"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Exports the status of fscrypt keys as Prometheus metrics over HTTP.
+
+Rather than executing "fscryptctl key_status" once per key and mountpoint,
+this keeps one file descriptor open per mountpoint and polls the status of each
+key in the background with FS_IOC_GET_ENCRYPTION_KEY_STATUS.  Scrapes of the
+/metrics endpoint are served from the results of the last poll, so they never
+issue any ioctls themselves.
+
+The keys are those given with --key, plus (unless --no-discover is given) the
+keys of the v2 encryption policies found on the encrypted directories at most
+--discover-depth levels below each mountpoint.  Discovery is repeated every
+--discover-interval seconds, so that new encrypted directories are picked up.
+The walk doesn't descend into encrypted directories or other filesystems.
+
+The mountpoints should be the root directories of the filesystems, and must not
+be encrypted directories themselves: an open file descriptor for an encrypted
+directory would keep its key in-use.
+
+The metrics are, for each mountpoint and key:
+
+    fscrypt_key_status{status="absent|present|incompletely_removed"}
+    fscrypt_key_user_count
+    fscrypt_key_added_by_self
+    fscrypt_key_status_error       (1 if the last poll failed)
+    fscrypt_key_status_poll_seconds (the latency of the last poll)
+
+and for each mountpoint fscrypt_mountpoint_up, plus totals for the exporter's
+own polls.  With --once, one poll is done and the metrics are printed instead
+of being served.
+
+Usage: fscrypt_exporter.py [--listen=ADDRESS:PORT] [--interval=SECONDS]
+                           [--key=KEY_IDENTIFIER]... [--no-discover]
+                           [--discover-depth=N] [--discover-interval=SECONDS]
+                           [--once] MOUNTPOINT..."""
+
+import argparse
+import collections
+import errno
+import http.server
+import os
+import stat
+import sys
+import threading
+import time
+
+import fscrypt
+
+DEFAULT_PORT = 9725
+
+_STATUS_NAMES = {
+    fscrypt.FSCRYPT_KEY_STATUS_ABSENT: "absent",
+    fscrypt.FSCRYPT_KEY_STATUS_PRESENT: "present",
+    fscrypt.FSCRYPT_KEY_STATUS_INCOMPLETELY_REMOVED: "incompletely_removed",
+}
+
+# The result of polling the status of one key on one mountpoint.  |status| is
+# a fscrypt.KeyStatus, or None if the ioctl failed with the OSError |error|.
+Sample = collections.namedtuple("Sample", [
+    "mountpoint", "identifier", "status", "error", "seconds"])
+
+
+def _escape_label(value):
+    return (value.replace("\\", "\\\\").replace("\"", "\\\"")
+            .replace("\n", "\\n"))
+
+
+def _metric(name, labels, value):
+    return "{}{{{}}} {}".format(name, ",".join(
+        "{}=\"{}\"".format(key, _escape_label(str(v)))
+        for key, v in labels), value)
+
+
+def discover_identifiers(mountpoint, depth):
+    """Returns the set of key identifiers of the v2 encryption policies of the
+    encrypted directories at most |depth| levels below |mountpoint|."""
+    identifiers = set()
+    root_dev = os.stat(mountpoint).st_dev
+    level = [mountpoint]
+    for _ in range(depth):
+        next_level = []
+        for directory in level:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    if not stat.S_ISDIR(st.st_mode) or st.st_dev != root_dev:
+                        continue
+                    policy = fscrypt.get_policy(entry.path)
+                except OSError as e:
+                    if e.errno == errno.ENODATA:
+                        next_level.append(entry.path)
+                    continue
+                except ValueError:
+                    continue
+                if policy.version == 2:
+                    identifiers.add(policy.key)
+        level = next_level
+    return identifiers
+
+
+class Exporter:
+    """Polls the status of a set of keys on a set of mountpoints, and renders
+    the results of the last poll as Prometheus metrics."""
+
+    def __init__(self, mountpoints, identifiers=(), discover_depth=1,
+                 discover_interval=300.0):
+        self.mountpoints = list(mountpoints)
+        self.identifiers = set(identifiers)
+        self.discover_depth = discover_depth
+        self.discover_interval = discover_interval
+        self._discovered = {mountpoint: set() for mountpoint in mountpoints}
+        self._last_discovery = None
+        self._fds = {}
+        self._lock = threading.Lock()
+        self._samples = []
+        self._up = {}
+        self._polls = 0
+        self._poll_seconds = 0.0
+        self._last_poll_time = 0.0
+
+    def _open(self, mountpoint):
+        fd = self._fds.get(mountpoint)
+        if fd is None:
+            fd = os.open(mountpoint, os.O_RDONLY | os.O_CLOEXEC)
+            self._fds[mountpoint] = fd
+        return fd
+
+    def _discover(self):
+        now = time.monotonic()
+        if self.discover_depth <= 0 or (
+                self._last_discovery is not None and
+                now - self._last_discovery < self.discover_interval):
+            return
+        self._last_discovery = now
+        for mountpoint in self.mountpoints:
+            try:
+                self._discovered[mountpoint] = discover_identifiers(
+                    mountpoint, self.discover_depth)
+            except OSError:
+                pass
+
+    def poll(self):
+        """Polls the status of every key on every mountpoint, and replaces the
+        cached results with the new ones."""
+        start = time.monotonic()
+        self._discover()
+        samples = []
+        up = {}
+        for mountpoint in self.mountpoints:
+            try:
+                fd = self._open(mountpoint)
+            except OSError:
+                up[mountpoint] = False
+                continue
+            up[mountpoint] = True
+            for identifier in sorted(self.identifiers |
+                                     self._discovered[mountpoint]):
+                ioctl_start = time.monotonic()
+                status, error = None, None
+                try:
+                    status = fscrypt.get_key_status(identifier, fd)
+                except OSError as e:
+                    error = e
+                samples.append(Sample(mountpoint, identifier, status, error,
+                                      time.monotonic() - ioctl_start))
+        with self._lock:
+            self._samples = samples
+            self._up = up
+            self._polls += 1
+            self._poll_seconds = time.monotonic() - start
+            self._last_poll_time = time.time()
+
+    def render(self):
+        """Returns the results of the last poll in the Prometheus text
+        exposition format."""
+        with self._lock:
+            samples, up = self._samples, self._up
+            polls, poll_seconds = self._polls, self._poll_seconds
+            last_poll_time = self._last_poll_time
+        # The samples of each metric must be contiguous in the output.
+        families = {name: [] for name in [
+            "fscrypt_key_status", "fscrypt_key_user_count",
+            "fscrypt_key_added_by_self", "fscrypt_key_status_error",
+            "fscrypt_key_status_poll_seconds", "fscrypt_mountpoint_up"]}
+        for sample in samples:
+            labels = [("mountpoint", sample.mountpoint),
+                      ("key", sample.identifier)]
+            families["fscrypt_key_status_error"].append(
+                (labels, int(sample.status is None)))
+            families["fscrypt_key_status_poll_seconds"].append(
+                (labels, "{:.9f}".format(sample.seconds)))
+            if sample.status is None:
+                continue
+            for value, name in _STATUS_NAMES.items():
+                families["fscrypt_key_status"].append(
+                    (labels + [("status", name)],
+                     int(sample.status.status == value)))
+            families["fscrypt_key_user_count"].append(
+                (labels, sample.status.user_count))
+            families["fscrypt_key_added_by_self"].append(
+                (labels, int(bool(
+                    sample.status.status_flags &
+                    fscrypt.FSCRYPT_KEY_STATUS_FLAG_ADDED_BY_SELF))))
+        for mountpoint in self.mountpoints:
+            if mountpoint in up:
+                families["fscrypt_mountpoint_up"].append(
+                    ([("mountpoint", mountpoint)], int(up[mountpoint])))
+        lines = []
+        for name, metrics in families.items():
+            lines.append("# TYPE {} gauge".format(name))
+            lines += [_metric(name, labels, value)
+                      for labels, value in metrics]
+        lines += [
+            "# TYPE fscrypt_exporter_polls_total counter",
+            "fscrypt_exporter_polls_total {}".format(polls),
+            "# TYPE fscrypt_exporter_poll_duration_seconds gauge",
+            "fscrypt_exporter_poll_duration_seconds {:.9f}".format(
+                poll_seconds),
+            "# TYPE fscrypt_exporter_last_poll_timestamp_seconds gauge",
+            "fscrypt_exporter_last_poll_timestamp_seconds {:.3f}".format(
+                last_poll_time),
+        ]
+        return "\n".join(lines) + "\n"
+
+    def run(self, interval, stop_event):
+        """Polls every |interval| seconds until |stop_event| is set."""
+        while not stop_event.is_set():
+            self.poll()
+            stop_event.wait(interval)
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+
+def make_server(exporter, address, port):
+    """Creates an HTTP server that serves the exporter's metrics on /metrics.
+    The caller must call serve_forever() on it."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = exporter.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return http.server.ThreadingHTTPServer((address, port), Handler)
+
+
+def _parse_listen(value):
+    address, _, port = value.rpartition(":")
+    return address or "127.0.0.1", int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the status of fscrypt keys as Prometheus metrics.")
+    parser.add_argument("--listen", metavar="ADDRESS:PORT",
+                        default="127.0.0.1:{}".format(DEFAULT_PORT),
+                        help="address to serve /metrics on")
+    parser.add_argument("--interval", type=float, default=15.0,
+                        help="seconds between polls")
+    parser.add_argument("--key", action="append", default=[],
+                        dest="identifiers", metavar="KEY_IDENTIFIER",
+                        help="key identifier to poll (may be repeated)")
+    parser.add_argument("--no-discover", action="store_true",
+                        help="don't discover keys from encryption policies")
+    parser.add_argument("--discover-depth", type=int, default=1,
+                        help="how many directory levels to discover keys in")
+    parser.add_argument("--discover-interval", type=float, default=300.0,
+                        help="seconds between rediscoveries of the keys")
+    parser.add_argument("--once", action="store_true",
+                        help="poll once and print the metrics")
+    parser.add_argument("mountpoints", nargs="+", metavar="MOUNTPOINT")
+    args = parser.parse_args()
+    for identifier in args.identifiers:
+        try:
+            if len(bytes.fromhex(identifier)) != \
+                    fscrypt.FSCRYPT_KEY_IDENTIFIER_SIZE:
+                raise ValueError
+        except ValueError:
+            parser.error("invalid key identifier: " + identifier)
+
+    exporter = Exporter(args.mountpoints, args.identifiers,
+                        0 if args.no_discover else args.discover_depth,
+                        args.discover_interval)
+    try:
+        if args.once:
+            exporter.poll()
+            sys.stdout.write(exporter.render())
+            return
+        server = make_server(exporter, *_parse_listen(args.listen))
+        stop_event = threading.Event()
+        poller = threading.Thread(target=exporter.run,
+                                  args=(args.interval, stop_event),
+                                  daemon=True)
+        poller.start()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop_event.set()
+            server.server_close()
+            poller.join()
+    finally:
+        exporter.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Fuzzes the argument parsing and output formatting of fscryptctl in-process.
+
+This calls the parsing and formatting code of fscryptctl in libfscryptctl.so
+through fscrypt_lib.py, so it runs without executing a process per input.  Each
+iteration checks three kinds of input:
+
+  - a well-formed set_policy argument list, built from the real options with
+    both valid and invalid values.  It must parse to exactly the result that a
+    model of fscryptctl's documented behavior, written in Python, predicts.
+  - a malformed argument list: random tokens, abbreviated, misspelled, and
+    repeated options, values in separate arguments, "--", and random bytes.
+    Only invariants of the result are checked for these, for example that the
+    directories and the invalid argument reported are among the arguments.
+  - a random encryption policy and path, which get_policy's formatting must
+    render the same way as fscrypt.py does, and as valid JSON with --json.
+
+A sample of the argument lists (--cli-samples of them) is also run through
+the fscryptctl binary, with the directories pointing to a nonexistent path.
+Its error message, or the directories it tried to use, must match what the
+library returned.  The inputs that fail a check are printed, and the exit
+status is 1 if there were any.
+
+Usage: fscrypt_fuzz.py [--iterations=N] [--seed=N] [--cli-samples=N]
+                       [--jobs=N] [--fscryptctl=PATH]"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import fscrypt
+import fscrypt_lib
+
+# Directories passed to fscryptctl must not exist, so that it doesn't change
+# anything.
+NONEXISTENT_DIR = "/nonexistent-fscrypt-fuzz"
+
+_MODES = {name: mode for mode, name in fscrypt.MODE_NAMES.items()}
+_VALUE_OPTIONS = ["--contents", "--filenames", "--padding", "--data-unit-size",
+                  "--dirs-from"]
+_FLAG_OPTIONS = {
+    "--direct-key": fscrypt.FSCRYPT_POLICY_FLAG_DIRECT_KEY,
+    "--iv-ino-lblk-64": fscrypt.FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64,
+    "--iv-ino-lblk-32": fscrypt.FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32,
+}
+_NUMBERS = ["4", "8", "16", "32", "512", "4096", "65536", "1", "0", "-16", "3",
+            "48", "1073741824", " 16", "\t4096", "+8", "16x", "0x10", "010",
+            "4096 ", ""]
+_PARSE_ERRORS = ["invalid contents mode: ", "invalid filenames mode: ",
+                 "invalid padding: ", "invalid data unit size: ",
+                 "invalid key identifier: "]
+_MISSING_ARGS = "must specify a key and a directory"
+_ATOI_RE = re.compile(r"[ \t\n\v\f\r]*([+-]?[0-9]+)")
+
+
+def _atoi(value):
+    """Converts a string to an int like the C atoi() does, for values that fit
+    in an int."""
+    match = _ATOI_RE.match(value)
+    return int(match.group(1)) if match else 0
+
+
+def _random_bytes_string(rng, max_length=12):
+    # Arguments can't contain null bytes.
+    data = rng.randbytes(rng.randrange(max_length)).replace(b"\0", b"\1")
+    return os.fsdecode(data)
+
+
+def _mutate(rng, value):
+    choice = rng.randrange(5)
+    if choice == 0:
+        return value.lower()
+    if choice == 1:
+        return value[:rng.randrange(len(value) + 1)]
+    if choice == 2:
+        i = rng.randrange(len(value) + 1)
+        return value[:i] + rng.choice("-_ x0\xe9") + value[i:]
+    if choice == 3:
+        return value + value
+    return _random_bytes_string(rng)
+
+
+def _random_value(rng, option):
+    if option in ("--contents", "--filenames"):
+        value = rng.choice(list(_MODES))
+    elif option == "--dirs-from":
+        return "{}/list{}".format(NONEXISTENT_DIR, rng.randrange(10))
+    else:
+        value = rng.choice(_NUMBERS)
+    return _mutate(rng, value) if rng.random() < 0.2 else value
+
+
+def _random_hex(rng, num_bytes):
+    return "{:0{}x}".format(rng.getrandbits(8 * num_bytes), 2 * num_bytes)
+
+
+def _random_key(rng):
+    key = _random_hex(rng, fscrypt.FSCRYPT_KEY_IDENTIFIER_SIZE)
+    choice = rng.randrange(8)
+    if choice == 0:
+        return key.upper()
+    if choice == 1:
+        return _mutate(rng, key)
+    if choice == 2:
+        i = rng.randrange(len(key))
+        return key[:i] + rng.choice(" -+xg\n") + key[i + 1:]
+    return key
+
+
+def _random_dir(rng):
+    return "{}/dir{}".format(NONEXISTENT_DIR, rng.randrange(100))
+
+
+def structured_args(rng):
+    """Returns a random well-formed argument list for set_policy: options of
+    the form --name=value or --flag, then the key and directories, which may
+    be interleaved with the options."""
+    options = []
+    for _ in range(rng.randrange(5)):
+        if rng.random() < 0.3:
+            options.append(rng.choice(list(_FLAG_OPTIONS)))
+        else:
+            option = rng.choice(_VALUE_OPTIONS)
+            options.append("{}={}".format(option, _random_value(rng, option)))
+    # A key starting with "-" would be an option.
+    positional = [_random_key(rng).lstrip("-")] if rng.random() < 0.95 else []
+    positional += [_random_dir(rng) for _ in range(rng.randrange(4))]
+    args = []
+    while options or positional:
+        if positional and (not options or rng.random() < 0.3):
+            args.append(positional.pop(0))
+        else:
+            args.append(options.pop(0))
+    return args
+
+
+def random_args(rng):
+    """Returns a random, usually malformed, argument list for set_policy."""
+    args = []
+    for _ in range(rng.randrange(8)):
+        choice = rng.randrange(10)
+        option = rng.choice(_VALUE_OPTIONS + list(_FLAG_OPTIONS))
+        if choice == 0:
+            args.append(option[:rng.randrange(3, len(option) + 1)])
+        elif choice == 1:
+            args += [option, _random_value(rng, option)]
+        elif choice == 2:
+            args.append("{}={}".format(_mutate(rng, option),
+                                       _random_value(rng, option)))
+        elif choice == 3:
+            args.append(rng.choice(["--", "-", "-x", "---", "--=",
+                                    "-contents"]))
+        elif choice == 4:
+            args.append(_random_key(rng))
+        elif choice == 5:
+            args.append(_random_dir(rng))
+        elif choice == 6:
+            args.append(_random_bytes_string(rng))
+        else:
+            args.append("{}={}".format(option, _random_value(rng, option)))
+    return args
+
+
+def expected_set_policy(args):
+    """Returns the SetPolicyResult that fscryptctl_parse_set_policy() should
+    return for an argument list from structured_args()."""
+    contents = fscrypt.FSCRYPT_MODE_AES_256_XTS
+    filenames = fscrypt.FSCRYPT_MODE_AES_256_CTS
+    flags = fscrypt.FSCRYPT_POLICY_FLAGS_PAD_32
+    log2_data_unit_size = 0
+    dirs_from = None
+    iv_ino_lblk_32 = False
+    positional = []
+
+    def invalid(error):
+        return fscrypt_lib.SetPolicyResult(
+            fscrypt_lib.PARSE_INVALID, None, [], dirs_from, iv_ino_lblk_32,
+            error)
+
+    for arg in args:
+        if not arg.startswith("--"):
+            positional.append(arg)
+            continue
+        option, _, value = arg.partition("=")
+        if option == "--contents":
+            if value not in _MODES:
+                return invalid("invalid contents mode: " + value)
+            contents = _MODES[value]
+        elif option == "--filenames":
+            if value not in _MODES:
+                return invalid("invalid filenames mode: " + value)
+            filenames = _MODES[value]
+        elif option == "--padding":
+            if _atoi(value) not in fscrypt.PADDING_VALUES:
+                return invalid("invalid padding: " + value)
+            flags &= ~fscrypt.FSCRYPT_POLICY_FLAGS_PAD_MASK
+            flags |= fscrypt.PADDING_VALUES.index(_atoi(value))
+        elif option == "--data-unit-size":
+            size = _atoi(value)
+            if size <= 1 or size & (size - 1):
+                return invalid("invalid data unit size: " + value)
+            log2_data_unit_size = size.bit_length() - 1
+        elif option == "--dirs-from":
+            dirs_from = value
+        else:
+            flags |= _FLAG_OPTIONS[option]
+            if option == "--iv-ino-lblk-32":
+                iv_ino_lblk_32 = True
+    if len(positional) < (1 if dirs_from is not None else 2):
+        return invalid(_MISSING_ARGS)
+    key = os.fsencode(positional[0])
+    if len(key) != 2 * fscrypt.FSCRYPT_KEY_IDENTIFIER_SIZE or not all(
+            c in b"0123456789abcdefABCDEF" for c in key):
+        return invalid("invalid key identifier: " + positional[0])
+    policy = fscrypt.make_policy(key.decode().lower(), contents, filenames,
+                                 flags, log2_data_unit_size)
+    return fscrypt_lib.SetPolicyResult(fscrypt_lib.PARSE_OK, policy,
+                                       positional[1:], dirs_from,
+                                       iv_ino_lblk_32, None)
+
+
+def _is_from_args(value, args):
+    return any(arg == value or arg.endswith("=" + value) for arg in args)
+
+
+def check_invariants(args, result):
+    """Returns a list of the invariants that the result of parsing |args|
+    violates."""
+    problems = []
+    if result.status == fscrypt_lib.PARSE_OK:
+        policy = result.policy
+        if fscrypt_lib.mode_to_string(policy.contents_mode) is None or \
+                fscrypt_lib.mode_to_string(policy.filenames_mode) is None:
+            problems.append("invalid mode in policy")
+        if policy.flags & ~0x1f:
+            problems.append("invalid flags in policy")
+        if not any(arg.lower() == policy.key for arg in args):
+            problems.append("key identifier isn't an argument")
+        if not result.dirs and result.dirs_from is None:
+            problems.append("no directories")
+        if any(d not in args for d in result.dirs):
+            problems.append("directory isn't an argument")
+        if result.iv_ino_lblk_32 != bool(
+                policy.flags & fscrypt.FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32):
+            problems.append("--iv-ino-lblk-32 warning doesn't match flags")
+    elif result.status == fscrypt_lib.PARSE_INVALID:
+        prefix = next((p for p in _PARSE_ERRORS
+                       if result.error.startswith(p)), None)
+        if prefix is not None:
+            if not _is_from_args(result.error[len(prefix):], args):
+                problems.append("invalid argument isn't an argument")
+        elif result.error != _MISSING_ARGS:
+            problems.append("unknown error message")
+    elif result.status != fscrypt_lib.PARSE_USAGE:
+        problems.append("unknown status {}".format(result.status))
+    return problems
+
+
+def random_policy(rng):
+    version = rng.choice([1, 2, 2, 2])
+    key_size = fscrypt.FSCRYPT_KEY_DESCRIPTOR_SIZE if version == 1 else \
+        fscrypt.FSCRYPT_KEY_IDENTIFIER_SIZE
+    modes = list(fscrypt.MODE_NAMES) + [0, 255]
+    return fscrypt.Policy(version, _random_hex(rng, key_size),
+                          rng.choice(modes + [rng.randrange(256)]),
+                          rng.choice(modes + [rng.randrange(256)]),
+                          rng.randrange(256),
+                          0 if version == 1 else rng.randrange(32))
+
+
+def expected_policy_text(path, policy):
+    lines = ["Encryption policy for {}:".format(path),
+             "\tPolicy version: {}".format(policy.version)]
+    lines.append("\tMaster key {}: {}".format(
+        "descriptor" if policy.version == 1 else "identifier", policy.key))
+    lines.append("\tContents encryption mode: " +
+                 fscrypt.mode_name(policy.contents_mode))
+    lines.append("\tFilenames encryption mode: " +
+                 fscrypt.mode_name(policy.filenames_mode))
+    lines.append("\tFlags: " + fscrypt.flags_to_string(policy.flags))
+    if policy.version == 2:
+        lines.append("\tData unit size: {}".format(
+            fscrypt.data_unit_size(policy) or "default"))
+    return "\n".join(lines) + "\n"
+
+
+def check_formatting(path, policy):
+    """Returns a list of the ways in which the formatting of |policy| differs
+    from what is expected."""
+    problems = []
+    if fscrypt_lib.format_policy(path, policy) != \
+            expected_policy_text(path, policy):
+        problems.append("policy formatted incorrectly")
+    record = fscrypt_lib.format_policy(path, policy, json=True)
+    try:
+        decoded = json.loads(record)
+    except ValueError:
+        return problems + ["policy formatted as invalid JSON"]
+    key_name = "master_key_descriptor" if policy.version == 1 else \
+        "master_key_identifier"
+    expected = {"path": path, "version": policy.version, key_name: policy.key,
+                "contents_encryption_mode": policy.contents_mode,
+                "filenames_encryption_mode": policy.filenames_mode,
+                "flags": policy.flags,
+                "data_unit_size": fscrypt.data_unit_size(policy)}
+    if decoded != expected or not record.endswith("}\n"):
+        problems.append("policy formatted incorrectly as JSON")
+    return problems
+
+
+def _asks_for_help(args):
+    # fscryptctl looks for these before parsing the command's arguments.
+    for arg in args:
+        if arg == "--":
+            return False
+        if arg in ("-h", "--help", "-v", "--version"):
+            return True
+    return False
+
+
+def check_cli(fscryptctl, args, result, cwd):
+    """Runs "fscryptctl set_policy" with |args| in the empty directory |cwd|,
+    and returns a list of the ways in which its behavior differs from the
+    library's |result|."""
+    if _asks_for_help(args):
+        return []
+    proc = subprocess.run([fscryptctl, "set_policy"] + args, cwd=cwd,
+                          stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, check=False)
+    stdout = os.fsdecode(proc.stdout)
+    stderr = os.fsdecode(proc.stderr)
+    problems = []
+    if proc.returncode != 1:
+        problems.append("fscryptctl exited with {}".format(proc.returncode))
+    if ("warning: --iv-ino-lblk-32" in stdout) != result.iv_ino_lblk_32:
+        problems.append("fscryptctl's --iv-ino-lblk-32 warning differs")
+    if result.status == fscrypt_lib.PARSE_USAGE:
+        if "\nUsage:\n" not in stderr:
+            problems.append("fscryptctl didn't report invalid usage")
+    elif result.status == fscrypt_lib.PARSE_INVALID:
+        if stderr != "error: {}\n".format(result.error):
+            problems.append("fscryptctl reported {!r}".format(stderr))
+    else:
+        # Directory names may contain newlines, but the generated ones don't.
+        tried = [line[len("error: opening "):].rpartition(": ")[0]
+                 for line in stderr.splitlines()
+                 if line.startswith("error: opening ")]
+        expected = list(result.dirs)
+        if result.dirs_from is not None:
+            expected.append(result.dirs_from)
+        if tried != expected:
+            problems.append("fscryptctl opened {!r}".format(tried))
+    return problems
+
+
+def fuzz(iterations, seed=0, cli_samples=0, fscryptctl="fscryptctl"):
+    """Runs |iterations| iterations of the fuzzer with the random seed |seed|,
+    running |cli_samples| of the argument lists through |fscryptctl| too.
+    Returns a list of (input, problem) for the checks that failed."""
+    rng = random.Random(seed)
+    cli_every = iterations // cli_samples if cli_samples else 0
+    failures = []
+    with tempfile.TemporaryDirectory() as cwd:
+        for i in range(iterations):
+            args = structured_args(rng)
+            result = fscrypt_lib.parse_set_policy(args)
+            if result != expected_set_policy(args):
+                failures.append((args, "parsed as {}".format(result)))
+            problems = check_invariants(args, result)
+
+            other_args = random_args(rng)
+            other_result = fscrypt_lib.parse_set_policy(other_args)
+            problems += check_invariants(other_args, other_result)
+
+            if cli_every and i % cli_every == 0:
+                problems += check_cli(fscryptctl, args, result, cwd)
+                for problem in check_cli(fscryptctl, other_args,
+                                         other_result, cwd):
+                    failures.append((other_args, problem))
+            failures += [(args, problem) for problem in problems]
+
+            path = _random_bytes_string(rng, 40)
+            policy = random_policy(rng)
+            failures += [((path, policy), problem)
+                         for problem in check_formatting(path, policy)]
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fuzz the argument parsing of fscryptctl in-process.")
+    parser.add_argument("--iterations", "-n", type=int, default=100000,
+                        help="iterations per job (each checks 3 inputs)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed of the first job")
+    parser.add_argument("--cli-samples", type=int, default=100,
+                        help="argument lists per job to also run through "
+                        "fscryptctl")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="number of fuzzing processes")
+    parser.add_argument("--fscryptctl", default="fscryptctl",
+                        help="the fscryptctl binary")
+    args = parser.parse_args()
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+
+    try:
+        fscrypt_lib.load()
+    except OSError as e:
+        print("error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    start = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        jobs = [executor.submit(fuzz, args.iterations, seed + i,
+                                args.cli_samples, args.fscryptctl)
+                for i in range(args.jobs)]
+        failures = [failure for job in jobs for failure in job.result()]
+    elapsed = time.monotonic() - start
+    for failed_input, problem in failures:
+        print("{!r}: {}".format(failed_input, problem))
+    inputs = 3 * args.iterations * args.jobs
+    print("Checked {} inputs in {:.1f} seconds ({:.0f} per second), seed {}: "
+          "{} failures".format(inputs, elapsed, inputs / elapsed, seed,
+                               len(failures)))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Finds the processes that are keeping files in the given directories in-use.
+
+When "fscryptctl remove_key" reports that some files using the key are still
+in-use, the key can't be fully removed until these files are closed.  This
+scans the open file descriptors, current directories, and root directories of
+all processes (via /proc/PID/fd, /proc/PID/cwd, and /proc/PID/root) for paths
+under the given directories, and prints one line per match:
+
+    PID COMMAND HOW PATH
+
+where HOW is "cwd", "root", or the file descriptor number.  The processes are
+scanned by a pool of threads.  Processes owned by other users can only be
+scanned by root; the number of processes that couldn't be scanned is reported.
+The exit status is 0 if any holders were found and 1 otherwise.
+
+Usage: fscrypt_holders.py [--jobs=N] DIRECTORY..."""
+
+import argparse
+import collections
+import concurrent.futures
+import os
+import sys
+
+# A process which holds a file under one of the directories being checked.
+# |how| is "cwd", "root", or the file descriptor number as a string.
+Holder = collections.namedtuple("Holder", ["pid", "command", "how", "path"])
+
+
+def _is_under(path, directories):
+    return any(path == d or path.startswith(d.rstrip("/") + "/")
+               for d in directories)
+
+
+def _command(pid):
+    try:
+        with open("/proc/{}/comm".format(pid)) as f:
+            return f.read().strip()
+    except OSError:
+        return "?"
+
+
+def _scan_process(pid, directories):
+    """Returns the list of Holders for one process.  Raises PermissionError if
+    the process can't be inspected; processes that exit during the scan are
+    ignored."""
+    holders = []
+    links = [("cwd", "/proc/{}/cwd".format(pid)),
+             ("root", "/proc/{}/root".format(pid))]
+    fd_dir = "/proc/{}/fd".format(pid)
+    try:
+        links += [(fd, os.path.join(fd_dir, fd)) for fd in os.listdir(fd_dir)]
+    except FileNotFoundError:
+        return []
+    for how, link in links:
+        try:
+            path = os.readlink(link)
+        except FileNotFoundError:
+            continue
+        # Files that have been deleted are shown with a " (deleted)" suffix.
+        if path.endswith(" (deleted)"):
+            path = path[:-len(" (deleted)")]
+        # Skip the root directory unless it was changed with chroot.
+        if how == "root" and path == "/":
+            continue
+        if _is_under(path, directories):
+            holders.append(Holder(pid, _command(pid), how, path))
+    return holders
+
+
+def find_holders(directories, jobs=None):
+    """Scans all processes for open files, current directories, and root
+    directories under any of |directories|.  Returns (list of Holders sorted by
+    PID, number of processes that couldn't be scanned due to permissions)."""
+    directories = [os.path.realpath(d) for d in directories]
+    pids = sorted(int(name) for name in os.listdir("/proc") if name.isdigit())
+    holders = []
+    denied = 0
+    with concurrent.futures.ThreadPoolExecutor(
+            jobs or min(32, (os.cpu_count() or 1) * 4)) as executor:
+        futures = [executor.submit(_scan_process, pid, directories)
+                   for pid in pids]
+        for future in futures:
+            try:
+                holders += future.result()
+            except PermissionError:
+                denied += 1
+    return holders, denied
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the processes keeping files in directories in-use.")
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="number of worker threads")
+    parser.add_argument("directories", nargs="+", metavar="DIRECTORY")
+    args = parser.parse_args()
+
+    holders, denied = find_holders(args.directories, args.jobs)
+    for holder in holders:
+        print("{} {} {} {}".format(*holder))
+    if denied:
+        print("warning: couldn't scan {} processes (permission denied)".format(
+            denied), file=sys.stderr)
+    sys.exit(0 if holders else 1)
+
+
+if __name__ == "__main__":
+    main()
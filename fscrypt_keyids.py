@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Computes the key identifiers of many raw keys, without adding them to any
+filesystem.
+
+Each key is given by a reference.  By default, a reference is the path to a
+file containing the raw key in binary, as would be given to "fscryptctl
+add_key" on standard input.  With --hex, each reference is instead a line
+containing the raw key in hex, optionally followed by whitespace and a name for
+the key.  The name defaults to "#N", where N is the number of the line or
+argument that gave the key; the key itself is never printed.  References are
+taken from the command line, or if there are none, from standard input, one
+per line.  Blank references are ignored.
+
+For each key, a line "IDENTIFIER REFERENCE" is printed, or with --descriptors,
+"IDENTIFIER DESCRIPTOR REFERENCE".  The key identifiers are the ones that the
+kernel (and "fscryptctl add_key") assigns to the keys.  The work is spread over
+a pool of processes, and the output is in the same order as the input.
+
+Usage: fscrypt_keyids.py [--jobs=N] [--hex] [--descriptors] [--stats] [REF...]
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+import fscrypt
+
+# The number of keys that are handed to a worker process at a time
+CHUNK_SIZE = 512
+
+# The smallest and largest raw keys that the kernel accepts
+MIN_KEY_SIZE = 16
+MAX_KEY_SIZE = fscrypt.FSCRYPT_MAX_KEY_SIZE
+
+
+def read_key_file(path):
+    """Reads a raw key from a file.  Like fscryptctl add_key, this reads at most
+    one byte more than the largest valid key."""
+    with open(path, "rb", buffering=0) as f:
+        return f.read(MAX_KEY_SIZE + 1)
+
+
+def parse_hex_line(line, default_name):
+    """Parses a "HEXKEY [NAME]" line into (raw key, name)."""
+    fields = line.split(None, 1)
+    raw = bytes.fromhex(fields[0])
+    return raw, fields[1] if len(fields) > 1 else default_name
+
+
+def compute(ref, hex_input=False, descriptors=False, number=1):
+    """Computes the output line for one key reference, |number| being its
+    position in the input.  Returns (True, line) on success, (False, error
+    message) on failure, or None if the reference is blank."""
+    if not ref.strip():
+        return None
+    # A hex key is secret, so it is referred to by its position instead.
+    label = "#{}".format(number) if hex_input else ref
+    try:
+        if hex_input:
+            raw, name = parse_hex_line(ref, label)
+        else:
+            raw, name = read_key_file(ref), ref
+    except (OSError, ValueError) as e:
+        return False, "error: reading key {}: {}".format(label, e)
+    if not MIN_KEY_SIZE <= len(raw) <= MAX_KEY_SIZE:
+        return False, "error: key {} has invalid size {}".format(name, len(raw))
+    fields = [fscrypt.compute_key_identifier(raw)]
+    if descriptors:
+        fields.append(fscrypt.compute_key_descriptor(raw))
+    fields.append(name)
+    return True, " ".join(fields)
+
+
+def _compute_chunk(args):
+    refs, hex_input, descriptors = args
+    return [compute(ref, hex_input, descriptors, number)
+            for number, ref in refs]
+
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def compute_all(refs, hex_input=False, descriptors=False, jobs=None):
+    """Yields compute() results for each of |refs| in order, spreading the work
+    over |jobs| worker processes.  Inputs that fit in a single chunk are
+    processed in this process, since starting the pool would cost more than
+    the computation itself."""
+    jobs = jobs or os.cpu_count() or 1
+    chunks = _chunks(enumerate(refs, 1), CHUNK_SIZE)
+    first = next(chunks, [])
+    second = next(chunks, None)
+    if second is None:
+        yield from _compute_chunk((first, hex_input, descriptors))
+        return
+    tasks = ((chunk, hex_input, descriptors)
+             for chunk in itertools.chain([first, second], chunks))
+    if jobs == 1:
+        for task in tasks:
+            yield from _compute_chunk(task)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        for results in pool.imap(_compute_chunk, tasks):
+            yield from results
+
+
+def _read_refs(args):
+    if args.refs and args.refs != ["-"]:
+        return iter(args.refs)
+    return (line.rstrip("\n") for line in sys.stdin)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compute the key identifiers of raw fscrypt keys.")
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument("--hex", action="store_true",
+                        help="references are hex keys rather than key files")
+    parser.add_argument("--descriptors", action="store_true",
+                        help="also print the v1 key descriptors")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the number of keys per second to stderr")
+    parser.add_argument("refs", nargs="*", metavar="REF")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    count = 0
+    failed = False
+    for result in compute_all(_read_refs(args), args.hex, args.descriptors,
+                              args.jobs):
+        if result is None:
+            continue
+        ok, line = result
+        count += 1
+        if ok:
+            print(line)
+        else:
+            print(line, file=sys.stderr)
+            failed = True
+    if args.stats:
+        elapsed = time.monotonic() - start
+        print("{} keys in {:.3f} seconds ({:.0f} keys/sec)".format(
+            count, elapsed, count / elapsed if elapsed else 0),
+            file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Maintains an on-disk index from key identifiers to key files.
+
+The index maps both the v2 key identifier and the v1 key descriptor of each
+indexed key to the path of the file containing the raw key, so that the key
+needed to unlock a directory can be found from the directory's encryption
+policy without reading and hashing every candidate key file.  Only paths are
+stored in the index, never key material.
+
+The index file consists of a header, an array of fixed-size records sorted by
+key type and key identifier, and a table of the paths.  It is memory-mapped
+for lookups, which are a binary search.  Adding keys merges the new records
+into the array and atomically replaces the index file.
+
+Usage: fscrypt_keyindex.py INDEX add KEYFILE...
+       fscrypt_keyindex.py INDEX lookup KEY_IDENTIFIER
+       fscrypt_keyindex.py INDEX list
+       fscrypt_keyindex.py INDEX unlock DIRECTORY..."""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+
+import fscrypt
+import fscrypt_keyids
+
+MAGIC = b"FSCKIDX1"
+
+# magic, number of records, offset of the path table
+_HEADER = struct.Struct("<8sIQ4x")
+
+# key type (FSCRYPT_KEY_SPEC_TYPE_*), key (descriptors are zero-padded), path
+# length, path offset relative to the start of the path table
+_RECORD = struct.Struct("<B16sxHI")
+
+# The number of bytes of each record that it is sorted by
+_SORT_KEY_SIZE = 17
+
+
+def _sort_key(identifier):
+    """Converts a hex key descriptor or key identifier to the form that records
+    are sorted by."""
+    raw = bytes.fromhex(identifier)
+    if len(raw) == fscrypt.FSCRYPT_KEY_IDENTIFIER_SIZE:
+        key_type = fscrypt.FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER
+    elif len(raw) == fscrypt.FSCRYPT_KEY_DESCRIPTOR_SIZE:
+        key_type = fscrypt.FSCRYPT_KEY_SPEC_TYPE_DESCRIPTOR
+    else:
+        raise ValueError("invalid key identifier: " + identifier)
+    return bytes([key_type]) + raw.ljust(fscrypt.FSCRYPT_KEY_IDENTIFIER_SIZE,
+                                         b"\0")
+
+
+def _identifier(sort_key):
+    """The inverse of _sort_key()."""
+    if sort_key[0] == fscrypt.FSCRYPT_KEY_SPEC_TYPE_DESCRIPTOR:
+        return sort_key[1:1 + fscrypt.FSCRYPT_KEY_DESCRIPTOR_SIZE].hex()
+    return sort_key[1:].hex()
+
+
+class KeyIndex:
+    """A read-only view of an index file.  An empty index is used if the file
+    doesn't exist."""
+
+    def __init__(self, path):
+        self._map = None
+        self._count = 0
+        self._paths_offset = _HEADER.size
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    raise ValueError("{}: not a key index".format(path))
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+        if len(self._map) < _HEADER.size:
+            self.close()
+            raise ValueError("{}: not a key index".format(path))
+        magic, self._count, self._paths_offset = _HEADER.unpack_from(self._map)
+        if (magic != MAGIC or self._paths_offset !=
+                _HEADER.size + self._count * _RECORD.size or
+                self._paths_offset > len(self._map)):
+            self.close()
+            raise ValueError("{}: not a key index".format(path))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, i):
+        return _RECORD.unpack_from(self._map, _HEADER.size + i * _RECORD.size)
+
+    def _path(self, length, offset):
+        start = self._paths_offset + offset
+        return os.fsdecode(self._map[start:start + length])
+
+    def _find(self, sort_key):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = _HEADER.size + mid * _RECORD.size
+            if self._map[start:start + _SORT_KEY_SIZE] < sort_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, identifier):
+        """Returns the path of the key file for the given hex key identifier or
+        key descriptor, or None if it isn't in the index."""
+        sort_key = _sort_key(identifier)
+        i = self._find(sort_key)
+        if i == self._count:
+            return None
+        key_type, key, length, offset = self._record(i)
+        if bytes([key_type]) + key != sort_key:
+            return None
+        return self._path(length, offset)
+
+    def entries(self):
+        """Yields (hex identifier or descriptor, path) for every record, in
+        sorted order."""
+        for i in range(self._count):
+            key_type, key, length, offset = self._record(i)
+            yield _identifier(bytes([key_type]) + key), self._path(length,
+                                                                   offset)
+
+
+def _write_index(path, entries):
+    """Writes an index file containing the given sorted (sort key, path bytes)
+    entries, replacing any existing file atomically."""
+    records = bytearray()
+    paths = bytearray()
+    for sort_key, path_bytes in entries:
+        records += _RECORD.pack(sort_key[0], sort_key[1:], len(path_bytes),
+                                len(paths))
+        paths += path_bytes
+    tmp_path = "{}.tmp.{}".format(path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC,
+                 0o600)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, len(records) // _RECORD.size,
+                                 _HEADER.size + len(records)))
+            f.write(records)
+            f.write(paths)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def add_keys(index_path, key_files, jobs=None):
+    """Adds the given key files to the index, creating it if needed.  A key
+    that is already indexed is updated to point to the new file.  Returns a list
+    of error messages for key files that couldn't be added."""
+    new = {}
+    errors = []
+    key_files = [os.path.abspath(key_file) for key_file in key_files]
+    for ok, line in fscrypt_keyids.compute_all(key_files, descriptors=True,
+                                               jobs=jobs):
+        if not ok:
+            errors.append(line)
+            continue
+        identifier, descriptor, key_file = line.split(" ", 2)
+        path_bytes = os.fsencode(key_file)
+        if len(path_bytes) > 0xffff:
+            errors.append("error: path too long: " + key_file)
+            continue
+        new[_sort_key(identifier)] = path_bytes
+        new[_sort_key(descriptor)] = path_bytes
+    with KeyIndex(index_path) as index:
+        entries = {_sort_key(identifier): os.fsencode(path)
+                   for identifier, path in index.entries()}
+    entries.update(new)
+    _write_index(index_path, sorted(entries.items()))
+    return errors
+
+
+def unlock(directory, index_path):
+    """Adds the key needed by the encrypted directory |directory| to its
+    filesystem, finding the key file using the index.  Returns the key
+    identifier.  Raises KeyError if the key isn't indexed."""
+    policy = fscrypt.get_policy(directory)
+    if policy.version != 2:
+        raise ValueError("{}: v1 encryption policies are not supported".format(
+            directory))
+    with KeyIndex(index_path) as index:
+        key_file = index.lookup(policy.key)
+    if key_file is None:
+        raise KeyError(policy.key)
+    raw = bytearray(fscrypt_keyids.read_key_file(key_file))
+    try:
+        identifier = fscrypt.add_key(directory, bytes(raw))
+    finally:
+        raw[:] = bytes(len(raw))
+    if identifier != policy.key:
+        raise ValueError("{}: key file {} has identifier {}, not {}".format(
+            directory, key_file, identifier, policy.key))
+    return identifier
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Maintain an index from key identifiers to key files.")
+    parser.add_argument("index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser("add", help="add key files")
+    add_parser.add_argument("--jobs", "-j", type=int, default=None,
+                            help="number of worker processes")
+    add_parser.add_argument("key_files", nargs="+", metavar="KEYFILE")
+    lookup_parser = subparsers.add_parser(
+        "lookup", help="print the key file for a key identifier")
+    lookup_parser.add_argument("identifier")
+    subparsers.add_parser("list", help="list the indexed keys")
+    unlock_parser = subparsers.add_parser(
+        "unlock", help="add the keys needed by encrypted directories")
+    unlock_parser.add_argument("directories", nargs="+", metavar="DIRECTORY")
+    args = parser.parse_args()
+
+    if args.command == "lookup":
+        try:
+            _sort_key(args.identifier)
+        except ValueError:
+            print("error: invalid key identifier: {}".format(args.identifier),
+                  file=sys.stderr)
+            sys.exit(1)
+
+    status = 0
+    try:
+        if args.command == "add":
+            for error in add_keys(args.index, args.key_files, args.jobs):
+                print(error, file=sys.stderr)
+                status = 1
+        elif args.command == "lookup":
+            with KeyIndex(args.index) as index:
+                key_file = index.lookup(args.identifier)
+            if key_file is None:
+                print("error: key not found in index", file=sys.stderr)
+                status = 1
+            else:
+                print(key_file)
+        elif args.command == "list":
+            with KeyIndex(args.index) as index:
+                for identifier, key_file in index.entries():
+                    print(identifier, key_file)
+        else:
+            for directory in args.directories:
+                try:
+                    print(unlock(directory, args.index))
+                except KeyError as e:
+                    print("error: {}: key {} not found in index".format(
+                        directory, e.args[0]), file=sys.stderr)
+                    status = 1
+                except (OSError, ValueError) as e:
+                    print("error: {}".format(e), file=sys.stderr)
+                    status = 1
+    except (OSError, ValueError) as e:
+        # The index couldn't be read or written.
+        print("error: {}".format(e), file=sys.stderr)
+        status = 1
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Python bindings for libfscryptctl.so.
+
+libfscryptctl.so contains the argument parsing and output formatting code of
+fscryptctl (see libfscryptctl.h), built as a shared library with "make
+libfscryptctl.so".  Calling it in-process with ctypes is several orders of
+magnitude faster than executing fscryptctl, which is what makes fuzzing it with
+fscrypt_fuzz.py practical.
+
+The library is looked for in $LIBFSCRYPTCTL if set, otherwise next to this
+file, and is loaded on first use.  Arguments may be given as str or bytes;
+strings returned by the library are decoded with os.fsdecode()."""
+
+import collections
+import ctypes
+import os
+import threading
+
+import fscrypt
+
+# Return values of fscryptctl_parse_set_policy()
+PARSE_OK = 0
+PARSE_USAGE = 1
+PARSE_INVALID = 2
+
+
+class fscryptctl_set_policy_args(ctypes.Structure):
+    _fields_ = [
+        ("policy", fscrypt.fscrypt_policy_v2),
+        ("dirs_from", ctypes.c_char_p),
+        ("first_dir", ctypes.c_int),
+        ("num_dirs", ctypes.c_int),
+        ("iv_ino_lblk_32", ctypes.c_bool),
+        ("error", ctypes.c_char_p),
+        ("error_arg", ctypes.c_char_p),
+    ]
+
+
+# The result of parse_set_policy().  |policy| is a fscrypt.Policy and |dirs|
+# the list of directories if |status| is PARSE_OK, and |error| is the message
+# that fscryptctl prints (after "error: ") if it is PARSE_INVALID.
+SetPolicyResult = collections.namedtuple("SetPolicyResult", [
+    "status", "policy", "dirs", "dirs_from", "iv_ino_lblk_32", "error"])
+
+_lib = None
+_lib_lock = threading.Lock()
+# getopt keeps its state in global variables, so parsing isn't thread-safe.
+_getopt_lock = threading.Lock()
+
+
+def library_path():
+    return os.environ.get("LIBFSCRYPTCTL") or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "libfscryptctl.so")
+
+
+def _declare(lib, name, restype, *argtypes):
+    func = getattr(lib, "fscryptctl_" + name)
+    func.restype = restype
+    func.argtypes = argtypes
+
+
+def load():
+    """Loads libfscryptctl.so, if it hasn't been loaded already, and returns
+    it.  Raises OSError if it can't be loaded.  getopt's own error messages
+    are turned off, since they would be printed for every invalid input."""
+    global _lib
+    with _lib_lock:
+        if _lib is not None:
+            return _lib
+        lib = ctypes.CDLL(library_path())
+        u8p = ctypes.POINTER(ctypes.c_uint8)
+        _declare(lib, "string_to_mode", ctypes.c_bool, ctypes.c_char_p, u8p)
+        _declare(lib, "mode_to_string", ctypes.c_char_p, ctypes.c_uint8)
+        _declare(lib, "string_to_padding_flag", ctypes.c_int, ctypes.c_char_p)
+        _declare(lib, "parse_data_unit_size", ctypes.c_bool, ctypes.c_char_p,
+                 u8p)
+        _declare(lib, "bytes_to_hex", None, ctypes.c_char_p, ctypes.c_size_t,
+                 ctypes.c_char_p)
+        _declare(lib, "hex_to_bytes", ctypes.c_bool, ctypes.c_char_p,
+                 ctypes.c_char_p, ctypes.c_size_t)
+        _declare(lib, "build_key_specifier", ctypes.c_bool, ctypes.c_char_p,
+                 ctypes.POINTER(fscrypt.fscrypt_key_specifier))
+        _declare(lib, "parse_set_policy", ctypes.c_int, ctypes.c_int,
+                 ctypes.POINTER(ctypes.c_char_p),
+                 ctypes.POINTER(fscryptctl_set_policy_args))
+        _declare(lib, "format_policy_flags", ctypes.c_size_t, ctypes.c_uint8,
+                 ctypes.c_char_p, ctypes.c_size_t)
+        _declare(lib, "format_json_string", ctypes.c_size_t, ctypes.c_char_p,
+                 ctypes.c_char_p, ctypes.c_size_t)
+        _declare(lib, "format_policy", ctypes.c_size_t, ctypes.c_char_p,
+                 ctypes.POINTER(fscrypt.fscrypt_get_policy_ex_arg),
+                 ctypes.c_bool, ctypes.c_char_p, ctypes.c_size_t)
+        ctypes.c_int.in_dll(ctypes.CDLL(None), "opterr").value = 0
+        _lib = lib
+        return lib
+
+
+def _decode(value):
+    return None if value is None else os.fsdecode(value)
+
+
+def string_to_mode(name):
+    """Returns the encryption mode number named |name|, or None."""
+    mode = ctypes.c_uint8()
+    if not load().fscryptctl_string_to_mode(os.fsencode(name),
+                                            ctypes.byref(mode)):
+        return None
+    return mode.value
+
+
+def mode_to_string(mode):
+    """Returns the name of the encryption mode number |mode|, or None."""
+    return _decode(load().fscryptctl_mode_to_string(mode))
+
+
+def string_to_padding_flag(value):
+    """Returns the padding flag for the amount of padding |value|, or -1."""
+    return load().fscryptctl_string_to_padding_flag(os.fsencode(value))
+
+
+def parse_data_unit_size(value):
+    """Returns the log2 of the data unit size |value|, or None if invalid."""
+    bits = ctypes.c_uint8()
+    if not load().fscryptctl_parse_data_unit_size(os.fsencode(value),
+                                                  ctypes.byref(bits)):
+        return None
+    return bits.value
+
+
+def bytes_to_hex(data):
+    buf = ctypes.create_string_buffer(2 * len(data) + 1)
+    load().fscryptctl_bytes_to_hex(data, len(data), buf)
+    return buf.value.decode()
+
+
+def hex_to_bytes(value, num_bytes):
+    """Returns the |num_bytes| bytes encoded in hex by |value|, or None."""
+    buf = ctypes.create_string_buffer(num_bytes)
+    if not load().fscryptctl_hex_to_bytes(os.fsencode(value), buf, num_bytes):
+        return None
+    return buf.raw
+
+
+def build_key_specifier(identifier):
+    """Returns the fscrypt.fscrypt_key_specifier for the hex key identifier
+    |identifier|, or None if it is invalid."""
+    key_spec = fscrypt.fscrypt_key_specifier()
+    if not load().fscryptctl_build_key_specifier(os.fsencode(identifier),
+                                                 ctypes.byref(key_spec)):
+        return None
+    return key_spec
+
+
+def parse_set_policy(args):
+    """Parses the arguments |args| of "fscryptctl set_policy" (not including
+    the command name).  Returns a SetPolicyResult."""
+    lib = load()
+    encoded = [b"set_policy"] + [os.fsencode(arg) for arg in args]
+    argv = (ctypes.c_char_p * (len(encoded) + 1))(*encoded)
+    result = fscryptctl_set_policy_args()
+    with _getopt_lock:
+        status = lib.fscryptctl_parse_set_policy(len(encoded), argv,
+                                                 ctypes.byref(result))
+    policy = None
+    dirs = []
+    error = None
+    if status == PARSE_OK:
+        p = result.policy
+        policy = fscrypt.Policy(
+            2, bytes(p.master_key_identifier).hex(),
+            p.contents_encryption_mode, p.filenames_encryption_mode, p.flags,
+            p.log2_data_unit_size)
+        # getopt_long() may have permuted argv, so read the directories back
+        # from it rather than from |args|.
+        dirs = [os.fsdecode(argv[i]) for i in range(
+            result.first_dir, result.first_dir + result.num_dirs)]
+    elif status == PARSE_INVALID:
+        error = os.fsdecode(result.error)
+        if result.error_arg is not None:
+            error += ": " + os.fsdecode(result.error_arg)
+    return SetPolicyResult(status, policy, dirs, _decode(result.dirs_from),
+                           result.iv_ino_lblk_32, error)
+
+
+def _format(func, *args):
+    buf = ctypes.create_string_buffer(256)
+    length = func(*args, buf, len(buf))
+    if length >= len(buf):
+        buf = ctypes.create_string_buffer(length + 1)
+        func(*args, buf, len(buf))
+    return os.fsdecode(buf.value)
+
+
+def format_policy_flags(flags):
+    """Formats policy flags like fscryptctl, for example "PAD_32, DIRECT_KEY".
+    """
+    return _format(load().fscryptctl_format_policy_flags, flags)
+
+
+def format_json_string(value):
+    return _format(load().fscryptctl_format_json_string, os.fsencode(value))
+
+
+def format_policy(path, policy, json=False):
+    """Formats the fscrypt.Policy |policy| of |path| the way "fscryptctl
+    get_policy" prints it, or as with --json if |json|."""
+    arg = fscrypt.fscrypt_get_policy_ex_arg()
+    if policy.version == 1:
+        p = arg.policy.v1
+        p.version = fscrypt.FSCRYPT_POLICY_V1
+        p.master_key_descriptor[:] = bytes.fromhex(policy.key)
+    else:
+        p = arg.policy.v2
+        p.version = policy.version
+        p.log2_data_unit_size = policy.log2_data_unit_size
+        p.master_key_identifier[:] = bytes.fromhex(policy.key)
+    p.contents_encryption_mode = policy.contents_mode
+    p.filenames_encryption_mode = policy.filenames_mode
+    p.flags = policy.flags
+    return _format(load().fscryptctl_format_policy, os.fsencode(path),
+                   ctypes.byref(arg), json)
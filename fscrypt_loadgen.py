@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Generates a metadata-heavy load in encrypted directories.
+
+For each filenames encryption mode (--filenames, by default AES-256-CTS,
+AES-256-HCTR2 and Adiantum) and each amount of filename padding (--padding,
+by default 4, 8, 16 and 32 bytes), a temporary directory is created in the
+given directory and encrypted with that policy, using a randomly generated key.
+An unencrypted directory is used too, as a baseline.  Each directory gets one
+subdirectory per thread (--threads), which is populated with --files files
+whose names have random lengths between --min-name-length and
+--max-name-length.
+
+Then each thread runs a random mix of operations (--mix) on the files in its
+subdirectory: "create" creates a new empty file, "lookup" stats a file,
+"readdir" lists the subdirectory, "unlink" deletes a file, and "rename" renames
+a file to a new name.  --ops operations are run in each directory in total,
+and the throughput and latency percentiles of each operation are reported.
+
+This is done first with the key present ("unlocked"), then again after the key
+has been removed ("locked"), in which case the files are listed and looked up
+by their no-key names.  Files can't be created in a locked directory, so only
+the lookup and readdir operations of the mix are run in that state.
+
+Policies that the kernel rejects are skipped.  Like with fscrypt_advisor.py,
+the policies that are unsupported are looked up in the capability cache of
+fscrypt_caps.py, unless --no-caps-cache is given.
+
+Usage: fscrypt_loadgen.py [--filenames=MODE]... [--padding=N]...
+                          [--threads=N] [--files=N] [--ops=N] [--mix=MIX]
+                          [--min-name-length=N] [--max-name-length=N]
+                          [--state=STATE]... [--json=FILE] [--no-caps-cache]
+                          DIRECTORY"""
+
+import argparse
+import collections
+import concurrent.futures
+import errno
+import json
+import math
+import os
+import random
+import shutil
+import string
+import sys
+import time
+
+import fscrypt
+import fscrypt_caps
+
+# The contents encryption mode that each filenames encryption mode is used with
+CONTENTS_MODES = {
+    fscrypt.FSCRYPT_MODE_AES_256_CTS: fscrypt.FSCRYPT_MODE_AES_256_XTS,
+    fscrypt.FSCRYPT_MODE_AES_256_HCTR2: fscrypt.FSCRYPT_MODE_AES_256_XTS,
+    fscrypt.FSCRYPT_MODE_AES_128_CTS: fscrypt.FSCRYPT_MODE_AES_128_CBC,
+    fscrypt.FSCRYPT_MODE_SM4_CTS: fscrypt.FSCRYPT_MODE_SM4_XTS,
+    fscrypt.FSCRYPT_MODE_ADIANTUM: fscrypt.FSCRYPT_MODE_ADIANTUM,
+}
+
+DEFAULT_FILENAMES_MODES = [fscrypt.FSCRYPT_MODE_AES_256_CTS,
+                           fscrypt.FSCRYPT_MODE_AES_256_HCTR2,
+                           fscrypt.FSCRYPT_MODE_ADIANTUM]
+
+OPERATIONS = ["create", "lookup", "readdir", "unlink", "rename"]
+
+# The operations that can be run in a locked directory
+LOCKED_OPERATIONS = ["lookup", "readdir"]
+
+STATES = ["unlocked", "locked"]
+
+DEFAULT_MIX = {"create": 1, "lookup": 4, "readdir": 1, "unlink": 1,
+               "rename": 1}
+
+NAME_CHARS = string.ascii_letters + string.digits + "_-"
+
+# A configuration to measure: a short name, and the arguments to
+# fscrypt.make_policy() (or None for the unencrypted baseline)
+Configuration = collections.namedtuple("Configuration", ["name",
+                                                         "policy_args"])
+
+# The results of one operation in one run: the number of times it was run,
+# its throughput (the count divided by the wall time of the whole run), and
+# its latency percentiles, in seconds
+OpStats = collections.namedtuple("OpStats", [
+    "count", "ops_per_sec", "p50", "p90", "p99", "max"])
+
+
+def configurations(filenames_modes=None, paddings=None):
+    """Returns the unencrypted baseline and a Configuration for each
+    combination of the given filenames encryption modes and amounts of
+    padding."""
+    configs = [Configuration("unencrypted", None)]
+    for mode in filenames_modes or DEFAULT_FILENAMES_MODES:
+        for padding in paddings or fscrypt.PADDING_VALUES:
+            configs.append(Configuration(
+                "{},padding={}".format(fscrypt.mode_name(mode), padding), {
+                    "contents_mode": CONTENTS_MODES[mode],
+                    "filenames_mode": mode,
+                    "flags": fscrypt.PADDING_VALUES.index(padding)}))
+    return configs
+
+
+def parse_mix(value):
+    """Parses a mix of operations like "create=1,lookup=4" into a dict from
+    operation to relative weight.  Raises ValueError if it is invalid."""
+    mix = {}
+    for item in value.split(","):
+        operation, _, weight = item.partition("=")
+        if operation not in OPERATIONS:
+            raise ValueError("unknown operation: " + operation)
+        mix[operation] = float(weight) if weight else 1.0
+        if mix[operation] < 0 or not math.isfinite(mix[operation]):
+            raise ValueError("invalid weight: " + weight)
+    if not any(mix.values()):
+        raise ValueError("the mix has no operations")
+    return mix
+
+
+def locked_mix(mix):
+    """Returns the part of |mix| that can be run in a locked directory, or None
+    if it has no operations with a positive weight."""
+    mix = {operation: weight for operation, weight in mix.items()
+           if operation in LOCKED_OPERATIONS}
+    return mix if any(mix.values()) else None
+
+
+def _percentile(sorted_samples, fraction):
+    rank = max(1, math.ceil(len(sorted_samples) * fraction))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def _summarize(samples, seconds):
+    samples = sorted(samples)
+    return OpStats(len(samples), len(samples) / seconds if seconds else 0.0,
+                   _percentile(samples, 0.50), _percentile(samples, 0.90),
+                   _percentile(samples, 0.99), samples[-1])
+
+
+class _Worker:
+    """Runs operations on the files in one subdirectory, which no other thread
+    uses, so that the list of filenames needs no locking."""
+
+    def __init__(self, directory, num_files, name_lengths, seed):
+        self.directory = directory
+        self.num_files = num_files
+        self.name_lengths = name_lengths
+        self.rng = random.Random(seed)
+        self.names = []
+        self.next_id = 0
+
+    def _new_name(self):
+        """Returns a new unique filename with a random length.  Names that are
+        too short to be unique are lengthened as needed."""
+        prefix = "{:x}.".format(self.next_id)
+        self.next_id += 1
+        length = self.rng.randint(*self.name_lengths) - len(prefix)
+        return prefix + "".join(self.rng.choice(NAME_CHARS)
+                                for _ in range(max(0, length)))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def populate(self):
+        os.mkdir(self.directory)
+        for _ in range(self.num_files):
+            name = self._new_name()
+            os.close(os.open(self._path(name), os.O_WRONLY | os.O_CREAT |
+                             os.O_EXCL | os.O_CLOEXEC, 0o600))
+            self.names.append(name)
+
+    def create(self):
+        name = self._new_name()
+        path = self._path(name)
+        start = time.perf_counter()
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         os.O_CLOEXEC, 0o600))
+        elapsed = time.perf_counter() - start
+        self.names.append(name)
+        return elapsed
+
+    def lookup(self):
+        path = self._path(self.rng.choice(self.names))
+        start = time.perf_counter()
+        os.lstat(path)
+        return time.perf_counter() - start
+
+    def readdir(self):
+        start = time.perf_counter()
+        with os.scandir(self.directory) as it:
+            for _ in it:
+                pass
+        return time.perf_counter() - start
+
+    def _take_name(self):
+        i = self.rng.randrange(len(self.names))
+        name = self.names[i]
+        self.names[i] = self.names[-1]
+        self.names.pop()
+        return name
+
+    def unlink(self):
+        path = self._path(self._take_name())
+        start = time.perf_counter()
+        os.unlink(path)
+        return time.perf_counter() - start
+
+    def rename(self):
+        old_path = self._path(self._take_name())
+        name = self._new_name()
+        new_path = self._path(name)
+        start = time.perf_counter()
+        os.rename(old_path, new_path)
+        elapsed = time.perf_counter() - start
+        self.names.append(name)
+        return elapsed
+
+    def run(self, mix, num_ops, locked):
+        """Runs |num_ops| operations chosen randomly according to |mix|.  When
+        the directory is locked, the files are looked up by the no-key names
+        that it is listed with.  Returns a dict from operation to the list of
+        latencies."""
+        if locked:
+            self.names = os.listdir(self.directory)
+        operations = list(mix)
+        weights = [mix[operation] for operation in operations]
+        latencies = collections.defaultdict(list)
+        for operation in self.rng.choices(operations, weights, k=num_ops):
+            # Files can't be looked up, deleted or renamed if there are none.
+            if not self.names and operation != "readdir":
+                operation = "readdir" if locked else "create"
+            latencies[operation].append(getattr(self, operation)())
+        return latencies
+
+
+class _Load:
+    """The worker threads of one configuration."""
+
+    def __init__(self, directory, threads, files, name_lengths, seed):
+        self.directory = directory
+        self.workers = [
+            _Worker(os.path.join(directory, "t{}".format(i)),
+                    files // threads + (i < files % threads), name_lengths,
+                    seed + i) for i in range(threads)]
+
+    def populate(self):
+        for worker in self.workers:
+            worker.populate()
+
+    def run(self, executor, mix, num_ops, locked):
+        """Runs |num_ops| operations in total, split between the workers.
+        Returns a dict from operation (and "all") to OpStats."""
+        if locked:
+            mix = locked_mix(mix)
+            # The names of the subdirectories are encrypted too, so they have
+            # to be found by listing the directory.  Which worker gets which
+            # subdirectory doesn't matter.
+            for worker, name in zip(self.workers,
+                                    sorted(os.listdir(self.directory))):
+                worker.directory = os.path.join(self.directory, name)
+        threads = len(self.workers)
+        start = time.perf_counter()
+        futures = [executor.submit(worker.run, mix, num_ops // threads +
+                                   (i < num_ops % threads), locked)
+                   for i, worker in enumerate(self.workers)]
+        results = [future.result() for future in futures]
+        seconds = time.perf_counter() - start
+        latencies = collections.defaultdict(list)
+        for result in results:
+            for operation, samples in result.items():
+                latencies[operation] += samples
+        stats = {operation: _summarize(latencies[operation], seconds)
+                 for operation in OPERATIONS if latencies[operation]}
+        all_samples = [t for samples in latencies.values() for t in samples]
+        if all_samples:
+            stats["all"] = _summarize(all_samples, seconds)
+        return stats
+
+
+def _prepare_directory(path, key_identifier, config):
+    """Creates the directory for a configuration and encrypts it.  Raises
+    OSError if the kernel rejects the policy, including if it is accepted by
+    set_policy but files can't actually be created with it."""
+    os.mkdir(path)
+    if config.policy_args is None:
+        return
+    fscrypt.set_policy(path, fscrypt.make_policy(key_identifier,
+                                                 **config.policy_args))
+    probe = os.path.join(path, "probe")
+    os.close(os.open(probe, os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o600))
+    os.remove(probe)
+
+
+def _skip_reason(e):
+    if e.errno == errno.EINVAL:
+        return "not supported by the kernel or filesystem"
+    if e.errno == errno.ENOPKG:
+        return "algorithm not available in the kernel's crypto API"
+    return e.strerror or str(e)
+
+
+def _known_skip_reason(capabilities, config):
+    if capabilities is None or config.policy_args is None:
+        return None
+    try:
+        return fscrypt_caps.unsupported_reason(
+            capabilities, fscrypt.make_policy("", **config.policy_args))
+    except KeyError:
+        return None
+
+
+def run(directory, configs=None, mix=None, states=None, threads=4,
+        files=1000, ops=10000, name_lengths=(1, 255), seed=0, log=None,
+        capabilities=None):
+    """Generates the load for each Configuration in a temporary subdirectory of
+    |directory|, first in each unlocked directory and then in each locked
+    directory (if those states are requested, and for the locked state, if
+    |mix| contains lookup or readdir operations).  Returns a list of
+    (Configuration, dict from state to the dict of OpStats returned by
+    _Load.run(), or a string giving the reason the configuration was
+    skipped)."""
+    configs = configs or configurations()
+    mix = mix or DEFAULT_MIX
+    states = states or STATES
+    if "locked" in states and locked_mix(mix) is None:
+        if log:
+            log("locked: skipped (the mix has no lookup or readdir "
+                "operations)")
+        states = [state for state in states if state != "locked"]
+    raw_key = os.urandom(fscrypt.FSCRYPT_MAX_KEY_SIZE)
+    key_identifier = fscrypt.add_key(directory, raw_key)
+    key_present = True
+    results = []
+    paths = []
+    loads = {}
+    try:
+        for i, config in enumerate(configs):
+            path = os.path.join(directory, "fscrypt_loadgen.{}.{}".format(
+                os.getpid(), i))
+            reason = _known_skip_reason(capabilities, config)
+            if reason is None:
+                paths.append(path)
+                try:
+                    _prepare_directory(path, key_identifier, config)
+                except OSError as e:
+                    reason = _skip_reason(e)
+            if reason is None:
+                loads[i] = _Load(path, threads, files, name_lengths, seed)
+                loads[i].populate()
+            results.append((config, {} if reason is None else reason))
+            if reason is not None and log:
+                log("{}: skipped ({})".format(config.name, reason))
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            for state in STATES:
+                if state not in states:
+                    continue
+                if state == "locked":
+                    # Removing the key locks all the encrypted directories.
+                    if fscrypt.remove_key(key_identifier, directory):
+                        print("warning: the key was only partially removed, "
+                              "so some files are still unlocked",
+                              file=sys.stderr)
+                    key_present = False
+                for i, load in loads.items():
+                    config, r = results[i]
+                    r[state] = load.run(executor, mix, ops, state == "locked")
+                    if log:
+                        log("{} ({}): done".format(config.name, state))
+    finally:
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+        if key_present:
+            fscrypt.remove_key(key_identifier, directory)
+    return results
+
+
+def results_to_json(results, mix, threads, files, ops, name_lengths):
+    """Converts the results of run() to a JSON-serializable dict.  Latencies
+    are in microseconds."""
+    out = {"kernel": os.uname().release, "mix": mix, "threads": threads,
+           "files": files, "ops": ops, "name_lengths": list(name_lengths),
+           "configurations": []}
+    for config, r in results:
+        entry = {"name": config.name, "policy": config.policy_args}
+        if isinstance(r, str):
+            entry["skipped"] = r
+        else:
+            entry["states"] = {
+                state: {operation: {
+                    "count": stats.count,
+                    "ops_per_sec": stats.ops_per_sec,
+                    "p50_us": stats.p50 * 1e6,
+                    "p90_us": stats.p90 * 1e6,
+                    "p99_us": stats.p99 * 1e6,
+                    "max_us": stats.max * 1e6,
+                } for operation, stats in by_operation.items()}
+                for state, by_operation in r.items()}
+        out["configurations"].append(entry)
+    return out
+
+
+def print_results(results, out=sys.stdout):
+    """Prints a table of the results of each state, comparing the p50 latency
+    of each operation against the unencrypted baseline."""
+    baseline = next((r for config, r in results
+                     if config.policy_args is None and
+                     not isinstance(r, str)), {})
+    name_width = max([len("configuration")] +
+                     [len(config.name) for config, _ in results])
+    for state in STATES:
+        rows = [(config, r[state]) for config, r in results
+                if not isinstance(r, str) and state in r]
+        if not rows:
+            continue
+        print("{}:".format(state), file=out)
+        print("  {:<{}} {:<9} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            "configuration", name_width, "operation", "ops/sec", "p50 (us)",
+            "p90 (us)", "p99 (us)", "max (us)", "p50 vs"), file=out)
+        for config, by_operation in rows:
+            for operation, stats in by_operation.items():
+                line = ("  {:<{}} {:<9} {:>10.0f} {:>9.1f} {:>9.1f} {:>9.1f} "
+                        "{:>9.1f}").format(
+                            config.name, name_width, operation,
+                            stats.ops_per_sec, stats.p50 * 1e6,
+                            stats.p90 * 1e6, stats.p99 * 1e6, stats.max * 1e6)
+                base = baseline.get(state, {}).get(operation)
+                if base and base.p50:
+                    line += " {:>8.2f}x".format(stats.p50 / base.p50)
+                print(line, file=out)
+    skipped = [(config, r) for config, r in results if isinstance(r, str)]
+    if skipped:
+        print("skipped:", file=out)
+        for config, reason in skipped:
+            print("  {}: {}".format(config.name, reason), file=out)
+
+
+def _filenames_mode(value):
+    modes = {fscrypt.mode_name(mode): mode for mode in CONTENTS_MODES}
+    try:
+        return modes[value]
+    except KeyError:
+        raise argparse.ArgumentTypeError(
+            "invalid filenames mode: {} (choose from {})".format(
+                value, ", ".join(modes))) from None
+
+
+def _mix(value):
+    try:
+        return parse_mix(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a metadata-heavy load in encrypted directories.")
+    parser.add_argument("--filenames", action="append", type=_filenames_mode,
+                        help="filenames encryption mode (may be repeated; "
+                        "default: AES-256-CTS, AES-256-HCTR2 and Adiantum)")
+    parser.add_argument("--padding", action="append", type=int,
+                        choices=fscrypt.PADDING_VALUES,
+                        help="bytes of zero-padding for filenames (may be "
+                        "repeated; default: all)")
+    parser.add_argument("--threads", "-j", type=int, default=4,
+                        help="number of threads (default: 4)")
+    parser.add_argument("--files", type=int, default=1000,
+                        help="number of files to create in each directory "
+                        "before the operations start (default: 1000)")
+    parser.add_argument("--ops", "-n", type=int, default=10000,
+                        help="number of operations in each directory and "
+                        "state (default: 10000)")
+    parser.add_argument("--mix", type=_mix, default=DEFAULT_MIX,
+                        help="relative weights of the operations (default: "
+                        "create=1,lookup=4,readdir=1,unlink=1,rename=1)")
+    parser.add_argument("--min-name-length", type=int, default=1,
+                        help="minimum filename length (default: 1)")
+    parser.add_argument("--max-name-length", type=int, default=255,
+                        help="maximum filename length (default: 255)")
+    parser.add_argument("--state", action="append", choices=STATES,
+                        help="state of the directories (may be repeated; "
+                        "default: both)")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results as JSON to FILE")
+    parser.add_argument("--no-caps-cache", action="store_true",
+                        help="try every policy rather than consulting the "
+                        "capability cache")
+    parser.add_argument("directory")
+    args = parser.parse_args()
+    if args.threads < 1 or args.files < 0 or args.ops < 0:
+        parser.error("--threads must be positive, and --files and --ops "
+                     "can't be negative")
+    name_lengths = (args.min_name_length, args.max_name_length)
+    if not 1 <= name_lengths[0] <= name_lengths[1] <= 255:
+        parser.error("the filename lengths must be between 1 and 255")
+    if args.state and "locked" in args.state and locked_mix(args.mix) is None:
+        parser.error("the locked state needs lookup or readdir operations in "
+                     "the mix")
+
+    try:
+        capabilities = None
+        if not args.no_caps_cache:
+            capabilities = fscrypt_caps.get_capabilities(args.directory)
+        results = run(args.directory,
+                      configurations(args.filenames, args.padding), args.mix,
+                      args.state, args.threads, args.files, args.ops,
+                      name_lengths, capabilities=capabilities,
+                      log=lambda msg: print(msg, file=sys.stderr))
+    except OSError as e:
+        print("error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results_to_json(results, args.mix, args.threads,
+                                      args.files, args.ops, name_lengths),
+                      f, indent=2)
+            f.write("\n")
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
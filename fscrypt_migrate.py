@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Migrates an existing directory tree into an encrypted directory.
+
+An encryption policy can only be set on an empty directory, so encrypting
+existing data requires copying it.  This copies the tree SOURCE into a new
+encrypted directory SOURCE.fscrypt-migrate, then atomically exchanges the two
+directories with renameat2(RENAME_EXCHANGE).  Afterwards SOURCE is encrypted,
+and SOURCE.fscrypt-migrate holds the original unencrypted tree, which is only
+deleted if --remove-original is given.  Note that deleting files doesn't
+securely erase their contents from the storage device.
+
+The key is either read from a key file (--key-file), in which case it is added
+to the filesystem, or given by its identifier (--key), in which case it must
+already have been added.
+
+Files are copied by a pool of worker threads using copy_file_range(), falling
+back to sendfile() and then to read() and write().  The number of workers
+defaults to a small number for rotational devices and a larger one otherwise.
+Directories, regular files, symlinks, hard links, FIFOs, and device nodes are
+copied, with their permissions, ownership (when running as root), timestamps,
+and extended attributes.
+
+Progress is checkpointed to SOURCE.fscrypt-migrate.checkpoint: periodically,
+the filesystem is synced and the files copied since the last checkpoint are
+recorded.  If the migration is interrupted, running the same command again
+resumes it, skipping the files that were already recorded.  SOURCE must not be
+modified while it is being migrated.
+
+The encryption settings can be given with the same options as "fscryptctl
+set_policy".
+
+Usage: fscrypt_migrate.py (--key-file=FILE | --key=KEY_IDENTIFIER)
+                          [SET_POLICY_OPTION...] [--jobs=N]
+                          [--remove-original] SOURCE"""
+
+import argparse
+import concurrent.futures
+import ctypes
+import errno
+import json
+import os
+import shutil
+import stat
+import sys
+import time
+
+import fscrypt
+import fscrypt_keyids
+
+STAGING_SUFFIX = ".fscrypt-migrate"
+CHECKPOINT_SUFFIX = ".fscrypt-migrate.checkpoint"
+
+# From <linux/fs.h>
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = 2
+
+# The largest amount of data that is copied by each system call
+_COPY_CHUNK_SIZE = 1 << 30
+
+
+def default_jobs(path):
+    """Returns the default number of copy workers for the filesystem containing
+    |path|: 2 if it is on a rotational device, where more concurrency would
+    just cause seeking, otherwise twice the number of CPUs (up to 32)."""
+    dev = os.stat(path).st_dev
+    sysfs = "/sys/dev/block/{}:{}".format(os.major(dev), os.minor(dev))
+    # Partitions don't have a queue directory, but their parent device does.
+    for queue in [os.path.join(sysfs, "queue"),
+                  os.path.join(sysfs, "..", "queue")]:
+        try:
+            with open(os.path.join(queue, "rotational")) as f:
+                if f.read().strip() == "1":
+                    return 2
+                break
+        except OSError:
+            continue
+    return min(32, (os.cpu_count() or 1) * 2)
+
+
+def _copy_data(src_fd, dst_fd, size):
+    """Copies |size| bytes between two file descriptors, using the most
+    efficient method that works."""
+    offset = 0
+    for method in ["copy_file_range", "sendfile"]:
+        try:
+            while offset < size:
+                count = min(size - offset, _COPY_CHUNK_SIZE)
+                if method == "copy_file_range":
+                    n = os.copy_file_range(src_fd, dst_fd, count)
+                else:
+                    n = os.sendfile(dst_fd, src_fd, None, count)
+                if n == 0:
+                    break
+                offset += n
+            return
+        except (AttributeError, OSError) as e:
+            if isinstance(e, OSError) and e.errno not in (
+                    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+            # Nothing was copied by the failed call, so the remaining data
+            # can still be copied using the next method.
+    while True:
+        data = os.read(src_fd, 1 << 20)
+        if not data:
+            break
+        os.write(dst_fd, data)
+
+
+def _copy_xattrs(src, dst):
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError:
+        return
+    for name in names:
+        try:
+            value = os.getxattr(src, name, follow_symlinks=False)
+            os.setxattr(dst, name, value, follow_symlinks=False)
+        except OSError:
+            pass
+
+
+def _copy_metadata(src, dst, st):
+    """Copies the ownership, permissions, timestamps, and extended attributes
+    of |src| (whose stat result is |st|) to |dst|."""
+    is_link = stat.S_ISLNK(st.st_mode)
+    if os.geteuid() == 0:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    _copy_xattrs(src, dst)
+    if not is_link:
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def _copy_file(src, dst, st):
+    """Copies a regular file, replacing any partial copy left by an earlier
+    interrupted migration.  Returns the number of bytes copied."""
+    src_fd = os.open(src, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                         os.O_CLOEXEC, 0o600)
+        try:
+            _copy_data(src_fd, dst_fd, st.st_size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    _copy_metadata(src, dst, st)
+    return st.st_size
+
+
+def _copy_special(src, dst, st):
+    """Copies a symlink, FIFO, or device node."""
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dst)
+    else:
+        os.mknod(dst, stat.S_IFMT(st.st_mode) | 0o600, st.st_rdev)
+    _copy_metadata(src, dst, st)
+    return 0
+
+
+def _renameat2_exchange(path1, path2):
+    libc = ctypes.CDLL(None, use_errno=True)
+    try:
+        renameat2 = libc.renameat2
+    except AttributeError:
+        raise OSError(errno.ENOSYS, "renameat2() is not available") from None
+    if renameat2(_AT_FDCWD, os.fsencode(path1), _AT_FDCWD,
+                 os.fsencode(path2), _RENAME_EXCHANGE) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path1, None, path2)
+
+
+class MigrationResult:
+    """The statistics of a completed migration."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.elapsed = 0.0
+
+    def gb_per_second(self):
+        return self.bytes / self.elapsed / 1e9 if self.elapsed else 0.0
+
+
+class Migration:
+    """Copies a directory tree into an encrypted directory, then swaps them.
+    If |progress| is given, it is called with the MigrationResult so far each
+    time some files have been copied."""
+
+    staging_suffix = STAGING_SUFFIX
+    checkpoint_suffix = CHECKPOINT_SUFFIX
+
+    def __init__(self, source, policy, jobs=None, checkpoint_interval=10.0,
+                 progress=None):
+        self.source = os.path.abspath(source).rstrip("/")
+        self.staging = self.source + self.staging_suffix
+        self.checkpoint_path = self.source + self.checkpoint_suffix
+        self.policy = policy
+        self.jobs = jobs or default_jobs(self.source)
+        self.checkpoint_interval = checkpoint_interval
+        self.progress = progress
+        self.result = MigrationResult()
+        self._done = set()
+        self._pending = []
+        self._last_checkpoint = 0.0
+        self._checkpoint_file = None
+
+    def _check_source(self):
+        """Raises ValueError if the source can't be migrated."""
+        try:
+            fscrypt.get_policy(self.source)
+        except OSError as e:
+            if e.errno != errno.ENODATA:
+                raise
+            return
+        raise ValueError("{}: already encrypted".format(self.source))
+
+    def _prepare(self):
+        """Creates the encrypted staging directory, or checks that the one left
+        by an interrupted migration has the right policy, and loads the
+        checkpoint."""
+        self._check_source()
+        if os.path.isdir(self.staging) and \
+                os.path.exists(self.checkpoint_path):
+            policy = fscrypt.get_policy(self.staging)
+            if policy != self.policy:
+                raise ValueError("{}: left by a migration with a different "
+                                 "encryption policy".format(self.staging))
+            with open(self.checkpoint_path) as f:
+                for line in f:
+                    # Ignore a partially written last line.
+                    if line.endswith("\n"):
+                        self._done.add(json.loads(line))
+        else:
+            os.mkdir(self.staging, 0o700)
+            fscrypt.set_policy(self.staging, self.policy)
+            with open(self.checkpoint_path, "w"):
+                pass
+        self._checkpoint_file = open(self.checkpoint_path, "a")
+        self._last_checkpoint = time.monotonic()
+
+    def _checkpoint(self, force=False):
+        """Records the files copied since the last checkpoint, after syncing
+        them to disk."""
+        now = time.monotonic()
+        if not self._pending or (
+                not force and now - self._last_checkpoint <
+                self.checkpoint_interval):
+            return
+        os.sync()
+        for path in self._pending:
+            self._checkpoint_file.write(json.dumps(path) + "\n")
+        self._checkpoint_file.flush()
+        os.fsync(self._checkpoint_file.fileno())
+        self._pending = []
+        self._last_checkpoint = now
+
+    def _walk(self):
+        """Creates the directories in the staging directory, and yields
+        (relative path, stat result) for each other file in the source tree, in
+        the order they should be copied.  Also yields the directories (after
+        their contents), so that their timestamps can be restored last."""
+        stack = [("", os.lstat(self.source), False)]
+        while stack:
+            rel, st, visited = stack.pop()
+            if visited:
+                yield rel, st
+                continue
+            stack.append((rel, st, True))
+            directory = os.path.join(self.source, rel)
+            os.makedirs(os.path.join(self.staging, rel), 0o700, exist_ok=True)
+            for entry in os.scandir(directory):
+                entry_rel = os.path.join(rel, entry.name)
+                entry_st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(entry_st.st_mode):
+                    stack.append((entry_rel, entry_st, False))
+                else:
+                    yield entry_rel, entry_st
+
+    def copy(self):
+        """Copies the tree into the staging directory, resuming from the
+        checkpoint if there is one."""
+        start = time.monotonic()
+        self._prepare()
+        links = {}
+        hard_links = []
+        directories = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+                futures = {}
+                for rel, st in self._walk():
+                    src = os.path.join(self.source, rel)
+                    dst = os.path.join(self.staging, rel)
+                    if stat.S_ISDIR(st.st_mode):
+                        directories.append((src, dst, st))
+                        continue
+                    # Hard links are recreated after all files have been
+                    # copied, so that their first name already exists.
+                    if st.st_nlink > 1:
+                        first = links.setdefault((st.st_dev, st.st_ino), rel)
+                        if first != rel:
+                            hard_links.append((first, rel))
+                            continue
+                    if rel in self._done:
+                        self.result.skipped_files += 1
+                        if stat.S_ISREG(st.st_mode):
+                            self.result.skipped_bytes += st.st_size
+                        continue
+                    copy_func = _copy_file if stat.S_ISREG(st.st_mode) \
+                        else _copy_special
+                    futures[executor.submit(copy_func, src, dst, st)] = rel
+                    if len(futures) >= self.jobs * 4:
+                        self._collect(futures)
+                while futures:
+                    self._collect(futures)
+            for first, rel in hard_links:
+                self._link(first, rel)
+            # Restore directory metadata after the directories' contents have
+            # been created, since that changes their modification times.
+            for src, dst, st in directories:
+                _copy_metadata(src, dst, st)
+        finally:
+            # Also record the files that were copied before any failure.
+            try:
+                self._checkpoint(force=True)
+            finally:
+                self._checkpoint_file.close()
+            self.result.elapsed += time.monotonic() - start
+        return self.result
+
+    def _link(self, first, rel):
+        dst = os.path.join(self.staging, rel)
+        try:
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        os.link(os.path.join(self.staging, first), dst)
+
+    def _collect(self, futures):
+        """Waits for at least one copy to finish, and records the finished
+        ones."""
+        done, _ = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        error = None
+        for future in done:
+            rel = futures.pop(future)
+            try:
+                self.result.bytes += future.result()
+            except OSError as e:
+                error = error or e
+                continue
+            self.result.files += 1
+            self._pending.append(rel)
+        if error:
+            raise error
+        self._checkpoint()
+        if self.progress:
+            self.progress(self.result)
+
+    def swap(self, remove_original=False):
+        """Atomically exchanges the source and staging directories, so that the
+        source path refers to the encrypted copy."""
+        os.sync()
+        _renameat2_exchange(self.source, self.staging)
+        os.unlink(self.checkpoint_path)
+        if remove_original:
+            shutil.rmtree(self.staging)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migrate a directory tree into an encrypted directory.")
+    key_group = parser.add_mutually_exclusive_group(required=True)
+    key_group.add_argument("--key-file",
+                           help="file containing the raw key to add and use")
+    key_group.add_argument("--key", metavar="KEY_IDENTIFIER",
+                           help="identifier of an already-added key")
+    fscrypt.add_policy_arguments(parser)
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="number of copy workers")
+    parser.add_argument("--remove-original", action="store_true",
+                        help="delete the unencrypted tree afterwards")
+    parser.add_argument("source", metavar="SOURCE")
+    args = parser.parse_args()
+    if args.key:
+        try:
+            if len(bytes.fromhex(args.key)) != \
+                    fscrypt.FSCRYPT_KEY_IDENTIFIER_SIZE:
+                raise ValueError
+        except ValueError:
+            parser.error("invalid key identifier: " + args.key)
+
+    try:
+        identifier = args.key
+        if args.key_file:
+            raw = bytearray(fscrypt_keyids.read_key_file(args.key_file))
+            try:
+                identifier = fscrypt.add_key(os.path.dirname(
+                    os.path.abspath(args.source)), bytes(raw))
+            finally:
+                raw[:] = bytes(len(raw))
+        policy = fscrypt.policy_from_arguments(identifier, args)
+        migration = Migration(args.source, policy, args.jobs)
+        result = migration.copy()
+        migration.swap(args.remove_original)
+    except (OSError, ValueError) as e:
+        print("error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    print("Copied {} files ({} bytes) in {:.1f} seconds: {:.3f} GB/s".format(
+        result.files, result.bytes, result.elapsed, result.gb_per_second()))
+    if result.skipped_files:
+        print("Skipped {} files copied before the migration was "
+              "resumed".format(result.skipped_files))
+    if not args.remove_original:
+        print("The unencrypted original is in {}".format(migration.staging))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Re-encrypts an encrypted directory tree with a different policy or key.
+
+The encryption policy of a directory can't be changed once it has been set, so
+changing the encryption modes or rotating the master key requires rewriting
+all the data.  This copies the encrypted directory SOURCE, which must be
+unlocked, into a new directory SOURCE.fscrypt-reencrypt that uses the new
+policy, verifies that the copy has the same contents as the original, and then
+atomically exchanges the two directories.  Afterwards the old copy is deleted
+and its key is removed from the filesystem, unless the new policy uses the same
+key or --keep-old-key is given because other directories still use the key.
+
+The copy is done the same way as by fscrypt_migrate.py: by a pool of worker
+threads, with a bounded number of files in flight and without reading whole
+files into memory, and with checkpoints so that an interrupted re-encryption
+resumes where it left off when the same command is run again.  While copying,
+the progress, throughput, and estimated time remaining are printed to standard
+error.
+
+The new key is either read from a key file (--key-file), in which case it is
+added to the filesystem, or given by its identifier (--key), in which case it
+must already have been added.  The new encryption settings are given with the
+same options as "fscryptctl set_policy".
+
+Usage: fscrypt_reencrypt.py (--key-file=FILE | --key=KEY_IDENTIFIER)
+                            [SET_POLICY_OPTION...] [--jobs=N]
+                            [--keep-old-key] SOURCE"""
+
+import argparse
+import concurrent.futures
+import errno
+import hashlib
+import os
+import shutil
+import stat
+import sys
+import time
+
+import fscrypt
+import fscrypt_keyids
+import fscrypt_migrate
+
+STAGING_SUFFIX = ".fscrypt-reencrypt"
+CHECKPOINT_SUFFIX = ".fscrypt-reencrypt.checkpoint"
+
+
+def tree_size(path):
+    """Returns the total size in bytes of the regular files under |path|,
+    counting each hard-linked file once."""
+    total = 0
+    seen = set()
+    for directory, _, files in os.walk(path):
+        for name in files:
+            st = os.lstat(os.path.join(directory, name))
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
+
+def format_progress(done, total, elapsed):
+    """Formats the progress of a copy of |total| bytes, of which |done| bytes
+    were copied in |elapsed| seconds."""
+    rate = done / elapsed if elapsed > 0 else 0.0
+    eta = "?"
+    if rate > 0:
+        minutes, seconds = divmod(round((total - done) / rate), 60)
+        eta = "{}:{:02}:{:02}".format(minutes // 60, minutes % 60, seconds)
+    return "{:5.1f}% {:.2f} of {:.2f} GB, {:.3f} GB/s, ETA {}".format(
+        100.0 * done / total if total else 100.0, done / 1e9, total / 1e9,
+        rate / 1e9, eta)
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+def _compare(src, dst):
+    """Returns true if the file |dst| has the same type and contents as
+    |src|."""
+    src_st = os.lstat(src)
+    dst_st = os.lstat(dst)
+    if stat.S_IFMT(src_st.st_mode) != stat.S_IFMT(dst_st.st_mode):
+        return False
+    if stat.S_ISLNK(src_st.st_mode):
+        return os.readlink(src) == os.readlink(dst)
+    if stat.S_ISREG(src_st.st_mode):
+        return (src_st.st_size == dst_st.st_size and
+                _file_digest(src) == _file_digest(dst))
+    return True
+
+
+class Reencryption(fscrypt_migrate.Migration):
+    """Copies an encrypted directory tree into a directory with a different
+    encryption policy, verifies the copy, then swaps them."""
+
+    staging_suffix = STAGING_SUFFIX
+    checkpoint_suffix = CHECKPOINT_SUFFIX
+
+    def __init__(self, source, policy, jobs=None, checkpoint_interval=10.0,
+                 progress=None):
+        super().__init__(source, policy, jobs, checkpoint_interval, progress)
+        self.old_policy = None
+
+    def _check_source(self):
+        try:
+            self.old_policy = fscrypt.get_policy(self.source)
+        except OSError as e:
+            if e.errno != errno.ENODATA:
+                raise
+            raise ValueError("{}: not encrypted".format(self.source)) from None
+        if self.old_policy == self.policy:
+            raise ValueError("{}: already uses the new encryption "
+                             "policy".format(self.source))
+        if self.old_policy.version == 2 and fscrypt.get_key_status(
+                self.old_policy.key, self.source).status != \
+                fscrypt.FSCRYPT_KEY_STATUS_PRESENT:
+            raise ValueError("{}: key {} is not present".format(
+                self.source, self.old_policy.key))
+
+    def verify(self):
+        """Checks that every file in the copy has the same type and contents
+        as in the source tree.  Raises ValueError on the first difference."""
+        pairs = []
+        for directory, dirs, files in os.walk(self.source):
+            rel = os.path.relpath(directory, self.source)
+            for name in dirs + files:
+                pairs.append((os.path.join(directory, name),
+                              os.path.join(self.staging, rel, name)))
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            for (src, _), same in zip(pairs, executor.map(
+                    lambda pair: _compare(*pair), pairs)):
+                if not same:
+                    raise ValueError("{}: copy differs".format(src))
+
+    def same_key(self):
+        """Returns whether the new policy uses the same key as the old one,
+        which is the case when only the encryption settings change."""
+        return self.old_policy.key == self.policy.key
+
+    def finish(self, keep_old_key=False):
+        """Deletes the old copy, which swap() moved to the staging path, and
+        removes its key unless |keep_old_key| or the new policy still uses it.
+        Returns the key removal status flags, or None if no key was removed."""
+        shutil.rmtree(self.staging)
+        if keep_old_key or self.old_policy.version != 2 or self.same_key():
+            return None
+        return fscrypt.remove_key(self.old_policy.key, self.source)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Re-encrypt a directory tree with a new policy or key.")
+    key_group = parser.add_mutually_exclusive_group(required=True)
+    key_group.add_argument("--key-file",
+                           help="file containing the new raw key to add")
+    key_group.add_argument("--key", metavar="KEY_IDENTIFIER",
+                           help="identifier of an already-added new key")
+    fscrypt.add_policy_arguments(parser)
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="number of copy workers")
+    parser.add_argument("--keep-old-key", action="store_true",
+                        help="don't remove the old key from the filesystem")
+    parser.add_argument("source", metavar="SOURCE")
+    args = parser.parse_args()
+    if args.key:
+        try:
+            if len(bytes.fromhex(args.key)) != \
+                    fscrypt.FSCRYPT_KEY_IDENTIFIER_SIZE:
+                raise ValueError
+        except ValueError:
+            parser.error("invalid key identifier: " + args.key)
+
+    start = time.monotonic()
+    last_report = [start]
+
+    def report(result, final=False):
+        now = time.monotonic()
+        if not final and now - last_report[0] < 1.0:
+            return
+        last_report[0] = now
+        print("\r" + format_progress(result.bytes + result.skipped_bytes,
+                                     total, now - start),
+              end="\n" if final else "", file=sys.stderr, flush=True)
+
+    try:
+        identifier = args.key
+        if args.key_file:
+            raw = bytearray(fscrypt_keyids.read_key_file(args.key_file))
+            try:
+                identifier = fscrypt.add_key(args.source, bytes(raw))
+            finally:
+                raw[:] = bytes(len(raw))
+        policy = fscrypt.policy_from_arguments(identifier, args)
+        total = tree_size(args.source)
+        reencryption = Reencryption(args.source, policy, args.jobs,
+                                    progress=report)
+        result = reencryption.copy()
+        report(result, final=True)
+        reencryption.verify()
+        reencryption.swap()
+        removal_status = reencryption.finish(args.keep_old_key)
+    except (OSError, ValueError) as e:
+        print("error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    print("Re-encrypted {} files ({} bytes) in {:.1f} seconds: {:.3f} "
+          "GB/s".format(result.files, result.bytes, result.elapsed,
+                        result.gb_per_second()))
+    if reencryption.old_policy.version != 2 and not args.keep_old_key and \
+            not reencryption.same_key():
+        print("note: the old key was for a v1 encryption policy, so it must "
+              "be removed from the keyring it was added to")
+    if removal_status:
+        print("warning: the old key was only partially removed, since some "
+              "files using it are still in-use", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
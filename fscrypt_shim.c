@@ -0,0 +1,1152 @@
+/*
+ * fscrypt_shim.c - LD_PRELOAD library which emulates the fscrypt and blk-crypto
+ *                  ioctls in userspace, for testing.
+ *
+ * Copyright 2026 Google LLC
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License"); you may not
+ * use this file except in compliance with the License. You may obtain a copy of
+ * the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+ * WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+ * License for the specific language governing permissions and limitations under
+ * the License.
+ */
+
+// When this library is loaded with LD_PRELOAD, ioctl() handles the fscrypt key
+// and policy ioctls and the blk-crypto hardware-wrapped key ioctls itself, and
+// passes all other ioctls through to the C library.  This allows the tests to
+// be run on any filesystem that supports user extended attributes, without
+// kernel encryption support or inline encryption hardware.
+//
+// Only the ioctls are emulated; files aren't actually encrypted, and removing a
+// key doesn't make the files that use it inaccessible.  The emulation follows
+// the kernel's semantics for what the ioctls themselves report:
+//
+//  - Keys are kept per filesystem (st_dev) in a state file shared by all
+//    processes, given by $FSCRYPT_SHIM_STATE (default /tmp/fscrypt-shim-state).
+//    Each key records which users have added it.  Removing a key removes the
+//    calling user's claim, and the key itself once no claims remain.  If any
+//    process still has a file or directory that uses the key open, or as its
+//    current directory, the key becomes "incompletely removed" instead.
+//
+//  - Encryption policies are stored in the "user.fscrypt_shim.policy" extended
+//    attribute of the directory they are set on, and are inherited by
+//    everything below that directory on the same filesystem.  Only v2 policies
+//    are supported.  Like the kernel's encryption context xattr, this xattr is
+//    hidden from listxattr(), so that programs which copy xattrs don't copy
+//    the policy too.
+//
+//  - Hardware-wrapped keys are emulated with a fixed, publicly known wrapping
+//    key, so they provide no security.  Ephemerally-wrapped keys are only
+//    valid until the next reboot, like real ones.
+
+#define _GNU_SOURCE  // For RTLD_NEXT and O_CLOEXEC
+
+#include <dirent.h>
+#include <dlfcn.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <stdarg.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/file.h>
+#include <sys/ioctl.h>
+#include <sys/random.h>
+#include <sys/stat.h>
+#include <sys/statfs.h>
+#include <sys/xattr.h>
+#include <unistd.h>
+
+#include "blk-crypto_uapi.h"
+#include "fscrypt_uapi.h"
+
+#define DEFAULT_STATE_FILE "/tmp/fscrypt-shim-state"
+#define POLICY_XATTR "user.fscrypt_shim.policy"
+
+// The maximum number of keys on all filesystems, and of users per key
+#define MAX_KEYS 1024
+#define MAX_KEY_USERS 16
+
+#define MIN_KEY_SIZE 16
+#define MAX_WRAPPED_KEY_SIZE 128
+#define GENERATED_KEY_SIZE 32
+#define SW_SECRET_SIZE 32
+
+// A wrapped key is the magic, the raw key XOR'ed with a mask, and a tag
+#define WRAPPED_KEY_MAGIC_SIZE 8
+#define WRAPPED_KEY_TAG_SIZE 8
+#define WRAPPED_KEY_OVERHEAD (WRAPPED_KEY_MAGIC_SIZE + WRAPPED_KEY_TAG_SIZE)
+#define LT_KEY_MAGIC "SHIMLTK1"
+#define EPH_KEY_MAGIC "SHIMEPH1"
+
+#define SHA512_DIGEST_SIZE 64
+#define SHA512_BLOCK_SIZE 128
+
+#define ARRAY_SIZE(array) (sizeof(array) / sizeof((array)[0]))
+
+// -----------------------------------------------------------------------------
+//                                  SHA-512
+// -----------------------------------------------------------------------------
+
+struct sha512_ctx {
+  uint64_t state[8];
+  uint64_t count;
+  uint8_t buf[SHA512_BLOCK_SIZE];
+};
+
+static const uint64_t sha512_iv[8] = {
+    0x6a09e667f3bcc908ULL, 0xbb67ae8584caa73bULL,
+    0x3c6ef372fe94f82bULL, 0xa54ff53a5f1d36f1ULL,
+    0x510e527fade682d1ULL, 0x9b05688c2b3e6c1fULL,
+    0x1f83d9abfb41bd6bULL, 0x5be0cd19137e2179ULL,
+};
+
+static const uint64_t sha512_k[80] = {
+    0x428a2f98d728ae22ULL, 0x7137449123ef65cdULL,
+    0xb5c0fbcfec4d3b2fULL, 0xe9b5dba58189dbbcULL,
+    0x3956c25bf348b538ULL, 0x59f111f1b605d019ULL,
+    0x923f82a4af194f9bULL, 0xab1c5ed5da6d8118ULL,
+    0xd807aa98a3030242ULL, 0x12835b0145706fbeULL,
+    0x243185be4ee4b28cULL, 0x550c7dc3d5ffb4e2ULL,
+    0x72be5d74f27b896fULL, 0x80deb1fe3b1696b1ULL,
+    0x9bdc06a725c71235ULL, 0xc19bf174cf692694ULL,
+    0xe49b69c19ef14ad2ULL, 0xefbe4786384f25e3ULL,
+    0x0fc19dc68b8cd5b5ULL, 0x240ca1cc77ac9c65ULL,
+    0x2de92c6f592b0275ULL, 0x4a7484aa6ea6e483ULL,
+    0x5cb0a9dcbd41fbd4ULL, 0x76f988da831153b5ULL,
+    0x983e5152ee66dfabULL, 0xa831c66d2db43210ULL,
+    0xb00327c898fb213fULL, 0xbf597fc7beef0ee4ULL,
+    0xc6e00bf33da88fc2ULL, 0xd5a79147930aa725ULL,
+    0x06ca6351e003826fULL, 0x142929670a0e6e70ULL,
+    0x27b70a8546d22ffcULL, 0x2e1b21385c26c926ULL,
+    0x4d2c6dfc5ac42aedULL, 0x53380d139d95b3dfULL,
+    0x650a73548baf63deULL, 0x766a0abb3c77b2a8ULL,
+    0x81c2c92e47edaee6ULL, 0x92722c851482353bULL,
+    0xa2bfe8a14cf10364ULL, 0xa81a664bbc423001ULL,
+    0xc24b8b70d0f89791ULL, 0xc76c51a30654be30ULL,
+    0xd192e819d6ef5218ULL, 0xd69906245565a910ULL,
+    0xf40e35855771202aULL, 0x106aa07032bbd1b8ULL,
+    0x19a4c116b8d2d0c8ULL, 0x1e376c085141ab53ULL,
+    0x2748774cdf8eeb99ULL, 0x34b0bcb5e19b48a8ULL,
+    0x391c0cb3c5c95a63ULL, 0x4ed8aa4ae3418acbULL,
+    0x5b9cca4f7763e373ULL, 0x682e6ff3d6b2b8a3ULL,
+    0x748f82ee5defb2fcULL, 0x78a5636f43172f60ULL,
+    0x84c87814a1f0ab72ULL, 0x8cc702081a6439ecULL,
+    0x90befffa23631e28ULL, 0xa4506cebde82bde9ULL,
+    0xbef9a3f7b2c67915ULL, 0xc67178f2e372532bULL,
+    0xca273eceea26619cULL, 0xd186b8c721c0c207ULL,
+    0xeada7dd6cde0eb1eULL, 0xf57d4f7fee6ed178ULL,
+    0x06f067aa72176fbaULL, 0x0a637dc5a2c898a6ULL,
+    0x113f9804bef90daeULL, 0x1b710b35131c471bULL,
+    0x28db77f523047d84ULL, 0x32caab7b40c72493ULL,
+    0x3c9ebe0a15c9bebcULL, 0x431d67c49c100d4cULL,
+    0x4cc5d4becb3e42b6ULL, 0x597f299cfc657e2aULL,
+    0x5fcb6fab3ad6faecULL, 0x6c44198c4a475817ULL,
+};
+
+static uint64_t ror64(uint64_t x, int n) { return (x >> n) | (x << (64 - n)); }
+
+static uint64_t get_be64(const uint8_t *p) {
+  uint64_t x = 0;
+  for (int i = 0; i < 8; i++) {
+    x = (x << 8) | p[i];
+  }
+  return x;
+}
+
+static void put_be64(uint8_t *p, uint64_t x) {
+  for (int i = 7; i >= 0; i--) {
+    p[i] = (uint8_t)x;
+    x >>= 8;
+  }
+}
+
+static void sha512_block(struct sha512_ctx *ctx, const uint8_t *block) {
+  uint64_t w[80];
+  uint64_t s[8];
+  for (int i = 0; i < 16; i++) {
+    w[i] = get_be64(&block[8 * i]);
+  }
+  for (int i = 16; i < 80; i++) {
+    uint64_t s0 = ror64(w[i - 15], 1) ^ ror64(w[i - 15], 8) ^ (w[i - 15] >> 7);
+    uint64_t s1 = ror64(w[i - 2], 19) ^ ror64(w[i - 2], 61) ^ (w[i - 2] >> 6);
+    w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+  }
+  memcpy(s, ctx->state, sizeof(s));
+  for (int i = 0; i < 80; i++) {
+    uint64_t t1 = s[7] + (ror64(s[4], 14) ^ ror64(s[4], 18) ^ ror64(s[4], 41)) +
+                  ((s[4] & s[5]) ^ (~s[4] & s[6])) + sha512_k[i] + w[i];
+    uint64_t t2 = (ror64(s[0], 28) ^ ror64(s[0], 34) ^ ror64(s[0], 39)) +
+                  ((s[0] & s[1]) ^ (s[0] & s[2]) ^ (s[1] & s[2]));
+    memmove(&s[1], &s[0], 7 * sizeof(s[0]));
+    s[4] += t1;
+    s[0] = t1 + t2;
+  }
+  for (int i = 0; i < 8; i++) {
+    ctx->state[i] += s[i];
+  }
+}
+
+static void sha512_init(struct sha512_ctx *ctx) {
+  memcpy(ctx->state, sha512_iv, sizeof(ctx->state));
+  ctx->count = 0;
+}
+
+static void sha512_update(struct sha512_ctx *ctx, const void *data,
+                          size_t size) {
+  const uint8_t *p = data;
+  while (size != 0) {
+    size_t used = ctx->count % SHA512_BLOCK_SIZE;
+    size_t n = SHA512_BLOCK_SIZE - used;
+    if (n > size) {
+      n = size;
+    }
+    memcpy(&ctx->buf[used], p, n);
+    ctx->count += n;
+    p += n;
+    size -= n;
+    if (ctx->count % SHA512_BLOCK_SIZE == 0) {
+      sha512_block(ctx, ctx->buf);
+    }
+  }
+}
+
+static void sha512_final(struct sha512_ctx *ctx,
+                         uint8_t out[SHA512_DIGEST_SIZE]) {
+  static const uint8_t padding[SHA512_BLOCK_SIZE] = {0x80};
+  uint8_t length[16] = {0};
+  uint64_t bits = ctx->count * 8;
+  size_t used = ctx->count % SHA512_BLOCK_SIZE;
+
+  put_be64(&length[8], bits);
+  sha512_update(ctx, padding,
+                (used < 112 ? 112 : 112 + SHA512_BLOCK_SIZE) - used);
+  sha512_update(ctx, length, sizeof(length));
+  for (int i = 0; i < 8; i++) {
+    put_be64(&out[8 * i], ctx->state[i]);
+  }
+  memset(ctx, 0, sizeof(*ctx));
+}
+
+static void sha512(const void *data, size_t size,
+                   uint8_t out[SHA512_DIGEST_SIZE]) {
+  struct sha512_ctx ctx;
+  sha512_init(&ctx);
+  sha512_update(&ctx, data, size);
+  sha512_final(&ctx, out);
+}
+
+static void hmac_sha512(const uint8_t *key, size_t key_size, const void *data,
+                        size_t size, uint8_t out[SHA512_DIGEST_SIZE]) {
+  uint8_t pad[SHA512_BLOCK_SIZE] = {0};
+  uint8_t inner[SHA512_DIGEST_SIZE];
+  struct sha512_ctx ctx;
+
+  if (key_size > SHA512_BLOCK_SIZE) {
+    sha512(key, key_size, pad);
+  } else {
+    memcpy(pad, key, key_size);
+  }
+  for (size_t i = 0; i < sizeof(pad); i++) {
+    pad[i] ^= 0x36;
+  }
+  sha512_init(&ctx);
+  sha512_update(&ctx, pad, sizeof(pad));
+  sha512_update(&ctx, data, size);
+  sha512_final(&ctx, inner);
+  for (size_t i = 0; i < sizeof(pad); i++) {
+    pad[i] ^= 0x36 ^ 0x5c;
+  }
+  sha512_init(&ctx);
+  sha512_update(&ctx, pad, sizeof(pad));
+  sha512_update(&ctx, inner, sizeof(inner));
+  sha512_final(&ctx, out);
+  memset(pad, 0, sizeof(pad));
+  memset(inner, 0, sizeof(inner));
+}
+
+// Computes the key identifier of a key the same way the kernel does: using
+// HKDF-SHA512 with no salt and the info string "fscrypt\0" followed by the
+// context byte HKDF_CONTEXT_KEY_IDENTIFIER (1).  Since the identifier is
+// shorter than one SHA-512 digest, HKDF-Expand needs only a single block, so
+// the info is followed by the block counter 1.
+static void compute_key_identifier(const uint8_t *key, size_t key_size,
+                                   uint8_t identifier[]) {
+  static const uint8_t salt[SHA512_DIGEST_SIZE] = {0};
+  static const uint8_t info[] = {'f', 's', 'c', 'r', 'y', 'p', 't', '\0',
+                                 1,   1};
+  uint8_t prk[SHA512_DIGEST_SIZE];
+  uint8_t okm[SHA512_DIGEST_SIZE];
+
+  hmac_sha512(salt, sizeof(salt), key, key_size, prk);
+  hmac_sha512(prk, sizeof(prk), info, sizeof(info), okm);
+  memcpy(identifier, okm, FSCRYPT_KEY_IDENTIFIER_SIZE);
+  memset(prk, 0, sizeof(prk));
+  memset(okm, 0, sizeof(okm));
+}
+
+// -----------------------------------------------------------------------------
+//                          Emulated wrapped keys
+// -----------------------------------------------------------------------------
+
+// Derives the mask that a raw key is XOR'ed with to wrap it.  Ephemerally-
+// wrapped keys use a mask that also depends on the boot ID.
+static void wrapping_mask(const char *magic, uint8_t mask[SHA512_DIGEST_SIZE]) {
+  struct sha512_ctx ctx;
+  sha512_init(&ctx);
+  sha512_update(&ctx, magic, WRAPPED_KEY_MAGIC_SIZE);
+  if (strcmp(magic, EPH_KEY_MAGIC) == 0) {
+    char boot_id[64] = {0};
+    int fd = open("/proc/sys/kernel/random/boot_id", O_RDONLY | O_CLOEXEC);
+    if (fd >= 0) {
+      if (read(fd, boot_id, sizeof(boot_id) - 1) < 0) {
+        boot_id[0] = '\0';
+      }
+      close(fd);
+    }
+    sha512_update(&ctx, boot_id, strlen(boot_id));
+  }
+  sha512_final(&ctx, mask);
+}
+
+static void wrapped_key_tag(const char *magic, const uint8_t *raw,
+                            size_t raw_size,
+                            uint8_t tag[SHA512_DIGEST_SIZE]) {
+  hmac_sha512((const uint8_t *)magic, WRAPPED_KEY_MAGIC_SIZE, raw, raw_size,
+              tag);
+}
+
+// Wraps |raw| into |out|, which has room for |*out_size| bytes.  On success,
+// sets |*out_size| to the size of the wrapped key.
+static int wrap_key(const char *magic, const uint8_t *raw, size_t raw_size,
+                    uint8_t *out, __u64 *out_size) {
+  uint8_t mask[SHA512_DIGEST_SIZE];
+  uint8_t tag[SHA512_DIGEST_SIZE];
+  size_t size = raw_size + WRAPPED_KEY_OVERHEAD;
+
+  if (raw_size > sizeof(mask)) {
+    return -EINVAL;
+  }
+  if (*out_size < size) {
+    return -EOVERFLOW;
+  }
+  wrapping_mask(magic, mask);
+  wrapped_key_tag(magic, raw, raw_size, tag);
+  memcpy(out, magic, WRAPPED_KEY_MAGIC_SIZE);
+  for (size_t i = 0; i < raw_size; i++) {
+    out[WRAPPED_KEY_MAGIC_SIZE + i] = raw[i] ^ mask[i];
+  }
+  memcpy(&out[WRAPPED_KEY_MAGIC_SIZE + raw_size], tag, WRAPPED_KEY_TAG_SIZE);
+  *out_size = size;
+  memset(mask, 0, sizeof(mask));
+  return 0;
+}
+
+// Unwraps |wrapped| into |raw|, which must have room for SHA512_DIGEST_SIZE
+// bytes.  Returns the size of the raw key, or -EBADMSG if the wrapped key isn't
+// valid, as the hardware would.
+static int unwrap_key(const char *magic, const uint8_t *wrapped, size_t size,
+                      uint8_t raw[SHA512_DIGEST_SIZE]) {
+  uint8_t mask[SHA512_DIGEST_SIZE];
+  uint8_t tag[SHA512_DIGEST_SIZE];
+  size_t raw_size = size - WRAPPED_KEY_OVERHEAD;
+
+  if (size < WRAPPED_KEY_OVERHEAD + MIN_KEY_SIZE ||
+      raw_size > SHA512_DIGEST_SIZE ||
+      memcmp(wrapped, magic, WRAPPED_KEY_MAGIC_SIZE) != 0) {
+    return -EBADMSG;
+  }
+  wrapping_mask(magic, mask);
+  for (size_t i = 0; i < raw_size; i++) {
+    raw[i] = wrapped[WRAPPED_KEY_MAGIC_SIZE + i] ^ mask[i];
+  }
+  memset(mask, 0, sizeof(mask));
+  wrapped_key_tag(magic, raw, raw_size, tag);
+  if (memcmp(tag, &wrapped[WRAPPED_KEY_MAGIC_SIZE + raw_size],
+             WRAPPED_KEY_TAG_SIZE) != 0) {
+    memset(raw, 0, SHA512_DIGEST_SIZE);
+    return -EBADMSG;
+  }
+  return (int)raw_size;
+}
+
+static bool is_zero(const void *p, size_t size) {
+  const uint8_t *bytes = p;
+  for (size_t i = 0; i < size; i++) {
+    if (bytes[i] != 0) {
+      return false;
+    }
+  }
+  return true;
+}
+
+static int import_hw_wrapped_key(struct blk_crypto_import_key_arg *arg) {
+  if (!is_zero(arg->reserved, sizeof(arg->reserved)) ||
+      arg->raw_key_size < MIN_KEY_SIZE ||
+      arg->raw_key_size > FSCRYPT_MAX_KEY_SIZE) {
+    return -EINVAL;
+  }
+  return wrap_key(LT_KEY_MAGIC, (const uint8_t *)(uintptr_t)arg->raw_key_ptr,
+                  arg->raw_key_size, (uint8_t *)(uintptr_t)arg->lt_key_ptr,
+                  &arg->lt_key_size);
+}
+
+static int generate_hw_wrapped_key(struct blk_crypto_generate_key_arg *arg) {
+  uint8_t raw[GENERATED_KEY_SIZE];
+  int ret;
+
+  if (!is_zero(arg->reserved, sizeof(arg->reserved))) {
+    return -EINVAL;
+  }
+  if (getrandom(raw, sizeof(raw), 0) != sizeof(raw)) {
+    return -errno;
+  }
+  ret = wrap_key(LT_KEY_MAGIC, raw, sizeof(raw),
+                 (uint8_t *)(uintptr_t)arg->lt_key_ptr, &arg->lt_key_size);
+  memset(raw, 0, sizeof(raw));
+  return ret;
+}
+
+static int prepare_hw_wrapped_key(struct blk_crypto_prepare_key_arg *arg) {
+  uint8_t raw[SHA512_DIGEST_SIZE];
+  int ret;
+
+  if (!is_zero(arg->reserved, sizeof(arg->reserved)) ||
+      arg->lt_key_size == 0 || arg->lt_key_size > MAX_WRAPPED_KEY_SIZE) {
+    return -EINVAL;
+  }
+  ret = unwrap_key(LT_KEY_MAGIC, (const uint8_t *)(uintptr_t)arg->lt_key_ptr,
+                   arg->lt_key_size, raw);
+  if (ret >= 0) {
+    ret = wrap_key(EPH_KEY_MAGIC, raw, ret,
+                   (uint8_t *)(uintptr_t)arg->eph_key_ptr, &arg->eph_key_size);
+  }
+  memset(raw, 0, sizeof(raw));
+  return ret;
+}
+
+// Computes the key identifier of an ephemerally-wrapped key.  Like the kernel,
+// this derives the identifier from the key's "software secret", which the
+// hardware derives from the raw key.
+static int compute_hw_wrapped_key_identifier(const uint8_t *eph_key,
+                                             size_t size,
+                                             uint8_t identifier[]) {
+  static const char label[] = "fscrypt_shim sw_secret";
+  uint8_t raw[SHA512_DIGEST_SIZE];
+  uint8_t sw_secret[SHA512_DIGEST_SIZE];
+  int ret;
+
+  if (size > MAX_WRAPPED_KEY_SIZE) {
+    return -EINVAL;
+  }
+  ret = unwrap_key(EPH_KEY_MAGIC, eph_key, size, raw);
+  if (ret < 0) {
+    return ret;
+  }
+  hmac_sha512((const uint8_t *)label, strlen(label), raw, ret, sw_secret);
+  compute_key_identifier(sw_secret, SW_SECRET_SIZE, identifier);
+  memset(raw, 0, sizeof(raw));
+  memset(sw_secret, 0, sizeof(sw_secret));
+  return 0;
+}
+
+// -----------------------------------------------------------------------------
+//                             Emulated policies
+// -----------------------------------------------------------------------------
+
+// Reads the policy stored on |path| itself.  Returns 0 if found, -ENODATA if
+// |path| has no policy of its own, or another negative errno value.
+static int read_policy_xattr(const char *path,
+                             struct fscrypt_policy_v2 *policy) {
+  ssize_t ret = getxattr(path, POLICY_XATTR, policy, sizeof(*policy));
+  if (ret == sizeof(*policy)) {
+    return 0;
+  }
+  if (ret >= 0 || errno == ENOTSUP) {
+    return -ENODATA;
+  }
+  return -errno;
+}
+
+// Finds the policy of |path|, which must be an absolute path: either the
+// policy stored on it, or the policy inherited from the nearest ancestor
+// directory on the filesystem |dev| that has one.
+static int find_policy(const char *path, dev_t dev,
+                       struct fscrypt_policy_v2 *policy) {
+  char buf[PATH_MAX];
+  struct stat stbuf;
+
+  if (path[0] != '/' || strlen(path) >= sizeof(buf)) {
+    return -ENOTTY;
+  }
+  strcpy(buf, path);
+  for (;;) {
+    if (stat(buf, &stbuf) == 0) {
+      if (stbuf.st_dev != dev) {
+        return -ENODATA;
+      }
+      int ret = read_policy_xattr(buf, policy);
+      if (ret != -ENODATA) {
+        return ret;
+      }
+    }
+    char *slash = strrchr(buf, '/');
+    if (slash == buf) {
+      if (buf[1] == '\0') {
+        return -ENODATA;
+      }
+      buf[1] = '\0';
+    } else {
+      *slash = '\0';
+    }
+  }
+}
+
+// Gets the path that a /proc/PID/fd/N, cwd, or root link refers to, with the
+// " (deleted)" suffix that Linux adds for deleted files removed.
+static bool get_link_path(const char *link, char path[PATH_MAX]) {
+  static const char deleted[] = " (deleted)";
+  ssize_t len = readlink(link, path, PATH_MAX - 1);
+  if (len < 0) {
+    return false;
+  }
+  path[len] = '\0';
+  if ((size_t)len > strlen(deleted) &&
+      strcmp(&path[len - strlen(deleted)], deleted) == 0) {
+    path[len - strlen(deleted)] = '\0';
+  }
+  return true;
+}
+
+// Gets the policy of the file or directory |link| (a /proc/PID/fd/N, cwd, or
+// root link) refers to.
+static int get_link_policy(const char *link, struct fscrypt_policy_v2 *policy,
+                           dev_t *dev) {
+  char path[PATH_MAX];
+  struct stat stbuf;
+
+  if (stat(link, &stbuf) != 0) {
+    return -errno;
+  }
+  *dev = stbuf.st_dev;
+  // Check the file itself directly, in case it has been deleted.
+  int ret = read_policy_xattr(link, policy);
+  if (ret != -ENODATA) {
+    return ret;
+  }
+  if (!get_link_path(link, path)) {
+    return -errno;
+  }
+  return find_policy(path, stbuf.st_dev, policy);
+}
+
+static int get_fd_policy(int fd, struct fscrypt_policy_v2 *policy) {
+  char link[64];
+  dev_t dev;
+  snprintf(link, sizeof(link), "/proc/self/fd/%d", fd);
+  return get_link_policy(link, policy, &dev);
+}
+
+static bool is_valid_mode_pair(uint8_t contents, uint8_t filenames) {
+  static const uint8_t pairs[][2] = {
+      {FSCRYPT_MODE_AES_256_XTS, FSCRYPT_MODE_AES_256_CTS},
+      {FSCRYPT_MODE_AES_256_XTS, FSCRYPT_MODE_AES_256_HCTR2},
+      {FSCRYPT_MODE_AES_128_CBC, FSCRYPT_MODE_AES_128_CTS},
+      {FSCRYPT_MODE_SM4_XTS, FSCRYPT_MODE_SM4_CTS},
+      {FSCRYPT_MODE_ADIANTUM, FSCRYPT_MODE_ADIANTUM},
+  };
+  for (size_t i = 0; i < ARRAY_SIZE(pairs); i++) {
+    if (pairs[i][0] == contents && pairs[i][1] == filenames) {
+      return true;
+    }
+  }
+  return false;
+}
+
+// Checks the policy the same way the kernel does.  The IV_INO_LBLK flags are
+// always rejected, since they require stable inode numbers, which can't be
+// guaranteed for an arbitrary filesystem.
+static bool is_supported_policy(int fd, const struct fscrypt_policy_v2 *p) {
+  struct statfs stfs;
+  int log2_block_size = 0;
+
+  if (!is_valid_mode_pair(p->contents_encryption_mode,
+                          p->filenames_encryption_mode)) {
+    return false;
+  }
+  if (p->flags & ~(FSCRYPT_POLICY_FLAGS_PAD_MASK |
+                   FSCRYPT_POLICY_FLAG_DIRECT_KEY)) {
+    return false;
+  }
+  if ((p->flags & FSCRYPT_POLICY_FLAG_DIRECT_KEY) &&
+      p->contents_encryption_mode != p->filenames_encryption_mode) {
+    return false;
+  }
+  if (!is_zero(p->__reserved, sizeof(p->__reserved))) {
+    return false;
+  }
+  if (p->log2_data_unit_size != 0) {
+    if (fstatfs(fd, &stfs) != 0) {
+      return false;
+    }
+    while ((1L << (log2_block_size + 1)) <= stfs.f_bsize) {
+      log2_block_size++;
+    }
+    if (p->log2_data_unit_size < 9 ||
+        p->log2_data_unit_size > log2_block_size) {
+      return false;
+    }
+  }
+  return true;
+}
+
+static bool is_empty_dir(int fd) {
+  int dir_fd = openat(fd, ".", O_RDONLY | O_DIRECTORY | O_CLOEXEC);
+  if (dir_fd < 0) {
+    return false;
+  }
+  DIR *dir = fdopendir(dir_fd);
+  if (dir == NULL) {
+    close(dir_fd);
+    return false;
+  }
+  bool empty = true;
+  struct dirent *entry;
+  while (empty && (entry = readdir(dir)) != NULL) {
+    empty = strcmp(entry->d_name, ".") == 0 || strcmp(entry->d_name, "..") == 0;
+  }
+  closedir(dir);
+  return empty;
+}
+
+// -----------------------------------------------------------------------------
+//                               Emulated keys
+// -----------------------------------------------------------------------------
+
+struct shim_key {
+  uint64_t dev;
+  uint8_t identifier[FSCRYPT_KEY_IDENTIFIER_SIZE];
+  uint32_t status;  // FSCRYPT_KEY_STATUS_PRESENT or _INCOMPLETELY_REMOVED
+  uint32_t num_users;
+  uint32_t users[MAX_KEY_USERS];
+};
+
+struct shim_state {
+  int fd;
+  size_t num_keys;
+  struct shim_key keys[MAX_KEYS];
+};
+
+// Opens and locks the state file and reads all the keys.  Returns NULL with
+// errno set on failure.
+static struct shim_state *lock_state(void) {
+  const char *path = getenv("FSCRYPT_SHIM_STATE");
+  struct shim_state *state = calloc(1, sizeof(*state));
+  ssize_t ret;
+
+  if (state == NULL) {
+    return NULL;
+  }
+  if (path == NULL || path[0] == '\0') {
+    path = DEFAULT_STATE_FILE;
+  }
+  state->fd = open(path, O_RDWR | O_CREAT | O_CLOEXEC, 0600);
+  if (state->fd < 0) {
+    goto err;
+  }
+  if (flock(state->fd, LOCK_EX) != 0) {
+    goto err;
+  }
+  ret = pread(state->fd, state->keys, sizeof(state->keys), 0);
+  if (ret < 0) {
+    goto err;
+  }
+  state->num_keys = ret / sizeof(state->keys[0]);
+  return state;
+err:
+  if (state->fd >= 0) {
+    close(state->fd);
+  }
+  free(state);
+  return NULL;
+}
+
+// Writes back the keys if |save| is true, and unlocks the state file.
+static int unlock_state(struct shim_state *state, bool save) {
+  int ret = 0;
+  if (save) {
+    size_t size = state->num_keys * sizeof(state->keys[0]);
+    if (pwrite(state->fd, state->keys, size, 0) != (ssize_t)size ||
+        ftruncate(state->fd, size) != 0) {
+      ret = -errno;
+    }
+  }
+  close(state->fd);
+  free(state);
+  return ret;
+}
+
+static struct shim_key *find_key(struct shim_state *state, dev_t dev,
+                                 const uint8_t identifier[]) {
+  for (size_t i = 0; i < state->num_keys; i++) {
+    if (state->keys[i].dev == dev &&
+        memcmp(state->keys[i].identifier, identifier,
+               FSCRYPT_KEY_IDENTIFIER_SIZE) == 0) {
+      return &state->keys[i];
+    }
+  }
+  return NULL;
+}
+
+static void delete_key(struct shim_state *state, struct shim_key *key) {
+  *key = state->keys[--state->num_keys];
+}
+
+static int find_user(const struct shim_key *key, uint32_t uid) {
+  for (uint32_t i = 0; i < key->num_users; i++) {
+    if (key->users[i] == uid) {
+      return (int)i;
+    }
+  }
+  return -1;
+}
+
+// Returns true if the link at |link| refers to a file or directory that uses
+// the given key.
+static bool link_uses_key(const char *link, dev_t dev,
+                          const uint8_t identifier[]) {
+  struct fscrypt_policy_v2 policy;
+  struct stat stbuf;
+  dev_t link_dev;
+  if (stat(link, &stbuf) != 0 || stbuf.st_dev != dev) {
+    return false;
+  }
+  return get_link_policy(link, &policy, &link_dev) == 0 &&
+         memcmp(policy.master_key_identifier, identifier,
+                FSCRYPT_KEY_IDENTIFIER_SIZE) == 0;
+}
+
+// Checks whether any process has a file or directory that uses the given key
+// open, or as its current or root directory.  This is what keeps the kernel
+// from evicting the inodes using a key when the key is removed.
+static bool key_in_use(dev_t dev, const uint8_t identifier[]) {
+  DIR *proc = opendir("/proc");
+  struct dirent *entry;
+  char link[PATH_MAX];
+  bool in_use = false;
+
+  if (proc == NULL) {
+    return false;
+  }
+  while (!in_use && (entry = readdir(proc)) != NULL) {
+    const char *pid = entry->d_name;
+    if (pid[0] < '0' || pid[0] > '9') {
+      continue;
+    }
+    snprintf(link, sizeof(link), "/proc/%s/cwd", pid);
+    in_use = link_uses_key(link, dev, identifier);
+    snprintf(link, sizeof(link), "/proc/%s/root", pid);
+    in_use = in_use || link_uses_key(link, dev, identifier);
+
+    snprintf(link, sizeof(link), "/proc/%s/fd", pid);
+    DIR *fds = opendir(link);
+    if (fds == NULL) {
+      continue;
+    }
+    struct dirent *fd_entry;
+    while (!in_use && (fd_entry = readdir(fds)) != NULL) {
+      if (fd_entry->d_name[0] == '.') {
+        continue;
+      }
+      snprintf(link, sizeof(link), "/proc/%s/fd/%s", pid, fd_entry->d_name);
+      in_use = link_uses_key(link, dev, identifier);
+    }
+    closedir(fds);
+  }
+  closedir(proc);
+  return in_use;
+}
+
+static int get_fd_dev(int fd, dev_t *dev) {
+  struct stat stbuf;
+  if (fstat(fd, &stbuf) != 0) {
+    return -errno;
+  }
+  *dev = stbuf.st_dev;
+  return 0;
+}
+
+// Checks the key specifier of an ioctl argument.  v1 keys (given by key
+// descriptor) aren't emulated.
+static int check_key_spec(const struct fscrypt_key_specifier *spec) {
+  if (spec->__reserved != 0) {
+    return -EINVAL;
+  }
+  if (spec->type == FSCRYPT_KEY_SPEC_TYPE_DESCRIPTOR) {
+    return -EOPNOTSUPP;
+  }
+  if (spec->type != FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER) {
+    return -EINVAL;
+  }
+  return 0;
+}
+
+static int add_key(int fd, struct fscrypt_add_key_arg *arg) {
+  bool hw_wrapped = arg->flags & FSCRYPT_ADD_KEY_FLAG_HW_WRAPPED;
+  uint8_t identifier[FSCRYPT_KEY_IDENTIFIER_SIZE];
+  uint32_t uid = geteuid();
+  dev_t dev;
+  int ret;
+
+  ret = check_key_spec(&arg->key_spec);
+  if (ret != 0) {
+    return ret;
+  }
+  if ((arg->flags & ~FSCRYPT_ADD_KEY_FLAG_HW_WRAPPED) ||
+      !is_zero(arg->__reserved, sizeof(arg->__reserved))) {
+    return -EINVAL;
+  }
+  // Keys from the kernel keyring can't be read from userspace.
+  if (arg->key_id != 0) {
+    return -EOPNOTSUPP;
+  }
+  if (arg->raw_size < MIN_KEY_SIZE ||
+      arg->raw_size >
+          (hw_wrapped ? MAX_WRAPPED_KEY_SIZE : FSCRYPT_MAX_KEY_SIZE)) {
+    return -EINVAL;
+  }
+  ret = get_fd_dev(fd, &dev);
+  if (ret != 0) {
+    return ret;
+  }
+  if (hw_wrapped) {
+    ret = compute_hw_wrapped_key_identifier(arg->raw, arg->raw_size,
+                                            identifier);
+    if (ret != 0) {
+      return ret;
+    }
+  } else {
+    compute_key_identifier(arg->raw, arg->raw_size, identifier);
+  }
+
+  struct shim_state *state = lock_state();
+  if (state == NULL) {
+    return -errno;
+  }
+  struct shim_key *key = find_key(state, dev, identifier);
+  if (key == NULL) {
+    if (state->num_keys == MAX_KEYS) {
+      unlock_state(state, false);
+      return -EDQUOT;
+    }
+    key = &state->keys[state->num_keys++];
+    memset(key, 0, sizeof(*key));
+    key->dev = dev;
+    memcpy(key->identifier, identifier, sizeof(identifier));
+  }
+  // Adding an incompletely removed key makes it fully present again.
+  key->status = FSCRYPT_KEY_STATUS_PRESENT;
+  if (find_user(key, uid) < 0) {
+    if (key->num_users == MAX_KEY_USERS) {
+      unlock_state(state, false);
+      return -EDQUOT;
+    }
+    key->users[key->num_users++] = uid;
+  }
+  ret = unlock_state(state, true);
+  if (ret == 0) {
+    memcpy(arg->key_spec.u.identifier, identifier, sizeof(identifier));
+  }
+  return ret;
+}
+
+static int remove_key(int fd, struct fscrypt_remove_key_arg *arg,
+                      bool all_users) {
+  uint32_t uid = geteuid();
+  dev_t dev;
+  int ret;
+
+  ret = check_key_spec(&arg->key_spec);
+  if (ret != 0) {
+    return ret;
+  }
+  if (!is_zero(arg->__reserved, sizeof(arg->__reserved))) {
+    return -EINVAL;
+  }
+  if (all_users && uid != 0) {
+    return -EACCES;
+  }
+  ret = get_fd_dev(fd, &dev);
+  if (ret != 0) {
+    return ret;
+  }
+
+  struct shim_state *state = lock_state();
+  if (state == NULL) {
+    return -errno;
+  }
+  struct shim_key *key = find_key(state, dev, arg->key_spec.u.identifier);
+  if (key == NULL) {
+    unlock_state(state, false);
+    return -ENOKEY;
+  }
+  arg->removal_status_flags = 0;
+  if (key->status == FSCRYPT_KEY_STATUS_PRESENT) {
+    if (all_users) {
+      key->num_users = 0;
+    } else {
+      int i = find_user(key, uid);
+      if (i < 0) {
+        unlock_state(state, false);
+        return -ENOKEY;
+      }
+      key->users[i] = key->users[--key->num_users];
+    }
+    if (key->num_users != 0) {
+      arg->removal_status_flags |= FSCRYPT_KEY_REMOVAL_STATUS_FLAG_OTHER_USERS;
+      return unlock_state(state, true);
+    }
+  }
+  // No claims to the key remain, so try to remove the key itself.
+  if (key_in_use(dev, key->identifier)) {
+    key->status = FSCRYPT_KEY_STATUS_INCOMPLETELY_REMOVED;
+    arg->removal_status_flags |= FSCRYPT_KEY_REMOVAL_STATUS_FLAG_FILES_BUSY;
+  } else {
+    delete_key(state, key);
+  }
+  return unlock_state(state, true);
+}
+
+static int get_key_status(int fd, struct fscrypt_get_key_status_arg *arg) {
+  dev_t dev;
+  int ret;
+
+  ret = check_key_spec(&arg->key_spec);
+  if (ret != 0) {
+    return ret;
+  }
+  if (!is_zero(arg->__reserved, sizeof(arg->__reserved))) {
+    return -EINVAL;
+  }
+  ret = get_fd_dev(fd, &dev);
+  if (ret != 0) {
+    return ret;
+  }
+
+  struct shim_state *state = lock_state();
+  if (state == NULL) {
+    return -errno;
+  }
+  struct shim_key *key = find_key(state, dev, arg->key_spec.u.identifier);
+  arg->status = FSCRYPT_KEY_STATUS_ABSENT;
+  arg->status_flags = 0;
+  arg->user_count = 0;
+  memset(arg->__out_reserved, 0, sizeof(arg->__out_reserved));
+  if (key != NULL) {
+    arg->status = key->status;
+    if (key->status == FSCRYPT_KEY_STATUS_PRESENT) {
+      arg->user_count = key->num_users;
+      if (find_user(key, geteuid()) >= 0) {
+        arg->status_flags |= FSCRYPT_KEY_STATUS_FLAG_ADDED_BY_SELF;
+      }
+    }
+  }
+  return unlock_state(state, false);
+}
+
+// Checks that the key is present and was added by the calling user, which the
+// kernel requires for setting a v2 policy unless the caller has CAP_FOWNER.
+static int verify_key_added(int fd, const uint8_t identifier[]) {
+  dev_t dev = 0;
+  int ret = get_fd_dev(fd, &dev);
+  if (ret != 0) {
+    return ret;
+  }
+  struct shim_state *state = lock_state();
+  if (state == NULL) {
+    return -errno;
+  }
+  struct shim_key *key = find_key(state, dev, identifier);
+  if (key == NULL || key->status != FSCRYPT_KEY_STATUS_PRESENT ||
+      find_user(key, geteuid()) < 0) {
+    ret = -ENOKEY;
+  }
+  unlock_state(state, false);
+  if (ret == -ENOKEY && geteuid() == 0) {
+    ret = 0;
+  }
+  return ret;
+}
+
+static int set_policy(int fd, const void *arg) {
+  const struct fscrypt_policy_v2 *policy = arg;
+  struct fscrypt_policy_v2 existing;
+  struct stat stbuf;
+  int ret;
+
+  if (policy->version == FSCRYPT_POLICY_V1) {
+    return -EOPNOTSUPP;
+  }
+  if (policy->version != FSCRYPT_POLICY_V2) {
+    return -EINVAL;
+  }
+  if (fstat(fd, &stbuf) != 0) {
+    return -errno;
+  }
+  if (stbuf.st_uid != geteuid() && geteuid() != 0) {
+    return -EACCES;
+  }
+  ret = get_fd_policy(fd, &existing);
+  if (ret == 0) {
+    // Setting the same policy again is allowed.
+    return memcmp(&existing, policy, sizeof(existing)) == 0 ? 0 : -EEXIST;
+  }
+  if (ret != -ENODATA) {
+    return ret;
+  }
+  if (!S_ISDIR(stbuf.st_mode)) {
+    return -ENOTDIR;
+  }
+  if (!is_empty_dir(fd)) {
+    return -ENOTEMPTY;
+  }
+  if (!is_supported_policy(fd, policy)) {
+    return -EINVAL;
+  }
+  ret = verify_key_added(fd, policy->master_key_identifier);
+  if (ret != 0) {
+    return ret;
+  }
+  if (fsetxattr(fd, POLICY_XATTR, policy, sizeof(*policy), 0) != 0) {
+    return errno == ENOTSUP ? -EOPNOTSUPP : -errno;
+  }
+  return 0;
+}
+
+static int get_policy_ex(int fd, struct fscrypt_get_policy_ex_arg *arg) {
+  struct fscrypt_policy_v2 policy;
+  int ret = get_fd_policy(fd, &policy);
+  if (ret != 0) {
+    return ret;
+  }
+  if (arg->policy_size < sizeof(policy)) {
+    return -EOVERFLOW;
+  }
+  arg->policy_size = sizeof(policy);
+  memcpy(&arg->policy.v2, &policy, sizeof(policy));
+  return 0;
+}
+
+// -----------------------------------------------------------------------------
+//                            The ioctl() wrapper
+// -----------------------------------------------------------------------------
+
+int ioctl(int fd, unsigned long request, ...) {
+  static int (*real_ioctl)(int, unsigned long, ...);
+  va_list ap;
+  void *arg;
+  int ret;
+
+  va_start(ap, request);
+  arg = va_arg(ap, void *);
+  va_end(ap);
+
+  switch (request) {
+    case FS_IOC_ADD_ENCRYPTION_KEY:
+      ret = add_key(fd, arg);
+      break;
+    case FS_IOC_REMOVE_ENCRYPTION_KEY:
+      ret = remove_key(fd, arg, false);
+      break;
+    case FS_IOC_REMOVE_ENCRYPTION_KEY_ALL_USERS:
+      ret = remove_key(fd, arg, true);
+      break;
+    case FS_IOC_GET_ENCRYPTION_KEY_STATUS:
+      ret = get_key_status(fd, arg);
+      break;
+    case FS_IOC_SET_ENCRYPTION_POLICY:
+      ret = set_policy(fd, arg);
+      break;
+    case FS_IOC_GET_ENCRYPTION_POLICY_EX:
+      ret = get_policy_ex(fd, arg);
+      break;
+    case BLKCRYPTOIMPORTKEY:
+      ret = import_hw_wrapped_key(arg);
+      break;
+    case BLKCRYPTOGENERATEKEY:
+      ret = generate_hw_wrapped_key(arg);
+      break;
+    case BLKCRYPTOPREPAREKEY:
+      ret = prepare_hw_wrapped_key(arg);
+      break;
+    default:
+      if (real_ioctl == NULL) {
+        // This form of assignment avoids a warning with -pedantic.
+        *(void **)&real_ioctl = dlsym(RTLD_NEXT, "ioctl");
+      }
+      return real_ioctl(fd, request, arg);
+  }
+  if (ret < 0) {
+    errno = -ret;
+    return -1;
+  }
+  return 0;
+}
+
+// -----------------------------------------------------------------------------
+//                          The listxattr() wrappers
+// -----------------------------------------------------------------------------
+
+// The kernel doesn't list the xattr that holds a file's encryption context, so
+// that programs which copy xattrs don't copy it.  Likewise, remove the xattr
+// that holds an emulated policy from a list of xattr names.  When only the
+// size of the list is queried, it is left as an overestimate.
+static ssize_t hide_policy_xattr(char *list, ssize_t size) {
+  ssize_t pos = 0;
+  if (size <= 0 || list == NULL) {
+    return size;
+  }
+  while (pos < size) {
+    size_t len = strnlen(list + pos, size - pos) + 1;
+    if (strcmp(list + pos, POLICY_XATTR) == 0) {
+      memmove(list + pos, list + pos + len, size - pos - len);
+      size -= len;
+    } else {
+      pos += len;
+    }
+  }
+  return size;
+}
+
+ssize_t listxattr(const char *path, char *list, size_t size) {
+  static ssize_t (*real_listxattr)(const char *, char *, size_t);
+  if (real_listxattr == NULL) {
+    *(void **)&real_listxattr = dlsym(RTLD_NEXT, "listxattr");
+  }
+  return hide_policy_xattr(list, real_listxattr(path, list, size));
+}
+
+ssize_t llistxattr(const char *path, char *list, size_t size) {
+  static ssize_t (*real_llistxattr)(const char *, char *, size_t);
+  if (real_llistxattr == NULL) {
+    *(void **)&real_llistxattr = dlsym(RTLD_NEXT, "llistxattr");
+  }
+  return hide_policy_xattr(list, real_llistxattr(path, list, size));
+}
+
+ssize_t flistxattr(int fd, char *list, size_t size) {
+  static ssize_t (*real_flistxattr)(int, char *, size_t);
+  if (real_flistxattr == NULL) {
+    *(void **)&real_flistxattr = dlsym(RTLD_NEXT, "flistxattr");
+  }
+  return hide_policy_xattr(list, real_flistxattr(fd, list, size));
+}
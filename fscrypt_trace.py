@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Summarizes the trace records written by fscryptctl as latency histograms.
+
+When the environment variable FSCRYPTCTL_TRACE is set to the number of an open
+file descriptor, fscryptctl writes a record to it for each command and for each
+open, ioctl, read, and write that the command does, for example:
+
+    FSCRYPTCTL_TRACE=3 fscryptctl add_key /mnt < key 3>>trace.log
+
+This reads such records from the given files (or standard input) and prints,
+for each command and each operation within it, a histogram of the latencies
+with power-of-two buckets.  Lines that aren't trace records are ignored, so
+the trace can be mixed with other output.
+
+Usage: fscrypt_trace.py [--json] [FILE...]"""
+
+import argparse
+import collections
+import json
+import math
+import re
+import sys
+
+RECORD_PREFIX = "fscryptctl-trace "
+
+# The fields of a trace record that are integers
+_INTEGER_FIELDS = ["pid", "start_ns", "duration_ns", "result", "errno"]
+
+# The fields that every trace record has
+_REQUIRED_FIELDS = ["cmd", "op", "name", "duration_ns", "result"]
+
+
+def _unescape(value):
+    return re.sub(r"\\x([0-9a-f]{2})", lambda m: chr(int(m.group(1), 16)),
+                  value)
+
+
+def parse_record(line):
+    """Parses one trace record into a dict, or returns None if the line isn't a
+    trace record, or is one that was truncated or interleaved with another
+    write so that a field is missing or invalid."""
+    if not line.startswith(RECORD_PREFIX):
+        return None
+    record = {}
+    for field in line[len(RECORD_PREFIX):].split():
+        key, _, value = field.partition("=")
+        if key in _INTEGER_FIELDS:
+            try:
+                value = int(value)
+            except ValueError:
+                return None
+        record[key] = value
+    if any(key not in record for key in _REQUIRED_FIELDS):
+        return None
+    if "path" in record:
+        record["path"] = _unescape(record["path"])
+    return record
+
+
+def group_records(records):
+    """Groups the durations of trace records, in nanoseconds, by (command,
+    operation, name).  Returns a dict mapping each group to a list of
+    (duration_ns, failed)."""
+    groups = collections.defaultdict(list)
+    for record in records:
+        key = (record["cmd"], record["op"], record["name"])
+        groups[key].append((record["duration_ns"], record["result"] < 0))
+    return groups
+
+
+def histogram(durations):
+    """Counts durations (in nanoseconds) into power-of-two buckets of
+    microseconds.  Returns a list of (limit in us, count) in increasing order of
+    limit, where each bucket counts the durations that are less than its limit
+    but not less than the previous bucket's limit."""
+    counts = collections.Counter((d // 1000).bit_length() for d in durations)
+    return [(2 ** b, counts[b]) for b in range(min(counts), max(counts) + 1)]
+
+
+def _percentile(sorted_samples, fraction):
+    rank = max(1, math.ceil(len(sorted_samples) * fraction))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def _summary_order(group):
+    command, op, name = group
+    return command, op != "command", op, name
+
+
+def summarize(groups):
+    """Converts the result of group_records() to a JSON-serializable list, with
+    latencies in microseconds.  Commands are sorted by name, with each command
+    followed by the operations done within it."""
+    summary = []
+    for group in sorted(groups, key=_summary_order):
+        command, op, name = group
+        samples = groups[group]
+        durations = sorted(d for d, _ in samples)
+        summary.append({
+            "command": command,
+            "op": op,
+            "name": name,
+            "count": len(durations),
+            "errors": sum(failed for _, failed in samples),
+            "p50_us": _percentile(durations, 0.50) / 1000.0,
+            "p99_us": _percentile(durations, 0.99) / 1000.0,
+            "max_us": durations[-1] / 1000.0,
+            "total_us": sum(durations) / 1000.0,
+            "histogram": [{"lt_us": bound, "count": count}
+                          for bound, count in histogram(durations)],
+        })
+    return summary
+
+
+def print_summary(summary, out=sys.stdout):
+    """Prints the result of summarize() as text histograms."""
+    for entry in summary:
+        if entry["op"] == "command":
+            title = entry["command"]
+        else:
+            title = "  {} {}".format(entry["op"], entry["name"])
+        print("{}: count={} errors={} p50={:.1f}us p99={:.1f}us "
+              "max={:.1f}us".format(title, entry["count"], entry["errors"],
+                                    entry["p50_us"], entry["p99_us"],
+                                    entry["max_us"]), file=out)
+        peak = max(bucket["count"] for bucket in entry["histogram"])
+        for bucket in entry["histogram"]:
+            bar = "#" * math.ceil(40 * bucket["count"] / peak)
+            print("      <{:>9} us |{:<40}| {}".format(
+                bucket["lt_us"], bar, bucket["count"]), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarize fscryptctl trace records as histograms.")
+    parser.add_argument("--json", action="store_true",
+                        help="print the summary as JSON")
+    parser.add_argument("files", nargs="*", metavar="FILE",
+                        help="trace files (default: standard input)")
+    args = parser.parse_args()
+
+    records = []
+    for path in args.files or ["-"]:
+        f = sys.stdin if path == "-" else open(path)
+        with f:
+            records += filter(None, map(parse_record, f))
+    summary = summarize(group_records(records))
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Adds many encryption keys to their filesystems concurrently, e.g. at boot.
+
+The keys are listed in a manifest file, one per line, as
+
+    MOUNTPOINT KEY_SOURCE KEY_IDENTIFIER
+
+where KEY_SOURCE is the path of a file containing a raw key,
+"hw-wrapped:PATH" for a file containing an ephemerally-wrapped
+hardware-wrapped key, or "key-id:SERIAL" for an "fscrypt-provisioning" key in
+the kernel keyring (as with "fscryptctl add_key --key-id").  Fields are split
+like shell words, so paths containing spaces can be quoted.  Empty lines and
+lines starting with "#" are ignored.
+
+Each key is added with FS_IOC_ADD_ENCRYPTION_KEY in-process, by a pool of
+worker threads, so that adding all the keys takes about as long as the
+slowest one rather than the sum of all of them.  The identifier of each key is
+checked against the manifest: for raw keys it is computed before the key is
+added, so a wrong key is never added, and for other keys the key is removed
+again if the identifier the kernel returned is wrong.
+
+All the keys must be added before the --deadline (in seconds) expires;
+any that weren't are reported as timed out, and the program exits without
+waiting for them.  With --wait-for-mounts, keys whose mountpoint isn't mounted
+yet are retried until it is, so that this can be started early in boot.
+
+A report of the time each key took is printed.  The exit status is 0 if all
+the keys were added, or 1 otherwise.
+
+Usage: fscrypt_unlock.py [--deadline=SECONDS] [--jobs=N] [--wait-for-mounts]
+                         MANIFEST"""
+
+import argparse
+import collections
+import os
+import queue
+import shlex
+import sys
+import threading
+import time
+
+import fscrypt
+import fscrypt_keyids
+
+HW_WRAPPED_PREFIX = "hw-wrapped:"
+KEY_ID_PREFIX = "key-id:"
+
+# How often to check whether a mountpoint has been mounted yet, in seconds
+MOUNT_POLL_INTERVAL = 0.05
+
+# A key to add, from line |line| of the manifest
+Entry = collections.namedtuple("Entry", [
+    "mountpoint", "source", "identifier", "line"])
+
+# The outcome of adding a key.  |error| is None if it was added.  |started| and
+# |finished| are the times from the start of the run until a worker started
+# and finished adding the key, and |elapsed| the difference (which includes
+# waiting for the mountpoint to be mounted), all in seconds.
+Result = collections.namedtuple("Result", [
+    "entry", "error", "started", "elapsed", "finished"])
+
+
+def parse_manifest(lines, name="manifest"):
+    """Parses the lines of a manifest.  Returns a list of Entry, or raises
+    ValueError if a line is invalid."""
+    entries = []
+    for line_num, line in enumerate(lines, 1):
+        try:
+            fields = shlex.split(line, comments=True)
+        except ValueError as e:
+            raise ValueError("{}:{}: {}".format(name, line_num, e)) from None
+        if not fields:
+            continue
+        if len(fields) != 3:
+            raise ValueError("{}:{}: expected MOUNTPOINT KEY_SOURCE "
+                             "KEY_IDENTIFIER".format(name, line_num))
+        mountpoint, source, identifier = fields
+        try:
+            if len(bytes.fromhex(identifier)) != \
+                    fscrypt.FSCRYPT_KEY_IDENTIFIER_SIZE:
+                raise ValueError
+        except ValueError:
+            raise ValueError("{}:{}: invalid key identifier: {}".format(
+                name, line_num, identifier)) from None
+        if source.startswith(KEY_ID_PREFIX):
+            serial = source[len(KEY_ID_PREFIX):]
+            if not serial.isdigit() or int(serial) == 0:
+                raise ValueError("{}:{}: invalid key ID: {}".format(
+                    name, line_num, serial))
+        entries.append(Entry(mountpoint, source, identifier.lower(),
+                             line_num))
+    return entries
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return parse_manifest(f, path)
+
+
+def _read_key(source):
+    """Reads the key given by a KEY_SOURCE.  Returns (raw key as a bytearray,
+    whether it is hardware-wrapped, keyring key ID or None)."""
+    if source.startswith(KEY_ID_PREFIX):
+        return bytearray(), False, int(source[len(KEY_ID_PREFIX):])
+    if source.startswith(HW_WRAPPED_PREFIX):
+        path = source[len(HW_WRAPPED_PREFIX):]
+        with open(path, "rb", buffering=0) as f:
+            return (bytearray(f.read(fscrypt.MAX_WRAPPED_KEY_SIZE + 1)), True,
+                    None)
+    return bytearray(fscrypt_keyids.read_key_file(source)), False, None
+
+
+class Unlocker:
+    """Adds the keys in a manifest to their filesystems concurrently."""
+
+    def __init__(self, entries, jobs=None, wait_for_mounts=False):
+        self.entries = entries
+        self.jobs = jobs or max(1, min(len(entries), 64))
+        self.wait_for_mounts = wait_for_mounts
+        self._fds = {}
+        self._fds_lock = threading.Lock()
+
+    def _open(self, mountpoint):
+        """Returns a file descriptor for |mountpoint|, opening it only once
+        for all the keys that are added to it."""
+        with self._fds_lock:
+            if mountpoint not in self._fds:
+                self._fds[mountpoint] = os.open(
+                    mountpoint, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+            return self._fds[mountpoint]
+
+    def close(self):
+        with self._fds_lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds = {}
+
+    def _wait_for_mount(self, mountpoint, deadline):
+        """Waits until |mountpoint| is mounted.  Returns false if it wasn't
+        mounted before the deadline."""
+        while not os.path.ismount(mountpoint):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(MOUNT_POLL_INTERVAL)
+        return True
+
+    def _add(self, entry):
+        """Adds the key of |entry|.  Returns None on success or an error
+        message."""
+        raw, hw_wrapped, key_id = _read_key(entry.source)
+        try:
+            if not hw_wrapped and key_id is None and \
+                    fscrypt_keyids.MIN_KEY_SIZE <= len(raw) <= \
+                    fscrypt_keyids.MAX_KEY_SIZE:
+                identifier = fscrypt.compute_key_identifier(bytes(raw))
+                if identifier != entry.identifier:
+                    return "key has identifier {}".format(identifier)
+            fd = self._open(entry.mountpoint)
+            identifier = fscrypt.add_key(fd, bytes(raw), hw_wrapped, key_id)
+        finally:
+            raw[:] = bytes(len(raw))
+        if identifier != entry.identifier:
+            fscrypt.remove_key(identifier, fd)
+            return "key has identifier {}; removed it".format(identifier)
+        return None
+
+    def _worker(self, work, results, start, deadline, done):
+        while True:
+            try:
+                i, entry = work.get_nowait()
+            except queue.Empty:
+                return
+            begin = time.monotonic()
+            if self.wait_for_mounts and not self._wait_for_mount(
+                    entry.mountpoint, deadline):
+                error = "not mounted"
+            else:
+                try:
+                    error = self._add(entry)
+                except (OSError, ValueError) as e:
+                    error = str(e)
+            end = time.monotonic()
+            results[i] = Result(entry, error, begin - start, end - begin,
+                                end - start)
+            done.release()
+
+    def run(self, timeout=None):
+        """Adds all the keys, giving up after |timeout| seconds if given.
+        Returns a Result for each entry, in order; the keys that weren't added
+        by then have the error "timed out".  The threads that are still adding
+        keys are left running, so the caller should exit soon afterwards."""
+        start = time.monotonic()
+        deadline = start + timeout if timeout is not None else None
+        work = queue.Queue()
+        for item in enumerate(self.entries):
+            work.put(item)
+        results = [None] * len(self.entries)
+        done = threading.Semaphore(0)
+        for _ in range(min(self.jobs, len(self.entries))):
+            threading.Thread(target=self._worker, daemon=True,
+                             args=(work, results, start,
+                                   deadline or float("inf"), done)).start()
+        for _ in self.entries:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+            if not done.acquire(timeout=remaining):
+                break
+        now = time.monotonic()
+        return [result or Result(entry, "timed out", None, None, now - start)
+                for entry, result in zip(self.entries, list(results))]
+
+
+def _ms(seconds):
+    return "-" if seconds is None else "{:.1f}".format(seconds * 1000)
+
+
+def format_report(results):
+    """Formats a table of the Results, and a summary line."""
+    rows = [("MOUNTPOINT", "KEY IDENTIFIER", "START MS", "ADD MS", "DONE MS",
+             "STATUS")]
+    for r in results:
+        rows.append((r.entry.mountpoint, r.entry.identifier, _ms(r.started),
+                     _ms(r.elapsed), _ms(r.finished),
+                     "ok" if r.error is None else "error: " + r.error))
+    widths = [max(len(row[i]) for row in rows) for i in range(5)]
+    lines = ["  ".join(field.ljust(width) for field, width in
+                       zip(row, widths)) + "  " + row[5] for row in rows]
+    added = [r for r in results if r.error is None]
+    total = max((r.finished for r in results), default=0.0)
+    serial = sum(r.elapsed for r in added)
+    lines.append("Added {} of {} keys in {} ms ({} ms if added one at a "
+                 "time)".format(len(added), len(results), _ms(total),
+                                _ms(serial)))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add many encryption keys to their filesystems "
+        "concurrently.")
+    parser.add_argument("--deadline", type=float, default=30.0,
+                        help="seconds until giving up on the keys that "
+                        "haven't been added (default: 30)")
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="number of keys to add at a time")
+    parser.add_argument("--wait-for-mounts", action="store_true",
+                        help="wait for the mountpoints to be mounted")
+    parser.add_argument("manifest", metavar="MANIFEST")
+    args = parser.parse_args()
+    if args.deadline <= 0:
+        parser.error("the deadline must be positive")
+
+    try:
+        entries = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        print("error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    unlocker = Unlocker(entries, args.jobs, args.wait_for_mounts)
+    results = unlocker.run(args.deadline)
+    print(format_report(results))
+    sys.stdout.flush()
+    if any(r.error == "timed out" for r in results):
+        # Don't wait for the keys that are still being added.
+        os._exit(1)
+    unlocker.close()
+    sys.exit(0 if all(r.error is None for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
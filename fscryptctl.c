@@ -20,22 +20,28 @@
  * the License.
  */
 
-#define _GNU_SOURCE  // For O_CLOEXEC
+#define _GNU_SOURCE  // For O_CLOEXEC and memfd_create()
 
 #include <errno.h>
 #include <fcntl.h>
 #include <getopt.h>
+#include <limits.h>
+#include <poll.h>
 #include <stdbool.h>
 #include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 #include <sys/ioctl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include <sys/utsname.h>
+#include <time.h>
 #include <unistd.h>
 
 #include "blk-crypto_uapi.h"
 #include "fscrypt_uapi.h"
+#include "libfscryptctl.h"
 
 #ifndef VERSION
 // Update this on each new release, along with the NEWS.md file.
@@ -47,8 +53,45 @@
 // but it can be increased if ever needed.
 #define MAX_WRAPPED_KEY_SIZE 128
 
+// The maximum amount of standard input that is kept for a command executed by
+// the batch command.  This is one more than the largest input that any command
+// accepts, so that too-long inputs can still be detected.
+#define MAX_BATCH_INPUT_SIZE (MAX_WRAPPED_KEY_SIZE + 1)
+
+// Limits on the size of the commands that can be given to the batch command.
+#define MAX_BATCH_LINE_SIZE 65536
+#define MAX_BATCH_ARGS 1024
+
+// The maximum number of mountpoints whose file descriptors are kept open and
+// reused in batch mode and by "add_key --multiple".
+#define MAX_CACHED_MOUNTPOINTS 16
+
+// The maximum size of the header line of each key record in the input of
+// "add_key --multiple": the key size, a space, and an optional mountpoint.
+#define MAX_KEY_HEADER_SIZE (PATH_MAX + 32)
+
+// The default and maximum timeouts of "remove_key --wait", in seconds, and the
+// bounds of the exponential backoff between its attempts, in milliseconds.
+#define DEFAULT_REMOVE_KEY_WAIT_TIMEOUT 10
+#define MAX_REMOVE_KEY_WAIT_TIMEOUT 86400
+#define MIN_REMOVE_KEY_RETRY_DELAY_MS 10
+#define MAX_REMOVE_KEY_RETRY_DELAY_MS 1000
+
 #define ARRAY_SIZE(array) (sizeof(array) / sizeof((array)[0]))
 
+// True if commands are being executed by the batch command.
+static bool batch_mode;
+
+// The file descriptor that trace records are written to, or -1 if tracing is
+// disabled, and the name of the command whose operations are being traced.
+static int trace_fd = -1;
+static const char *trace_command = "";
+
+// True if open_mountpoint() should keep the file descriptors of filesystem root
+// directories open for reuse.  This is done in batch mode and by
+// "add_key --multiple".
+static bool cache_mountpoints;
+
 static void *xzalloc(size_t size) {
   void *ptr = calloc(1, size);
   if (!ptr) {
@@ -85,34 +128,14 @@ static void wipe_and_free(void *v, size_t n) {
 // if the key is too short for the encryption policy it is used for.
 #define FSCRYPT_MIN_KEY_SIZE 16
 
-#define FSCRYPT_KEY_DESCRIPTOR_HEX_SIZE ((2 * FSCRYPT_KEY_DESCRIPTOR_SIZE) + 1)
-#define FSCRYPT_KEY_IDENTIFIER_HEX_SIZE ((2 * FSCRYPT_KEY_IDENTIFIER_SIZE) + 1)
-
-// Human-readable strings for encryption modes, indexed by the encryption mode
-static const char *const mode_strings[] = {
-    [FSCRYPT_MODE_AES_256_XTS] = "AES-256-XTS",
-    [FSCRYPT_MODE_AES_256_CTS] = "AES-256-CTS",
-    [FSCRYPT_MODE_AES_128_CBC] = "AES-128-CBC",
-    [FSCRYPT_MODE_AES_128_CTS] = "AES-128-CTS",
-    [FSCRYPT_MODE_SM4_XTS] = "SM4-XTS",
-    [FSCRYPT_MODE_SM4_CTS] = "SM4-CTS",
-    [FSCRYPT_MODE_ADIANTUM] = "Adiantum",
-    [FSCRYPT_MODE_AES_256_HCTR2] = "AES-256-HCTR2",
-};
-
-// Valid amounts of filename padding, indexed by the padding flag
-static const int padding_values[] = {4, 8, 16, 32};
-
 enum {
+  OPT_ALL_FILESYSTEMS,
   OPT_ALL_USERS,
-  OPT_CONTENTS,
-  OPT_DATA_UNIT_SIZE,
-  OPT_DIRECT_KEY,
-  OPT_FILENAMES,
   OPT_HW_WRAPPED_KEY,
-  OPT_IV_INO_LBLK_32,
-  OPT_IV_INO_LBLK_64,
-  OPT_PADDING,
+  OPT_JSON,
+  OPT_KEY_ID,
+  OPT_MULTIPLE,
+  OPT_WAIT,
 };
 
 /* util-linux style usage */
@@ -124,16 +147,29 @@ static void __attribute__((__noreturn__)) usage(FILE *out) {
       "  fscryptctl add_key <mountpoint>\n"
       "    Read a key from stdin, add it to the specified mounted filesystem,\n"
       "    and print its identifier.\n"
+      "  fscryptctl add_key --key-id=<key ID> <mountpoint>...\n"
+      "    Add the key in the specified fscrypt-provisioning keyring key to\n"
+      "    the specified mounted filesystems, and print its identifier.\n"
+      "  fscryptctl add_key --multiple [<mountpoint>]\n"
+      "    Read many keys from stdin, each preceded by a line with its size\n"
+      "    and optionally a mountpoint, and add them all.\n"
       "  fscryptctl remove_key <key identifier> <mountpoint>\n"
       "    Remove the key with the specified identifier from the specified\n"
       "    mounted filesystem.\n"
-      "  fscryptctl key_status <key identifier> <mountpoint>\n"
-      "    Get the status of the key with the specified identifier on the\n"
+      "  fscryptctl remove_key --all-filesystems <key identifier>\n"
+      "    Remove the key from all mounted filesystems that have it added.\n"
+      "  fscryptctl key_status <key identifier>... <mountpoint>\n"
+      "    Get the status of the keys with the specified identifiers on the\n"
       "    specified mounted filesystem.\n"
-      "  fscryptctl get_policy <file or directory>\n"
-      "    Print out the encryption policy for the specified path.\n"
-      "  fscryptctl set_policy <key identifier> <directory>\n"
-      "    Set up an encryption policy on the specified directory with the\n"
+      "  fscryptctl key_status --all-filesystems <key identifier>...\n"
+      "    Get the status of the keys on all mounted filesystems that\n"
+      "    support encryption.\n"
+      "  fscryptctl list_filesystems\n"
+      "    List the mounted filesystems that support encryption.\n"
+      "  fscryptctl get_policy <file or directory>...\n"
+      "    Print out the encryption policies for the specified paths.\n"
+      "  fscryptctl set_policy <key identifier> <directory>...\n"
+      "    Set up an encryption policy on the specified directories with the\n"
       "    specified key identifier.\n"
       "  fscryptctl import_hw_wrapped_key <block device>\n"
       "    Create a hardware-wrapped key by importing a raw key.\n"
@@ -142,6 +178,10 @@ static void __attribute__((__noreturn__)) usage(FILE *out) {
       "  fscryptctl prepare_hw_wrapped_key <block device>\n"
       "    Prepare a hardware-wrapped key to be used by converting it from\n"
       "    long-term wrapped form to ephemerally-wrapped form.\n"
+      "  fscryptctl batch\n"
+      "    Read commands from stdin, one per line, and execute them all in\n"
+      "    this process.  See `man fscryptctl` for the input and output\n"
+      "    formats.\n"
       "\nOptions:\n"
       "    -h, --help\n"
       "        print this help screen\n"
@@ -150,9 +190,21 @@ static void __attribute__((__noreturn__)) usage(FILE *out) {
       "    add_key\n"
       "        --hw-wrapped-key\n"
       "            add a hardware-wrapped key (rather than a raw key)\n"
+      "        --key-id=<key ID>\n"
+      "            use a key from the kernel keyring rather than stdin\n"
+      "        --multiple\n"
+      "            add many framed keys (see `man fscryptctl`)\n"
+      "    remove_key, key_status\n"
+      "        --all-filesystems\n"
+      "            use all mounted filesystems that support encryption\n"
       "    remove_key\n"
       "        --all-users\n"
       "            force-remove all users' claims to the key (requires root)\n"
+      "        --wait[=<seconds>]\n"
+      "            retry until files using the key are closed (default: 10)\n"
+      "    key_status, get_policy\n"
+      "        --json\n"
+      "            print one JSON object per line for each key or path\n"
       "    set_policy\n"
       "        --contents=<mode>\n"
       "            contents encryption mode (default: AES-256-XTS)\n"
@@ -168,6 +220,9 @@ static void __attribute__((__noreturn__)) usage(FILE *out) {
       "            optimize for eMMC inline crypto hardware (not recommended)\n"
       "        --data-unit-size=<du_size>\n"
       "            data unit size in bytes (default: filesystem block size)\n"
+      "        --dirs-from=<file>\n"
+      "            also read directories from file, one per line (- means\n"
+      "            stdin)\n"
       "\nNotes:\n"
       "  Keys are identified by 32-character hex strings (key identifiers).\n"
       "\n"
@@ -179,18 +234,32 @@ static void __attribute__((__noreturn__)) usage(FILE *out) {
   exit(out == stderr ? EXIT_FAILURE : EXIT_SUCCESS);
 }
 
+// Handles an invalid option given to a command.  Normally this shows the usage
+// and exits, but in batch mode the error just becomes the result of the current
+// command so that the next command can still be executed.
+static int usage_error(void) {
+  if (!batch_mode) {
+    usage(stderr);
+  }
+  fputs("error: invalid usage; run `fscryptctl --help` for help\n", stderr);
+  return EXIT_FAILURE;
+}
+
 // Preprocesses argc and argv for a command that takes no options.  (It may take
 // positional parameters.)  This makes the command handle all options as unknown
 // options and handle "--" as "end of options", rather than treating them as
 // positional parameters.  This way, we can add options in the future if needed.
-static void handle_no_options(int *argc, char *const *argv[]) {
+// Returns false if an option was given.
+static bool handle_no_options(int *argc, char *const *argv[]) {
   static const struct option no_options[] = {{NULL, 0, NULL, 0}};
   int ch = getopt_long(*argc, *argv, "", no_options, NULL);
   if (ch != -1) {
-    usage(stderr);
+    usage_error();
+    return false;
   }
   *argc -= optind;
   *argv += optind;
+  return true;
 }
 
 // Describes common error codes for the fscrypt ioctls.
@@ -250,94 +319,199 @@ static const char *describe_fscrypt_v2_error(int errno_val) {
   return describe_fscrypt_error(errno_val);
 }
 
-// Converts str to an encryption mode.  Returns false if the string does not
-// correspond to an encryption mode.
-static bool string_to_mode(const char *str, uint8_t *mode_ret) {
-  for (size_t i = 0; i < ARRAY_SIZE(mode_strings); i++) {
-    if (mode_strings[i] != NULL && strcmp(str, mode_strings[i]) == 0) {
-      *mode_ret = i;
-      return true;
-    }
+// Parses the serial number of a key in the kernel keyring.
+static bool parse_key_id(const char *str, __u32 *key_id_ret) {
+  char *end;
+  errno = 0;
+  unsigned long key_id = strtoul(str, &end, 10);
+  if (*str < '1' || *str > '9' || *end != '\0' || errno != 0 ||
+      key_id > INT32_MAX) {
+    return false;
   }
-  return false;
+  *key_id_ret = key_id;
+  return true;
 }
 
-// Converts the encryption mode to a human-readable string.  Returns NULL if the
-// mode is not a valid encryption mode.
-static const char *mode_to_string(uint8_t mode) {
-  if (mode >= ARRAY_SIZE(mode_strings)) {
-    return NULL;
+static bool parse_timeout(const char *str, unsigned int *seconds_ret) {
+  char *end;
+  errno = 0;
+  unsigned long seconds = strtoul(str, &end, 10);
+  if (*str < '0' || *str > '9' || *end != '\0' || errno != 0 ||
+      seconds > MAX_REMOVE_KEY_WAIT_TIMEOUT) {
+    return false;
   }
-  return mode_strings[mode];
+  *seconds_ret = seconds;
+  return true;
 }
 
-// Converts an amount of padding (as a string) into the appropriate padding
-// flag. Returns -1 if the flag is invalid.
-static int string_to_padding_flag(const char *str) {
-  int padding = atoi(str);
-  for (size_t i = 0; i < ARRAY_SIZE(padding_values); i++) {
-    if (padding == padding_values[i]) {
-      return i;
-    }
-  }
-  return -1;
+static int64_t monotonic_ns(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (int64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
 }
 
-static bool parse_data_unit_size(const char *str,
-                                 uint8_t *log2_data_unit_size_ret) {
-  int du_size = atoi(str);
-  int bits = 0;
+static int64_t monotonic_ms(void) { return monotonic_ns() / 1000000; }
 
-  while ((1LL << bits) < du_size) {
-    bits++;
+static void sleep_ms(int64_t ms) {
+  struct timespec ts = {.tv_sec = ms / 1000, .tv_nsec = (ms % 1000) * 1000000};
+  while (nanosleep(&ts, &ts) != 0 && errno == EINTR) {
   }
-  *log2_data_unit_size_ret = bits;
-  return du_size > 1 && (1LL << bits) == du_size;
 }
 
-// Converts an array of bytes to hex.  The output string will be
-// (2*num_bytes)+1 characters long including the null terminator.
-static void bytes_to_hex(const uint8_t *bytes, size_t num_bytes, char *hex) {
-  for (size_t i = 0; i < num_bytes; i++) {
-    sprintf(&hex[2 * i], "%02x", bytes[i]);
-  }
+// -----------------------------------------------------------------------------
+//                                 Tracing
+// -----------------------------------------------------------------------------
+
+// If the environment variable FSCRYPTCTL_TRACE is set to the number of an open
+// file descriptor, then a trace record is written to that file descriptor for
+// each command and for each open, ioctl, read, and write that it does.  Each
+// record is one line of space-separated key=value fields:
+//
+//   fscryptctl-trace pid=PID cmd=COMMAND op=OP name=NAME start_ns=START
+//       duration_ns=DURATION result=RESULT [errno=ERRNO] [path=PATH]
+//
+// where START is a CLOCK_MONOTONIC timestamp.  Each record is written with a
+// single write(), so records from concurrent processes sharing a pipe don't get
+// interleaved.  An invalid value only causes a warning, so that tracing can
+// never make a command fail.
+static void init_tracing(void) {
+  const char *value = getenv("FSCRYPTCTL_TRACE");
+  char *end;
+
+  if (value == NULL || *value == '\0') {
+    return;
+  }
+  errno = 0;
+  long fd = strtol(value, &end, 10);
+  if (*value < '0' || *value > '9' || *end != '\0' || errno != 0 ||
+      fd > INT_MAX || fcntl(fd, F_GETFD) < 0) {
+    fprintf(stderr, "warning: ignoring invalid FSCRYPTCTL_TRACE: %s\n", value);
+    return;
+  }
+  trace_fd = fd;
 }
 
-// Converts a hex string to bytes, where the output length is known.
-static bool hex_to_bytes(const char *hex, uint8_t *bytes, size_t num_bytes) {
-  if (strlen(hex) != 2 * num_bytes) {
-    return false;
-  }
-  for (size_t i = 0; i < num_bytes; i++) {
-    // We must read two hex characters of input into one byte of buffer.
-    int chars_read = 0;
-    int ret = sscanf(&hex[2 * i], "%2hhx%n", &bytes[i], &chars_read);
-    if (ret != 1 || chars_read != 2) {
-      return false;
+static int64_t trace_start(void) { return trace_fd >= 0 ? monotonic_ns() : 0; }
+
+// Appends a path to a trace record, escaping whitespace, control characters,
+// and backslashes as \xHH so that the record stays one field per path.
+static size_t append_trace_path(char *buf, size_t pos, size_t size,
+                                const char *path) {
+  pos += snprintf(&buf[pos], size - pos, " path=");
+  for (const unsigned char *p = (const unsigned char *)path; *p; p++) {
+    if (pos + 5 >= size) {
+      break;
+    }
+    if (*p <= ' ' || *p == '\\' || *p == 0x7f) {
+      pos += sprintf(&buf[pos], "\\x%02x", *p);
+    } else {
+      buf[pos++] = *p;
     }
   }
-  return true;
+  return pos;
+}
+
+// Writes a trace record for an operation that started at |start| (a value
+// returned by trace_start()) and just finished with the given result.  errno is
+// preserved, so that callers can still report the operation's error.
+static void trace_end(const char *op, const char *name, const char *path,
+                      int64_t start, long result) {
+  if (trace_fd < 0) {
+    return;
+  }
+  int saved_errno = errno;
+  char buf[1024];
+  int64_t now = monotonic_ns();
+  size_t pos = snprintf(buf, sizeof(buf),
+                        "fscryptctl-trace pid=%d cmd=%s op=%s name=%s "
+                        "start_ns=%lld duration_ns=%lld result=%ld",
+                        (int)getpid(), trace_command, op, name,
+                        (long long)start, (long long)(now - start), result);
+  if (result < 0) {
+    pos += snprintf(&buf[pos], sizeof(buf) - pos, " errno=%d", saved_errno);
+  }
+  if (path != NULL) {
+    pos = append_trace_path(buf, pos, sizeof(buf) - 1, path);
+  }
+  buf[pos++] = '\n';
+  // Tracing is best-effort, so a failed write is ignored.
+  if (write(trace_fd, buf, pos) < 0) {
+  }
+  errno = saved_errno;
+}
+
+static const char *ioctl_name(unsigned long request) {
+  switch (request) {
+    case FS_IOC_SET_ENCRYPTION_POLICY:
+      return "FS_IOC_SET_ENCRYPTION_POLICY";
+    case FS_IOC_GET_ENCRYPTION_POLICY_EX:
+      return "FS_IOC_GET_ENCRYPTION_POLICY_EX";
+    case FS_IOC_ADD_ENCRYPTION_KEY:
+      return "FS_IOC_ADD_ENCRYPTION_KEY";
+    case FS_IOC_REMOVE_ENCRYPTION_KEY:
+      return "FS_IOC_REMOVE_ENCRYPTION_KEY";
+    case FS_IOC_REMOVE_ENCRYPTION_KEY_ALL_USERS:
+      return "FS_IOC_REMOVE_ENCRYPTION_KEY_ALL_USERS";
+    case FS_IOC_GET_ENCRYPTION_KEY_STATUS:
+      return "FS_IOC_GET_ENCRYPTION_KEY_STATUS";
+    case BLKCRYPTOIMPORTKEY:
+      return "BLKCRYPTOIMPORTKEY";
+    case BLKCRYPTOGENERATEKEY:
+      return "BLKCRYPTOGENERATEKEY";
+    case BLKCRYPTOPREPAREKEY:
+      return "BLKCRYPTOPREPAREKEY";
+  }
+  return "unknown";
+}
+
+static int traced_open(const char *path, int flags) {
+  int64_t start = trace_start();
+  int fd = open(path, flags);
+  trace_end("open", "open", path, start, fd);
+  return fd;
+}
+
+static int traced_ioctl(int fd, unsigned long request, void *arg) {
+  int64_t start = trace_start();
+  int ret = ioctl(fd, request, arg);
+  trace_end("ioctl", ioctl_name(request), NULL, start, ret);
+  return ret;
+}
+
+// Executes a command, tracing the command as a whole and the flush of any
+// output that it buffered in stdout.
+static int traced_command(const char *name, int (*func)(int, char *const *),
+                          int argc, char *const argv[]) {
+  const char *saved_command = trace_command;
+  trace_command = name;
+  int64_t start = trace_start();
+  int status = func(argc, argv);
+  int64_t flush_start = trace_start();
+  int ret = fflush(stdout);
+  trace_end("write", "stdout", NULL, flush_start, ret == 0 ? 0 : -1);
+  trace_end("command", name, NULL, start, status);
+  trace_command = saved_command;
+  return status;
 }
 
 // Builds a 'struct fscrypt_key_specifier' for passing to the kernel, given a
 // key identifier hex string.
 static bool build_key_specifier(const char *identifier_hex,
                                 struct fscrypt_key_specifier *key_spec) {
-  memset(key_spec, 0, sizeof(*key_spec));
-  if (!hex_to_bytes(identifier_hex, key_spec->u.identifier,
-                    FSCRYPT_KEY_IDENTIFIER_SIZE)) {
+  if (!fscryptctl_build_key_specifier(identifier_hex, key_spec)) {
     fprintf(stderr, "error: invalid key identifier: %s\n", identifier_hex);
     return false;
   }
-  key_spec->type = FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER;
   return true;
 }
 
 static ssize_t read_until_limit_or_eof(int fd, uint8_t *buf, size_t limit) {
+  int64_t start = trace_start();
   size_t pos = 0;
   while (pos < limit) {
     ssize_t ret = read(fd, &buf[pos], limit - pos);
     if (ret < 0) {
+      trace_end("read", "read", NULL, start, ret);
       return ret;
     }
     if (ret == 0) {
@@ -345,9 +519,15 @@ static ssize_t read_until_limit_or_eof(int fd, uint8_t *buf, size_t limit) {
     }
     pos += ret;
   }
+  trace_end("read", "read", NULL, start, pos);
   return pos;
 }
 
+// In batch mode, the standard input of the current command, which the batch
+// command has already read from its own standard input.
+static const uint8_t *batch_input;
+static size_t batch_input_size;
+
 // Reads a key, of size at least FSCRYPT_MIN_KEY_SIZE bytes and at most max_size
 // bytes, from standard input into the provided buffer.  On success, returns the
 // key size in bytes.  On failure, returns 0.
@@ -356,7 +536,13 @@ static ssize_t read_until_limit_or_eof(int fd, uint8_t *buf, size_t limit) {
 // prevent the key from being copied into the internal buffer of the 'FILE *'.
 static size_t read_key(uint8_t *raw_key, size_t max_size) {
   uint8_t *buf = xzalloc(max_size + 1);
-  ssize_t ret = read_until_limit_or_eof(STDIN_FILENO, buf, max_size + 1);
+  ssize_t ret;
+  if (batch_mode) {
+    ret = batch_input_size < max_size + 1 ? batch_input_size : max_size + 1;
+    memcpy(buf, batch_input, ret);
+  } else {
+    ret = read_until_limit_or_eof(STDIN_FILENO, buf, max_size + 1);
+  }
   if (ret < 0) {
     fprintf(stderr, "error: reading from stdin: %s\n", strerror(errno));
     ret = 0;
@@ -381,47 +567,491 @@ cleanup:
 }
 
 static bool full_write(int fd, const uint8_t *buf, size_t size) {
+  int64_t start = trace_start();
+  size_t total = size;
   while (size) {
     ssize_t ret = write(fd, buf, size);
     if (ret < 0) {
+      trace_end("write", "write", NULL, start, ret);
       fprintf(stderr, "error: writing output: %s\n", strerror(errno));
       return false;
     }
     buf += ret;
     size -= ret;
   }
+  trace_end("write", "write", NULL, start, total);
   return true;
 }
 
-static bool get_policy(const char *path,
-                       struct fscrypt_get_policy_ex_arg *arg) {
-  int fd = open(path, O_RDONLY | O_CLOEXEC);
+// File descriptors for mountpoints that are kept open in batch mode, so that
+// they can be reused by later commands that operate on the same mountpoint.
+static struct {
+  char *path;
+  int fd;
+} mountpoint_cache[MAX_CACHED_MOUNTPOINTS];
+static size_t num_cached_mountpoints;
+
+// Returns true if the given file descriptor refers to the root directory of a
+// mounted filesystem.
+static bool is_filesystem_root(int fd) {
+  struct stat stbuf, parent_stbuf;
+  return fstat(fd, &stbuf) == 0 &&
+         fstatat(fd, "..", &parent_stbuf, 0) == 0 &&
+         (stbuf.st_dev != parent_stbuf.st_dev ||
+          stbuf.st_ino == parent_stbuf.st_ino);
+}
+
+// Opens a mountpoint for the key management ioctls.  In batch mode and for
+// "add_key --multiple", file descriptors for filesystem root directories are
+// cached and reused.  Other directories aren't cached, since holding a file
+// descriptor open for an encrypted directory would keep its key in-use.
+static int open_mountpoint(const char *mountpoint) {
+  for (size_t i = 0; i < num_cached_mountpoints; i++) {
+    if (strcmp(mountpoint, mountpoint_cache[i].path) == 0) {
+      return mountpoint_cache[i].fd;
+    }
+  }
+  int fd = traced_open(mountpoint, O_RDONLY | O_CLOEXEC);
+  if (fd >= 0 && cache_mountpoints &&
+      num_cached_mountpoints < MAX_CACHED_MOUNTPOINTS &&
+      is_filesystem_root(fd)) {
+    char *path = strdup(mountpoint);
+    if (path) {
+      mountpoint_cache[num_cached_mountpoints].path = path;
+      mountpoint_cache[num_cached_mountpoints].fd = fd;
+      num_cached_mountpoints++;
+    }
+  }
+  return fd;
+}
+
+// Closes a file descriptor returned by open_mountpoint(), unless it is cached.
+static void close_mountpoint(int fd) {
+  for (size_t i = 0; i < num_cached_mountpoints; i++) {
+    if (mountpoint_cache[i].fd == fd) {
+      return;
+    }
+  }
+  close(fd);
+}
+
+static void clear_mountpoint_cache(void) {
+  for (size_t i = 0; i < num_cached_mountpoints; i++) {
+    close(mountpoint_cache[i].fd);
+    free(mountpoint_cache[i].path);
+  }
+  num_cached_mountpoints = 0;
+}
+
+// -----------------------------------------------------------------------------
+//                           Filesystem discovery
+// -----------------------------------------------------------------------------
+
+// The types of filesystem that can support encryption.  Mounts of other types
+// are never opened, since opening e.g. an autofs mountpoint can trigger a mount
+// and opening a stale network mount can hang.
+static const char *const encryption_fs_types[] = {"ext4", "f2fs", "ubifs",
+                                                  "ceph"};
+
+// A mount of the root directory of a filesystem of one of the above types, and
+// whether the filesystem supports encryption.  |escaped_mountpoint| is the
+// mountpoint as escaped in /proc/self/mountinfo, which is also how it is
+// stored in the mount cache file.
+struct mount {
+  int id;
+  unsigned int major;
+  unsigned int minor;
+  char *escaped_mountpoint;
+  char *mountpoint;
+  bool supported;
+};
+
+// The mounts found by the last call to discover_filesystems().  In batch mode,
+// /proc/self/mountinfo is also kept open, so that polling it can tell whether
+// the mounts have changed since then.
+static struct mount *mounts;
+static size_t num_mounts;
+static int mountinfo_fd = -1;
+
+static void free_mounts(struct mount *list, size_t count) {
+  for (size_t i = 0; i < count; i++) {
+    free(list[i].escaped_mountpoint);
+    free(list[i].mountpoint);
+  }
+  free(list);
+}
+
+static void clear_filesystem_cache(void) {
+  free_mounts(mounts, num_mounts);
+  mounts = NULL;
+  num_mounts = 0;
+  if (mountinfo_fd >= 0) {
+    close(mountinfo_fd);
+    mountinfo_fd = -1;
+  }
+}
+
+// Reads the whole of a file, from the beginning, into a null-terminated buffer
+// which the caller must free.
+static char *read_whole_file(int fd) {
+  size_t size = 0;
+  size_t capacity = 4096;
+  char *buf = malloc(capacity);
+
+  if (buf == NULL || lseek(fd, 0, SEEK_SET) != 0) {
+    free(buf);
+    return NULL;
+  }
+  for (;;) {
+    if (size + 1 == capacity) {
+      char *new_buf = realloc(buf, capacity * 2);
+      if (new_buf == NULL) {
+        free(buf);
+        return NULL;
+      }
+      buf = new_buf;
+      capacity *= 2;
+    }
+    ssize_t ret = read(fd, &buf[size], capacity - 1 - size);
+    if (ret < 0) {
+      if (errno == EINTR) {
+        continue;
+      }
+      free(buf);
+      return NULL;
+    }
+    if (ret == 0) {
+      break;
+    }
+    size += ret;
+  }
+  buf[size] = '\0';
+  return buf;
+}
+
+// Decodes the octal escapes (such as \040 for a space) that mountinfo uses in
+// paths.  Returns a new string, or NULL if out of memory.
+static char *unescape_mountinfo_path(const char *escaped) {
+  char *path = malloc(strlen(escaped) + 1);
+  char *dst = path;
+
+  if (path == NULL) {
+    return NULL;
+  }
+  for (const char *src = escaped; *src; dst++) {
+    if (src[0] == '\\' && src[1] >= '0' && src[1] <= '3' && src[2] >= '0' &&
+        src[2] <= '7' && src[3] >= '0' && src[3] <= '7') {
+      *dst = (char)((src[1] - '0') * 64 + (src[2] - '0') * 8 + (src[3] - '0'));
+      src += 4;
+    } else {
+      *dst = *src++;
+    }
+  }
+  *dst = '\0';
+  return path;
+}
+
+// Parses a line of /proc/self/mountinfo.  Returns true if it is a mount of the
+// root directory of a filesystem whose type can support encryption, in which
+// case *m is filled in except for m->mountpoint and m->supported.  The line is
+// modified.
+static bool parse_mountinfo_line(char *line, struct mount *m) {
+  char *fields[64];
+  size_t num_fields = 0;
+  char *saveptr;
+
+  for (char *field = strtok_r(line, " ", &saveptr);
+       field != NULL && num_fields < ARRAY_SIZE(fields);
+       field = strtok_r(NULL, " ", &saveptr)) {
+    fields[num_fields++] = field;
+  }
+  // Fields: ID, parent ID, major:minor, root, mountpoint, options, optional
+  // fields, "-", filesystem type, source, superblock options.
+  size_t sep = 6;
+  while (sep < num_fields && strcmp(fields[sep], "-") != 0) {
+    sep++;
+  }
+  if (sep + 1 >= num_fields || strcmp(fields[3], "/") != 0 ||
+      sscanf(fields[0], "%d", &m->id) != 1 ||
+      sscanf(fields[2], "%u:%u", &m->major, &m->minor) != 2) {
+    return false;
+  }
+  for (size_t i = 0; i < ARRAY_SIZE(encryption_fs_types); i++) {
+    if (strcmp(fields[sep + 1], encryption_fs_types[i]) == 0) {
+      m->escaped_mountpoint = fields[4];
+      return true;
+    }
+  }
+  return false;
+}
+
+// Looks up a mount in a list of previously discovered mounts.  The mount ID
+// alone isn't enough, since mount IDs are reused after unmounting.
+static const struct mount *find_mount(const struct mount *list, size_t count,
+                                      const struct mount *m) {
+  for (size_t i = 0; i < count; i++) {
+    if (list[i].id == m->id && list[i].major == m->major &&
+        list[i].minor == m->minor &&
+        strcmp(list[i].escaped_mountpoint, m->escaped_mountpoint) == 0) {
+      return &list[i];
+    }
+  }
+  return NULL;
+}
+
+// Finds out whether a filesystem supports encryption by getting the status of
+// a key that can't exist, which needs just one ioctl.
+static bool probe_encryption_support(const char *mountpoint) {
+  struct fscrypt_get_key_status_arg arg = {0};
+  int fd = traced_open(mountpoint, O_RDONLY | O_CLOEXEC);
+
   if (fd < 0) {
-    fprintf(stderr, "error: opening %s: %s\n", path, strerror(errno));
     return false;
   }
+  arg.key_spec.type = FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER;
+  int ret = traced_ioctl(fd, FS_IOC_GET_ENCRYPTION_KEY_STATUS, &arg);
+  close(fd);
+  return ret == 0;
+}
+
+// Loads the probe results saved in the mount cache file.  The file is ignored
+// if it could have been written by another user, since it decides which
+// filesystems "--all-filesystems" operates on.
+static void load_mount_cache(const char *path, struct mount **list_ret,
+                             size_t *count_ret) {
+  FILE *file = fopen(path, "re");
+  struct stat stbuf;
+  char line[PATH_MAX * 4 + 64];
+  struct mount *list = NULL;
+  size_t count = 0;
+
+  *list_ret = NULL;
+  *count_ret = 0;
+  if (file == NULL) {
+    return;
+  }
+  if (fstat(fileno(file), &stbuf) != 0 || stbuf.st_uid != geteuid() ||
+      (stbuf.st_mode & (S_IWGRP | S_IWOTH))) {
+    fprintf(stderr, "warning: ignoring unsafe mount cache %s\n", path);
+    fclose(file);
+    return;
+  }
+  while (fgets(line, sizeof(line), file)) {
+    struct mount m = {0};
+    int supported, pos = 0;
+
+    line[strcspn(line, "\n")] = '\0';
+    if (sscanf(line, "%d %u:%u %d %n", &m.id, &m.major, &m.minor, &supported,
+               &pos) != 4 ||
+        pos == 0 || line[pos] == '\0') {
+      continue;
+    }
+    struct mount *new_list = realloc(list, (count + 1) * sizeof(*list));
+    if (new_list == NULL) {
+      break;
+    }
+    list = new_list;
+    m.escaped_mountpoint = strdup(&line[pos]);
+    if (m.escaped_mountpoint == NULL) {
+      break;
+    }
+    m.supported = supported;
+    list[count++] = m;
+  }
+  fclose(file);
+  *list_ret = list;
+  *count_ret = count;
+}
+
+// Atomically replaces the mount cache file with the given probe results.
+static void save_mount_cache(const char *path, const struct mount *list,
+                             size_t count) {
+  char tmp_path[PATH_MAX];
+  FILE *file = NULL;
+
+  if (snprintf(tmp_path, sizeof(tmp_path), "%s.tmp.%d", path, (int)getpid()) >=
+      (int)sizeof(tmp_path)) {
+    return;
+  }
+  int fd = open(tmp_path, O_WRONLY | O_CREAT | O_EXCL | O_CLOEXEC, 0600);
+  if (fd < 0 || (file = fdopen(fd, "w")) == NULL) {
+    goto fail;
+  }
+  for (size_t i = 0; i < count; i++) {
+    fprintf(file, "%d %u:%u %d %s\n", list[i].id, list[i].major,
+            list[i].minor, list[i].supported, list[i].escaped_mountpoint);
+  }
+  fd = -1;
+  if (fclose(file) != 0) {
+    file = NULL;
+    goto fail;
+  }
+  file = NULL;
+  if (rename(tmp_path, path) == 0) {
+    return;
+  }
+fail:
+  fprintf(stderr, "warning: failed to write mount cache %s: %s\n", path,
+          strerror(errno));
+  if (file != NULL) {
+    fclose(file);
+  } else if (fd >= 0) {
+    close(fd);
+  }
+  unlink(tmp_path);
+}
+
+// Finds the mounted filesystems that support encryption.  /proc/self/mountinfo
+// is parsed, and each filesystem whose type can support encryption is probed.
+// Probe results are reused from the previous call in batch mode, and from the
+// file named by the FSCRYPTCTL_MOUNT_CACHE environment variable if it is set,
+// so that a filesystem is only probed once per mount.  In batch mode, nothing
+// is re-read at all if the mounts haven't changed.  Returns false on error.
+static bool discover_filesystems(void) {
+  const char *cache_path = getenv("FSCRYPTCTL_MOUNT_CACHE");
+  struct mount *cached = NULL;
+  size_t num_cached = 0;
+  struct mount *list = NULL;
+  size_t count = 0;
+  bool probed = false;
+  bool ok = false;
+  char *contents = NULL;
+
+  if (mountinfo_fd >= 0) {
+    struct pollfd pfd = {.fd = mountinfo_fd, .events = POLLPRI};
+    if (poll(&pfd, 1, 0) == 0) {
+      return true;
+    }
+  } else {
+    mountinfo_fd = open("/proc/self/mountinfo", O_RDONLY | O_CLOEXEC);
+    if (mountinfo_fd < 0) {
+      fprintf(stderr, "error: opening /proc/self/mountinfo: %s\n",
+              strerror(errno));
+      return false;
+    }
+  }
+  contents = read_whole_file(mountinfo_fd);
+  if (contents == NULL) {
+    fprintf(stderr, "error: reading /proc/self/mountinfo: %s\n",
+            strerror(errno));
+    goto cleanup;
+  }
+  if (cache_path != NULL && *cache_path != '\0') {
+    load_mount_cache(cache_path, &cached, &num_cached);
+  }
+
+  char *saveptr;
+  for (char *line = strtok_r(contents, "\n", &saveptr); line != NULL;
+       line = strtok_r(NULL, "\n", &saveptr)) {
+    struct mount m = {0};
+    if (!parse_mountinfo_line(line, &m)) {
+      continue;
+    }
+    const struct mount *old = find_mount(mounts, num_mounts, &m);
+    if (old == NULL) {
+      old = find_mount(cached, num_cached, &m);
+    }
+    m.escaped_mountpoint = strdup(m.escaped_mountpoint);
+    m.mountpoint = unescape_mountinfo_path(m.escaped_mountpoint);
+    struct mount *new_list = realloc(list, (count + 1) * sizeof(*list));
+    if (new_list != NULL) {
+      list = new_list;
+    }
+    if (m.escaped_mountpoint == NULL || m.mountpoint == NULL ||
+        new_list == NULL) {
+      free(m.escaped_mountpoint);
+      free(m.mountpoint);
+      fputs("error: out of memory\n", stderr);
+      goto cleanup;
+    }
+    if (old != NULL) {
+      m.supported = old->supported;
+    } else {
+      m.supported = probe_encryption_support(m.mountpoint);
+      probed = true;
+    }
+    list[count++] = m;
+  }
+  if (probed && cache_path != NULL && *cache_path != '\0') {
+    save_mount_cache(cache_path, list, count);
+  }
+  free_mounts(mounts, num_mounts);
+  mounts = list;
+  num_mounts = count;
+  list = NULL;
+  count = 0;
+  ok = true;
+cleanup:
+  free_mounts(list, count);
+  free_mounts(cached, num_cached);
+  free(contents);
+  if (!batch_mode || !ok) {
+    close(mountinfo_fd);
+    mountinfo_fd = -1;
+  }
+  return ok;
+}
+
+// Returns true if the i'th discovered mount is the first mount of a filesystem
+// that supports encryption.  Each filesystem is only listed once, even if it
+// is mounted in several places.
+static bool is_listed_filesystem(size_t i) {
+  if (!mounts[i].supported) {
+    return false;
+  }
+  for (size_t j = 0; j < i; j++) {
+    if (mounts[j].supported && mounts[j].major == mounts[i].major &&
+        mounts[j].minor == mounts[i].minor) {
+      return false;
+    }
+  }
+  return true;
+}
+
+// Gets the encryption policy of a file or directory.  Returns 0 on success, or
+// else the errno value, with *open_failed_ret set to true if the file couldn't
+// be opened and false if the ioctl failed.
+static int try_get_policy(const char *path,
+                          struct fscrypt_get_policy_ex_arg *arg,
+                          bool *open_failed_ret) {
+  int fd = traced_open(path, O_RDONLY | O_CLOEXEC);
+  *open_failed_ret = fd < 0;
+  if (fd < 0) {
+    return errno;
+  }
 
   arg->policy_size = sizeof(arg->policy);
-  int ret = ioctl(fd, FS_IOC_GET_ENCRYPTION_POLICY_EX, arg);
+  int ret = traced_ioctl(fd, FS_IOC_GET_ENCRYPTION_POLICY_EX, arg);
+  int err = errno;
   close(fd);
+  return ret == 0 ? 0 : err;
+}
 
-  if (ret != 0) {
+static bool get_policy(const char *path,
+                       struct fscrypt_get_policy_ex_arg *arg) {
+  bool open_failed;
+  int err = try_get_policy(path, arg, &open_failed);
+  if (err == 0) {
+    return true;
+  }
+  if (open_failed) {
+    fprintf(stderr, "error: opening %s: %s\n", path, strerror(err));
+  } else {
     fprintf(stderr, "error: getting policy for %s: %s\n", path,
-            describe_get_policy_error(errno));
-    return false;
+            describe_get_policy_error(err));
   }
-  return true;
+  return false;
 }
 
 static bool set_policy(const char *path,
                        const struct fscrypt_policy_v2 *policy) {
-  int fd = open(path, O_RDONLY | O_CLOEXEC);
+  int fd = traced_open(path, O_RDONLY | O_CLOEXEC);
   if (fd < 0) {
     fprintf(stderr, "error: opening %s: %s\n", path, strerror(errno));
     return false;
   }
 
-  int ret = ioctl(fd, FS_IOC_SET_ENCRYPTION_POLICY, policy);
+  int ret = traced_ioctl(fd, FS_IOC_SET_ENCRYPTION_POLICY, (void *)policy);
   close(fd);
 
   if (ret != 0) {
@@ -436,12 +1066,194 @@ static bool set_policy(const char *path,
 //                                 Commands
 // -----------------------------------------------------------------------------
 
+// Adds the key in |arg| to the filesystem mounted at |mountpoint| and prints
+// its identifier.
+static bool add_key(const char *mountpoint, struct fscrypt_add_key_arg *arg) {
+  int fd = open_mountpoint(mountpoint);
+  if (fd < 0) {
+    fprintf(stderr, "error: opening %s: %s\n", mountpoint, strerror(errno));
+    return false;
+  }
+  if (traced_ioctl(fd, FS_IOC_ADD_ENCRYPTION_KEY, arg) != 0) {
+    fprintf(stderr, "error: adding key to %s: %s\n", mountpoint,
+            describe_fscrypt_v2_error(errno));
+    close_mountpoint(fd);
+    return false;
+  }
+  close_mountpoint(fd);
+
+  char identifier_hex[FSCRYPT_KEY_IDENTIFIER_HEX_SIZE];
+  fscryptctl_bytes_to_hex(arg->key_spec.u.identifier,
+                          FSCRYPT_KEY_IDENTIFIER_SIZE, identifier_hex);
+  puts(identifier_hex);
+  return true;
+}
+
+// Reads the header line of the next key record in the input of
+// "add_key --multiple".  This reads one byte at a time, so that none of the key
+// which follows the header is read.  Returns 1 if a header was read, 0 at the
+// end of the input, or -1 on error.
+static int read_key_header(char *header, size_t size, size_t key_num) {
+  int64_t start = trace_start();
+  size_t len = 0;
+  for (;;) {
+    char c;
+    ssize_t ret = read(STDIN_FILENO, &c, 1);
+    if (ret < 0) {
+      if (errno == EINTR) {
+        continue;
+      }
+      trace_end("read", "header", NULL, start, ret);
+      fprintf(stderr, "error: reading from stdin: %s\n", strerror(errno));
+      return -1;
+    }
+    if (ret == 0) {
+      trace_end("read", "header", NULL, start, len);
+      if (len == 0) {
+        return 0;
+      }
+      fprintf(stderr, "error: key %zu: unexpected end of input\n", key_num);
+      return -1;
+    }
+    if (c == '\n') {
+      trace_end("read", "header", NULL, start, len + 1);
+      header[len] = '\0';
+      return 1;
+    }
+    if (len == size - 1) {
+      trace_end("read", "header", NULL, start, len + 1);
+      fprintf(stderr, "error: key %zu: record header is too long\n", key_num);
+      return -1;
+    }
+    header[len++] = c;
+  }
+}
+
+// Implements "add_key --multiple", which reads a sequence of key records from
+// standard input and adds each key.  Each record is a header line containing
+// the key size in bytes, optionally followed by a space and the mountpoint to
+// add the key to, followed by exactly that many bytes of key.  Records without
+// a mountpoint use |default_mountpoint|.
+//
+// The keys are all read directly into the same buffer, which is locked into
+// memory so that key material never gets swapped out, and which is wiped after
+// each key.  Failing to add a key doesn't stop the later keys from being
+// added, but invalid input does.
+static int add_multiple_keys(const char *default_mountpoint, __u32 flags,
+                             size_t max_size) {
+  size_t arg_size = sizeof(struct fscrypt_add_key_arg) + max_size;
+  struct fscrypt_add_key_arg *arg = xzalloc(arg_size);
+  char *header = xzalloc(MAX_KEY_HEADER_SIZE);
+  size_t num_keys = 0;
+  size_t num_failures = 0;
+  bool input_ok = false;
+
+  if (mlock(arg, arg_size) != 0) {
+    fprintf(stderr, "error: locking key buffer into memory: %s\n",
+            strerror(errno));
+    free(arg);
+    free(header);
+    return EXIT_FAILURE;
+  }
+  cache_mountpoints = true;
+  for (;;) {
+    size_t key_num = num_keys + 1;
+    int ret = read_key_header(header, MAX_KEY_HEADER_SIZE, key_num);
+    if (ret <= 0) {
+      input_ok = (ret == 0);
+      break;
+    }
+
+    char *end;
+    errno = 0;
+    unsigned long size = strtoul(header, &end, 10);
+    if (header[0] < '0' || header[0] > '9' || errno != 0 ||
+        (*end != '\0' && *end != ' ')) {
+      fprintf(stderr, "error: key %zu: invalid record header\n", key_num);
+      break;
+    }
+    const char *mountpoint = *end == ' ' ? end + 1 : default_mountpoint;
+    if (size < FSCRYPT_MIN_KEY_SIZE || size > max_size) {
+      fprintf(stderr,
+              "error: key %zu: invalid key size %lu; it must be between %d "
+              "and %zu bytes\n",
+              key_num, size, FSCRYPT_MIN_KEY_SIZE, max_size);
+      break;
+    }
+    ssize_t n = read_until_limit_or_eof(STDIN_FILENO, arg->raw, size);
+    if (n < 0) {
+      fprintf(stderr, "error: reading from stdin: %s\n", strerror(errno));
+      break;
+    }
+    if ((size_t)n != size) {
+      fprintf(stderr, "error: key %zu: unexpected end of input\n", key_num);
+      break;
+    }
+    num_keys++;
+
+    memset(arg, 0, sizeof(*arg));
+    arg->raw_size = size;
+    arg->flags = flags;
+    arg->key_spec.type = FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER;
+    if (mountpoint == NULL || mountpoint[0] == '\0') {
+      fprintf(stderr, "error: key %zu: no mountpoint specified\n", key_num);
+      num_failures++;
+    } else if (!add_key(mountpoint, arg)) {
+      num_failures++;
+    }
+    secure_wipe(arg->raw, max_size);
+  }
+  cache_mountpoints = false;
+  clear_mountpoint_cache();
+
+  secure_wipe(arg, arg_size);
+  munlock(arg, arg_size);
+  free(arg);
+  free(header);
+  if (num_failures != 0) {
+    fprintf(stderr, "error: failed to add %zu of %zu keys\n", num_failures,
+            num_keys);
+  }
+  return input_ok && num_failures == 0 ? EXIT_SUCCESS : EXIT_FAILURE;
+}
+
+// Implements "add_key --key-id", which adds the key contained in an existing
+// "fscrypt-provisioning" key in the kernel keyring to each of the given
+// mountpoints.  The key itself never passes through this process.
+static int add_keyring_key(__u32 key_id, __u32 flags, int num_mountpoints,
+                           char *const mountpoints[]) {
+  struct fscrypt_add_key_arg arg;
+  int num_failures = 0;
+
+  for (int i = 0; i < num_mountpoints; i++) {
+    memset(&arg, 0, sizeof(arg));
+    arg.key_spec.type = FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER;
+    arg.key_id = key_id;
+    arg.flags = flags;
+    if (!add_key(mountpoints[i], &arg)) {
+      num_failures++;
+    }
+  }
+  if (num_failures != 0) {
+    if (num_mountpoints > 1) {
+      fprintf(stderr, "error: failed to add key to %d of %d mountpoints\n",
+              num_failures, num_mountpoints);
+    }
+    return EXIT_FAILURE;
+  }
+  return EXIT_SUCCESS;
+}
+
 static int cmd_add_key(int argc, char *const argv[]) {
   static const struct option add_key_options[] = {
       {"hw-wrapped-key", no_argument, NULL, OPT_HW_WRAPPED_KEY},
+      {"key-id", required_argument, NULL, OPT_KEY_ID},
+      {"multiple", no_argument, NULL, OPT_MULTIPLE},
       {NULL, 0, NULL, 0}};
   int max_size = FSCRYPT_MAX_KEY_SIZE;
   __u32 flags = 0;
+  __u32 key_id = 0;
+  bool multiple = false;
 
   int ch;
   while ((ch = getopt_long(argc, argv, "", add_key_options, NULL)) != -1) {
@@ -450,12 +1262,45 @@ static int cmd_add_key(int argc, char *const argv[]) {
         flags |= FSCRYPT_ADD_KEY_FLAG_HW_WRAPPED;
         max_size = MAX_WRAPPED_KEY_SIZE;
         break;
+      case OPT_KEY_ID:
+        if (!parse_key_id(optarg, &key_id)) {
+          fprintf(stderr, "error: invalid key ID: %s\n", optarg);
+          return EXIT_FAILURE;
+        }
+        break;
+      case OPT_MULTIPLE:
+        // In batch mode, standard input is the stream of batch commands.
+        if (batch_mode) {
+          fputs("error: --multiple can't be used in batch mode\n", stderr);
+          return EXIT_FAILURE;
+        }
+        multiple = true;
+        break;
       default:
-        usage(stderr);
+        return usage_error();
     }
   }
   argc -= optind;
   argv += optind;
+  if (key_id != 0) {
+    if (multiple) {
+      fputs("error: --key-id and --multiple can't be used together\n",
+            stderr);
+      return EXIT_FAILURE;
+    }
+    if (argc == 0) {
+      fputs("error: must specify at least one mountpoint\n", stderr);
+      return EXIT_FAILURE;
+    }
+    return add_keyring_key(key_id, flags, argc, argv);
+  }
+  if (multiple) {
+    if (argc > 1) {
+      fputs("error: must specify at most one default mountpoint\n", stderr);
+      return EXIT_FAILURE;
+    }
+    return add_multiple_keys(argc == 1 ? argv[0] : NULL, flags, max_size);
+  }
   if (argc != 1) {
     fputs("error: must specify a single mountpoint\n", stderr);
     return EXIT_FAILURE;
@@ -470,120 +1315,230 @@ static int cmd_add_key(int argc, char *const argv[]) {
   }
   arg->flags = flags;
   arg->key_spec.type = FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER;
-
-  int fd = open(mountpoint, O_RDONLY | O_CLOEXEC);
-  if (fd < 0) {
-    fprintf(stderr, "error: opening %s: %s\n", mountpoint, strerror(errno));
-    goto cleanup;
-  }
-  if (ioctl(fd, FS_IOC_ADD_ENCRYPTION_KEY, arg) != 0) {
-    fprintf(stderr, "error: adding key to %s: %s\n", mountpoint,
-            describe_fscrypt_v2_error(errno));
-    close(fd);
-    goto cleanup;
+  if (add_key(mountpoint, arg)) {
+    status = EXIT_SUCCESS;
   }
-  close(fd);
-
-  char identifier_hex[FSCRYPT_KEY_IDENTIFIER_HEX_SIZE];
-  bytes_to_hex(arg->key_spec.u.identifier, FSCRYPT_KEY_IDENTIFIER_SIZE,
-               identifier_hex);
-  puts(identifier_hex);
-  status = EXIT_SUCCESS;
 cleanup:
   wipe_and_free(arg, sizeof(*arg) + max_size);
   return status;
 }
 
+// Repeats a key removal that left the key incompletely removed, until the
+// files that were still in-use have been closed and the key is fully removed,
+// or until the timeout expires.  Each retry tries again to evict the files'
+// inodes.  The delay between retries starts small and doubles up to a limit.
+// Returns false if the ioctl fails; otherwise arg->removal_status_flags is
+// updated to the result of the last attempt.
+static bool wait_for_key_removal(int fd, unsigned long ioc,
+                                 struct fscrypt_remove_key_arg *arg,
+                                 unsigned int timeout) {
+  int64_t deadline = monotonic_ms() + (int64_t)timeout * 1000;
+  int64_t delay = MIN_REMOVE_KEY_RETRY_DELAY_MS;
+
+  while (arg->removal_status_flags &
+         FSCRYPT_KEY_REMOVAL_STATUS_FLAG_FILES_BUSY) {
+    int64_t remaining = deadline - monotonic_ms();
+    if (remaining <= 0) {
+      break;
+    }
+    sleep_ms(delay < remaining ? delay : remaining);
+    delay *= 2;
+    if (delay > MAX_REMOVE_KEY_RETRY_DELAY_MS) {
+      delay = MAX_REMOVE_KEY_RETRY_DELAY_MS;
+    }
+    arg->removal_status_flags = 0;
+    if (traced_ioctl(fd, ioc, arg) != 0) {
+      return false;
+    }
+  }
+  return true;
+}
+
+// Prints the warnings for a key removal that didn't fully remove the key, with
+// the mountpoint if it isn't NULL.  Returns false if "--wait" timed out.
+static bool show_removal_status(const struct fscrypt_remove_key_arg *arg,
+                                const char *mountpoint, bool wait,
+                                unsigned int timeout) {
+  const char *prefix = mountpoint ? mountpoint : "";
+  const char *separator = mountpoint ? ": " : "";
+
+  if (arg->removal_status_flags & FSCRYPT_KEY_REMOVAL_STATUS_FLAG_OTHER_USERS) {
+    printf("warning: %s%sother users still have this key added\n", prefix,
+           separator);
+  } else if (arg->removal_status_flags &
+             FSCRYPT_KEY_REMOVAL_STATUS_FLAG_FILES_BUSY) {
+    printf("warning: %s%ssome files using this key are still in-use\n",
+           prefix, separator);
+    if (wait) {
+      fprintf(stderr,
+              "error: %s%stimed out after %u seconds waiting for files to be "
+              "closed\n",
+              prefix, separator, timeout);
+      return false;
+    }
+  }
+  return true;
+}
+
+// Removes a key from one mounted filesystem, waiting for its files to be closed
+// if |wait| is true.  Returns 0 on success, -1 if the mountpoint couldn't be
+// opened (which has been reported), or else the errno value of the ioctl.
+static int remove_key_from(const char *mountpoint, unsigned long ioc,
+                           struct fscrypt_remove_key_arg *arg, bool wait,
+                           unsigned int timeout) {
+  int fd = open_mountpoint(mountpoint);
+  if (fd < 0) {
+    fprintf(stderr, "error: opening %s: %s\n", mountpoint, strerror(errno));
+    return -1;
+  }
+  arg->removal_status_flags = 0;
+  bool ok = traced_ioctl(fd, ioc, arg) == 0;
+  if (ok && wait &&
+      !(arg->removal_status_flags &
+        FSCRYPT_KEY_REMOVAL_STATUS_FLAG_OTHER_USERS)) {
+    ok = wait_for_key_removal(fd, ioc, arg, timeout);
+  }
+  int err = errno;
+  close_mountpoint(fd);
+  return ok ? 0 : err;
+}
+
+// Implements "remove_key --all-filesystems", which removes the key from every
+// mounted filesystem that supports encryption and has the key added.
+static int remove_key_from_all(unsigned long ioc,
+                               struct fscrypt_remove_key_arg *arg, bool wait,
+                               unsigned int timeout) {
+  int status = EXIT_SUCCESS;
+  size_t num_removed = 0;
+
+  if (!discover_filesystems()) {
+    return EXIT_FAILURE;
+  }
+  for (size_t i = 0; i < num_mounts; i++) {
+    if (!is_listed_filesystem(i)) {
+      continue;
+    }
+    const char *mountpoint = mounts[i].mountpoint;
+    int err = remove_key_from(mountpoint, ioc, arg, wait, timeout);
+    if (err == ENOKEY) {
+      continue;
+    }
+    if (err != 0) {
+      if (err > 0) {
+        fprintf(stderr, "error: removing key from %s: %s\n", mountpoint,
+                describe_fscrypt_v2_error(err));
+      }
+      status = EXIT_FAILURE;
+      continue;
+    }
+    num_removed++;
+    if (!show_removal_status(arg, mountpoint, wait, timeout)) {
+      status = EXIT_FAILURE;
+    }
+  }
+  if (num_removed == 0 && status == EXIT_SUCCESS) {
+    fputs("error: removing key: key not found on any filesystem\n", stderr);
+    status = EXIT_FAILURE;
+  }
+  return status;
+}
+
 static int cmd_remove_key(int argc, char *const argv[]) {
   unsigned long ioc = FS_IOC_REMOVE_ENCRYPTION_KEY;
+  bool all_filesystems = false;
+  bool wait = false;
+  unsigned int timeout = DEFAULT_REMOVE_KEY_WAIT_TIMEOUT;
 
   static const struct option remove_key_options[] = {
-      {"all-users", no_argument, NULL, OPT_ALL_USERS}, {NULL, 0, NULL, 0}};
+      {"all-filesystems", no_argument, NULL, OPT_ALL_FILESYSTEMS},
+      {"all-users", no_argument, NULL, OPT_ALL_USERS},
+      {"wait", optional_argument, NULL, OPT_WAIT},
+      {NULL, 0, NULL, 0}};
 
   int ch;
   while ((ch = getopt_long(argc, argv, "", remove_key_options, NULL)) != -1) {
     switch (ch) {
+      case OPT_ALL_FILESYSTEMS:
+        all_filesystems = true;
+        break;
       case OPT_ALL_USERS:
         ioc = FS_IOC_REMOVE_ENCRYPTION_KEY_ALL_USERS;
         break;
+      case OPT_WAIT:
+        wait = true;
+        if (optarg && !parse_timeout(optarg, &timeout)) {
+          fprintf(stderr, "error: invalid timeout: %s\n", optarg);
+          return EXIT_FAILURE;
+        }
+        break;
       default:
-        usage(stderr);
+        return usage_error();
     }
   }
   argc -= optind;
   argv += optind;
-  if (argc != 2) {
+  if (all_filesystems && argc != 1) {
+    fputs("error: must specify a single key identifier\n", stderr);
+    return EXIT_FAILURE;
+  }
+  if (!all_filesystems && argc != 2) {
     fputs("error: must specify a key identifier and a mountpoint\n", stderr);
     return EXIT_FAILURE;
   }
   const char *key_identifier = argv[0];
-  const char *mountpoint = argv[1];
 
   struct fscrypt_remove_key_arg arg = {0};
   if (!build_key_specifier(key_identifier, &arg.key_spec)) {
     return EXIT_FAILURE;
   }
+  if (all_filesystems) {
+    return remove_key_from_all(ioc, &arg, wait, timeout);
+  }
 
-  int fd = open(mountpoint, O_RDONLY | O_CLOEXEC);
-  if (fd < 0) {
-    fprintf(stderr, "error: opening %s: %s\n", mountpoint, strerror(errno));
+  int err = remove_key_from(argv[1], ioc, &arg, wait, timeout);
+  if (err != 0) {
+    if (err > 0) {
+      fprintf(stderr, "error: removing key: %s\n",
+              describe_fscrypt_v2_error(err));
+    }
     return EXIT_FAILURE;
   }
-  int ret = ioctl(fd, ioc, &arg);
-  close(fd);
-  if (ret != 0) {
-    fprintf(stderr, "error: removing key: %s\n",
-            describe_fscrypt_v2_error(errno));
+  if (!show_removal_status(&arg, NULL, wait, timeout)) {
     return EXIT_FAILURE;
   }
-
-  if (arg.removal_status_flags & FSCRYPT_KEY_REMOVAL_STATUS_FLAG_OTHER_USERS) {
-    printf("warning: other users still have this key added\n");
-  } else if (arg.removal_status_flags &
-             FSCRYPT_KEY_REMOVAL_STATUS_FLAG_FILES_BUSY) {
-    printf("warning: some files using this key are still in-use\n");
-  }
   return EXIT_SUCCESS;
 }
 
-static int cmd_key_status(int argc, char *const argv[]) {
-  handle_no_options(&argc, &argv);
-  if (argc != 2) {
-    fputs("error: must specify a key identifier and a mountpoint\n", stderr);
-    return EXIT_FAILURE;
-  }
-  const char *key_identifier = argv[0];
-  const char *mountpoint = argv[1];
+// Prints a string as a JSON string.
+static void print_json_string(const char *str) {
+  size_t len = fscryptctl_format_json_string(str, NULL, 0);
+  char *buf = xzalloc(len + 1);
+  fscryptctl_format_json_string(str, buf, len + 1);
+  fputs(buf, stdout);
+  free(buf);
+}
 
-  struct fscrypt_get_key_status_arg arg = {0};
-  if (!build_key_specifier(key_identifier, &arg.key_spec)) {
-    return EXIT_FAILURE;
-  }
+// Finishes a JSON record that describes an error.
+static void show_json_error(int err, const char *message) {
+  printf(",\"error\":");
+  print_json_string(message);
+  printf(",\"errno\":%d}\n", err);
+}
 
-  int fd = open(mountpoint, O_RDONLY | O_CLOEXEC);
-  if (fd < 0) {
-    fprintf(stderr, "error: opening %s: %s\n", mountpoint, strerror(errno));
-    return EXIT_FAILURE;
-  }
-  int ret = ioctl(fd, FS_IOC_GET_ENCRYPTION_KEY_STATUS, &arg);
-  close(fd);
-  if (ret != 0) {
-    fprintf(stderr, "error: getting key status: %s\n",
-            describe_fscrypt_v2_error(errno));
-    return EXIT_FAILURE;
-  }
+static void show_key_status(const struct fscrypt_get_key_status_arg *arg) {
+  uint32_t status_flags = arg->status_flags;
 
-  switch (arg.status) {
+  switch (arg->status) {
     case FSCRYPT_KEY_STATUS_PRESENT:
       printf("Present");
-      if (arg.user_count || arg.status_flags) {
-        printf(" (user_count=%u", arg.user_count);
-        if (arg.status_flags & FSCRYPT_KEY_STATUS_FLAG_ADDED_BY_SELF) {
+      if (arg->user_count || status_flags) {
+        printf(" (user_count=%u", arg->user_count);
+        if (status_flags & FSCRYPT_KEY_STATUS_FLAG_ADDED_BY_SELF) {
           printf(", added_by_self");
         }
-        arg.status_flags &= ~FSCRYPT_KEY_STATUS_FLAG_ADDED_BY_SELF;
-        if (arg.status_flags) {
-          printf(", unknown_flags=0x%08x", arg.status_flags);
+        status_flags &= ~FSCRYPT_KEY_STATUS_FLAG_ADDED_BY_SELF;
+        if (status_flags) {
+          printf(", unknown_flags=0x%08x", status_flags);
         }
         printf(")");
       }
@@ -596,198 +1551,339 @@ static int cmd_key_status(int argc, char *const argv[]) {
       printf("Incompletely removed\n");
       break;
     default:
-      printf("Unknown status (%u)\n", arg.status);
+      printf("Unknown status (%u)\n", arg->status);
       break;
   }
-  return EXIT_SUCCESS;
 }
 
-static void show_encryption_mode(uint8_t mode_num, const char *type) {
-  const char *str = mode_to_string(mode_num);
-  if (str != NULL) {
-    printf("\t%s encryption mode: %s\n", type, str);
-  } else {
-    printf("\t%s encryption mode: Unknown (%d)\n", type, mode_num);
-  }
+static void show_json_key_status(const char *key_identifier,
+                                 const char *mountpoint,
+                                 const struct fscrypt_get_key_status_arg *arg) {
+  printf("{\"key_identifier\":");
+  print_json_string(key_identifier);
+  printf(",\"mountpoint\":");
+  print_json_string(mountpoint);
+  printf(",\"status\":%u,\"status_flags\":%u,\"user_count\":%u}\n",
+         arg->status, arg->status_flags, arg->user_count);
 }
 
-static void show_policy_flags(uint8_t flags) {
-  printf("\tFlags: PAD_%d",
-         padding_values[flags & FSCRYPT_POLICY_FLAGS_PAD_MASK]);
-  flags &= ~FSCRYPT_POLICY_FLAGS_PAD_MASK;
+static void show_json_key_status_error(const char *key_identifier,
+                                       const char *mountpoint, int err,
+                                       const char *message) {
+  printf("{\"key_identifier\":");
+  print_json_string(key_identifier);
+  printf(",\"mountpoint\":");
+  print_json_string(mountpoint);
+  show_json_error(err, message);
+}
 
-  if (flags & FSCRYPT_POLICY_FLAG_DIRECT_KEY) {
-    printf(", DIRECT_KEY");
-    flags &= ~FSCRYPT_POLICY_FLAG_DIRECT_KEY;
+// Prints the status of the specified keys on one mounted filesystem.  If
+// |show_mountpoint| is true, each line of text output begins with the
+// mountpoint.  Returns false if any status couldn't be gotten.
+static bool show_key_statuses(const char *mountpoint, int num_keys,
+                              char *const keys[], bool json,
+                              bool show_mountpoint) {
+  int fd = open_mountpoint(mountpoint);
+  if (fd < 0) {
+    int err = errno;
+    if (!json) {
+      fprintf(stderr, "error: opening %s: %s\n", mountpoint, strerror(err));
+      return false;
+    }
+    for (int i = 0; i < num_keys; i++) {
+      show_json_key_status_error(keys[i], mountpoint, err, strerror(err));
+    }
+    return false;
   }
 
-  if (flags & FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64) {
-    printf(", IV_INO_LBLK_64");
-    flags &= ~FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64;
-  }
+  bool ok = true;
+  for (int i = 0; i < num_keys; i++) {
+    const char *key_identifier = keys[i];
+    struct fscrypt_get_key_status_arg arg = {0};
 
-  if (flags & FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32) {
-    printf(", IV_INO_LBLK_32");
-    flags &= ~FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32;
-  }
+    if (json) {
+      if (!fscryptctl_build_key_specifier(key_identifier, &arg.key_spec)) {
+        show_json_key_status_error(key_identifier, mountpoint, EINVAL,
+                                   "invalid key identifier");
+        ok = false;
+        continue;
+      }
+    } else if (!build_key_specifier(key_identifier, &arg.key_spec)) {
+      ok = false;
+      continue;
+    }
 
-  if (flags != 0) {
-    printf(", Unknown (%02x)", flags);
-  }
+    if (traced_ioctl(fd, FS_IOC_GET_ENCRYPTION_KEY_STATUS, &arg) != 0) {
+      if (json) {
+        show_json_key_status_error(key_identifier, mountpoint, errno,
+                                   describe_fscrypt_v2_error(errno));
+      } else {
+        fprintf(stderr, "error: getting status of key %s: %s\n",
+                key_identifier, describe_fscrypt_v2_error(errno));
+      }
+      ok = false;
+      continue;
+    }
 
-  printf("\n");
+    if (json) {
+      show_json_key_status(key_identifier, mountpoint, &arg);
+    } else {
+      if (show_mountpoint) {
+        printf("%s: ", mountpoint);
+      }
+      if (num_keys > 1) {
+        printf("%s: ", key_identifier);
+      }
+      show_key_status(&arg);
+    }
+  }
+  close_mountpoint(fd);
+  return ok;
 }
 
-static void show_v1_encryption_policy(const struct fscrypt_policy_v1 *policy) {
-  char descriptor_hex[FSCRYPT_KEY_DESCRIPTOR_HEX_SIZE];
-  bytes_to_hex(policy->master_key_descriptor, FSCRYPT_KEY_DESCRIPTOR_SIZE,
-               descriptor_hex);
-  printf("\tMaster key descriptor: %s\n", descriptor_hex);
-  show_encryption_mode(policy->contents_encryption_mode, "Contents");
-  show_encryption_mode(policy->filenames_encryption_mode, "Filenames");
-  show_policy_flags(policy->flags);
-}
+// Print the status of the specified keys on the specified mounted filesystem,
+// or on all mounted filesystems that support encryption.
+static int cmd_key_status(int argc, char *const argv[]) {
+  bool all_filesystems = false;
+  bool json = false;
 
-static void show_v2_encryption_policy(const struct fscrypt_policy_v2 *policy) {
-  char identifier_hex[FSCRYPT_KEY_IDENTIFIER_HEX_SIZE];
-  bytes_to_hex(policy->master_key_identifier, FSCRYPT_KEY_IDENTIFIER_SIZE,
-               identifier_hex);
-  printf("\tMaster key identifier: %s\n", identifier_hex);
-  show_encryption_mode(policy->contents_encryption_mode, "Contents");
-  show_encryption_mode(policy->filenames_encryption_mode, "Filenames");
-  show_policy_flags(policy->flags);
-  if (policy->log2_data_unit_size) {
-    printf("\tData unit size: %u\n", 1U << policy->log2_data_unit_size);
-  } else {
-    printf("\tData unit size: default\n");
+  static const struct option key_status_options[] = {
+      {"all-filesystems", no_argument, NULL, OPT_ALL_FILESYSTEMS},
+      {"json", no_argument, NULL, OPT_JSON},
+      {NULL, 0, NULL, 0}};
+
+  int ch;
+  while ((ch = getopt_long(argc, argv, "", key_status_options, NULL)) != -1) {
+    switch (ch) {
+      case OPT_ALL_FILESYSTEMS:
+        all_filesystems = true;
+        break;
+      case OPT_JSON:
+        json = true;
+        break;
+      default:
+        return usage_error();
+    }
+  }
+  argc -= optind;
+  argv += optind;
+  if (all_filesystems) {
+    if (argc < 1) {
+      fputs("error: must specify a key identifier\n", stderr);
+      return EXIT_FAILURE;
+    }
+    if (!discover_filesystems()) {
+      return EXIT_FAILURE;
+    }
+    int status = EXIT_SUCCESS;
+    for (size_t i = 0; i < num_mounts; i++) {
+      if (is_listed_filesystem(i) &&
+          !show_key_statuses(mounts[i].mountpoint, argc, argv, json, true)) {
+        status = EXIT_FAILURE;
+      }
+    }
+    return status;
+  }
+  if (argc < 2) {
+    fputs("error: must specify a key identifier and a mountpoint\n", stderr);
+    return EXIT_FAILURE;
   }
+  if (!show_key_statuses(argv[argc - 1], argc - 1, argv, json, false)) {
+    return EXIT_FAILURE;
+  }
+  return EXIT_SUCCESS;
 }
 
-// For a specified file or directory with encryption enabled, print the
-// corresponding policy to stdout.
-static int cmd_get_policy(int argc, char *const argv[]) {
-  handle_no_options(&argc, &argv);
-  if (argc != 1) {
-    fputs("error: must specify a single file or directory\n", stderr);
+// Prints the mountpoints of the mounted filesystems that support encryption.
+static int cmd_list_filesystems(int argc, char *const argv[]) {
+  if (!handle_no_options(&argc, &argv)) {
     return EXIT_FAILURE;
   }
-  const char *path = argv[0];
-
-  struct fscrypt_get_policy_ex_arg arg = {0};
-  if (!get_policy(path, &arg)) {
+  if (argc != 0) {
+    fputs("error: list_filesystems does not accept any arguments\n", stderr);
     return EXIT_FAILURE;
   }
-
-  printf("Encryption policy for %s:\n", path);
-  printf("\tPolicy version: %d\n",
-         // Hide the quirk of FSCRYPT_POLICY_V1 really being 0.
-         arg.policy.version == FSCRYPT_POLICY_V1 ? 1 : arg.policy.version);
-  switch (arg.policy.version) {
-    case FSCRYPT_POLICY_V1:
-      show_v1_encryption_policy(&arg.policy.v1);
-      break;
-    case FSCRYPT_POLICY_V2:
-      show_v2_encryption_policy(&arg.policy.v2);
-      break;
+  if (!discover_filesystems()) {
+    return EXIT_FAILURE;
+  }
+  for (size_t i = 0; i < num_mounts; i++) {
+    if (is_listed_filesystem(i)) {
+      puts(mounts[i].mountpoint);
+    }
   }
-
   return EXIT_SUCCESS;
 }
 
-// Apply an encryption policy to the specified directory.  The encryption
-// options can be overridden by command-line options.
-static int cmd_set_policy(int argc, char *const argv[]) {
-  uint8_t contents_encryption_mode = FSCRYPT_MODE_AES_256_XTS;
-  uint8_t filenames_encryption_mode = FSCRYPT_MODE_AES_256_CTS;
-  // Default to maximum zero-padding to leak less info about filename lengths.
-  uint8_t flags = FSCRYPT_POLICY_FLAGS_PAD_32;
-  uint8_t log2_data_unit_size = 0;
-
-  static const struct option set_policy_options[] = {
-      {"contents", required_argument, NULL, OPT_CONTENTS},
-      {"filenames", required_argument, NULL, OPT_FILENAMES},
-      {"padding", required_argument, NULL, OPT_PADDING},
-      {"direct-key", no_argument, NULL, OPT_DIRECT_KEY},
-      {"iv-ino-lblk-64", no_argument, NULL, OPT_IV_INO_LBLK_64},
-      {"iv-ino-lblk-32", no_argument, NULL, OPT_IV_INO_LBLK_32},
-      {"data-unit-size", required_argument, NULL, OPT_DATA_UNIT_SIZE},
-      {NULL, 0, NULL, 0}};
+// Prints the encryption policy of a file, as formatted by
+// fscryptctl_format_policy().
+static void show_policy(const char *path,
+                        const struct fscrypt_get_policy_ex_arg *arg,
+                        bool json) {
+  char buf[1024];
+  size_t len = fscryptctl_format_policy(path, arg, json, buf, sizeof(buf));
+  if (len < sizeof(buf)) {
+    fputs(buf, stdout);
+    return;
+  }
+  // The path is long, so a larger buffer is needed.
+  char *big_buf = xzalloc(len + 1);
+  fscryptctl_format_policy(path, arg, json, big_buf, len + 1);
+  fputs(big_buf, stdout);
+  free(big_buf);
+}
+
+// For the specified files or directories with encryption enabled, print the
+// corresponding policies to stdout.
+static int cmd_get_policy(int argc, char *const argv[]) {
+  bool json = false;
 
-  int ch, padding_flag;
-  while ((ch = getopt_long(argc, argv, "", set_policy_options, NULL)) != -1) {
+  static const struct option get_policy_options[] = {
+      {"json", no_argument, NULL, OPT_JSON}, {NULL, 0, NULL, 0}};
+
+  int ch;
+  while ((ch = getopt_long(argc, argv, "", get_policy_options, NULL)) != -1) {
     switch (ch) {
-      case OPT_CONTENTS:
-        if (!string_to_mode(optarg, &contents_encryption_mode)) {
-          fprintf(stderr, "error: invalid contents mode: %s\n", optarg);
-          return EXIT_FAILURE;
-        }
-        break;
-      case OPT_FILENAMES:
-        if (!string_to_mode(optarg, &filenames_encryption_mode)) {
-          fprintf(stderr, "error: invalid filenames mode: %s\n", optarg);
-          return EXIT_FAILURE;
-        }
-        break;
-      case OPT_PADDING:
-        padding_flag = string_to_padding_flag(optarg);
-        if (padding_flag < 0) {
-          fprintf(stderr, "error: invalid padding: %s\n", optarg);
-          return EXIT_FAILURE;
-        }
-        flags &= ~FSCRYPT_POLICY_FLAGS_PAD_MASK;
-        flags |= padding_flag;
-        break;
-      case OPT_DIRECT_KEY:
-        flags |= FSCRYPT_POLICY_FLAG_DIRECT_KEY;
-        break;
-      case OPT_IV_INO_LBLK_64:
-        flags |= FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64;
-        break;
-      case OPT_IV_INO_LBLK_32:
-        printf("warning: --iv-ino-lblk-32 should normally not be used\n");
-        flags |= FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32;
-        break;
-      case OPT_DATA_UNIT_SIZE:
-        if (!parse_data_unit_size(optarg, &log2_data_unit_size)) {
-          fprintf(stderr, "error: invalid data unit size: %s\n", optarg);
-          return EXIT_FAILURE;
-        }
+      case OPT_JSON:
+        json = true;
         break;
       default:
-        usage(stderr);
+        return usage_error();
     }
   }
   argc -= optind;
   argv += optind;
-  if (argc != 2) {
-    fputs("error: must specify a key and a directory\n", stderr);
+  if (argc < 1) {
+    fputs("error: must specify at least one file or directory\n", stderr);
     return EXIT_FAILURE;
   }
-  const char *key_identifier = argv[0];
-  const char *path = argv[1];
 
-  // Initialize the encryption policy struct.
-  struct fscrypt_policy_v2 policy = {.version = FSCRYPT_POLICY_V2};
-  if (!hex_to_bytes(key_identifier, policy.master_key_identifier,
-                    FSCRYPT_KEY_IDENTIFIER_SIZE)) {
-    fprintf(stderr, "error: invalid key identifier: %s\n", key_identifier);
+  int status = EXIT_SUCCESS;
+  for (int i = 0; i < argc; i++) {
+    const char *path = argv[i];
+    struct fscrypt_get_policy_ex_arg arg = {0};
+
+    if (json) {
+      bool open_failed;
+      int err = try_get_policy(path, &arg, &open_failed);
+      if (err != 0) {
+        printf("{\"path\":");
+        print_json_string(path);
+        show_json_error(err, open_failed ? strerror(err)
+                                         : describe_get_policy_error(err));
+        status = EXIT_FAILURE;
+        continue;
+      }
+      show_policy(path, &arg, true);
+    } else {
+      if (!get_policy(path, &arg)) {
+        status = EXIT_FAILURE;
+        continue;
+      }
+      show_policy(path, &arg, false);
+    }
+  }
+  return status;
+}
+
+// Sets an encryption policy on each of the directories listed in the given
+// file, one per line.  Empty lines are ignored.  On return, *num_dirs and
+// *num_failures have been incremented by the number of directories and the
+// number of directories on which the policy couldn't be set.  Returns false if
+// the file couldn't be read.
+static bool set_policy_from_file(const char *filename,
+                                 const struct fscrypt_policy_v2 *policy,
+                                 size_t *num_dirs, size_t *num_failures) {
+  FILE *file = stdin;
+  char *line = NULL;
+  size_t line_size = 0;
+  ssize_t len;
+  bool ok = true;
+
+  if (strcmp(filename, "-") != 0) {
+    file = fopen(filename, "re");
+    if (file == NULL) {
+      fprintf(stderr, "error: opening %s: %s\n", filename, strerror(errno));
+      return false;
+    }
+  }
+  while ((len = getline(&line, &line_size, file)) >= 0) {
+    if (len > 0 && line[len - 1] == '\n') {
+      line[--len] = '\0';
+    }
+    if (len == 0) {
+      continue;
+    }
+    (*num_dirs)++;
+    if (!set_policy(line, policy)) {
+      (*num_failures)++;
+    }
+  }
+  if (ferror(file)) {
+    fprintf(stderr, "error: reading %s: %s\n", filename, strerror(errno));
+    ok = false;
+  }
+  free(line);
+  if (file != stdin) {
+    fclose(file);
+  }
+  return ok;
+}
+
+// Apply an encryption policy to the specified directories.  The encryption
+// options can be overridden by command-line options.
+static int cmd_set_policy(int argc, char *const argv[]) {
+  struct fscryptctl_set_policy_args args;
+  int ret = fscryptctl_parse_set_policy(argc, argv, &args);
+
+  if (args.iv_ino_lblk_32) {
+    printf("warning: --iv-ino-lblk-32 should normally not be used\n");
+  }
+  if (ret == FSCRYPTCTL_PARSE_USAGE) {
+    return usage_error();
+  }
+  if (ret != FSCRYPTCTL_PARSE_OK) {
+    if (args.error_arg != NULL) {
+      fprintf(stderr, "error: %s: %s\n", args.error, args.error_arg);
+    } else {
+      fprintf(stderr, "error: %s\n", args.error);
+    }
+    return EXIT_FAILURE;
+  }
+  // In batch mode, standard input is the stream of batch commands.
+  if (batch_mode && args.dirs_from && strcmp(args.dirs_from, "-") == 0) {
+    fputs("error: --dirs-from=- can't be used in batch mode\n", stderr);
     return EXIT_FAILURE;
   }
-  policy.contents_encryption_mode = contents_encryption_mode;
-  policy.filenames_encryption_mode = filenames_encryption_mode;
-  policy.flags = flags;
-  policy.log2_data_unit_size = log2_data_unit_size;
 
-  // Set the encryption policy on the directory.
-  if (!set_policy(path, &policy)) {
+  // Set the encryption policy on the directories.  A directory that already
+  // has exactly this policy counts as a success, as the kernel allows that.
+  size_t num_dirs = 0;
+  size_t num_failures = 0;
+  for (int i = 0; i < args.num_dirs; i++) {
+    num_dirs++;
+    if (!set_policy(argv[args.first_dir + i], &args.policy)) {
+      num_failures++;
+    }
+  }
+  if (args.dirs_from && !set_policy_from_file(args.dirs_from, &args.policy,
+                                              &num_dirs, &num_failures)) {
     return EXIT_FAILURE;
   }
 
+  if (num_failures != 0) {
+    if (num_dirs > 1) {
+      fprintf(stderr, "error: failed to set policy on %zu of %zu directories\n",
+              num_failures, num_dirs);
+    }
+    return EXIT_FAILURE;
+  }
   return EXIT_SUCCESS;
 }
 
 static int cmd_import_hw_wrapped_key(int argc, char *const argv[]) {
-  handle_no_options(&argc, &argv);
+  if (!handle_no_options(&argc, &argv)) {
+    return EXIT_FAILURE;
+  }
   if (argc != 1) {
     fputs("error: must specify a single block device\n", stderr);
     return EXIT_FAILURE;
@@ -806,12 +1902,12 @@ static int cmd_import_hw_wrapped_key(int argc, char *const argv[]) {
   arg.lt_key_ptr = (uintptr_t)lt_key;
   arg.lt_key_size = MAX_WRAPPED_KEY_SIZE;
 
-  int fd = open(blkdev, O_RDONLY | O_CLOEXEC);
+  int fd = traced_open(blkdev, O_RDONLY | O_CLOEXEC);
   if (fd < 0) {
     fprintf(stderr, "error: opening %s: %s\n", blkdev, strerror(errno));
     goto cleanup;
   }
-  if (ioctl(fd, BLKCRYPTOIMPORTKEY, &arg) != 0) {
+  if (traced_ioctl(fd, BLKCRYPTOIMPORTKEY, &arg) != 0) {
     fprintf(stderr, "error: importing hardware-wrapped key: %s\n",
             strerror(errno));
     close(fd);
@@ -829,7 +1925,9 @@ cleanup:
 }
 
 static int cmd_generate_hw_wrapped_key(int argc, char *const argv[]) {
-  handle_no_options(&argc, &argv);
+  if (!handle_no_options(&argc, &argv)) {
+    return EXIT_FAILURE;
+  }
   if (argc != 1) {
     fputs("error: must specify a single block device\n", stderr);
     return EXIT_FAILURE;
@@ -842,12 +1940,12 @@ static int cmd_generate_hw_wrapped_key(int argc, char *const argv[]) {
   arg.lt_key_ptr = (uintptr_t)lt_key;
   arg.lt_key_size = MAX_WRAPPED_KEY_SIZE;
 
-  int fd = open(blkdev, O_RDONLY | O_CLOEXEC);
+  int fd = traced_open(blkdev, O_RDONLY | O_CLOEXEC);
   if (fd < 0) {
     fprintf(stderr, "error: opening %s: %s\n", blkdev, strerror(errno));
     goto cleanup;
   }
-  if (ioctl(fd, BLKCRYPTOGENERATEKEY, &arg) != 0) {
+  if (traced_ioctl(fd, BLKCRYPTOGENERATEKEY, &arg) != 0) {
     fprintf(stderr, "error: generating hardware-wrapped key: %s\n",
             strerror(errno));
     close(fd);
@@ -864,7 +1962,9 @@ cleanup:
 }
 
 static int cmd_prepare_hw_wrapped_key(int argc, char *const argv[]) {
-  handle_no_options(&argc, &argv);
+  if (!handle_no_options(&argc, &argv)) {
+    return EXIT_FAILURE;
+  }
   if (argc != 1) {
     fputs("error: must specify a single block device\n", stderr);
     return EXIT_FAILURE;
@@ -883,12 +1983,12 @@ static int cmd_prepare_hw_wrapped_key(int argc, char *const argv[]) {
   arg.eph_key_ptr = (uintptr_t)eph_key;
   arg.eph_key_size = MAX_WRAPPED_KEY_SIZE;
 
-  int fd = open(blkdev, O_RDONLY | O_CLOEXEC);
+  int fd = traced_open(blkdev, O_RDONLY | O_CLOEXEC);
   if (fd < 0) {
     fprintf(stderr, "error: opening %s: %s\n", blkdev, strerror(errno));
     goto cleanup;
   }
-  if (ioctl(fd, BLKCRYPTOPREPAREKEY, &arg) != 0) {
+  if (traced_ioctl(fd, BLKCRYPTOPREPAREKEY, &arg) != 0) {
     fprintf(stderr, "error: preparing hardware-wrapped key: %s\n",
             strerror(errno));
     close(fd);
@@ -906,23 +2006,330 @@ cleanup:
 }
 
 // -----------------------------------------------------------------------------
-//                            The main() function
+//                              The command table
 // -----------------------------------------------------------------------------
 
+static int cmd_batch(int argc, char *const argv[]);
+
 static const struct {
   const char *name;
   int (*func)(int argc, char *const argv[]);
+  bool reads_stdin;
 } commands[] = {
-    {"add_key", cmd_add_key},
-    {"remove_key", cmd_remove_key},
-    {"key_status", cmd_key_status},
-    {"get_policy", cmd_get_policy},
-    {"set_policy", cmd_set_policy},
-    {"import_hw_wrapped_key", cmd_import_hw_wrapped_key},
-    {"generate_hw_wrapped_key", cmd_generate_hw_wrapped_key},
-    {"prepare_hw_wrapped_key", cmd_prepare_hw_wrapped_key},
+    {"add_key", cmd_add_key, true},
+    {"remove_key", cmd_remove_key, false},
+    {"key_status", cmd_key_status, false},
+    {"list_filesystems", cmd_list_filesystems, false},
+    {"get_policy", cmd_get_policy, false},
+    {"set_policy", cmd_set_policy, false},
+    {"import_hw_wrapped_key", cmd_import_hw_wrapped_key, true},
+    {"generate_hw_wrapped_key", cmd_generate_hw_wrapped_key, false},
+    {"prepare_hw_wrapped_key", cmd_prepare_hw_wrapped_key, true},
+    {"batch", cmd_batch, false},
 };
 
+// -----------------------------------------------------------------------------
+//                                Batch mode
+// -----------------------------------------------------------------------------
+
+// Reads a line from standard input into buf, without the trailing newline.
+// This reads one byte at a time, so that the data following a command line
+// (such as a key) never gets read into a buffer.  Returns 1 if a line was
+// read, 0 on end-of-file, or -1 on error.
+static int read_batch_line(char *buf, size_t bufsize) {
+  size_t len = 0;
+  for (;;) {
+    char c;
+    ssize_t ret = read(STDIN_FILENO, &c, 1);
+    if (ret < 0) {
+      fprintf(stderr, "error: reading from stdin: %s\n", strerror(errno));
+      return -1;
+    }
+    if (ret == 0) {
+      if (len == 0) {
+        return 0;
+      }
+      break;
+    }
+    if (c == '\n') {
+      break;
+    }
+    if (len + 1 >= bufsize) {
+      fputs("error: batch command is too long\n", stderr);
+      return -1;
+    }
+    buf[len++] = c;
+  }
+  buf[len] = '\0';
+  return 1;
+}
+
+// Splits a batch command line into arguments, in place.  Arguments are
+// separated by spaces or tabs, and a backslash escapes the next character.
+// argv must have room for max_args + 1 entries.  Returns the number of
+// arguments, or -1 if there are too many.
+static int split_batch_line(char *line, char *argv[], int max_args) {
+  char *src = line;
+  char *dst = line;
+  int argc = 0;
+
+  for (;;) {
+    while (*src == ' ' || *src == '\t') {
+      src++;
+    }
+    if (*src == '\0') {
+      break;
+    }
+    if (argc == max_args) {
+      return -1;
+    }
+    argv[argc++] = dst;
+    while (*src != '\0' && *src != ' ' && *src != '\t') {
+      if (*src == '\\' && src[1] != '\0') {
+        src++;
+      }
+      *dst++ = *src++;
+    }
+    if (*src != '\0') {
+      src++;
+    }
+    *dst++ = '\0';
+  }
+  argv[argc] = NULL;
+  return argc;
+}
+
+// Reads the standard input of a batch command that reads its standard input:
+// a line containing the size of the data in bytes, followed by the data itself.
+// Up to bufsize bytes of the data are stored in buf, and any remainder is
+// discarded.  Returns false on error, in which case the input stream can't be
+// parsed any further.
+static bool read_batch_input(uint8_t *buf, size_t bufsize, size_t *size_ret) {
+  char line[32];
+  char *end;
+
+  if (read_batch_line(line, sizeof(line)) <= 0) {
+    fputs("error: batch command is missing its input size\n", stderr);
+    return false;
+  }
+  errno = 0;
+  unsigned long long size = strtoull(line, &end, 10);
+  if (line[0] < '0' || line[0] > '9' || *end != '\0' || errno != 0) {
+    fprintf(stderr, "error: invalid batch input size: %s\n", line);
+    return false;
+  }
+  *size_ret = size < bufsize ? size : bufsize;
+
+  // Read as much of the data as fits into buf, then read and discard the rest.
+  uint8_t *dst = buf;
+  uint8_t discard[256];
+  while (size != 0) {
+    size_t limit = dst == buf ? *size_ret : sizeof(discard);
+    size_t n = size < limit ? size : limit;
+    ssize_t ret = read_until_limit_or_eof(STDIN_FILENO, dst, n);
+    if (ret < 0) {
+      fprintf(stderr, "error: reading from stdin: %s\n", strerror(errno));
+      secure_wipe(discard, sizeof(discard));
+      return false;
+    }
+    if ((size_t)ret != n) {
+      fputs("error: unexpected end of batch input\n", stderr);
+      secure_wipe(discard, sizeof(discard));
+      return false;
+    }
+    size -= n;
+    dst = discard;
+  }
+  secure_wipe(discard, sizeof(discard));
+  return true;
+}
+
+// Copies the contents of the staging file tmp_fd to out_fd, then empties the
+// staging file so that it can be reused.
+static bool copy_and_truncate(int tmp_fd, int out_fd) {
+  uint8_t buf[4096];
+  bool ok = false;
+
+  if (lseek(tmp_fd, 0, SEEK_SET) != 0) {
+    goto out;
+  }
+  for (;;) {
+    ssize_t ret = read(tmp_fd, buf, sizeof(buf));
+    if (ret < 0) {
+      goto out;
+    }
+    if (ret == 0) {
+      break;
+    }
+    if (!full_write(out_fd, buf, ret)) {
+      goto out_wipe;
+    }
+  }
+  if (lseek(tmp_fd, 0, SEEK_SET) != 0 || ftruncate(tmp_fd, 0) != 0) {
+    goto out;
+  }
+  ok = true;
+out:
+  if (!ok) {
+    fprintf(stderr, "error: copying batch output: %s\n", strerror(errno));
+  }
+out_wipe:
+  secure_wipe(buf, sizeof(buf));
+  return ok;
+}
+
+// Writes the result record of a batch command to out_fd: a line containing the
+// command's exit status and the sizes of its standard output and standard
+// error, followed by its standard output and standard error themselves.
+static bool write_batch_result(int out_fd, int status, int stdout_tmp,
+                               int stderr_tmp) {
+  off_t stdout_size = lseek(stdout_tmp, 0, SEEK_CUR);
+  off_t stderr_size = lseek(stderr_tmp, 0, SEEK_CUR);
+  char header[64];
+
+  if (stdout_size < 0 || stderr_size < 0) {
+    fprintf(stderr, "error: copying batch output: %s\n", strerror(errno));
+    return false;
+  }
+  snprintf(header, sizeof(header), "%d %lld %lld\n", status,
+           (long long)stdout_size, (long long)stderr_size);
+  return full_write(out_fd, (const uint8_t *)header, strlen(header)) &&
+         copy_and_truncate(stdout_tmp, out_fd) &&
+         copy_and_truncate(stderr_tmp, out_fd);
+}
+
+static int find_command(const char *name) {
+  for (size_t i = 0; i < ARRAY_SIZE(commands); i++) {
+    if (strcmp(name, commands[i].name) == 0) {
+      return i;
+    }
+  }
+  return -1;
+}
+
+// Executes a command in batch mode, with its standard output and standard error
+// redirected to the given file descriptors.
+static int execute_batch_command(int cmd, int argc, char *argv[], int stdout_fd,
+                                 int stderr_fd) {
+  int status = EXIT_FAILURE;
+
+  fflush(stdout);
+  if (dup2(stdout_fd, STDOUT_FILENO) < 0 ||
+      dup2(stderr_fd, STDERR_FILENO) < 0) {
+    return -1;
+  }
+  if (cmd < 0 || commands[cmd].func == cmd_batch) {
+    fprintf(stderr, "error: invalid command: %s\n", argv[0]);
+  } else {
+    // Each command parses its own options, so getopt must be reinitialized.
+    optind = 0;
+    status = traced_command(commands[cmd].name, commands[cmd].func, argc,
+                            argv);
+  }
+  fflush(stdout);
+  fflush(stderr);
+  return status;
+}
+
+// Reads commands from standard input, one per line, and executes them.  For
+// each command a result record is written to standard output, and an error in
+// one command doesn't prevent the following commands from being executed.
+static int cmd_batch(int argc, char *const argv[]) {
+  if (!handle_no_options(&argc, &argv)) {
+    return EXIT_FAILURE;
+  }
+  if (argc != 0) {
+    fputs("error: batch does not accept any arguments\n", stderr);
+    return EXIT_FAILURE;
+  }
+
+  int status = EXIT_FAILURE;
+  char *line = xzalloc(MAX_BATCH_LINE_SIZE);
+  char **args = xzalloc((MAX_BATCH_ARGS + 1) * sizeof(args[0]));
+  uint8_t *input = xzalloc(MAX_BATCH_INPUT_SIZE);
+  // The output of each command is staged in memory-backed files rather than in
+  // temporary files on disk, since it may contain wrapped keys.
+  int stdout_tmp = memfd_create("batch-stdout", MFD_CLOEXEC);
+  int stderr_tmp = memfd_create("batch-stderr", MFD_CLOEXEC);
+  int saved_stdout = dup(STDOUT_FILENO);
+  int saved_stderr = dup(STDERR_FILENO);
+  if (stdout_tmp < 0 || stderr_tmp < 0 || saved_stdout < 0 ||
+      saved_stderr < 0) {
+    fprintf(stderr, "error: setting up batch output: %s\n", strerror(errno));
+    goto cleanup;
+  }
+
+  batch_mode = true;
+  cache_mountpoints = true;
+  batch_input = input;
+  for (;;) {
+    int ret = read_batch_line(line, MAX_BATCH_LINE_SIZE);
+    if (ret <= 0) {
+      if (ret == 0) {
+        status = EXIT_SUCCESS;
+      }
+      break;
+    }
+    int nargs = split_batch_line(line, args, MAX_BATCH_ARGS);
+    if (nargs == 0) {
+      continue;
+    }
+    if (nargs < 0) {
+      fputs("error: batch command has too many arguments\n", stderr);
+      break;
+    }
+
+    int cmd = find_command(args[0]);
+    batch_input_size = 0;
+    if (cmd >= 0 && commands[cmd].reads_stdin &&
+        !read_batch_input(input, MAX_BATCH_INPUT_SIZE, &batch_input_size)) {
+      break;
+    }
+    int cmd_status =
+        execute_batch_command(cmd, nargs, args, stdout_tmp, stderr_tmp);
+    secure_wipe(input, MAX_BATCH_INPUT_SIZE);
+    if (dup2(saved_stdout, STDOUT_FILENO) < 0 ||
+        dup2(saved_stderr, STDERR_FILENO) < 0) {
+      break;
+    }
+    if (cmd_status < 0) {
+      fprintf(stderr, "error: redirecting batch output: %s\n",
+              strerror(errno));
+      break;
+    }
+    if (!write_batch_result(STDOUT_FILENO, cmd_status, stdout_tmp,
+                            stderr_tmp)) {
+      break;
+    }
+  }
+cleanup:
+  batch_mode = false;
+  cache_mountpoints = false;
+  batch_input = NULL;
+  clear_mountpoint_cache();
+  clear_filesystem_cache();
+  if (saved_stdout >= 0) {
+    close(saved_stdout);
+  }
+  if (saved_stderr >= 0) {
+    close(saved_stderr);
+  }
+  if (stdout_tmp >= 0) {
+    close(stdout_tmp);
+  }
+  if (stderr_tmp >= 0) {
+    close(stderr_tmp);
+  }
+  wipe_and_free(input, MAX_BATCH_INPUT_SIZE);
+  free(args);
+  free(line);
+  return status;
+}
+
+// -----------------------------------------------------------------------------
+//                            The main() function
+// -----------------------------------------------------------------------------
+
 int main(int argc, char *const argv[]) {
   // Check for the help or version options.
   for (int i = 1; i < argc; i++) {
@@ -944,9 +2351,13 @@ int main(int argc, char *const argv[]) {
   }
   const char *command = argv[1];
 
+  init_tracing();
   for (size_t i = 0; i < ARRAY_SIZE(commands); i++) {
     if (strcmp(command, commands[i].name) == 0) {
-      return commands[i].func(argc - 1, argv + 1);
+      int status = traced_command(commands[i].name, commands[i].func,
+                                  argc - 1, argv + 1);
+      clear_filesystem_cache();
+      return status;
     }
   }
 
@@ -17,28 +17,13 @@
 """This program generates the key descriptors and key identifiers for the test
 keys in test.py."""
 
-import hashlib
+import fscrypt
 import test
 
-# For HKDF-SHA512; see
-# https://www.pycryptodome.org/en/latest/src/protocol/kdf.html#hkdf
-import Crypto.Hash.SHA512
-import Crypto.Protocol.KDF
-
-
-def compute_key_descriptor(raw):
-    return hashlib.sha512(hashlib.sha512(raw).digest()).hexdigest()[:16]
-
-
-def compute_key_identifier(raw):
-    return Crypto.Protocol.KDF.HKDF(raw, 16, "", Crypto.Hash.SHA512,
-                                    context=b"fscrypt\0\1").hex()
-
-
 for key in test.TEST_KEYS:
     raw = key["raw"]
-    descriptor = compute_key_descriptor(raw)
-    identifier = compute_key_identifier(raw)
+    descriptor = fscrypt.compute_key_descriptor(raw)
+    identifier = fscrypt.compute_key_identifier(raw)
     if "descriptor" in key:
         assert descriptor == key["descriptor"]
     if "identifier" in key:
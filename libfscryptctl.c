@@ -0,0 +1,463 @@
+/*
+ * libfscryptctl.c - Argument parsing and output formatting of fscryptctl,
+ *                   as a library.
+ *
+ * Copyright 2026 Google LLC
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License"); you may not
+ * use this file except in compliance with the License. You may obtain a copy of
+ * the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+ * WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+ * License for the specific language governing permissions and limitations under
+ * the License.
+ */
+
+#define _GNU_SOURCE  // For getopt_long()
+
+#include "libfscryptctl.h"
+
+#include <ctype.h>
+#include <getopt.h>
+#include <stdarg.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define ARRAY_SIZE(array) (sizeof(array) / sizeof((array)[0]))
+
+// Human-readable strings for encryption modes, indexed by the encryption mode
+static const char *const mode_strings[] = {
+    [FSCRYPT_MODE_AES_256_XTS] = "AES-256-XTS",
+    [FSCRYPT_MODE_AES_256_CTS] = "AES-256-CTS",
+    [FSCRYPT_MODE_AES_128_CBC] = "AES-128-CBC",
+    [FSCRYPT_MODE_AES_128_CTS] = "AES-128-CTS",
+    [FSCRYPT_MODE_SM4_XTS] = "SM4-XTS",
+    [FSCRYPT_MODE_SM4_CTS] = "SM4-CTS",
+    [FSCRYPT_MODE_ADIANTUM] = "Adiantum",
+    [FSCRYPT_MODE_AES_256_HCTR2] = "AES-256-HCTR2",
+};
+
+// Valid amounts of filename padding, indexed by the padding flag
+static const int padding_values[] = {4, 8, 16, 32};
+
+enum {
+  OPT_CONTENTS,
+  OPT_DATA_UNIT_SIZE,
+  OPT_DIRECT_KEY,
+  OPT_DIRS_FROM,
+  OPT_FILENAMES,
+  OPT_IV_INO_LBLK_32,
+  OPT_IV_INO_LBLK_64,
+  OPT_PADDING,
+};
+
+bool fscryptctl_string_to_mode(const char *str, uint8_t *mode_ret) {
+  for (size_t i = 0; i < ARRAY_SIZE(mode_strings); i++) {
+    if (mode_strings[i] != NULL && strcmp(str, mode_strings[i]) == 0) {
+      *mode_ret = i;
+      return true;
+    }
+  }
+  return false;
+}
+
+const char *fscryptctl_mode_to_string(uint8_t mode) {
+  if (mode >= ARRAY_SIZE(mode_strings)) {
+    return NULL;
+  }
+  return mode_strings[mode];
+}
+
+int fscryptctl_string_to_padding_flag(const char *str) {
+  int padding = atoi(str);
+  for (size_t i = 0; i < ARRAY_SIZE(padding_values); i++) {
+    if (padding == padding_values[i]) {
+      return i;
+    }
+  }
+  return -1;
+}
+
+bool fscryptctl_parse_data_unit_size(const char *str,
+                                     uint8_t *log2_data_unit_size_ret) {
+  int du_size = atoi(str);
+  int bits = 0;
+
+  while ((1LL << bits) < du_size) {
+    bits++;
+  }
+  *log2_data_unit_size_ret = bits;
+  return du_size > 1 && (1LL << bits) == du_size;
+}
+
+void fscryptctl_bytes_to_hex(const uint8_t *bytes, size_t num_bytes,
+                             char *hex) {
+  for (size_t i = 0; i < num_bytes; i++) {
+    sprintf(&hex[2 * i], "%02x", bytes[i]);
+  }
+}
+
+bool fscryptctl_hex_to_bytes(const char *hex, uint8_t *bytes,
+                             size_t num_bytes) {
+  if (strlen(hex) != 2 * num_bytes) {
+    return false;
+  }
+  for (size_t i = 0; i < num_bytes; i++) {
+    // sscanf() would also skip whitespace and accept a sign or a "0x" prefix,
+    // so check for hex digits first.
+    if (!isxdigit((unsigned char)hex[2 * i]) ||
+        !isxdigit((unsigned char)hex[2 * i + 1])) {
+      return false;
+    }
+    // We must read two hex characters of input into one byte of buffer.
+    int chars_read = 0;
+    int ret = sscanf(&hex[2 * i], "%2hhx%n", &bytes[i], &chars_read);
+    if (ret != 1 || chars_read != 2) {
+      return false;
+    }
+  }
+  return true;
+}
+
+bool fscryptctl_build_key_specifier(const char *identifier_hex,
+                                    struct fscrypt_key_specifier *key_spec) {
+  memset(key_spec, 0, sizeof(*key_spec));
+  if (!fscryptctl_hex_to_bytes(identifier_hex, key_spec->u.identifier,
+                               FSCRYPT_KEY_IDENTIFIER_SIZE)) {
+    return false;
+  }
+  key_spec->type = FSCRYPT_KEY_SPEC_TYPE_IDENTIFIER;
+  return true;
+}
+
+static int invalid_argument(struct fscryptctl_set_policy_args *args,
+                            const char *error, const char *error_arg) {
+  args->error = error;
+  args->error_arg = error_arg;
+  return FSCRYPTCTL_PARSE_INVALID;
+}
+
+int fscryptctl_parse_set_policy(int argc, char *const argv[],
+                                struct fscryptctl_set_policy_args *args) {
+  static const struct option set_policy_options[] = {
+      {"contents", required_argument, NULL, OPT_CONTENTS},
+      {"filenames", required_argument, NULL, OPT_FILENAMES},
+      {"padding", required_argument, NULL, OPT_PADDING},
+      {"direct-key", no_argument, NULL, OPT_DIRECT_KEY},
+      {"iv-ino-lblk-64", no_argument, NULL, OPT_IV_INO_LBLK_64},
+      {"iv-ino-lblk-32", no_argument, NULL, OPT_IV_INO_LBLK_32},
+      {"data-unit-size", required_argument, NULL, OPT_DATA_UNIT_SIZE},
+      {"dirs-from", required_argument, NULL, OPT_DIRS_FROM},
+      {NULL, 0, NULL, 0}};
+  struct fscrypt_policy_v2 *policy = &args->policy;
+
+  memset(args, 0, sizeof(*args));
+  policy->version = FSCRYPT_POLICY_V2;
+  policy->contents_encryption_mode = FSCRYPT_MODE_AES_256_XTS;
+  policy->filenames_encryption_mode = FSCRYPT_MODE_AES_256_CTS;
+  // Default to maximum zero-padding to leak less info about filename lengths.
+  policy->flags = FSCRYPT_POLICY_FLAGS_PAD_32;
+
+  // Each call parses a new argument list, so getopt must be reinitialized.
+  optind = 0;
+  int ch, padding_flag;
+  while ((ch = getopt_long(argc, argv, "", set_policy_options, NULL)) != -1) {
+    switch (ch) {
+      case OPT_CONTENTS:
+        if (!fscryptctl_string_to_mode(optarg,
+                                       &policy->contents_encryption_mode)) {
+          return invalid_argument(args, "invalid contents mode", optarg);
+        }
+        break;
+      case OPT_FILENAMES:
+        if (!fscryptctl_string_to_mode(optarg,
+                                       &policy->filenames_encryption_mode)) {
+          return invalid_argument(args, "invalid filenames mode", optarg);
+        }
+        break;
+      case OPT_PADDING:
+        padding_flag = fscryptctl_string_to_padding_flag(optarg);
+        if (padding_flag < 0) {
+          return invalid_argument(args, "invalid padding", optarg);
+        }
+        policy->flags &= ~FSCRYPT_POLICY_FLAGS_PAD_MASK;
+        policy->flags |= padding_flag;
+        break;
+      case OPT_DIRECT_KEY:
+        policy->flags |= FSCRYPT_POLICY_FLAG_DIRECT_KEY;
+        break;
+      case OPT_IV_INO_LBLK_64:
+        policy->flags |= FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64;
+        break;
+      case OPT_IV_INO_LBLK_32:
+        args->iv_ino_lblk_32 = true;
+        policy->flags |= FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32;
+        break;
+      case OPT_DATA_UNIT_SIZE:
+        if (!fscryptctl_parse_data_unit_size(optarg,
+                                             &policy->log2_data_unit_size)) {
+          return invalid_argument(args, "invalid data unit size", optarg);
+        }
+        break;
+      case OPT_DIRS_FROM:
+        args->dirs_from = optarg;
+        break;
+      default:
+        return FSCRYPTCTL_PARSE_USAGE;
+    }
+  }
+  if (argc - optind < (args->dirs_from ? 1 : 2)) {
+    return invalid_argument(args, "must specify a key and a directory", NULL);
+  }
+  if (!fscryptctl_hex_to_bytes(argv[optind], policy->master_key_identifier,
+                               FSCRYPT_KEY_IDENTIFIER_SIZE)) {
+    return invalid_argument(args, "invalid key identifier", argv[optind]);
+  }
+  args->first_dir = optind + 1;
+  args->num_dirs = argc - args->first_dir;
+  return FSCRYPTCTL_PARSE_OK;
+}
+
+// An output buffer for the formatting functions, which keeps counting the
+// length of the output after the buffer is full.
+struct output {
+  char *buf;
+  size_t size;
+  size_t len;
+};
+
+static void __attribute__((format(printf, 2, 3)))
+append(struct output *out, const char *format, ...) {
+  char *dst = out->len < out->size ? &out->buf[out->len] : NULL;
+  va_list va;
+
+  va_start(va, format);
+  int n = vsnprintf(dst, dst ? out->size - out->len : 0, format, va);
+  va_end(va);
+  if (n > 0) {
+    out->len += n;
+  }
+}
+
+static void append_policy_flags(struct output *out, uint8_t flags) {
+  append(out, "PAD_%d", padding_values[flags & FSCRYPT_POLICY_FLAGS_PAD_MASK]);
+  flags &= ~FSCRYPT_POLICY_FLAGS_PAD_MASK;
+
+  if (flags & FSCRYPT_POLICY_FLAG_DIRECT_KEY) {
+    append(out, ", DIRECT_KEY");
+    flags &= ~FSCRYPT_POLICY_FLAG_DIRECT_KEY;
+  }
+
+  if (flags & FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64) {
+    append(out, ", IV_INO_LBLK_64");
+    flags &= ~FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64;
+  }
+
+  if (flags & FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32) {
+    append(out, ", IV_INO_LBLK_32");
+    flags &= ~FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32;
+  }
+
+  if (flags != 0) {
+    append(out, ", Unknown (%02x)", flags);
+  }
+}
+
+// Returns the length of the valid UTF-8 sequence that starts at p, or 0 if
+// there isn't one.  Overlong encodings and encoded surrogates are invalid.
+static size_t utf8_sequence_length(const unsigned char *p) {
+  unsigned char min = 0x80;
+  unsigned char max = 0xbf;
+  size_t len;
+
+  if (*p < 0x80) {
+    return 1;
+  }
+  if (*p >= 0xc2 && *p <= 0xdf) {
+    len = 2;
+  } else if (*p >= 0xe0 && *p <= 0xef) {
+    len = 3;
+    if (*p == 0xe0) {
+      min = 0xa0;
+    } else if (*p == 0xed) {
+      max = 0x9f;
+    }
+  } else if (*p >= 0xf0 && *p <= 0xf4) {
+    len = 4;
+    if (*p == 0xf0) {
+      min = 0x90;
+    } else if (*p == 0xf4) {
+      max = 0x8f;
+    }
+  } else {
+    return 0;
+  }
+  if (p[1] < min || p[1] > max) {
+    return 0;
+  }
+  for (size_t i = 2; i < len; i++) {
+    if (p[i] < 0x80 || p[i] > 0xbf) {
+      return 0;
+    }
+  }
+  return len;
+}
+
+// Bytes that aren't part of valid UTF-8 are escaped as the lone surrogates
+// U+DC80 to U+DCFF, like Python's "surrogateescape" error handler does, so that
+// the output is always valid JSON and the original bytes can be recovered.
+static void append_json_string(struct output *out, const char *str) {
+  append(out, "\"");
+  for (const unsigned char *p = (const unsigned char *)str; *p;) {
+    size_t len = utf8_sequence_length(p);
+    if (len == 0) {
+      append(out, "\\u%04x", 0xdc00 + *p);
+      p++;
+    } else if (*p == '"' || *p == '\\') {
+      append(out, "\\%c", *p);
+      p++;
+    } else if (*p < 0x20) {
+      append(out, "\\u%04x", *p);
+      p++;
+    } else {
+      append(out, "%.*s", (int)len, (const char *)p);
+      p += len;
+    }
+  }
+  append(out, "\"");
+}
+
+static void append_encryption_mode(struct output *out, uint8_t mode_num,
+                                   const char *type) {
+  const char *str = fscryptctl_mode_to_string(mode_num);
+  if (str != NULL) {
+    append(out, "\t%s encryption mode: %s\n", type, str);
+  } else {
+    append(out, "\t%s encryption mode: Unknown (%d)\n", type, mode_num);
+  }
+}
+
+static void append_v1_encryption_policy(
+    struct output *out, const struct fscrypt_policy_v1 *policy) {
+  char descriptor_hex[FSCRYPT_KEY_DESCRIPTOR_HEX_SIZE];
+  fscryptctl_bytes_to_hex(policy->master_key_descriptor,
+                          FSCRYPT_KEY_DESCRIPTOR_SIZE, descriptor_hex);
+  append(out, "\tMaster key descriptor: %s\n", descriptor_hex);
+  append_encryption_mode(out, policy->contents_encryption_mode, "Contents");
+  append_encryption_mode(out, policy->filenames_encryption_mode, "Filenames");
+  append(out, "\tFlags: ");
+  append_policy_flags(out, policy->flags);
+  append(out, "\n");
+}
+
+static void append_v2_encryption_policy(
+    struct output *out, const struct fscrypt_policy_v2 *policy) {
+  char identifier_hex[FSCRYPT_KEY_IDENTIFIER_HEX_SIZE];
+  fscryptctl_bytes_to_hex(policy->master_key_identifier,
+                          FSCRYPT_KEY_IDENTIFIER_SIZE, identifier_hex);
+  append(out, "\tMaster key identifier: %s\n", identifier_hex);
+  append_encryption_mode(out, policy->contents_encryption_mode, "Contents");
+  append_encryption_mode(out, policy->filenames_encryption_mode, "Filenames");
+  append(out, "\tFlags: ");
+  append_policy_flags(out, policy->flags);
+  append(out, "\n");
+  if (policy->log2_data_unit_size) {
+    append(out, "\tData unit size: %u\n", 1U << policy->log2_data_unit_size);
+  } else {
+    append(out, "\tData unit size: default\n");
+  }
+}
+
+static void append_policy(struct output *out, const char *path,
+                          const struct fscrypt_get_policy_ex_arg *arg) {
+  append(out, "Encryption policy for %s:\n", path);
+  append(out, "\tPolicy version: %d\n",
+         // Hide the quirk of FSCRYPT_POLICY_V1 really being 0.
+         arg->policy.version == FSCRYPT_POLICY_V1 ? 1 : arg->policy.version);
+  switch (arg->policy.version) {
+    case FSCRYPT_POLICY_V1:
+      append_v1_encryption_policy(out, &arg->policy.v1);
+      break;
+    case FSCRYPT_POLICY_V2:
+      append_v2_encryption_policy(out, &arg->policy.v2);
+      break;
+  }
+}
+
+static void append_json_policy(struct output *out, const char *path,
+                               const struct fscrypt_get_policy_ex_arg *arg) {
+  char hex[FSCRYPT_KEY_IDENTIFIER_HEX_SIZE];
+
+  append(out, "{\"path\":");
+  append_json_string(out, path);
+  switch (arg->policy.version) {
+    case FSCRYPT_POLICY_V1: {
+      const struct fscrypt_policy_v1 *policy = &arg->policy.v1;
+      fscryptctl_bytes_to_hex(policy->master_key_descriptor,
+                              FSCRYPT_KEY_DESCRIPTOR_SIZE, hex);
+      append(
+          out,
+          ",\"version\":1,\"master_key_descriptor\":\"%s\","
+          "\"contents_encryption_mode\":%u,\"filenames_encryption_mode\":%u,"
+          "\"flags\":%u,\"data_unit_size\":0}\n",
+          hex, policy->contents_encryption_mode,
+          policy->filenames_encryption_mode, policy->flags);
+      break;
+    }
+    case FSCRYPT_POLICY_V2: {
+      const struct fscrypt_policy_v2 *policy = &arg->policy.v2;
+      fscryptctl_bytes_to_hex(policy->master_key_identifier,
+                              FSCRYPT_KEY_IDENTIFIER_SIZE, hex);
+      append(
+          out,
+          ",\"version\":2,\"master_key_identifier\":\"%s\","
+          "\"contents_encryption_mode\":%u,\"filenames_encryption_mode\":%u,"
+          "\"flags\":%u,\"data_unit_size\":%u}\n",
+          hex, policy->contents_encryption_mode,
+          policy->filenames_encryption_mode, policy->flags,
+          policy->log2_data_unit_size ? 1U << policy->log2_data_unit_size : 0);
+      break;
+    }
+    default:
+      append(out, ",\"version\":%u}\n", arg->policy.version);
+      break;
+  }
+}
+
+size_t fscryptctl_format_policy_flags(uint8_t flags, char *buf, size_t size) {
+  struct output out = {buf, size, 0};
+  if (size > 0) {
+    buf[0] = '\0';
+  }
+  append_policy_flags(&out, flags);
+  return out.len;
+}
+
+size_t fscryptctl_format_json_string(const char *str, char *buf, size_t size) {
+  struct output out = {buf, size, 0};
+  if (size > 0) {
+    buf[0] = '\0';
+  }
+  append_json_string(&out, str);
+  return out.len;
+}
+
+size_t fscryptctl_format_policy(const char *path,
+                                const struct fscrypt_get_policy_ex_arg *arg,
+                                bool json, char *buf, size_t size) {
+  struct output out = {buf, size, 0};
+  if (size > 0) {
+    buf[0] = '\0';
+  }
+  if (json) {
+    append_json_policy(&out, path, arg);
+  } else {
+    append_policy(&out, path, arg);
+  }
+  return out.len;
+}
@@ -0,0 +1,118 @@
+/*
+ * libfscryptctl.h - Argument parsing and output formatting of fscryptctl,
+ *                   as a library.
+ *
+ * Copyright 2026 Google LLC
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License"); you may not
+ * use this file except in compliance with the License. You may obtain a copy of
+ * the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+ * WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+ * License for the specific language governing permissions and limitations under
+ * the License.
+ */
+
+// These functions contain no I/O and no ioctls, so that they can be called
+// in-process (for example through the Python bindings in fscrypt_lib.py) at a
+// much higher rate than the fscryptctl binary can be executed.  fscryptctl is
+// linked with the same code, so its behavior is exactly what's tested.
+
+#ifndef LIBFSCRYPTCTL_H
+#define LIBFSCRYPTCTL_H
+
+#include <stdbool.h>
+#include <stddef.h>
+#include <stdint.h>
+
+#include "fscrypt_uapi.h"
+
+#define FSCRYPT_KEY_DESCRIPTOR_HEX_SIZE ((2 * FSCRYPT_KEY_DESCRIPTOR_SIZE) + 1)
+#define FSCRYPT_KEY_IDENTIFIER_HEX_SIZE ((2 * FSCRYPT_KEY_IDENTIFIER_SIZE) + 1)
+
+// Return values of fscryptctl_parse_set_policy()
+enum {
+  FSCRYPTCTL_PARSE_OK = 0,
+  // An unknown option, or an option missing its argument.  getopt has already
+  // printed a message about it, unless opterr was 0.
+  FSCRYPTCTL_PARSE_USAGE = 1,
+  // An invalid argument, described by 'error' and 'error_arg'.
+  FSCRYPTCTL_PARSE_INVALID = 2,
+};
+
+// The result of parsing the arguments of 'fscryptctl set_policy'
+struct fscryptctl_set_policy_args {
+  struct fscrypt_policy_v2 policy;
+  // The argument of --dirs-from, or NULL
+  const char *dirs_from;
+  // The index in argv of the first directory, and the number of directories
+  int first_dir;
+  int num_dirs;
+  // Whether --iv-ino-lblk-32 was given, which deserves a warning
+  bool iv_ino_lblk_32;
+  // If parsing failed with FSCRYPTCTL_PARSE_INVALID, the error message and the
+  // invalid argument (or NULL if the message is complete by itself)
+  const char *error;
+  const char *error_arg;
+};
+
+// Converts str to an encryption mode.  Returns false if the string does not
+// correspond to an encryption mode.
+bool fscryptctl_string_to_mode(const char *str, uint8_t *mode_ret);
+
+// Converts the encryption mode to a human-readable string.  Returns NULL if the
+// mode is not a valid encryption mode.
+const char *fscryptctl_mode_to_string(uint8_t mode);
+
+// Converts an amount of padding (as a string) into the appropriate padding
+// flag. Returns -1 if the flag is invalid.
+int fscryptctl_string_to_padding_flag(const char *str);
+
+// Converts a data unit size in bytes (as a string) into its log2.  Returns
+// false if it isn't a power of 2 greater than 1.
+bool fscryptctl_parse_data_unit_size(const char *str,
+                                     uint8_t *log2_data_unit_size_ret);
+
+// Converts an array of bytes to hex.  The output string will be
+// (2*num_bytes)+1 characters long including the null terminator.
+void fscryptctl_bytes_to_hex(const uint8_t *bytes, size_t num_bytes,
+                             char *hex);
+
+// Converts a hex string to bytes, where the output length is known.
+bool fscryptctl_hex_to_bytes(const char *hex, uint8_t *bytes,
+                             size_t num_bytes);
+
+// Builds a 'struct fscrypt_key_specifier' for passing to the kernel, given a
+// key identifier hex string.  Returns false if the identifier is invalid.
+bool fscryptctl_build_key_specifier(const char *identifier_hex,
+                                    struct fscrypt_key_specifier *key_spec);
+
+// Parses the arguments of 'fscryptctl set_policy' (argv[0] being the command
+// name) into a v2 encryption policy and the list of directories.  Returns one
+// of the FSCRYPTCTL_PARSE_* values.  Like getopt_long(), this may permute
+// argv.
+int fscryptctl_parse_set_policy(int argc, char *const argv[],
+                                struct fscryptctl_set_policy_args *args);
+
+// The formatting functions below work like snprintf(): they write at most
+// 'size' bytes including the null terminator, and return the length of the
+// whole output, so a return value >= size means it was truncated.
+
+// Formats encryption policy flags like "PAD_32, DIRECT_KEY".
+size_t fscryptctl_format_policy_flags(uint8_t flags, char *buf, size_t size);
+
+// Formats a string as a JSON string.  Bytes that aren't part of valid UTF-8 are
+// escaped as the lone surrogates U+DC80 to U+DCFF.
+size_t fscryptctl_format_json_string(const char *str, char *buf, size_t size);
+
+// Formats the encryption policy of 'path' the way 'fscryptctl get_policy'
+// shows it, or as a JSON record (with a trailing newline) if 'json'.
+size_t fscryptctl_format_policy(const char *path,
+                                const struct fscrypt_get_policy_ex_arg *arg,
+                                bool json, char *buf, size_t size);
+
+#endif  // LIBFSCRYPTCTL_H
@@ -25,14 +25,67 @@ TEST_DIR must point to a directory on a filesystem that supports encryption.
 The environment variable ENABLE_VALGRIND may also be set to 1 to wrap all
 invocations of fscryptctl with valgrind.
 
+The number of fscryptctl invocations made by each test, and the time they took,
+are profiled by conftest.py.  The environment variable TEST_PROFILE may be set
+to the path of a file to write the profile to as JSON.
+
+The environment variable ENABLE_BATCH may also be set to 1 to execute the
+fscryptctl commands in a single long-lived "fscryptctl batch" process, rather
+than by executing fscryptctl once per command.
+
+The environment variable TEST_BACKEND may also be set to "ioctl" to make the
+test helpers add and remove keys in-process using the fscrypt module, rather
+than by executing fscryptctl.  The fscryptctl commands themselves are still
+tested by executing fscryptctl.
+
+The environment variable TEST_FILESYSTEMS may also be set to a comma-separated
+list of filesystem types, for example "ext4,f2fs", to run every test once on
+each of them.  Each filesystem is created on a loop-backed image and mounted
+below $TEST_DIR once per test session (this requires root), and is unmounted
+at the end of the session.  Filesystem types that can't be set up, for example
+because mkfs.f2fs isn't installed, are skipped.
+
+The tests may also be run with the fscrypt_shim.so library loaded using
+LD_PRELOAD (as "make test-shim" does), which emulates the fscrypt and blk-crypto
+ioctls in userspace.  TEST_DIR can then be on any filesystem that supports user
+extended attributes.  The tests that depend on files actually being encrypted
+are skipped, and the tests of hardware-wrapped keys, which otherwise need inline
+encryption hardware, are run.
+
 See the CONTRIBUTING.md file for more information."""
 
+import contextlib
+import errno
+import hashlib
+import json
 import os
+import resource
 import shutil
 import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
 
 import pytest
 
+import fscrypt
+import fscrypt_advisor
+import fscrypt_audit
+import fscrypt_exporter
+import fscrypt_bench
+import fscrypt_caps
+import fscrypt_fuzz
+import fscrypt_holders
+import fscrypt_keyindex
+import fscrypt_lib
+import fscrypt_loadgen
+import fscrypt_migrate
+import fscrypt_reencrypt
+import fscrypt_trace
+import fscrypt_unlock
+
 # Retrieve the test directory from the environment.
 RAW_TEST_DIR = os.environ.get("TEST_DIR")
 if not RAW_TEST_DIR:
@@ -41,17 +94,54 @@ if not os.path.isdir(RAW_TEST_DIR):
     raise SystemError("Directory " + RAW_TEST_DIR + " does not exist")
 # Actually use a subdirectory of $TEST_DIR instead of $TEST_DIR itself, in case
 # $TEST_DIR is the filesystem's root directory.  Filesystem root directories are
-# nonempty (since they contain "lost+found") and can't be encrypted.
-TEST_DIR = os.path.join(RAW_TEST_DIR, "test")
+# nonempty (since they contain "lost+found") and can't be encrypted.  When the
+# tests are run in parallel by pytest-xdist, each worker uses its own
+# subdirectory.
+XDIST_WORKER = os.environ.get("PYTEST_XDIST_WORKER")
+if XDIST_WORKER:
+    TEST_DIR = os.path.join(RAW_TEST_DIR, "test-" + XDIST_WORKER)
+else:
+    TEST_DIR = os.path.join(RAW_TEST_DIR, "test")
 
 # Determine how the fscryptctl binary will be invoked.
 FSCRYPTCTL = ["fscryptctl"]
 VALGRIND_ERROR_EXITCODE = 100
-if os.environ.get("ENABLE_VALGRIND") == "1":
+ENABLE_VALGRIND = os.environ.get("ENABLE_VALGRIND") == "1"
+if ENABLE_VALGRIND:
     FSCRYPTCTL = ["valgrind", "--quiet",
                   "--error-exitcode={}".format(VALGRIND_ERROR_EXITCODE),
                   "--leak-check=full", "--errors-for-leak-kinds=all"] + FSCRYPTCTL
 
+# The commands that can be executed by "fscryptctl batch", and the subset of
+# them that read standard input.
+BATCH_COMMANDS = ["add_key", "remove_key", "key_status", "list_filesystems",
+                  "get_policy", "set_policy", "import_hw_wrapped_key",
+                  "generate_hw_wrapped_key", "prepare_hw_wrapped_key"]
+BATCH_STDIN_COMMANDS = ["add_key", "import_hw_wrapped_key",
+                        "prepare_hw_wrapped_key"]
+ENABLE_BATCH = os.environ.get("ENABLE_BATCH") == "1"
+
+# Determine how the test helpers will add and remove keys.
+USE_IOCTL_BACKEND = os.environ.get("TEST_BACKEND") == "ioctl"
+
+# Determine whether the ioctls are emulated by fscrypt_shim.so.
+USE_SHIM = "fscrypt_shim" in os.environ.get("LD_PRELOAD", "")
+
+# The filesystem types that TEST_FILESYSTEMS may list, and how to format them
+# with encryption support.
+MKFS_COMMANDS = {
+    "ext4": ["mkfs.ext4", "-q", "-b", "4096", "-O", "encrypt", "-F"],
+    "f2fs": ["mkfs.f2fs", "-q", "-f", "-O", "encrypt"],
+}
+TEST_IMAGE_SIZE = 64 << 20
+TEST_FILESYSTEMS = [
+    fstype for fstype in os.environ.get("TEST_FILESYSTEMS", "").split(",")
+    if fstype]
+for fstype in TEST_FILESYSTEMS:
+    if fstype not in MKFS_COMMANDS:
+        raise SystemError("Unsupported filesystem type in TEST_FILESYSTEMS: " +
+                          fstype)
+
 # The list of test keys.  The expected key identifiers were computed by
 # generate_test_key_identifiers.py.
 
@@ -70,6 +160,20 @@ TEST_KEY_16B = {
 TEST_KEYS = [TEST_KEY, TEST_KEY_32B, TEST_KEY_16B]
 
 
+def make_worker_key(key, worker):
+    """Derives a key of the same size as |key| that is unique to the given
+    pytest-xdist worker, so that workers never add or remove each other's keys
+    on the shared filesystem."""
+    raw = hashlib.sha512(worker.encode("utf-8") + b"\0" + key["raw"]).digest()
+    raw = (raw * 2)[:len(key["raw"])]
+    return {"raw": raw, "identifier": fscrypt.compute_key_identifier(raw)}
+
+
+if XDIST_WORKER:
+    for key in TEST_KEYS:
+        key.update(make_worker_key(key, XDIST_WORKER))
+
+
 def postprocess_output(output):
     """Decodes the stdout or stderr output of fscryptctl and replaces any
     references to the path of TEST_DIR with the literal string "TEST_DIR" so
@@ -77,33 +181,175 @@ def postprocess_output(output):
     return output.decode("utf-8").strip().replace(TEST_DIR, "TEST_DIR")
 
 
+class BatchProcess:
+    """A long-lived "fscryptctl batch" process which executes commands on
+    behalf of fscryptctl()."""
+
+    def __init__(self):
+        self.cwd = os.getcwd()
+        self.process = subprocess.Popen(FSCRYPTCTL + ["batch"],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.executed = False
+
+    def can_execute(self, args):
+        """Returns true if the given command can be executed by the batch
+        process.  Relative paths are resolved against the directory that the
+        batch process was started in, batch command lines can't contain empty
+        arguments or newlines, and only some commands can read stdin."""
+        return (len(args) != 0 and args[0] in BATCH_COMMANDS and
+                os.getcwd() == self.cwd and "--dirs-from=-" not in args and
+                "--multiple" not in args and
+                all(arg and "\n" not in arg for arg in args))
+
+    def execute(self, args, stdin):
+        """Executes a command and returns its exit status, standard output,
+        and standard error."""
+        line = " ".join(arg.replace("\\", "\\\\").replace(" ", "\\ ")
+                        .replace("\t", "\\\t") for arg in args)
+        request = line.encode("utf-8") + b"\n"
+        if args[0] in BATCH_STDIN_COMMANDS:
+            request += str(len(stdin)).encode("utf-8") + b"\n" + stdin
+        self.process.stdin.write(request)
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().decode("utf-8").split()
+        returncode, stdout_size, stderr_size = [int(x) for x in header]
+        stdout = self.process.stdout.read(stdout_size)
+        stderr = self.process.stdout.read(stderr_size)
+        self.executed = True
+        return returncode, stdout, stderr
+
+    def cpu_time(self):
+        """Returns the CPU time that the batch process has used so far, in
+        seconds."""
+        with open("/proc/{}/stat".format(self.process.pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def close(self):
+        """Stops the batch process and checks that it exited successfully."""
+        self.process.stdin.close()
+        self.process.stdout.close()
+        assert self.process.wait() == 0
+
+
+BATCH_PROCESS = None
+
+
+@pytest.fixture(scope="session", autouse=True)
+def batch_process(filesystem_pool):
+    """This fixture stops the batch process, if any, at the end of the test
+    session, before the filesystem pool is unmounted."""
+    yield
+    if BATCH_PROCESS:
+        BATCH_PROCESS.close()
+
+
+# The fscryptctl invocations made since conftest.py last collected them (at the
+# end of each phase of each test), as tuples of (command name, wall time, CPU
+# time, estimated valgrind overhead), all in seconds.
+FSCRYPTCTL_INVOCATIONS = []
+
+VALGRIND_STARTUP_TIME = None
+
+
+def valgrind_startup_time():
+    """Returns how much longer it takes to execute fscryptctl under valgrind
+    than without it, as measured by running "fscryptctl --version" both ways
+    the first time this is called."""
+    global VALGRIND_STARTUP_TIME
+    if VALGRIND_STARTUP_TIME is None:
+        times = []
+        for command in [FSCRYPTCTL, FSCRYPTCTL[-1:]]:
+            start = time.perf_counter()
+            for _ in range(3):
+                subprocess.run(command + ["--version"],
+                               stdout=subprocess.DEVNULL, check=True)
+            times.append((time.perf_counter() - start) / 3)
+        VALGRIND_STARTUP_TIME = max(0.0, times[0] - times[1])
+    return VALGRIND_STARTUP_TIME
+
+
+def children_cpu_time():
+    """Returns the CPU time used by the child processes that have exited."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def record_invocation(args, start, cpu_time, started_process):
+    """Records an fscryptctl invocation which started at time |start| in
+    FSCRYPTCTL_INVOCATIONS.  The valgrind overhead is estimated as the startup
+    time of valgrind, if the invocation had to start a new process."""
+    wall_time = time.perf_counter() - start
+    overhead = 0.0
+    if ENABLE_VALGRIND and started_process:
+        overhead = min(wall_time, valgrind_startup_time())
+    FSCRYPTCTL_INVOCATIONS.append((args[0] if args else "", wall_time,
+                                   cpu_time, overhead))
+
+
+def run_fscryptctl(args, stdin):
+    """Executes the fscryptctl program with the given arguments and returns
+    its exit status, standard output, and standard error."""
+    global BATCH_PROCESS
+    args = [arg.decode("utf-8") if isinstance(arg, bytes) else arg
+            for arg in args]
+    start = time.perf_counter()
+    if ENABLE_BATCH:
+        if not BATCH_PROCESS:
+            BATCH_PROCESS = BatchProcess()
+        if BATCH_PROCESS.can_execute(args):
+            started_process = not BATCH_PROCESS.executed
+            cpu_start = BATCH_PROCESS.cpu_time()
+            result = BATCH_PROCESS.execute(args, stdin)
+            cpu_time = BATCH_PROCESS.cpu_time() - cpu_start
+            record_invocation(args, start, cpu_time, started_process)
+            return result
+    cpu_start = children_cpu_time()
+    p = subprocess.Popen(FSCRYPTCTL + args, stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(stdin)
+    record_invocation(args, start, children_cpu_time() - cpu_start, True)
+    return p.returncode, stdout, stderr
+
+
 def fscryptctl(*args, stdin=b"", expected_error=""):
     """Executes the fscryptctl program with the given arguments and returns the
     text (if any) that it printed to standard output.  |stdin| is the bytes to
     pass on standard input.  By default the program is expected to succeed.  If
     instead |expected_error| is nonempty, then it is expected to fail and print
     the given error message to stderr."""
-    p = subprocess.Popen(FSCRYPTCTL + list(args), stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate(stdin)
+    returncode, stdout, stderr = run_fscryptctl(args, stdin)
     stdout = postprocess_output(stdout)
     stderr = postprocess_output(stderr)
 
     # Check for errors.
-    if p.returncode != 0:
-        assert p.returncode != VALGRIND_ERROR_EXITCODE, stderr
+    if returncode != 0:
+        assert returncode != VALGRIND_ERROR_EXITCODE, stderr
         if expected_error:
             assert stderr == expected_error
             return stdout
         if stderr:
             raise SystemError(stderr)
-        raise subprocess.CalledProcessError(p.returncode, "fscryptctl")
+        raise subprocess.CalledProcessError(returncode, "fscryptctl")
 
     assert not stderr
     assert not expected_error
     return stdout
 
 
+def fscryptctl_bytes(*args, stdin=b""):
+    """Like fscryptctl(), but for commands that are expected to succeed and that
+    print binary data, such as wrapped keys.  Returns the exact bytes that were
+    printed to standard output."""
+    returncode, stdout, stderr = run_fscryptctl(args, stdin)
+    assert returncode != VALGRIND_ERROR_EXITCODE, stderr
+    if returncode != 0:
+        raise SystemError(postprocess_output(stderr))
+    assert not stderr
+    return stdout
+
+
 def list_filenames(directory):
     """Lists the filenames in the given directory."""
     filenames = []
@@ -113,11 +359,113 @@ def list_filenames(directory):
     return filenames
 
 
+class FilesystemPool:
+    """The filesystems listed in TEST_FILESYSTEMS.  Each one is created on a
+    loop-backed image and mounted the first time it is needed, and stays
+    mounted until close() is called at the end of the test session."""
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.image_dir = None
+        self.mountpoints = {}
+        self.errors = {}
+
+    def _setup(self, fstype):
+        if self.image_dir is None:
+            self.image_dir = tempfile.mkdtemp(prefix="fscryptctl-test-")
+        image = os.path.join(self.image_dir, fstype + ".img")
+        with open(image, "wb") as f:
+            f.truncate(TEST_IMAGE_SIZE)
+        mountpoint = os.path.join(self.parent, "pool-" + fstype)
+        if XDIST_WORKER:
+            mountpoint += "-" + XDIST_WORKER
+        subprocess.run(MKFS_COMMANDS[fstype] + [image], check=True,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        os.makedirs(mountpoint, exist_ok=True)
+        subprocess.run(["mount", "-o", "loop", image, mountpoint], check=True,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return mountpoint
+
+    def get(self, fstype):
+        """Returns the mountpoint of the given filesystem type, setting it up
+        if needed.  Raises SystemError if it can't be set up."""
+        if fstype not in self.mountpoints and fstype not in self.errors:
+            try:
+                self.mountpoints[fstype] = self._setup(fstype)
+            except subprocess.CalledProcessError as e:
+                self.errors[fstype] = "{}: {} failed: {}".format(
+                    fstype, e.cmd[0], e.stdout.decode("utf-8").strip())
+            except OSError as e:
+                self.errors[fstype] = "{}: {}".format(fstype, e)
+        if fstype in self.errors:
+            raise SystemError(self.errors[fstype])
+        return self.mountpoints[fstype]
+
+    def close(self):
+        """Unmounts all the filesystems and deletes their images.  The unmounts
+        are lazy, since other pytest-xdist workers' batch processes may still
+        have the filesystems open (list_filesystems and --all-filesystems find
+        every worker's filesystems)."""
+        for mountpoint in self.mountpoints.values():
+            subprocess.run(["umount", "--lazy", mountpoint], check=True)
+            os.rmdir(mountpoint)
+        self.mountpoints = {}
+        if self.image_dir is not None:
+            shutil.rmtree(self.image_dir)
+            self.image_dir = None
+
+
+FILESYSTEM_POOL = FilesystemPool(RAW_TEST_DIR)
+
+
+def pytest_generate_tests(metafunc):
+    """Runs every test once on each filesystem type in TEST_FILESYSTEMS."""
+    if TEST_FILESYSTEMS and "filesystem" in metafunc.fixturenames:
+        metafunc.parametrize("filesystem", TEST_FILESYSTEMS, indirect=True,
+                             scope="session")
+
+
+@pytest.fixture(scope="session")
+def filesystem_pool():
+    """This fixture unmounts the filesystems in the pool, if any, at the end of
+    the test session."""
+    yield FILESYSTEM_POOL
+    FILESYSTEM_POOL.close()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def filesystem(request, filesystem_pool):
+    """This fixture points RAW_TEST_DIR and TEST_DIR at the filesystem type
+    that the test is being run on, if TEST_FILESYSTEMS is set.  Since it is
+    session-scoped, pytest groups the tests by filesystem type."""
+    global RAW_TEST_DIR, TEST_DIR
+    fstype = getattr(request, "param", None)
+    if fstype is not None:
+        try:
+            RAW_TEST_DIR = filesystem_pool.get(fstype)
+        except SystemError as e:
+            pytest.skip(str(e))
+        TEST_DIR = os.path.join(RAW_TEST_DIR, os.path.basename(TEST_DIR))
+    yield fstype
+
+
 def cleanup_directory():
     """Cleans up by removing the test directory and all test keys which may have
     been added to the filesystem."""
     shutil.rmtree(TEST_DIR, ignore_errors=True)
     for key in TEST_KEYS:
+        # Most tests add only some of the keys, and checking the status of a
+        # key in-process is much faster than executing fscryptctl to remove it.
+        if fscrypt.get_key_status(key["identifier"], RAW_TEST_DIR).status == \
+                fscrypt.FSCRYPT_KEY_STATUS_ABSENT:
+            continue
+        if USE_IOCTL_BACKEND:
+            try:
+                fscrypt.remove_key(key["identifier"], RAW_TEST_DIR)
+            except OSError as e:
+                # It is okay if the key doesn't exist.
+                assert e.errno == errno.ENOKEY
+            continue
         try:
             fscryptctl("remove_key", key["identifier"], RAW_TEST_DIR)
         except SystemError as e:
@@ -138,13 +486,14 @@ def directory():
     cleanup_directory()
 
 
-def describe_policy(path=TEST_DIR, key=TEST_KEY, contents="AES-256-XTS",
+def describe_policy(path=None, key=TEST_KEY, contents="AES-256-XTS",
                     filenames="AES-256-CTS", flags="PAD_32",
                     data_unit_size="default"):
     """Builds the expected output for a successful invocation of the get_policy
     command.  The arguments specify the settings used in the encryption policy
-    as well as the path to the file or directory that has the policy."""
-    path = path.replace(TEST_DIR, "TEST_DIR")
+    as well as the path to the file or directory (by default TEST_DIR) that has
+    the policy."""
+    path = (path or TEST_DIR).replace(TEST_DIR, "TEST_DIR")
     out = "Encryption policy for {}:\n".format(path)
     out += "\tPolicy version: 2\n"
     out += "\tMaster key identifier: {}\n".format(key["identifier"])
@@ -163,6 +512,51 @@ def check_policy(path, **kwargs):
     assert fscryptctl("get_policy", path) == expected_output
 
 
+# The cache file that fscrypt_caps uses in the tests.  It is kept next to
+# TEST_DIR rather than in $HOME, and is deleted at the start and end of each
+# test session, so that a cache left by an earlier session can't affect the
+# results.  Each pytest-xdist worker uses its own.
+CAPABILITIES_CACHE = os.path.join(
+    RAW_TEST_DIR, ".fscrypt-caps{}.json".format(
+        "-" + XDIST_WORKER if XDIST_WORKER else ""))
+
+
+def remove_capabilities_cache():
+    if os.path.exists(CAPABILITIES_CACHE):
+        os.remove(CAPABILITIES_CACHE)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def capabilities_cache():
+    """This fixture gives each test session a fresh capabilities cache."""
+    remove_capabilities_cache()
+    yield CAPABILITIES_CACHE
+    remove_capabilities_cache()
+
+
+def get_capabilities():
+    """Returns the capabilities of the kernel and the filesystem of
+    RAW_TEST_DIR, as probed by fscrypt_caps (once per test session)."""
+    return fscrypt_caps.get_capabilities(RAW_TEST_DIR, CAPABILITIES_CACHE)
+
+
+def unsupported_reason(**policy_args):
+    """Returns None if the kernel and the filesystem of RAW_TEST_DIR support
+    the encryption policy built by fscrypt.make_policy() with the given
+    arguments (other than the key), or otherwise the reason they don't."""
+    policy = fscrypt.make_policy("", **policy_args)
+    return fscrypt_caps.unsupported_reason(get_capabilities(), policy)
+
+
+def require_policy_support(**policy_args):
+    """Skips the test unless the given encryption policy is supported, as per
+    unsupported_reason()."""
+    reason = unsupported_reason(**policy_args)
+    if reason:
+        pytest.skip("{}: {}".format(fscrypt_caps.policy_name(
+            fscrypt.make_policy("", **policy_args)), reason))
+
+
 def prepare_encrypted_dir(directory, *set_policy_args,
                           key=TEST_KEY, expected_error=""):
     """Prepares an encrypted directory by (re-)creating the directory, adding
@@ -177,7 +571,10 @@ def prepare_encrypted_dir(directory, *set_policy_args,
     os.mkdir(directory)
 
     # Add the key to the filesystem keyring.
-    key_identifier = fscryptctl("add_key", directory, stdin=key["raw"])
+    if USE_IOCTL_BACKEND:
+        key_identifier = fscrypt.add_key(directory, key["raw"])
+    else:
+        key_identifier = fscryptctl("add_key", directory, stdin=key["raw"])
     assert key_identifier == key["identifier"]
 
     # Set the encryption policy on the directory.
@@ -227,11 +624,11 @@ def test_unknown_command():
 
 
 def test_get_policy_parameters():
-    """Tests that the get_policy command expects exactly one positional
+    """Tests that the get_policy command expects at least one positional
     parameter."""
-    for args in [[], ["foo", "bar"]]:
+    for args in [[], ["--json"]]:
         fscryptctl("get_policy", *args,
-                   expected_error="error: must specify a single file or directory")
+                   expected_error="error: must specify at least one file or directory")
 
 
 def test_set_policy_parameters():
@@ -300,6 +697,45 @@ def test_filename_like_option(directory):
         os.chdir(orig_cwd)
 
 
+def test_get_policy_multiple_paths(directory):
+    """Tests getting the encryption policies of several paths at once, as text
+    and as JSON, including paths that fail."""
+    encrypted = os.path.join(directory, "encrypted")
+    plain = os.path.join(directory, "plain\"\\")
+    os.mkdir(plain)
+    prepare_encrypted_dir(encrypted, "--padding=16")
+    paths = [encrypted, plain, "NONEXISTENT", encrypted]
+
+    returncode, stdout, stderr = run_fscryptctl(["get_policy"] + paths, b"")
+    assert returncode == 1
+    assert postprocess_output(stdout) == "\n".join(
+        [describe_policy(encrypted, flags="PAD_16")] * 2)
+    assert postprocess_output(stderr) == "\n".join([
+        "error: getting policy for TEST_DIR/plain\"\\: file or directory not encrypted",
+        "error: opening NONEXISTENT: No such file or directory"])
+
+    returncode, stdout, stderr = run_fscryptctl(["get_policy", "--json"] + paths,
+                                                b"")
+    assert (returncode, stderr) == (1, b"")
+    policy = {
+        "path": encrypted,
+        "version": 2,
+        "master_key_identifier": TEST_KEY["identifier"],
+        "contents_encryption_mode": fscrypt.FSCRYPT_MODE_AES_256_XTS,
+        "filenames_encryption_mode": fscrypt.FSCRYPT_MODE_AES_256_CTS,
+        "flags": fscrypt.FSCRYPT_POLICY_FLAGS_PAD_16,
+        "data_unit_size": 0,
+    }
+    assert [json.loads(line) for line in stdout.splitlines()] == [
+        policy,
+        {"path": plain, "error": "file or directory not encrypted",
+         "errno": errno.ENODATA},
+        {"path": "NONEXISTENT", "error": "No such file or directory",
+         "errno": errno.ENOENT},
+        policy,
+    ]
+
+
 def test_set_get_policy_alternate_padding(directory):
     """Tests getting and setting an encryption policy with a non-default value
     for the filenames padding option."""
@@ -330,8 +766,9 @@ def test_set_get_policy_aes_256_xts(directory):
                           "--filenames=AES-256-CTS")
     check_policy(directory, contents="AES-256-XTS", filenames="AES-256-CTS")
     # AES-256-XTS is only allowed with master keys that are 32 bytes or longer.
-    # Shorter keys shouldn't work.
-    for key in [TEST_KEY_16B]:
+    # Shorter keys shouldn't work.  (The shim doesn't derive per-file keys, so
+    # it can't detect this.)
+    for key in [] if USE_SHIM else [TEST_KEY_16B]:
         with pytest.raises(OSError):
             prepare_encrypted_dir(directory, "--contents=AES-256-XTS",
                                   "--filenames=AES-256-CTS", key=key)
@@ -343,12 +780,8 @@ def test_set_get_policy_aes_128_cbc(directory):
 
     # This algorithm isn't guaranteed to be available, so skip this test if the
     # kernel lacks the crypto API support that is needed to run it.
-    try:
-        prepare_encrypted_dir(directory, "--contents=AES-128-CBC",
-                              "--filenames=AES-128-CTS")
-    except OSError as e:
-        assert "Package not installed" in str(e)
-        pytest.skip("Kernel doesn't support AES-128-CBC encryption")
+    require_policy_support(contents_mode=fscrypt.FSCRYPT_MODE_AES_128_CBC,
+                           filenames_mode=fscrypt.FSCRYPT_MODE_AES_128_CTS)
 
     # AES-128-CBC expects a key that is 16 bytes or longer.
     for key in [TEST_KEY_16B, TEST_KEY_32B, TEST_KEY]:
@@ -363,16 +796,8 @@ def test_set_get_policy_sm4(directory):
     contents encryption and SM4-CTS filenames encryption."""
 
     # Skip the test if the kernel lacks support for SM4-XTS and SM4-CTS.
-    try:
-        prepare_encrypted_dir(directory, "--contents=SM4-XTS",
-                              "--filenames=SM4-CTS")
-    except SystemError as e:
-        # Old kernel that doesn't know about SM4-XTS and SM4-CTS
-        assert "invalid encryption options provided" in str(e)
-        pytest.skip("Kernel doesn't support SM4-XTS and SM4-CTS encryption")
-    except OSError as e:
-        assert "Package not installed" in str(e)
-        pytest.skip("Kernel doesn't support SM4-XTS and SM4-CTS encryption")
+    require_policy_support(contents_mode=fscrypt.FSCRYPT_MODE_SM4_XTS,
+                           filenames_mode=fscrypt.FSCRYPT_MODE_SM4_CTS)
 
     for key in [TEST_KEY_16B]:
         prepare_encrypted_dir(directory, "--contents=SM4-XTS",
@@ -387,12 +812,8 @@ def test_set_get_policy_adiantum(directory):
 
     # This algorithm isn't guaranteed to be available, so skip this test if the
     # kernel lacks the crypto API support that is needed to run it.
-    try:
-        prepare_encrypted_dir(directory, "--contents=Adiantum",
-                              "--filenames=Adiantum")
-    except OSError as e:
-        assert "Package not installed" in str(e)
-        pytest.skip("Kernel doesn't support Adiantum encryption")
+    require_policy_support(contents_mode=fscrypt.FSCRYPT_MODE_ADIANTUM,
+                           filenames_mode=fscrypt.FSCRYPT_MODE_ADIANTUM)
 
     # The --direct-key flag is allowed with Adiantum.
     for direct_key in [False, True]:
@@ -421,6 +842,8 @@ def test_set_get_policy_adiantum(directory):
                 prepare_encrypted_dir(directory, *set_policy_args, key=key)
                 check_policy(directory, key=key, contents="Adiantum",
                              filenames="Adiantum", flags=flags)
+            if USE_SHIM:
+                continue
             with pytest.raises(OSError):
                 prepare_encrypted_dir(directory, "--contents=Adiantum",
                                       "--filenames=Adiantum", key=TEST_KEY_16B)
@@ -432,18 +855,8 @@ def test_set_get_policy_aes_256_hctr2(directory):
     AES-256-HCTR2 contents encryption, so that is not tested."""
 
     # Skip the test if the kernel lacks support for AES-256-HCTR2.
-    try:
-        prepare_encrypted_dir(directory, "--contents=AES-256-XTS",
-                              "--filenames=AES-256-HCTR2")
-    except SystemError as e:
-        # Old kernel that doesn't know about AES-256-HCTR2
-        assert "invalid encryption options provided" in str(e)
-        pytest.skip("Kernel doesn't support AES-256-HCTR2 encryption")
-    except OSError as e:
-        # New kernel that knows about AES-256-HCTR2, but doesn't have HCTR2
-        # support enabled in the crypto API.
-        assert "Package not installed" in str(e)
-        pytest.skip("Kernel doesn't support AES-256-HCTR2 encryption")
+    require_policy_support(
+        filenames_mode=fscrypt.FSCRYPT_MODE_AES_256_HCTR2)
 
     for padding in [4, 16, 32, None]:
         set_policy_args = ["--contents=AES-256-XTS", "--filenames=AES-256-HCTR2"]
@@ -464,10 +877,10 @@ def test_set_get_policy_iv_ino_lblk_64(directory):
     IV_INO_LBLK_64 flag."""
     # This flag may not always be accepted, as on some filesystems it is only
     # allowed if the filesystem was formatted with '-O stable_inodes'.
-    try:
-        prepare_encrypted_dir(directory, "--iv-ino-lblk-64")
-    except SystemError as e:
-        assert "invalid encryption options provided" in str(e)
+    require_policy_support(flags=fscrypt.FSCRYPT_POLICY_FLAGS_PAD_32 |
+                           fscrypt.FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64)
+    prepare_encrypted_dir(directory, "--iv-ino-lblk-64")
+    check_policy(directory, flags="PAD_32, IV_INO_LBLK_64")
 
 
 def test_set_get_policy_iv_ino_lblk_32(directory):
@@ -475,10 +888,10 @@ def test_set_get_policy_iv_ino_lblk_32(directory):
     IV_INO_LBLK_32 flag."""
     # This flag may not always be accepted, as on some filesystems it is only
     # allowed if the filesystem was formatted with '-O stable_inodes'.
-    try:
-        prepare_encrypted_dir(directory, "--iv-ino-lblk-32")
-    except SystemError as e:
-        assert "invalid encryption options provided" in str(e)
+    require_policy_support(flags=fscrypt.FSCRYPT_POLICY_FLAGS_PAD_32 |
+                           fscrypt.FSCRYPT_POLICY_FLAG_IV_INO_LBLK_32)
+    prepare_encrypted_dir(directory, "--iv-ino-lblk-32")
+    check_policy(directory, flags="PAD_32, IV_INO_LBLK_32")
 
 
 def test_set_policy_bad_padding(directory):
@@ -512,18 +925,144 @@ def test_set_policy_bad_mode_combination(directory):
                           expected_error="error: setting policy for TEST_DIR: invalid encryption options provided")
 
 
+def test_set_policy_multiple_dirs(directory):
+    """Tests setting an encryption policy on multiple directories at once,
+    including directories given in a file and directories that fail."""
+    fscryptctl("add_key", directory, stdin=TEST_KEY["raw"])
+    dirs = [os.path.join(directory, str(i)) for i in range(6)]
+    for d in dirs:
+        os.mkdir(d)
+    dirs_file = os.path.join(directory, "dirs")
+    with open(dirs_file, "w") as f:
+        f.write("\n".join(dirs[3:]) + "\n\n")
+    # Setting the same policy again on dirs[0] is not an error.
+    fscryptctl("set_policy", "--padding=16", TEST_KEY["identifier"], dirs[0])
+    fscryptctl("set_policy", "--padding=16", "--dirs-from=" + dirs_file,
+               TEST_KEY["identifier"], *dirs[:3])
+    for d in dirs:
+        check_policy(d, flags="PAD_16")
+
+    # Directories that fail shouldn't stop the others from being processed.
+    more_dirs = [os.path.join(directory, "more" + str(i)) for i in range(3)]
+    for d in more_dirs:
+        os.mkdir(d)
+    fscryptctl("set_policy", TEST_KEY["identifier"], more_dirs[0], dirs[0],
+               "NONEXISTENT", more_dirs[1],
+               expected_error="error: setting policy for TEST_DIR/0: file or directory already encrypted\n"
+               "error: opening NONEXISTENT: No such file or directory\n"
+               "error: failed to set policy on 2 of 4 directories")
+    check_policy(more_dirs[0])
+    check_policy(more_dirs[1])
+    fscryptctl("set_policy", "--dirs-from=-", TEST_KEY["identifier"],
+               stdin=more_dirs[2].encode("utf-8"))
+    check_policy(more_dirs[2])
+
+
 def test_set_policy_bad_key(directory):
     """Tests that the set_policy command expects a valid key identifier."""
     fscryptctl("set_policy", "bad", directory,
                expected_error="error: invalid key identifier: bad")
     fscryptctl("set_policy", "X" * 32, directory,
                expected_error="error: invalid key identifier: " + "X" * 32)
+    # sscanf() alone would accept a sign, whitespace, or a 0x prefix.
+    for key in ["+1" + "0" * 30, "0" * 30 + " a", "0x" + "0" * 30]:
+        fscryptctl("set_policy", key, directory,
+                   expected_error="error: invalid key identifier: " + key)
+
+
+def filesystem_root(directory):
+    """Returns the mountpoint that "fscryptctl list_filesystems" lists for the
+    filesystem containing |directory|, or None if it isn't listed."""
+    dev = os.stat(directory).st_dev
+    for mountpoint in fscryptctl("list_filesystems").splitlines():
+        if os.stat(mountpoint).st_dev == dev:
+            return mountpoint
+    return None
+
+
+@pytest.mark.skipif(USE_SHIM, reason="the shim makes every filesystem appear "
+                    "to support encryption")
+def test_list_filesystems(directory):
+    """Tests that list_filesystems lists the filesystem of the test directory,
+    and that the probe results are reused from the mount cache file."""
+    root = filesystem_root(directory)
+    assert root is not None
+    fscryptctl("list_filesystems", "foo",
+               expected_error="error: list_filesystems does not accept any arguments")
+
+    cache = os.path.join(directory, "mount_cache")
+    env = dict(os.environ, FSCRYPTCTL_MOUNT_CACHE=cache)
+
+    def list_filesystems():
+        p = subprocess.run(FSCRYPTCTL + ["list_filesystems"], env=env,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert p.returncode == 0
+        return (p.stdout.decode("utf-8").splitlines(),
+                postprocess_output(p.stderr))
+
+    assert list_filesystems()[0] == \
+        fscryptctl("list_filesystems").splitlines()
+    assert os.stat(cache).st_mode & 0o777 == 0o600
+    with open(cache) as f:
+        lines = f.read().splitlines()
+    # Each line is: mount ID, major:minor, whether encryption is supported,
+    # and the escaped mountpoint.
+    escaped_root = root.replace("\\", "\\134").replace(" ", "\\040")
+    entries = [line.split(" ", 3) for line in lines]
+    assert [e[2] for e in entries if e[3] == escaped_root] == ["1"]
+
+    # A cached result is used instead of probing the filesystem again.
+    with open(cache, "w") as f:
+        for e in entries:
+            if e[3] == escaped_root:
+                e[2] = "0"
+            f.write(" ".join(e) + "\n")
+    assert root not in list_filesystems()[0]
+
+    # ... but not if the cache file could have been written by another user.
+    os.chmod(cache, 0o620)
+    filesystems, warning = list_filesystems()
+    assert root in filesystems
+    assert warning == "warning: ignoring unsafe mount cache " + cache.replace(
+        TEST_DIR, "TEST_DIR")
+
+
+@pytest.mark.skipif(USE_SHIM, reason="the shim makes every filesystem appear "
+                    "to support encryption")
+def test_all_filesystems(directory):
+    """Tests key_status and remove_key with --all-filesystems."""
+    root = filesystem_root(directory)
+    for key in TEST_KEYS[:2]:
+        fscryptctl("add_key", directory, stdin=key["raw"])
+    lines = fscryptctl("key_status", "--all-filesystems", TEST_KEY["identifier"],
+                       TEST_KEY_32B["identifier"]).splitlines()
+    for key in TEST_KEYS[:2]:
+        assert "{}: {}: Present (user_count=1, added_by_self)".format(
+            root, key["identifier"]) in lines
+    statuses = [json.loads(line) for line in fscryptctl(
+        "key_status", "--all-filesystems", "--json",
+        TEST_KEY_16B["identifier"]).splitlines()]
+    assert {"key_identifier": TEST_KEY_16B["identifier"], "mountpoint": root,
+            "status": 1, "status_flags": 0, "user_count": 0} in statuses
+
+    assert fscryptctl("remove_key", "--all-filesystems",
+                      TEST_KEY["identifier"]) == ""
+    check_key_absent(TEST_KEY, directory)
+    check_key_present(TEST_KEY_32B, directory)
+    fscryptctl("remove_key", "--all-filesystems", TEST_KEY["identifier"],
+               expected_error="error: removing key: key not found on any filesystem")
+
+    fscryptctl("key_status", "--all-filesystems",
+               expected_error="error: must specify a key identifier")
+    for args in [[], [TEST_KEY["identifier"], directory]]:
+        fscryptctl("remove_key", "--all-filesystems", *args,
+                   expected_error="error: must specify a single key identifier")
 
 
 def test_key_status_parameters():
-    """Tests that the key_status command expects exactly two positional
+    """Tests that the key_status command expects at least two positional
     parameters."""
-    for args in [[], ["foo"], ["foo", "bar", "baz"]]:
+    for args in [[], ["foo"], ["--json", "foo"]]:
         fscryptctl("key_status", *args,
                    expected_error="error: must specify a key identifier and a mountpoint")
 
@@ -540,6 +1079,53 @@ def test_key_status_needs_directory():
                expected_error="error: opening NONEXISTENT: No such file or directory")
 
 
+def test_key_status_multiple_keys(directory):
+    """Tests getting the status of several keys at once, as text and as
+    JSON."""
+    fscryptctl("add_key", directory, stdin=TEST_KEY["raw"])
+    keys = [TEST_KEY["identifier"], TEST_KEY_32B["identifier"], "bad"]
+
+    returncode, stdout, stderr = run_fscryptctl(
+        ["key_status"] + keys + [directory], b"")
+    assert returncode == 1
+    assert postprocess_output(stdout) == "\n".join([
+        TEST_KEY["identifier"] + ": Present (user_count=1, added_by_self)",
+        TEST_KEY_32B["identifier"] + ": Absent"])
+    assert postprocess_output(stderr) == "error: invalid key identifier: bad"
+
+    returncode, stdout, stderr = run_fscryptctl(
+        ["key_status", "--json"] + keys + [directory], b"")
+    assert (returncode, stderr) == (1, b"")
+    assert [json.loads(line) for line in stdout.splitlines()] == [
+        {"key_identifier": TEST_KEY["identifier"], "mountpoint": directory,
+         "status": fscrypt.FSCRYPT_KEY_STATUS_PRESENT,
+         "status_flags": fscrypt.FSCRYPT_KEY_STATUS_FLAG_ADDED_BY_SELF,
+         "user_count": 1},
+        {"key_identifier": TEST_KEY_32B["identifier"], "mountpoint": directory,
+         "status": fscrypt.FSCRYPT_KEY_STATUS_ABSENT, "status_flags": 0,
+         "user_count": 0},
+        {"key_identifier": "bad", "mountpoint": directory,
+         "error": "invalid key identifier", "errno": errno.EINVAL},
+    ]
+
+    returncode, stdout, _ = run_fscryptctl(
+        ["key_status", "--json", TEST_KEY["identifier"], "NONEXISTENT"], b"")
+    assert returncode == 1
+    assert json.loads(stdout) == {
+        "key_identifier": TEST_KEY["identifier"], "mountpoint": "NONEXISTENT",
+        "error": "No such file or directory", "errno": errno.ENOENT}
+
+    # Errors getting the status of a key should name the key, as the JSON
+    # records do.  /proc doesn't support encryption, unless the shim makes
+    # every filesystem appear to support it.
+    if not USE_SHIM:
+        returncode, _, stderr = run_fscryptctl(
+            ["key_status", TEST_KEY["identifier"], "/proc"], b"")
+        assert returncode == 1
+        assert postprocess_output(stderr).startswith(
+            "error: getting status of key {}: ".format(TEST_KEY["identifier"]))
+
+
 def check_key_status(key, directory, status):
     """Helper function which checks that the given key has the given status on
     the filesystem that contains the given directory."""
@@ -564,6 +1150,28 @@ def check_key_incompletely_removed(key, directory):
     check_key_status(key, directory, "Incompletely removed")
 
 
+@contextlib.contextmanager
+def provisioning_key(key, hw_wrapped=False):
+    """Adds the given test key to the user keyring as an "fscrypt-provisioning"
+    key for the duration of the "with" block, and yields its key ID.  The user
+    keyring is used rather than the session keyring so that the batch process
+    can find the key too.  The test is skipped if the kernel doesn't support
+    fscrypt-provisioning keys."""
+    description = "fscryptctl-test:{}:{}".format(os.getpid(), key["identifier"])
+    try:
+        key_id = fscrypt.add_provisioning_key(
+            key["raw"], description, hw_wrapped=hw_wrapped,
+            keyring=fscrypt.KEY_SPEC_USER_KEYRING)
+    except OSError as e:
+        if e.errno in (errno.ENODEV, errno.ENOSYS):
+            pytest.skip("fscrypt-provisioning keys aren't supported")
+        raise
+    try:
+        yield key_id
+    finally:
+        fscrypt.invalidate_key(key_id)
+
+
 def test_add_key_parameters():
     """Tests that the add_key command expects exactly one positional
     parameter."""
@@ -596,6 +1204,374 @@ def test_add_key(directory):
         check_key_present(key, directory)
 
 
+def test_add_key_multiple(directory):
+    """Tests adding many keys at once from framed input, with the mountpoint
+    given either on the command line or in each key's record."""
+    parent_dir = os.path.join(directory, "..")
+    records = b"".join(
+        "{}{}\n".format(len(key["raw"]), " " + directory if i % 2 else "")
+        .encode("utf-8") + key["raw"] for i, key in enumerate(TEST_KEYS))
+    assert fscryptctl("add_key", "--multiple", parent_dir, stdin=records) == \
+        "\n".join(key["identifier"] for key in TEST_KEYS)
+    for key in TEST_KEYS:
+        check_key_present(key, directory)
+    assert fscryptctl("add_key", "--multiple", stdin=b"") == ""
+
+    # A key that can't be added doesn't stop the later keys from being added.
+    fscryptctl("remove_key", TEST_KEY["identifier"], parent_dir)
+    records = b"16\n" + TEST_KEY_16B["raw"] + b"64 NONEXISTENT\n" + \
+        TEST_KEY["raw"] + b"64 " + directory.encode("utf-8") + b"\n" + \
+        TEST_KEY["raw"]
+    assert fscryptctl("add_key", "--multiple", stdin=records,
+                      expected_error="error: key 1: no mountpoint specified\n"
+                      "error: opening NONEXISTENT: No such file or directory\n"
+                      "error: failed to add 2 of 3 keys") == \
+        TEST_KEY["identifier"]
+    check_key_present(TEST_KEY, directory)
+
+    # Invalid input stops the command.
+    for records, error in [
+            (b"8\n12345678", "error: key 1: invalid key size 8; it must be between 16 and 64 bytes"),
+            (b"16 x", "error: key 1: unexpected end of input"),
+            (b"32\n" + TEST_KEY_32B["raw"][:20], "error: key 1: unexpected end of input"),
+            (b"foo\n", "error: key 1: invalid record header"),
+            (b"16\n" + TEST_KEY_16B["raw"] + b"16x\n", "error: key 2: invalid record header")]:
+        fscryptctl("add_key", "--multiple", directory, stdin=records,
+                   expected_error=error)
+    fscryptctl("add_key", "--multiple", "foo", "bar",
+               expected_error="error: must specify at most one default mountpoint")
+    assert batch(b"add_key --multiple\n0\n") == [
+        (1, "", "error: --multiple can't be used in batch mode")]
+
+
+@pytest.mark.skipif(USE_SHIM, reason="the shim can't read keyring keys")
+def test_add_key_from_keyring(directory):
+    """Tests adding a key to one or more filesystems from an
+    "fscrypt-provisioning" key in the kernel keyring."""
+    parent_dir = os.path.join(directory, "..")
+    with provisioning_key(TEST_KEY) as key_id:
+        assert fscryptctl("add_key", "--key-id={}".format(key_id), directory,
+                          parent_dir) == \
+            "\n".join([TEST_KEY["identifier"]] * 2)
+        check_key_present(TEST_KEY, directory)
+        fscryptctl("remove_key", TEST_KEY["identifier"], directory)
+        assert fscrypt.add_key(directory, b"", key_id=key_id) == \
+            TEST_KEY["identifier"]
+        check_key_present(TEST_KEY, directory)
+        fscryptctl("remove_key", TEST_KEY["identifier"], directory)
+
+        fscryptctl("add_key", "--key-id={}".format(key_id),
+                   expected_error="error: must specify at least one mountpoint")
+        fscryptctl("add_key", "--key-id={}".format(key_id), "--multiple",
+                   directory, expected_error="error: --key-id and --multiple can't be used together")
+        assert fscryptctl("add_key", "--key-id={}".format(key_id), directory,
+                          "NONEXISTENT", expected_error="error: opening NONEXISTENT: No such file or directory\n"
+                          "error: failed to add key to 1 of 2 mountpoints") == \
+            TEST_KEY["identifier"]
+        fscryptctl("remove_key", TEST_KEY["identifier"], directory)
+    # The flags of the provisioning key must match the add_key flags.
+    with provisioning_key(TEST_KEY, hw_wrapped=True) as key_id:
+        fscryptctl("add_key", "--key-id={}".format(key_id), directory,
+                   expected_error="error: adding key to TEST_DIR: Key was rejected by service")
+    # The key can't be used after it has been invalidated.
+    fscryptctl("add_key", "--key-id={}".format(key_id), directory,
+               expected_error="error: adding key to TEST_DIR: Required key not available")
+    check_key_absent(TEST_KEY, directory)
+    for key_id in ["bad", "0", "-1", "2147483648"]:
+        fscryptctl("add_key", "--key-id=" + key_id, directory,
+                   expected_error="error: invalid key ID: " + key_id)
+
+
+def test_trace(directory):
+    """Tests that setting FSCRYPTCTL_TRACE makes fscryptctl write a trace
+    record for each command and for each of its system calls, and that
+    fscrypt_trace.py can summarize the records."""
+    nonexistent = os.path.join(directory, "NONEXISTENT dir")
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ, FSCRYPTCTL_TRACE=str(write_fd))
+    try:
+        for args, stdin in [(["add_key", directory], TEST_KEY["raw"]),
+                            (["get_policy", nonexistent], b"")]:
+            subprocess.run(FSCRYPTCTL + args, input=stdin, env=env,
+                           pass_fds=[write_fd], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+    finally:
+        os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        records = [fscrypt_trace.parse_record(line) for line in f]
+    assert None not in records
+    ops = [(r["cmd"], r["op"], r["name"], r["result"], r.get("path"))
+           for r in records]
+    assert ops == [
+        ("add_key", "read", "read", len(TEST_KEY["raw"]), None),
+        ("add_key", "open", "open", ops[1][3], directory),
+        ("add_key", "ioctl", "FS_IOC_ADD_ENCRYPTION_KEY", 0, None),
+        ("add_key", "write", "stdout", 0, None),
+        ("add_key", "command", "add_key", 0, None),
+        ("get_policy", "open", "open", -1, nonexistent),
+        ("get_policy", "write", "stdout", 0, None),
+        ("get_policy", "command", "get_policy", 1, None)]
+    assert ops[1][3] >= 0
+    assert records[5]["errno"] == errno.ENOENT
+    for record in records:
+        assert record["duration_ns"] >= 0
+
+    summary = fscrypt_trace.summarize(fscrypt_trace.group_records(records))
+    assert [(s["command"], s["op"], s["count"], s["errors"])
+            for s in summary] == [
+        ("add_key", "command", 1, 0), ("add_key", "ioctl", 1, 0),
+        ("add_key", "open", 1, 0), ("add_key", "read", 1, 0),
+        ("add_key", "write", 1, 0), ("get_policy", "command", 1, 0),
+        ("get_policy", "open", 1, 1), ("get_policy", "write", 1, 0)]
+    for entry in summary:
+        assert sum(b["count"] for b in entry["histogram"]) == entry["count"]
+
+    # Lines that aren't complete trace records are ignored.
+    line = "fscryptctl-trace pid=1 cmd=add_key op=read name=read " \
+        "start_ns=5 duration_ns=7 result=0"
+    assert fscrypt_trace.parse_record(line)["duration_ns"] == 7
+    for bad_line in ["other output", line[:40], line[:-9],
+                     line.replace("duration_ns=7", "duration_ns=7fscr")]:
+        assert fscrypt_trace.parse_record(bad_line) is None
+
+    # A record header that is too long is traced as a read too.
+    read_fd, write_fd = os.pipe()
+    try:
+        subprocess.run(FSCRYPTCTL + ["add_key", "--multiple", directory],
+                       input=b"9" * 5000,
+                       env=dict(os.environ, FSCRYPTCTL_TRACE=str(write_fd)),
+                       pass_fds=[write_fd], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    finally:
+        os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        records = [fscrypt_trace.parse_record(line) for line in f]
+    assert [(r["op"], r["name"]) for r in records][0] == ("read", "header")
+    assert records[0]["result"] > 0
+
+    # An invalid trace file descriptor only causes a warning.
+    p = subprocess.run(FSCRYPTCTL + ["key_status", TEST_KEY["identifier"],
+                                     directory],
+                       env=dict(os.environ, FSCRYPTCTL_TRACE="bad"),
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert p.returncode == 0
+    assert postprocess_output(p.stderr) == \
+        "warning: ignoring invalid FSCRYPTCTL_TRACE: bad"
+    assert postprocess_output(p.stdout).startswith("Present")
+
+
+def test_exporter(directory):
+    """Tests that fscrypt_exporter.py polls the configured and the discovered
+    keys, and serves their statuses as metrics."""
+    encrypted_dir = os.path.join(directory, "encrypted")
+    prepare_encrypted_dir(encrypted_dir)
+    nonexistent = os.path.join(directory, "NONEXISTENT")
+    exporter = fscrypt_exporter.Exporter(
+        [directory, nonexistent], [TEST_KEY_32B["identifier"]])
+    try:
+        exporter.poll()
+        metrics = exporter.render().splitlines()
+        labels = 'mountpoint="{}",key="{}"'.format(directory,
+                                                   TEST_KEY["identifier"])
+        for line in [
+                'fscrypt_key_status{{{},status="present"}} 1'.format(labels),
+                'fscrypt_key_status{{{},status="absent"}} 0'.format(labels),
+                "fscrypt_key_user_count{{{}}} 1".format(labels),
+                "fscrypt_key_added_by_self{{{}}} 1".format(labels),
+                "fscrypt_key_status_error{{{}}} 0".format(labels),
+                'fscrypt_key_status{{mountpoint="{}",key="{}",'
+                'status="absent"}} 1'.format(directory,
+                                             TEST_KEY_32B["identifier"]),
+                'fscrypt_mountpoint_up{{mountpoint="{}"}} 1'.format(directory),
+                'fscrypt_mountpoint_up{{mountpoint="{}"}} 0'.format(
+                    nonexistent),
+                "fscrypt_exporter_polls_total 1"]:
+            assert line in metrics
+        # Each metric's samples must be contiguous.
+        names = [line.split("{")[0].split()[0] for line in metrics
+                 if not line.startswith("#")]
+        assert len(set(names)) == len([name for i, name in enumerate(names)
+                                       if i == 0 or names[i - 1] != name])
+
+        # Scrapes are served from the cached results, until the next poll.
+        fscryptctl("remove_key", TEST_KEY["identifier"], directory)
+        server = fscrypt_exporter.make_server(exporter, "127.0.0.1", 0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:{}".format(server.server_address[1])
+            line = 'fscrypt_key_status{{{},status="present"}} {}'
+            with urllib.request.urlopen(url + "/metrics") as response:
+                assert line.format(labels, 1) in \
+                    response.read().decode("utf-8").splitlines()
+            exporter.poll()
+            with urllib.request.urlopen(url + "/metrics") as response:
+                assert line.format(labels, 0) in \
+                    response.read().decode("utf-8").splitlines()
+            with pytest.raises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(url + "/other")
+            assert e.value.code == 404
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+    finally:
+        exporter.close()
+
+
+def test_migrate(directory, monkeypatch):
+    """Tests that fscrypt_migrate.py copies a tree into an encrypted directory
+    with its metadata, resumes from its checkpoint after being interrupted, and
+    swaps the directories."""
+    source = os.path.join(directory, "source")
+    os.makedirs(os.path.join(source, "a", "b"))
+    contents = {}
+    for i, size in enumerate([0, 1, 4096, 100000, 1000000]):
+        for subdir in ["", "a", os.path.join("a", "b")]:
+            rel = os.path.join(subdir, "file{}".format(i))
+            contents[rel] = os.urandom(size)
+            with open(os.path.join(source, rel), "wb") as f:
+                f.write(contents[rel])
+    os.chmod(os.path.join(source, "file2"), 0o640)
+    os.utime(os.path.join(source, "file3"), ns=(1000000001, 2000000002))
+    os.link(os.path.join(source, "file4"), os.path.join(source, "a", "link"))
+    os.symlink("file1", os.path.join(source, "symlink"))
+    os.mkfifo(os.path.join(source, "fifo"))
+    os.chmod(os.path.join(source, "a"), 0o750)
+    os.utime(os.path.join(source, "a"), ns=(3000000003, 4000000004))
+    num_copies = len(contents) + 2
+
+    identifier = fscryptctl("add_key", directory, stdin=TEST_KEY["raw"])
+    policy = fscrypt.make_policy(identifier)
+
+    # Interrupt the first migration after some files have been copied.
+    copy_file = fscrypt_migrate._copy_file
+    copied = []
+
+    def failing_copy_file(src, dst, st):
+        if len(copied) >= 5:
+            raise OSError(errno.EIO, "simulated failure")
+        copied.append(src)
+        return copy_file(src, dst, st)
+
+    monkeypatch.setattr(fscrypt_migrate, "_copy_file", failing_copy_file)
+    migration = fscrypt_migrate.Migration(source, policy, jobs=1,
+                                          checkpoint_interval=0)
+    with pytest.raises(OSError):
+        migration.copy()
+    first_result = migration.result
+    assert first_result.files >= 5
+    monkeypatch.setattr(fscrypt_migrate, "_copy_file", copy_file)
+
+    # The second migration only copies the files that weren't checkpointed.
+    migration = fscrypt_migrate.Migration(source, policy, jobs=4)
+    result = migration.copy()
+    assert result.skipped_files == first_result.files
+    assert result.files == num_copies - first_result.files
+    assert result.bytes + first_result.bytes == \
+        sum(len(data) for data in contents.values())
+    migration.swap()
+
+    assert fscrypt.get_policy(source) == policy
+    assert not os.path.exists(source + fscrypt_migrate.CHECKPOINT_SUFFIX)
+    original = source + fscrypt_migrate.STAGING_SUFFIX
+    with pytest.raises(OSError) as e:
+        fscrypt.get_policy(original)
+    assert e.value.errno == errno.ENODATA
+    for rel, data in contents.items():
+        with open(os.path.join(source, rel), "rb") as f:
+            assert f.read() == data
+    for rel in ["file2", "file3", "a", "symlink", "fifo"]:
+        st = os.lstat(os.path.join(source, rel))
+        original_st = os.lstat(os.path.join(original, rel))
+        assert st.st_mode == original_st.st_mode
+        assert st.st_mtime_ns == original_st.st_mtime_ns
+    assert os.readlink(os.path.join(source, "symlink")) == "file1"
+    assert os.stat(os.path.join(source, "file4")).st_ino == \
+        os.stat(os.path.join(source, "a", "link")).st_ino
+
+
+def test_reencrypt(directory):
+    """Tests that fscrypt_reencrypt.py re-encrypts a directory tree with a new
+    key and policy, verifies it, and removes the old key."""
+    source = os.path.join(directory, "source")
+    prepare_encrypted_dir(source)
+    os.mkdir(os.path.join(source, "subdir"))
+    contents = {}
+    for rel in ["file", os.path.join("subdir", "file")]:
+        contents[rel] = os.urandom(200000)
+        with open(os.path.join(source, rel), "wb") as f:
+            f.write(contents[rel])
+    os.symlink("file", os.path.join(source, "symlink"))
+    old_policy = fscrypt.get_policy(source)
+
+    # Re-encrypting with the same policy is rejected.
+    with pytest.raises(ValueError) as e:
+        fscrypt_reencrypt.Reencryption(source, old_policy).copy()
+    assert str(e.value).endswith("already uses the new encryption policy")
+    assert not os.path.exists(source + fscrypt_reencrypt.STAGING_SUFFIX)
+
+    identifier = fscryptctl("add_key", directory, stdin=TEST_KEY_32B["raw"])
+    policy = fscrypt.make_policy(identifier,
+                                 flags=fscrypt.FSCRYPT_POLICY_FLAGS_PAD_16)
+    progress = []
+    reencryption = fscrypt_reencrypt.Reencryption(source, policy, jobs=2,
+                                                  progress=progress.append)
+    result = reencryption.copy()
+    assert result.files == 3
+    assert result.bytes == fscrypt_reencrypt.tree_size(source) == 400000
+    assert progress
+    reencryption.verify()
+
+    # Verification catches a copy that differs from the source.
+    with open(os.path.join(reencryption.staging, "file"), "r+b") as f:
+        f.write(bytes([contents["file"][0] ^ 0xff]))
+    with pytest.raises(ValueError):
+        reencryption.verify()
+    with open(os.path.join(reencryption.staging, "file"), "r+b") as f:
+        f.write(contents["file"][:1])
+
+    reencryption.swap()
+    assert reencryption.finish() == 0
+    assert fscrypt.get_policy(source) == policy
+    assert fscrypt.get_policy(os.path.join(source, "subdir")) == policy
+    assert not os.path.exists(reencryption.staging)
+    for rel, data in contents.items():
+        with open(os.path.join(source, rel), "rb") as f:
+            assert f.read() == data
+    assert os.readlink(os.path.join(source, "symlink")) == "file"
+    check_key_absent(TEST_KEY, directory)
+
+    assert fscrypt_reencrypt.format_progress(250, 1000, 1.0) == \
+        " 25.0% 0.00 of 0.00 GB, 0.000 GB/s, ETA 0:00:03"
+    assert fscrypt_reencrypt.format_progress(0, 1000, 0.0).endswith("ETA ?")
+
+
+def test_reencrypt_same_key(directory):
+    """Tests that re-encrypting a directory tree with new encryption modes but
+    the same key leaves the key added."""
+    require_policy_support(contents_mode=fscrypt.FSCRYPT_MODE_AES_128_CBC,
+                           filenames_mode=fscrypt.FSCRYPT_MODE_AES_128_CTS)
+    source = os.path.join(directory, "source")
+    prepare_encrypted_dir(source, "--contents=AES-128-CBC",
+                          "--filenames=AES-128-CTS")
+    data = os.urandom(10000)
+    with open(os.path.join(source, "file"), "wb") as f:
+        f.write(data)
+
+    policy = fscrypt.make_policy(TEST_KEY["identifier"])
+    reencryption = fscrypt_reencrypt.Reencryption(source, policy)
+    assert reencryption.copy().files == 1
+    assert reencryption.same_key()
+    reencryption.verify()
+    reencryption.swap()
+    assert reencryption.finish() is None
+    assert fscrypt.get_policy(source) == policy
+    check_key_present(TEST_KEY, directory)
+    with open(os.path.join(source, "file"), "rb") as f:
+        assert f.read() == data
+
+
 def test_remove_key_parameters():
     """Tests that the remove_key command expects exactly two positional
     parameters."""
@@ -661,6 +1637,39 @@ def test_remove_key_incomplete(directory):
     check_key_absent(TEST_KEY, parent_dir)
 
 
+def test_remove_key_wait(directory):
+    """Tests that remove_key --wait retries until the files using the key have
+    been closed, and that it fails if they aren't closed before the timeout."""
+    prepare_encrypted_dir(directory)
+    file = os.path.join(directory, "file")
+    parent_dir = os.path.join(directory, "..")
+
+    with open(file, "w"):
+        # The process holding the file should be found.
+        holders, _ = fscrypt_holders.find_holders([directory])
+        assert (os.getpid(), "fd", os.path.realpath(file)) in \
+            [(h.pid, "fd" if h.how.isdigit() else h.how, h.path)
+             for h in holders]
+
+        fscryptctl("remove_key", "--wait=0", TEST_KEY["identifier"], parent_dir,
+                   expected_error="error: timed out after 0 seconds waiting for files to be closed")
+        check_key_incompletely_removed(TEST_KEY, parent_dir)
+
+        p = subprocess.Popen(FSCRYPTCTL + ["remove_key", "--wait=30",
+                                           TEST_KEY["identifier"], parent_dir],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        time.sleep(0.2)
+        assert p.poll() is None
+    stdout, stderr = p.communicate()
+    assert (p.returncode, stdout, stderr) == (0, b"", b"")
+    check_key_absent(TEST_KEY, parent_dir)
+    assert fscrypt_holders.find_holders([directory])[0] == []
+
+    fscryptctl("remove_key", "--wait=x", TEST_KEY["identifier"], parent_dir,
+               expected_error="error: invalid timeout: x")
+
+
+@pytest.mark.skipif(USE_SHIM, reason="the shim doesn't encrypt files")
 def test_remove_key_locks_files(directory):
     """Tests that remove_key really "locks" access to files in an encrypted
     directory, and that add_key restores access again."""
@@ -698,3 +1707,513 @@ def test_remove_key_locks_files(directory):
     with pytest.raises(FileNotFoundError):
         open(nokey_path, "r")
     assert list_filenames(directory) == [filename]
+
+
+@pytest.mark.skipif(not USE_SHIM,
+                    reason="needs inline encryption hardware or the shim")
+def test_hw_wrapped_keys(directory):
+    """Tests importing, generating, and preparing hardware-wrapped keys, and
+    adding them to a filesystem."""
+    parent_dir = os.path.join(directory, "..")
+
+    # Importing the same raw key twice gives long-term wrapped keys which
+    # prepare to equivalent ephemerally-wrapped keys.
+    lt_key = fscryptctl_bytes("import_hw_wrapped_key", directory,
+                              stdin=TEST_KEY["raw"])
+    assert len(lt_key) > len(TEST_KEY["raw"])
+    assert TEST_KEY["raw"] not in lt_key
+    eph_key = fscryptctl_bytes("prepare_hw_wrapped_key", directory,
+                               stdin=lt_key)
+    identifier = fscryptctl("add_key", "--hw-wrapped-key", parent_dir,
+                            stdin=eph_key)
+    assert identifier != TEST_KEY["identifier"]
+    assert fscryptctl("add_key", "--hw-wrapped-key", parent_dir,
+                      stdin=fscryptctl_bytes("prepare_hw_wrapped_key",
+                                             directory, stdin=lt_key)) == \
+        identifier
+    check_key_status({"identifier": identifier}, parent_dir,
+                     "Present (user_count=1, added_by_self)")
+    fscryptctl("set_policy", identifier, directory)
+    check_policy(directory, key={"identifier": identifier})
+    assert fscryptctl("remove_key", identifier, parent_dir) == ""
+
+    # Generated keys are different each time.
+    generated = [fscryptctl_bytes("generate_hw_wrapped_key", directory)
+                 for _ in range(2)]
+    assert generated[0] != generated[1]
+    eph_key = fscryptctl_bytes("prepare_hw_wrapped_key", directory,
+                               stdin=generated[0])
+    identifier = fscryptctl("add_key", "--hw-wrapped-key", parent_dir,
+                            stdin=eph_key)
+    assert fscryptctl("remove_key", identifier, parent_dir) == ""
+
+    # Invalid wrapped keys are rejected, and a long-term wrapped key can't be
+    # used as an ephemerally-wrapped key.
+    fscryptctl("prepare_hw_wrapped_key", directory, stdin=b"X" * 32,
+               expected_error="error: preparing hardware-wrapped key: Bad message")
+    fscryptctl("add_key", "--hw-wrapped-key", parent_dir, stdin=lt_key,
+               expected_error="error: adding key to TEST_DIR/..: Bad message")
+
+
+def test_ioctl_interface(directory):
+    """Tests that the in-process ioctl interface in the fscrypt module agrees
+    with the fscryptctl commands."""
+    parent_dir = os.path.join(directory, "..")
+    assert fscrypt.get_key_status(TEST_KEY["identifier"], parent_dir) == \
+        fscrypt.KeyStatus(fscrypt.FSCRYPT_KEY_STATUS_ABSENT, 0, 0)
+    assert fscrypt.add_key(parent_dir, TEST_KEY["raw"]) == TEST_KEY["identifier"]
+    check_key_present(TEST_KEY, parent_dir)
+    assert fscrypt.get_key_status(TEST_KEY["identifier"], parent_dir) == \
+        fscrypt.KeyStatus(fscrypt.FSCRYPT_KEY_STATUS_PRESENT,
+                          fscrypt.FSCRYPT_KEY_STATUS_FLAG_ADDED_BY_SELF, 1)
+
+    policy = fscrypt.make_policy(TEST_KEY["identifier"],
+                                 flags=fscrypt.FSCRYPT_POLICY_FLAGS_PAD_16)
+    fscrypt.set_policy(directory, policy)
+    check_policy(directory, flags="PAD_16")
+    assert fscrypt.get_policy(directory) == policy
+    fscryptctl("set_policy", "--padding=8", TEST_KEY["identifier"], directory,
+               expected_error="error: setting policy for TEST_DIR: file or directory already encrypted")
+
+    with pytest.raises(OSError) as e:
+        fscrypt.get_policy(parent_dir)
+    assert e.value.errno == errno.ENODATA
+
+    assert fscrypt.remove_key(TEST_KEY["identifier"], parent_dir) == 0
+    check_key_absent(TEST_KEY, parent_dir)
+    with pytest.raises(OSError) as e:
+        fscrypt.remove_key(TEST_KEY["identifier"], parent_dir)
+    assert e.value.errno == errno.ENOKEY
+
+
+def batch(request):
+    """Runs "fscryptctl batch" with the given input and returns its result
+    records as a list of (exit status, stdout, stderr) tuples."""
+    p = subprocess.Popen(FSCRYPTCTL + ["batch"], stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, stderr = p.communicate(request)
+    assert p.returncode == 0, stderr
+    results = []
+    while output:
+        header, output = output.split(b"\n", 1)
+        returncode, stdout_size, stderr_size = [int(x) for x in header.split()]
+        stdout = postprocess_output(output[:stdout_size])
+        output = output[stdout_size:]
+        stderr = postprocess_output(output[:stderr_size])
+        output = output[stderr_size:]
+        results.append((returncode, stdout, stderr))
+    return results
+
+
+def test_batch(directory):
+    """Tests executing several commands in one fscryptctl batch process,
+    including commands that fail."""
+    key_identifier = TEST_KEY["identifier"]
+    request = b"add_key " + directory.encode("utf-8") + b"\n"
+    request += b"64\n" + TEST_KEY["raw"]
+    request += b"\n".join([
+        b"",
+        b"key_status " + key_identifier.encode("utf-8") + b" " +
+        RAW_TEST_DIR.encode("utf-8"),
+        b"set_policy --padding=16 " + key_identifier.encode("utf-8") + b" " +
+        directory.encode("utf-8"),
+        b"get_policy NONEXISTENT",
+        b"NONEXISTENT_COMMAND foo",
+        b"",
+        b"get_policy " + directory.encode("utf-8"),
+        b"add_key " + RAW_TEST_DIR.encode("utf-8"),
+        b"3",
+        b"abc",
+    ])
+    assert batch(request) == [
+        (0, key_identifier, ""),
+        (0, "Present (user_count=1, added_by_self)", ""),
+        (0, "", ""),
+        (1, "", "error: opening NONEXISTENT: No such file or directory"),
+        (1, "", "error: invalid command: NONEXISTENT_COMMAND"),
+        (0, describe_policy(directory, flags="PAD_16"), ""),
+        (1, "", "error: key was too short; it must be at least 16 bytes"),
+    ]
+
+
+def test_batch_escaping(directory):
+    """Tests that fscryptctl batch handles escaped spaces in arguments and
+    rejects truncated input."""
+    subdir = os.path.join(directory, "a b")
+    os.mkdir(subdir)
+    escaped = subdir.replace(" ", "\\ ").encode("utf-8")
+    assert batch(b"get_policy " + escaped + b"\n") == [
+        (1, "", "error: getting policy for TEST_DIR/a b: file or directory not encrypted"),
+    ]
+
+    p = subprocess.Popen(FSCRYPTCTL + ["batch"], stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = p.communicate(b"add_key " + directory.encode("utf-8") +
+                              b"\n64\nabc")
+    assert p.returncode != 0
+    assert stderr == b"error: unexpected end of batch input\n"
+
+
+def test_audit(directory):
+    """Tests auditing the encryption policies of a directory tree."""
+    parent_dir = os.path.join(directory, "..")
+    encrypted = os.path.join(directory, "encrypted")
+    plain = os.path.join(directory, "plain")
+    nested = os.path.join(plain, "nested")
+    for path in [encrypted, plain, nested]:
+        os.mkdir(path)
+    fscrypt.add_key(parent_dir, TEST_KEY["raw"])
+    fscrypt.add_key(parent_dir, TEST_KEY_32B["raw"])
+    policy = fscrypt.make_policy(TEST_KEY["identifier"])
+    nested_policy = fscrypt.make_policy(TEST_KEY_32B["identifier"],
+                                        flags=fscrypt.FSCRYPT_POLICY_FLAGS_PAD_16)
+    fscrypt.set_policy(encrypted, policy)
+    fscrypt.set_policy(nested, nested_policy)
+    for subdir in ["a", "b", "a/c"]:
+        os.mkdir(os.path.join(encrypted, subdir))
+    for file in ["file", "a/file", "a/c/file"]:
+        open(os.path.join(encrypted, file), "w").close()
+    open(os.path.join(plain, "file"), "w").close()
+    open(os.path.join(nested, "file"), "w").close()
+
+    result = fscrypt_audit.audit(directory, jobs=4)
+    assert result.usage == {
+        None: fscrypt_audit.PolicyUsage(0, 2, 1),
+        policy: fscrypt_audit.PolicyUsage(1, 4, 3),
+        nested_policy: fscrypt_audit.PolicyUsage(1, 1, 1),
+    }
+    assert result.islands == []
+    assert result.mixed == []
+    assert result.errors == []
+
+    # Auditing from inside an encrypted directory should compare the root with
+    # its encrypted parent directory.
+    result = fscrypt_audit.audit(os.path.join(encrypted, "a"))
+    assert result.usage == {policy: fscrypt_audit.PolicyUsage(0, 2, 2)}
+
+
+def test_compute_key_identifier(directory):
+    """Tests that key identifiers computed without the kernel match the ones
+    that the kernel assigns, and that fscrypt_keyids.py computes them for key
+    files and hex keys."""
+    parent_dir = os.path.join(directory, "..")
+    keys = [test_key["raw"] for test_key in TEST_KEYS]
+    keys += [os.urandom(size) for size in [16, 17, 32, 63, 64]]
+    for i, raw in enumerate(keys):
+        identifier = fscrypt.compute_key_identifier(raw)
+        assert fscryptctl("add_key", parent_dir, stdin=raw) == identifier
+        fscryptctl("remove_key", identifier, parent_dir)
+        with open(os.path.join(directory, "key{}".format(i)), "wb") as f:
+            f.write(raw)
+    for test_key in TEST_KEYS:
+        assert fscrypt.compute_key_identifier(test_key["raw"]) == \
+            test_key["identifier"]
+
+    key_files = [os.path.join(directory, "key{}".format(i))
+                 for i in range(len(keys))]
+    with open(key_files[0], "wb") as f:
+        f.write(b"tooshort")
+    result = subprocess.run(["python3", "fscrypt_keyids.py", "--descriptors"] +
+                            key_files, cwd=os.path.dirname(__file__),
+                            capture_output=True, check=False)
+    assert result.returncode == 1
+    assert postprocess_output(result.stderr) == \
+        "error: key TEST_DIR/key0 has invalid size 8"
+    assert postprocess_output(result.stdout).split("\n") == [
+        "{} {} {}".format(fscrypt.compute_key_identifier(raw),
+                          fscrypt.compute_key_descriptor(raw),
+                          path.replace(TEST_DIR, "TEST_DIR"))
+        for raw, path in zip(keys[1:], key_files[1:])]
+
+    hex_input = "".join("{} key{}\n".format(raw.hex(), i)
+                        for i, raw in enumerate(keys))
+    result = subprocess.run(["python3", "fscrypt_keyids.py", "--hex", "-j2"],
+                            cwd=os.path.dirname(__file__), check=True,
+                            input=hex_input.encode("utf-8"),
+                            capture_output=True)
+    assert postprocess_output(result.stdout).split("\n") == [
+        "{} key{}".format(fscrypt.compute_key_identifier(raw), i)
+        for i, raw in enumerate(keys)]
+
+    # Keys without a name are named by their line number, and neither the
+    # output nor the error messages may contain the keys themselves.
+    hex_input = "{}\n\n{}\n{}zz\n".format(keys[1].hex(), keys[2].hex(),
+                                         keys[3].hex())
+    result = subprocess.run(["python3", "fscrypt_keyids.py", "--hex"],
+                            cwd=os.path.dirname(__file__), check=False,
+                            input=hex_input.encode("utf-8"),
+                            capture_output=True)
+    assert result.returncode == 1
+    assert postprocess_output(result.stdout).split("\n") == [
+        "{} #1".format(fscrypt.compute_key_identifier(keys[1])),
+        "{} #3".format(fscrypt.compute_key_identifier(keys[2]))]
+    assert postprocess_output(result.stderr).startswith(
+        "error: reading key #4: ")
+    for raw in keys[1:4]:
+        assert raw.hex()[:8] not in result.stdout.decode("utf-8")
+        assert raw.hex()[:8] not in result.stderr.decode("utf-8")
+
+
+def test_key_index(directory):
+    """Tests finding the key files for encrypted directories using a key
+    index."""
+    parent_dir = os.path.join(directory, "..")
+    index_path = os.path.join(directory, "index")
+    key_files = []
+    for i, test_key in enumerate(TEST_KEYS):
+        key_files.append(os.path.join(directory, "key{}".format(i)))
+        with open(key_files[-1], "wb") as f:
+            f.write(test_key["raw"])
+    assert fscrypt_keyindex.add_keys(index_path, key_files[:2]) == []
+    assert fscrypt_keyindex.add_keys(index_path, key_files[2:]) == []
+    with fscrypt_keyindex.KeyIndex(index_path) as index:
+        assert len(index) == 2 * len(TEST_KEYS)
+        for test_key, key_file in zip(TEST_KEYS, key_files):
+            assert index.lookup(test_key["identifier"]) == key_file
+            descriptor = fscrypt.compute_key_descriptor(test_key["raw"])
+            assert index.lookup(descriptor) == key_file
+        assert index.lookup("00" * 16) is None
+        assert index.lookup("ff" * 8) is None
+        for identifier in ["zz" * 16, "00" * 15]:
+            with pytest.raises(ValueError):
+                index.lookup(identifier)
+
+    encrypted = os.path.join(directory, "encrypted")
+    os.mkdir(encrypted)
+    fscrypt.add_key(parent_dir, TEST_KEY_32B["raw"])
+    fscrypt.set_policy(encrypted, fscrypt.make_policy(TEST_KEY_32B["identifier"]))
+    open(os.path.join(encrypted, "file"), "w").close()
+    fscrypt.remove_key(TEST_KEY_32B["identifier"], parent_dir)
+    check_key_absent(TEST_KEY_32B, parent_dir)
+    assert fscrypt_keyindex.unlock(encrypted, index_path) == \
+        TEST_KEY_32B["identifier"]
+    check_key_present(TEST_KEY_32B, parent_dir)
+    assert os.listdir(encrypted) == ["file"]
+    fscrypt.remove_key(TEST_KEY_32B["identifier"], parent_dir)
+
+    # An empty file isn't a valid index, and keys that aren't in the index
+    # can't be found.
+    with open(index_path + ".new", "wb"):
+        pass
+    with pytest.raises(ValueError):
+        fscrypt_keyindex.KeyIndex(index_path + ".new")
+    assert fscrypt_keyindex.add_keys(index_path + ".2", key_files[:1]) == []
+    with pytest.raises(KeyError):
+        fscrypt_keyindex.unlock(encrypted, index_path + ".2")
+
+    # The command line tool should tell an invalid identifier apart from an
+    # invalid index, for every command.
+    def keyindex(*args):
+        result = subprocess.run(["python3", "fscrypt_keyindex.py"] +
+                                list(args), cwd=os.path.dirname(__file__),
+                                capture_output=True, check=False)
+        assert result.returncode == 1
+        return postprocess_output(result.stderr)
+    not_an_index = "error: TEST_DIR/index.new: not a key index"
+    assert keyindex(index_path, "lookup", "zz") == \
+        "error: invalid key identifier: zz"
+    assert keyindex(index_path + ".new", "lookup", "zz") == \
+        "error: invalid key identifier: zz"
+    assert keyindex(index_path + ".new", "lookup",
+                    TEST_KEY["identifier"]) == not_an_index
+    assert keyindex(index_path + ".new", "list") == not_an_index
+    assert keyindex(index_path + ".new", "add", key_files[0]) == not_an_index
+    assert keyindex(index_path + ".new", "unlock", encrypted) == not_an_index
+
+
+def test_bench(directory):
+    """Tests that the benchmark can measure every operation."""
+    results = fscrypt_bench.run(iterations=3)
+    assert [(operation, interface) for operation, interface, _ in results] == [
+        (operation, interface) for operation in fscrypt_bench.OPERATIONS
+        for interface in ["ioctl", fscrypt_bench.cli_interface_name()]]
+    for _, _, stats in results:
+        assert stats.count == 3
+        assert 0 < stats.p50 <= stats.p99 <= stats.max
+    data = fscrypt_bench.results_to_json(results, 3)
+    assert data["kernel"] == os.uname().release
+    assert len(data["results"]) == len(results)
+    assert fscrypt_bench.percentile([1, 2, 3, 4], 0.0) == 1
+    assert fscrypt_bench.percentile([1, 2, 3, 4], 0.5) == 2
+    assert fscrypt_bench.percentile([1, 2, 3, 4], 0.99) == 4
+
+
+def test_advisor(directory):
+    """Tests that the advisor measures each supported policy and skips the ones
+    that the kernel rejects."""
+    results = fscrypt_advisor.evaluate(directory, size=1 << 20,
+                                       num_small_files=10, drop_caches=False)
+    assert [candidate for candidate, _ in results] == fscrypt_advisor.CANDIDATES
+    measured = {candidate.name: r for candidate, r in results
+                if not isinstance(r, str)}
+    assert "unencrypted" in measured
+    assert "AES-256-XTS/AES-256-CTS" in measured
+    for r in measured.values():
+        assert list(r) == fscrypt_advisor.WORKLOADS
+        assert r["seq_write"].bytes == 1 << 20
+        assert r["small_files"].operations == 10
+    ranked = fscrypt_advisor.overall_rank(results, fscrypt_advisor.WORKLOADS)
+    assert sorted(candidate.name for candidate, _, _ in ranked) == \
+        sorted(measured)
+    assert os.listdir(directory) == []
+    json.dumps(fscrypt_advisor.results_to_json(results))
+
+    # With the probed capabilities, the same candidates should be skipped.
+    cached_results = fscrypt_advisor.evaluate(
+        directory, size=1 << 20, num_small_files=10, drop_caches=False,
+        capabilities=get_capabilities())
+    assert {candidate.name for candidate, r in cached_results
+            if not isinstance(r, str)} == set(measured)
+
+
+def test_capabilities(directory, monkeypatch):
+    """Tests probing the supported encryption settings and caching them."""
+    cache_path = os.path.join(directory, "caps.json")
+    caps = fscrypt_caps.get_capabilities(directory, cache_path)
+    assert caps["v2_ioctls"]
+    assert fscrypt_caps.unsupported_reason(
+        caps, fscrypt.make_policy("", fscrypt.FSCRYPT_MODE_AES_256_XTS,
+                                  fscrypt.FSCRYPT_MODE_AES_256_CTS)) is None
+    with pytest.raises(KeyError):
+        fscrypt_caps.unsupported_reason(caps, fscrypt.make_policy(
+            "", fscrypt.FSCRYPT_MODE_AES_256_XTS,
+            fscrypt.FSCRYPT_MODE_AES_256_HCTR2,
+            fscrypt.FSCRYPT_POLICY_FLAG_IV_INO_LBLK_64))
+    with open(cache_path) as f:
+        assert list(json.load(f)) == [fscrypt_caps.cache_key(directory)]
+    assert [name for name in os.listdir(directory) if name != "caps.json"] \
+        == []
+
+    # Once cached, the capabilities shouldn't be probed again unless asked.
+    probe = fscrypt_caps.probe
+    monkeypatch.setattr(fscrypt_caps, "probe", lambda path: 1 / 0)
+    assert fscrypt_caps.get_capabilities(directory, cache_path) == caps
+    monkeypatch.setattr(fscrypt_caps, "probe", probe)
+    assert fscrypt_caps.get_capabilities(directory, cache_path,
+                                         refresh=True) == caps
+
+    # A corrupt cache should just be probed again.
+    with open(cache_path, "w") as f:
+        f.write("{")
+    assert fscrypt_caps.get_capabilities(directory, cache_path) == caps
+
+
+def require_libfscryptctl():
+    """Skips the test unless libfscryptctl.so has been built."""
+    try:
+        fscrypt_lib.load()
+    except OSError as e:
+        pytest.skip("libfscryptctl.so isn't built ({})".format(e))
+
+
+def test_lib_format_policy(directory):
+    """Tests that libfscryptctl.so formats policies exactly like get_policy."""
+    require_libfscryptctl()
+    prepare_encrypted_dir(directory, "--padding=16")
+    policy = fscrypt.get_policy(directory)
+    _, stdout, _ = run_fscryptctl(["get_policy", directory], b"")
+    assert fscrypt_lib.format_policy(directory, policy) == stdout.decode()
+    _, stdout, _ = run_fscryptctl(["get_policy", "--json", directory], b"")
+    assert fscrypt_lib.format_policy(directory, policy, json=True) == \
+        stdout.decode()
+
+    # Bytes that aren't valid UTF-8 should be escaped, so that the output is
+    # valid UTF-8 and the original bytes can be recovered from the JSON.
+    for raw in [b"\xff", b"a\xc3\xa9\"\\\n", b"\xc3", b"\xc0\xaf",
+                b"\xed\xa0\x80", b"\xf0\x9f\x94\x91", b"\xf4\x90\x80\x80"]:
+        record = fscrypt_lib.format_policy(os.fsdecode(raw), policy, json=True)
+        record.encode("utf-8")
+        assert os.fsencode(json.loads(record)["path"]) == raw
+
+
+def test_fuzz():
+    """Fuzzes the argument parsing and policy formatting in libfscryptctl.so,
+    also running a sample of the inputs through fscryptctl."""
+    require_libfscryptctl()
+    assert fscrypt_fuzz.fuzz(5000, seed=0, cli_samples=25,
+                             fscryptctl=FSCRYPTCTL[-1]) == []
+
+
+def test_unlock(directory):
+    """Tests adding the keys listed in a manifest concurrently."""
+    key_files = []
+    for i, key in enumerate([TEST_KEY, TEST_KEY_32B]):
+        path = os.path.join(directory, "key{}".format(i))
+        with open(path, "wb") as f:
+            f.write(key["raw"])
+        key_files.append(path)
+    manifest = [
+        "# mountpoint key identifier",
+        "{} {} {}".format(directory, key_files[0], TEST_KEY["identifier"]),
+        "",
+        "{} {} {}".format(directory, key_files[1],
+                          TEST_KEY_32B["identifier"].upper()),
+        "{} {} {}".format(directory, key_files[0], TEST_KEY_16B["identifier"]),
+    ]
+    entries = fscrypt_unlock.parse_manifest(manifest)
+    assert [entry.line for entry in entries] == [2, 4, 5]
+    results = fscrypt_unlock.Unlocker(entries).run(10)
+    assert [r.error for r in results[:2]] == [None, None]
+    assert results[2].error == "key has identifier {}".format(
+        TEST_KEY["identifier"])
+    check_key_present(TEST_KEY, directory)
+    check_key_present(TEST_KEY_32B, directory)
+    check_key_absent(TEST_KEY_16B, directory)
+    assert "Added 2 of 3 keys" in fscrypt_unlock.format_report(results)
+
+    # A mountpoint that never gets mounted should time out.
+    unmounted = os.path.join(directory, "unmounted")
+    os.mkdir(unmounted)
+    entries = fscrypt_unlock.parse_manifest(["{} {} {}".format(
+        unmounted, key_files[0], TEST_KEY["identifier"])])
+    results = fscrypt_unlock.Unlocker(entries, wait_for_mounts=True).run(0.2)
+    assert results[0].error in ("timed out", "not mounted")
+
+    for line in ["{} {}".format(directory, key_files[0]),
+                 "{} {} {}".format(directory, key_files[0], "00" * 15),
+                 "{} key-id:0 {}".format(directory, TEST_KEY["identifier"]),
+                 "'{} {} {}".format(directory, key_files[0],
+                                    TEST_KEY["identifier"])]:
+        with pytest.raises(ValueError, match="^manifest:1: "):
+            fscrypt_unlock.parse_manifest([line])
+
+
+def test_loadgen(directory):
+    """Tests that the load generator runs the operations in an encrypted
+    directory and in the unencrypted baseline, both unlocked and locked, and
+    cleans up afterwards."""
+    configs = fscrypt_loadgen.configurations(
+        [fscrypt.FSCRYPT_MODE_AES_256_CTS], [4, 32])
+    assert [config.name for config in configs] == [
+        "unencrypted", "AES-256-CTS,padding=4", "AES-256-CTS,padding=32"]
+    results = fscrypt_loadgen.run(directory, configs, threads=2, files=20,
+                                  ops=200, name_lengths=(1, 255))
+    assert [config for config, _ in results] == configs
+    for _, r in results:
+        assert list(r) == fscrypt_loadgen.STATES
+        assert set(r["unlocked"]) == set(fscrypt_loadgen.OPERATIONS + ["all"])
+        assert set(r["locked"]) == \
+            set(fscrypt_loadgen.LOCKED_OPERATIONS + ["all"])
+        for by_operation in r.values():
+            assert by_operation["all"].count == 200
+            assert sum(stats.count for operation, stats in by_operation.items()
+                       if operation != "all") == 200
+            for stats in by_operation.values():
+                assert 0 <= stats.p50 <= stats.p90 <= stats.p99 <= stats.max
+    assert os.listdir(directory) == []
+
+    assert fscrypt_loadgen.parse_mix("lookup=3,readdir") == {
+        "lookup": 3.0, "readdir": 1.0}
+    for mix in ["lookup=3,stat=1", "lookup=-1", "create=0", "readdir=x"]:
+        with pytest.raises(ValueError):
+            fscrypt_loadgen.parse_mix(mix)
+
+    # A mix without lookups or readdirs can't be run in a locked directory, so
+    # the locked state is skipped.
+    for mix in ["create,unlink", "create=1,lookup=0"]:
+        mix = fscrypt_loadgen.parse_mix(mix)
+        assert fscrypt_loadgen.locked_mix(mix) is None
+        results = fscrypt_loadgen.run(directory, configs[:2], mix, threads=1,
+                                      files=5, ops=20)
+        assert [list(r) for _, r in results] == [["unlocked"]] * 2
+    assert os.listdir(directory) == []